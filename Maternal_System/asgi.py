@@ -11,6 +11,11 @@ import os
 
 from django.core.asgi import get_asgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'MaternalSM.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Maternal_System.settings')
 
 application = get_asgi_application()
+
+# Compile every template now rather than on this worker's first requests
+from patients.templating import warm_on_startup  # noqa: E402
+
+warm_on_startup()
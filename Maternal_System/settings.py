@@ -4,6 +4,7 @@ Django settings for MaternalSM project.
 Generated by 'django-admin startproject' using Django 4.2.26.
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -34,10 +35,16 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # Outermost body-changing middleware: compresses what everything below produces
+    'django.middleware.gzip.GZipMiddleware',
+    'patients.middleware.StaticAssetMiddleware',
+    'patients.middleware.HtmlMinifyMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'patients.middleware.ReplicaRoutingMiddleware',
+    'patients.middleware.AuditUserMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -45,15 +52,25 @@ MIDDLEWARE = [
 # Ensure this matches the folder name where your main urls.py is located
 ROOT_URLCONF = 'Maternal_System.urls'
 
+# Templates live in patients/templates and are found by the app directories
+# loader (listing that folder in DIRS as well made every miss search it twice).
+# 'production' (the default) compiles each template once per process and keeps
+# it, and TEMPLATE_WARMUP has wsgi.py / asgi.py compile them all at startup;
+# runserver still picks up edits. 'development' re-reads templates on every
+# render, for servers that don't reload (MATERNAL_TEMPLATE_PROFILE=development).
+TEMPLATE_PROFILE = os.environ.get('MATERNAL_TEMPLATE_PROFILE', 'production')
+TEMPLATE_LOADERS = ['django.template.loaders.app_directories.Loader']
+TEMPLATE_WARMUP = TEMPLATE_PROFILE == 'production'
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
-        'DIRS': [
-            # Looking for templates in the patients/templates folder
-            BASE_DIR / 'patients' / 'templates',
-        ], 
-        'APP_DIRS': True,
+        'DIRS': [],
         'OPTIONS': {
+            'loaders': (
+                [('django.template.loaders.cached.Loader', TEMPLATE_LOADERS)]
+                if TEMPLATE_PROFILE == 'production' else TEMPLATE_LOADERS
+            ),
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -81,6 +98,25 @@ DATABASES = {
     }  
 }  
 
+# Local testing of the read replica: two SQLite files, db.sqlite3 as the primary
+# and replica.sqlite3 as the replica (refresh it with `manage.py refresh_local_replica`).
+if os.environ.get('MATERNAL_SQLITE_REPLICA'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        },
+        'replica': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'replica.sqlite3',
+            'TEST': {'MIRROR': 'default'},
+        },
+    }
+
+# To use a real MySQL replica add it as DATABASES['replica'] with the same
+# NAME/USER as 'default' and the replica's HOST.
+DATABASE_ROUTERS = ['patients.routers.ReadReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -122,6 +158,27 @@ STATICFILES_DIRS = [
 
 STATIC_ROOT = BASE_DIR / "staticfiles"
 
+# collectstatic minifies CSS/JS, adds content hashes to file names and writes
+# precompressed .gz/.br copies; StaticAssetMiddleware serves them with
+# far-future cache headers, so no separate web server is needed.
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'patients.storage.CompressedManifestStaticFilesStorage',
+    },
+}
+
+# Cache lifetime (seconds) for static files requested by their un-hashed name.
+STATIC_UNHASHED_MAX_AGE = 60
+
+
+# Uploaded / generated files (discharge summary PDFs). Served through
+# permission-checked views, not directly by the web server.
+MEDIA_URL = '/media/'
+MEDIA_ROOT = BASE_DIR / 'media'
+
 
 # Default primary key field type
 
@@ -144,4 +201,342 @@ LOGIN_REDIRECT_URL = 'patients:dashboard'
 
 # 3. LOGOUT REDIRECT
 # After logging out, send them back to the Login page.
-LOGOUT_REDIRECT_URL = 'patients:login'
\ No newline at end of file
+LOGOUT_REDIRECT_URL = 'patients:login'
+
+# 4. SESSIONS
+# 'cached_db' (default): sessions are read from the cache and only fall back
+# to the django_session table on a cache miss; writes go to both.
+# 'signed_cookies': no server-side storage at all (the session lives in a
+# signed cookie, so keep it small). 'db': Django's default table-only storage.
+# Choose with the MATERNAL_SESSION_BACKEND environment variable.
+SESSION_BACKENDS = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+SESSION_ENGINE = SESSION_BACKENDS[os.environ.get('MATERNAL_SESSION_BACKEND', 'cached_db')]
+
+# Flash messages (messages.success/error) travel in a cookie, so showing them
+# never touches the session store.
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+
+# 5. CACHED USERS
+# request.user is loaded from the cache instead of auth_user on each request
+# (the cached copy is dropped when the user is saved, see patients/signals.py).
+AUTHENTICATION_BACKENDS = ['patients.backends.CachedModelBackend']
+AUTH_USER_CACHE_TIMEOUT = 300
+
+# Shared cache for sessions, cached users, etc. Local memory is per process:
+# with several worker processes set MATERNAL_REDIS_URL (needs the `redis` package).
+if os.environ.get('MATERNAL_REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['MATERNAL_REDIS_URL'],
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+
+
+# ==========================================
+# DEVICE SYNC SETTINGS
+# ==========================================
+
+# A sync download stops before a gap in the change log's sequence numbers
+# until the gap is this old (seconds): a younger one is most likely a
+# transaction still committing. Past it the download moves on, but the gap is
+# noted and watched.
+SYNC_SETTLE_SECONDS = 10
+
+# How long (seconds) a noted gap is watched. An entry that commits into a
+# watched gap (a long-running transaction) is logged again under a new
+# sequence number, so every device and the analytics rollups still get it.
+# Gaps older than this are taken to be rolled-back transactions and dropped.
+CHANGELOG_GAP_WATCH_SECONDS = 24 * 60 * 60
+
+
+# ==========================================
+# READ REPLICA SETTINGS
+# ==========================================
+
+# Alias in DATABASES to read from. Ignored if that alias is not configured.
+REPLICA_DATABASE = 'replica'
+
+# Pages whose reads may be served by the replica (URL names).
+REPLICA_READ_VIEWS = [
+    'patients:dashboard',
+    'patients:dashboard_async',
+    'patients:patient_list',
+    'patients:appointment_list',
+    'patients:delivery_list',
+    'patients:discharge_list',
+    'patients:api_collection',
+    'patients:api_detail',
+    'patients:analytics',
+    'patients:api_analytics',
+]
+
+# After a POST, keep that user's reads on the primary for this many seconds.
+REPLICA_STICKY_SECONDS = 15
+
+# Fall back to the primary when the replica is further behind than this (seconds).
+REPLICA_MAX_LAG = 10
+
+# How often each process re-checks the replica's lag (seconds).
+REPLICA_CHECK_INTERVAL = 5
+
+
+# ==========================================
+# DASHBOARD SETTINGS
+# ==========================================
+
+# Max. dashboard queries (and so DB connections) the async dashboard runs at once.
+DASHBOARD_QUERY_CONCURRENCY = 4
+
+
+# ==========================================
+# AUDIT LOG SETTINGS
+# ==========================================
+
+# Write audit entries from a background thread in batches (False = write at commit).
+AUDIT_ASYNC = True
+
+# Seconds between background flushes, and entries that trigger an early flush.
+AUDIT_FLUSH_INTERVAL = 2.0
+AUDIT_BATCH_SIZE = 200
+
+# Every buffered entry is first appended to a spill file in this directory,
+# deleted once its entries are written. Files untouched for
+# AUDIT_SPILL_RECOVER_SECONDS (their process crashed) are written by another.
+AUDIT_SPILL_DIR = BASE_DIR / 'audit_spill'
+AUDIT_SPILL_RECOVER_SECONDS = 60
+
+# Entries the database refuses one by one while it is up are moved to
+# AUDIT_SPILL_DIR / 'dead' (logged as errors) instead of being retried forever.
+# While it is down at most this many entries wait in memory; the rest wait in
+# their spill files.
+AUDIT_MAX_PENDING = 10000
+
+# fsync each spill write: survives power loss, not only a process crash.
+AUDIT_SPILL_FSYNC = False
+
+
+# ==========================================
+# RESPONSE COMPRESSION SETTINGS
+# ==========================================
+
+# Strip comments / indentation from the patients app's HTML pages before
+# GZipMiddleware compresses them (responses under 200 bytes or already
+# encoded are never gzipped).
+HTML_MINIFY = True
+
+
+# ==========================================
+# ANC SCHEDULING SETTINGS
+# ==========================================
+
+# Book the WHO 8-contact ANC schedule when a mother is registered
+# (whole cohorts: `manage.py schedule_anc`).
+ANC_AUTO_SCHEDULE = True
+
+# Doctors who run the ANC clinic, and appointments each can take per day.
+ANC_DOCTORS = ['Dr. Otieno', 'Dr. Wanjiru', 'Dr. Mwangi']
+ANC_DOCTOR_DAILY_CAPACITY = 16
+
+# Clinic days (0 = Monday), first slot and slot length.
+ANC_CLINIC_DAYS = [0, 1, 2, 3, 4]
+ANC_CLINIC_START = '08:00'
+ANC_SLOT_MINUTES = 20
+
+# How many days after a contact's target date we may book it when doctors are full.
+ANC_SEARCH_DAYS = 7
+
+
+# ==========================================
+# REGIONAL ANALYTICS SETTINGS
+# ==========================================
+
+# refresh_rollups waits this long (seconds) at a gap in the change log before
+# moving on; later commits into the gap are picked up through
+# CHANGELOG_GAP_WATCH_SECONDS.
+ANALYTICS_SETTLE_SECONDS = 5
+
+
+# ==========================================
+# OUTCOME REPORT SETTINGS
+# ==========================================
+
+# Seconds the report page waits for a new run before showing "still running".
+REPORT_INLINE_WAIT = 2
+
+# A run queued or running for longer than this (seconds) is marked failed and
+# computed again when next asked for (its worker died, or the queue is stuck).
+REPORT_TIMEOUT = 900
+
+
+# ==========================================
+# DISCHARGE SUMMARY SETTINGS
+# ==========================================
+
+# Processes rendering discharge summary PDFs (per web process).
+DOCUMENT_WORKERS = 2
+
+# Printed at the top of every discharge summary.
+DOCUMENT_FACILITY_NAME = 'Genesis Maternal Health'
+
+
+# ==========================================
+# DUPLICATE PATIENT SETTINGS
+# ==========================================
+
+# find_duplicates queues pairs scoring at least this
+# (name 50%, same phone 25%, same LMP 15%, age 10%).
+DEDUPE_MIN_SCORE = 0.75
+
+# Blocking keys shared by more mothers than this (placeholder phone numbers,
+# very common names) are skipped instead of compared pair by pair.
+DEDUPE_MAX_BLOCK = 50
+
+
+# ==========================================
+# BACKGROUND JOB SETTINGS
+# ==========================================
+
+# Worker processes started by `manage.py runworkers`, and jobs each claims at a time.
+JOB_WORKERS = 2
+JOB_BATCH_SIZE = 10
+
+# Seconds an idle worker waits before looking for new jobs again.
+JOB_POLL_INTERVAL = 1.0
+
+# Retry delay: JOB_RETRY_BASE_SECONDS, doubled after every failed attempt, at most JOB_RETRY_MAX_SECONDS.
+JOB_RETRY_BASE_SECONDS = 10
+JOB_RETRY_MAX_SECONDS = 3600
+
+# A job 'running' for longer than this (seconds) is assumed lost with its worker and queued again.
+JOB_TIMEOUT = 600
+
+# How often runworkers requeues lost jobs / deletes old finished ones (seconds), and how long done jobs are kept.
+JOB_MAINTENANCE_INTERVAL = 60
+JOB_KEEP_DONE_DAYS = 7
+
+
+# ==========================================
+# SMS NOTIFICATION SETTINGS
+# ==========================================
+
+# Where SMS go: logged only (development) unless a gateway URL is configured.
+# `manage.py sms_gateway` runs a local stand-in for HttpGateway.
+if os.environ.get('MATERNAL_SMS_URL'):
+    SMS_GATEWAY = {
+        'BACKEND': 'patients.sms.HttpGateway',
+        'OPTIONS': {'url': os.environ['MATERNAL_SMS_URL'], 'api_key': os.environ.get('MATERNAL_SMS_API_KEY', '')},
+    }
+else:
+    SMS_GATEWAY = {'BACKEND': 'patients.sms.LogGateway'}
+
+# Text mothers a receipt for every successful payment.
+SMS_RECEIPTS = True
+
+# Seconds between queueing a message and sending: messages for the same phone
+# queued meanwhile leave as one SMS of at most SMS_MAX_CHARS (3 segments).
+SMS_COALESCE_SECONDS = 30
+SMS_MAX_CHARS = 459
+
+# Sending rate (SMS/second, bursts of up to SMS_BURST), SMS per gateway request,
+# and messages claimed from the queue at a time.
+SMS_RATE_PER_SECOND = 20
+SMS_BURST = 40
+SMS_BATCH_SIZE = 50
+SMS_CLAIM_SIZE = 500
+
+# Send attempts per message, and retries of a batch the gateway asked to slow down.
+SMS_MAX_ATTEMPTS = 3
+SMS_BUSY_RETRIES = 5
+
+# Delay before a rejected message is sent again: SMS_RETRY_BASE_SECONDS, doubled
+# after every attempt, at most SMS_RETRY_MAX_SECONDS.
+SMS_RETRY_BASE_SECONDS = 60
+SMS_RETRY_MAX_SECONDS = 3600
+
+# Signs every message (defaults to DOCUMENT_FACILITY_NAME).
+SMS_SIGNATURE = DOCUMENT_FACILITY_NAME
+
+# The gateway posts delivery reports to /api/v1/sms/delivery/?token=<this>.
+SMS_DELIVERY_REPORT_TOKEN = os.environ.get('MATERNAL_SMS_REPORT_TOKEN', '')
+
+
+# ==========================================
+# M-PESA CALLBACK SETTINGS
+# ==========================================
+
+# Where STK pushes go: simulated (development; answered with a successful
+# callback) unless Daraja credentials are configured.
+if os.environ.get('MATERNAL_MPESA_CONSUMER_KEY'):
+    MPESA_STK = {
+        'BACKEND': 'patients.payments.DarajaStkPush',
+        'OPTIONS': {
+            'base_url': os.environ.get('MATERNAL_MPESA_URL', 'https://sandbox.safaricom.co.ke'),
+            'consumer_key': os.environ['MATERNAL_MPESA_CONSUMER_KEY'],
+            'consumer_secret': os.environ.get('MATERNAL_MPESA_CONSUMER_SECRET', ''),
+            'shortcode': os.environ.get('MATERNAL_MPESA_SHORTCODE', ''),
+            'passkey': os.environ.get('MATERNAL_MPESA_PASSKEY', ''),
+            'callback_url': os.environ.get('MATERNAL_MPESA_CALLBACK_URL', ''),
+        },
+    }
+else:
+    MPESA_STK = {'BACKEND': 'patients.payments.SimulatedStkPush'}
+
+# Daraja's CallBackURL is /api/v1/payments/mpesa/callback/?token=<this>.
+PAYMENT_CALLBACK_TOKEN = os.environ.get('MATERNAL_MPESA_CALLBACK_TOKEN', '')
+
+# Seconds callbacks are collected before being applied, and callbacks applied per transaction.
+PAYMENT_APPLY_DELAY = 1
+PAYMENT_APPLY_BATCH = 200
+
+# A callback arriving before its transaction is committed is retried every
+# PAYMENT_RETRY_SECONDS, for up to PAYMENT_MATCH_WINDOW seconds.
+PAYMENT_RETRY_SECONDS = 5
+PAYMENT_MATCH_WINDOW = 3600
+
+# Statement reconciliation: a statement line with no recorded receipt is
+# matched to an unpaid payment of the same amount started this close to it.
+RECONCILE_WINDOW_MINUTES = 15
+
+
+# ==========================================
+# LOGIN THROTTLING SETTINGS
+# ==========================================
+
+# Logins are refused before the password is hashed once a client goes over
+# these (attempts, seconds) windows: per IP, attempts not followed by a
+# successful login; per username, failed attempts. Counts live in the cache,
+# so run several processes against Redis (MATERNAL_REDIS_URL) to share them.
+LOGIN_THROTTLE_ENABLED = True
+LOGIN_THROTTLE = {
+    'ip': [(10, 60), (50, 3600)],
+    'username': [(5, 300), (20, 86400)],
+}
+
+# Where the client address comes from; behind a reverse proxy use the header
+# it sets, e.g. 'HTTP_X_FORWARDED_FOR'.
+LOGIN_THROTTLE_IP_HEADER = os.environ.get('MATERNAL_LOGIN_IP_HEADER', 'REMOTE_ADDR')
+
+# Proxies in front of the app that append to that header. Its leftmost
+# entries are whatever the client sent, so the address used is this many
+# entries from the right: 1 for a single nginx ($proxy_add_x_forwarded_for),
+# 2 for a load balancer in front of nginx, and so on.
+LOGIN_THROTTLE_PROXY_HOPS = int(os.environ.get('MATERNAL_LOGIN_PROXY_HOPS', '1'))
+
+
+# ==========================================
+# STREAMED LIST SETTINGS
+# ==========================================
+
+# Rows read and rendered at a time when a list page is streamed (?stream=1).
+LIST_STREAM_CHUNK = 500
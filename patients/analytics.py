@@ -0,0 +1,344 @@
+"""
+Regional analytics cube.
+
+RegionalRollup holds one row per (county, ward, month) with pre-aggregated
+counts, so the analytics page and API only sum a few hundred small rows
+instead of grouping the patient tables on every request.
+
+What each source row adds to the cube is kept in RollupContribution.
+refresh_rollups() reads the sync ChangeLog from where it last stopped (with
+the same handling of not-yet-committed changes as device sync),
+recomputes the contributions of just the rows that changed and applies
+(new - old) to the affected cells. A mother moving to another ward takes
+her deliveries, discharges and payments with her. Rows removed by the
+archive job keep counting (the episode still happened).
+
+    manage.py refresh_rollups            # incremental, run from cron
+    manage.py refresh_rollups --rebuild  # recompute everything
+"""
+from collections import Counter
+from datetime import date
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Sum
+from django.utils import timezone
+
+from .models import (
+    PregnantWoman, Delivery, Discharge, Transaction, ChangeLog, ArchivedPatient,
+    RegionalRollup, RollupContribution, RollupCursor,
+)
+
+CURSOR_NAME = 'regional'
+
+METRICS = [
+    'registrations', 'high_risk',
+    'deliveries_normal', 'deliveries_c_section', 'deliveries_assisted',
+    'discharges_good', 'discharges_fair', 'discharges_critical', 'discharges_deceased',
+    'revenue',
+]
+
+DELIVERY_METRICS = {
+    'Normal Delivery': 'deliveries_normal',
+    'C-Section': 'deliveries_c_section',
+    'Assisted Delivery': 'deliveries_assisted',
+}
+
+DISCHARGE_METRICS = {
+    'Good': 'discharges_good',
+    'Fair': 'discharges_fair',
+    'Critical': 'discharges_critical',
+    'Deceased': 'discharges_deceased',
+}
+
+# Cube dimensions the page / API can group by
+GROUPINGS = {
+    'county': ['county'],
+    'ward': ['county', 'ward'],
+    'month': ['month'],
+}
+
+ONE = Decimal(1)
+
+
+def parse_month(value):
+    """'2025-03' (what <input type="month"> sends) -> date(2025, 3, 1); None if blank or invalid."""
+    try:
+        year, month = (int(part) for part in (value or '').split('-')[:2])
+        return date(year, month, 1)
+    except ValueError:
+        return None
+
+
+def month_of(value):
+    if hasattr(value, 'hour'):
+        value = timezone.localtime(value).date()
+    return value.replace(day=1)
+
+
+# ==========================================
+# Contributions of one source row
+# ==========================================
+# Each source: model, columns to read, and a function turning one row into
+# [(month, metric, amount)]. Region always comes from the mother.
+
+def _patient_cells(row):
+    month = month_of(row['created_at'])
+    cells = [(month, 'registrations', ONE)]
+    if row['risk_level'] == 'High':
+        cells.append((month, 'high_risk', ONE))
+    return cells
+
+
+def _delivery_cells(row):
+    metric = DELIVERY_METRICS.get(row['delivery_type'])
+    return [(month_of(row['delivery_date']), metric, ONE)] if metric else []
+
+
+def _discharge_cells(row):
+    metric = DISCHARGE_METRICS.get(row['condition'])
+    return [(month_of(row['discharge_date']), metric, ONE)] if metric else []
+
+
+def _transaction_cells(row):
+    if row['status'] != 'Success':
+        return []
+    return [(month_of(row['created_at']), 'revenue', row['amount'])]
+
+
+SOURCES = {
+    'patients': (PregnantWoman, ['created_at', 'risk_level'], _patient_cells),
+    'deliveries': (Delivery, ['delivery_date', 'delivery_type'], _delivery_cells),
+    'discharges': (Discharge, ['discharge_date', 'condition'], _discharge_cells),
+    'transactions': (Transaction, ['created_at', 'status', 'amount'], _transaction_cells),
+}
+
+
+def current_contributions(resource, queryset):
+    """{object_id: [RollupContribution]} computed from the rows in `queryset` (unsaved)."""
+    model, columns, cells = SOURCES[resource]
+    if model is PregnantWoman:
+        region = ['id', 'county', 'ward']
+    else:
+        region = ['id', 'patient_id', 'patient__county', 'patient__ward']
+
+    result = {}
+    for row in queryset.values(*region, *columns):
+        patient_id = row['id'] if model is PregnantWoman else row['patient_id']
+        county = row.get('county', row.get('patient__county')) or ''
+        ward = row.get('ward', row.get('patient__ward')) or ''
+        result[row['id']] = [
+            RollupContribution(
+                resource=resource, object_id=row['id'], patient_id=patient_id,
+                county=county, ward=ward, month=month, metric=metric, amount=amount,
+            )
+            for month, metric, amount in cells(row)
+        ]
+    return result
+
+
+# ==========================================
+# Applying changes
+# ==========================================
+def _apply_deltas(deltas):
+    """Adds {(county, ward, month, metric): amount} to the cube cells."""
+    deltas = {key: amount for key, amount in deltas.items() if amount}
+    if not deltas:
+        return
+    cells = {(c, w, m) for c, w, m, _ in deltas}
+    existing = {
+        (cell.county, cell.ward, cell.month): cell
+        for cell in RegionalRollup.objects.filter(
+            county__in={c for c, _, _ in cells},
+            ward__in={w for _, w, _ in cells},
+            month__in={m for _, _, m in cells},
+        )
+    }
+    new_cells = []
+    for (county, ward, month, metric), amount in deltas.items():
+        cell = existing.get((county, ward, month))
+        if cell is None:
+            cell = existing[(county, ward, month)] = RegionalRollup(county=county, ward=ward, month=month)
+            new_cells.append(cell)
+        value = getattr(cell, metric) + (amount if metric == 'revenue' else int(amount))
+        setattr(cell, metric, value)
+
+    RegionalRollup.objects.bulk_update(
+        [cell for cell in existing.values() if cell.pk is not None], METRICS, batch_size=500,
+    )
+    RegionalRollup.objects.bulk_create(new_cells, batch_size=500)
+
+
+def _refresh_rows(touched):
+    """Recomputes the contributions of {resource: {object ids}} and updates the cube."""
+    old = {}
+    for resource, ids in touched.items():
+        for contribution in RollupContribution.objects.filter(resource=resource, object_id__in=ids):
+            old.setdefault((resource, contribution.object_id), []).append(contribution)
+
+    new = {}
+    for resource, ids in touched.items():
+        model = SOURCES[resource][0]
+        for object_id, contributions in current_contributions(resource, model.objects.filter(pk__in=ids)).items():
+            new[(resource, object_id)] = contributions
+
+    # Rows deleted because their episode was archived keep their contribution
+    gone = {key for key in old if key not in new}
+    archived = set(ArchivedPatient.objects.filter(
+        patient_id__in={old[key][0].patient_id for key in gone},
+    ).values_list('patient_id', flat=True)) if gone else set()
+    for key in gone:
+        if old[key][0].patient_id in archived:
+            new[key] = old[key]
+
+    deltas = Counter()
+    changed = []
+    for key in set(old) | set(new):
+        before, after = old.get(key, []), new.get(key, [])
+        if before is after:
+            continue
+        for c in before:
+            deltas[(c.county, c.ward, c.month, c.metric)] -= c.amount
+        for c in after:
+            deltas[(c.county, c.ward, c.month, c.metric)] += c.amount
+        changed.append(key)
+
+    _apply_deltas(deltas)
+
+    by_resource = {}
+    for resource, object_id in changed:
+        by_resource.setdefault(resource, []).append(object_id)
+    for resource, ids in by_resource.items():
+        RollupContribution.objects.filter(resource=resource, object_id__in=ids).delete()
+    RollupContribution.objects.bulk_create(
+        [c for key in changed for c in new.get(key, [])], batch_size=1000,
+    )
+
+
+def _moved_patients(patient_ids):
+    """Mothers whose county/ward differs from the one their rows are counted under."""
+    counted = {
+        pk: (county, ward)
+        for pk, county, ward in RollupContribution.objects
+        .filter(resource='patients', object_id__in=patient_ids, metric='registrations')
+        .values_list('object_id', 'county', 'ward')
+    }
+    moved = []
+    for pk, county, ward in PregnantWoman.objects.filter(pk__in=patient_ids).values_list('pk', 'county', 'ward'):
+        if pk in counted and counted[pk] != (county or '', ward or ''):
+            moved.append(pk)
+    return moved
+
+
+def refresh_rollups(batch_size=5000):
+    """
+    Folds the next `batch_size` ChangeLog entries into the cube.
+    Returns the number of entries processed (0 = up to date).
+    """
+    with transaction.atomic():
+        cursor, _ = RollupCursor.objects.get_or_create(name=CURSOR_NAME)
+        cursor = RollupCursor.objects.select_for_update().get(pk=cursor.pk)
+
+        # Waits at a gap in the seqs that may still be a transaction committing
+        # (see ChangeLog.read_after)
+        changes, _ = ChangeLog.read_after(cursor.seq, batch_size, getattr(settings, 'ANALYTICS_SETTLE_SECONDS', 5))
+        if not changes:
+            return 0
+
+        touched = {}
+        for _, resource, object_id, _ in changes:
+            if resource in SOURCES:
+                touched.setdefault(resource, set()).add(object_id)
+
+        # A mother who moved takes her already-counted rows with her
+        moved = _moved_patients(touched.get('patients', ()))
+        if moved:
+            for resource, object_id in (
+                RollupContribution.objects
+                .filter(patient_id__in=moved)
+                .exclude(resource='patients')
+                .values_list('resource', 'object_id')
+            ):
+                touched.setdefault(resource, set()).add(object_id)
+
+        if touched:
+            _refresh_rows(touched)
+
+        cursor.seq = changes[-1][0]
+        cursor.refreshed_at = timezone.now()
+        cursor.save(update_fields=['seq', 'refreshed_at'])
+        return len(changes)
+
+
+def refresh_all(batch_size=5000, progress=None):
+    total = 0
+    while True:
+        done = refresh_rollups(batch_size)
+        if not done:
+            return total
+        total += done
+        if progress:
+            progress(total)
+
+
+@transaction.atomic
+def rebuild_rollups(chunk_size=5000):
+    """
+    Recomputes the whole cube from the hot tables (archived episodes are
+    not in them, so they drop out). Memory is one chunk of rows plus the cube.
+    """
+    RegionalRollup.objects.all().delete()
+    RollupContribution.objects.all().delete()
+    # Everything logged so far is covered by this rebuild
+    last_seq = ChangeLog.objects.aggregate(last=Max('seq'))['last'] or 0
+
+    deltas = Counter()
+    for resource, (model, _, _) in SOURCES.items():
+        last_pk = 0
+        while True:
+            ids = list(model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not ids:
+                break
+            last_pk = ids[-1]
+            contributions = [
+                c for rows in current_contributions(resource, model.objects.filter(pk__in=ids)).values()
+                for c in rows
+            ]
+            for c in contributions:
+                deltas[(c.county, c.ward, c.month, c.metric)] += c.amount
+            RollupContribution.objects.bulk_create(contributions, batch_size=1000)
+    _apply_deltas(deltas)
+
+    RollupCursor.objects.update_or_create(
+        name=CURSOR_NAME, defaults={'seq': last_seq, 'refreshed_at': timezone.now()},
+    )
+
+
+# ==========================================
+# Reading the cube
+# ==========================================
+def slice_cube(group_by='county', county=None, ward=None, month_from=None, month_to=None):
+    """Sums of every metric per `group_by` value, for the selected region / months."""
+    cells = RegionalRollup.objects.all()
+    if county:
+        cells = cells.filter(county=county)
+    if ward:
+        cells = cells.filter(ward=ward)
+    if month_from:
+        cells = cells.filter(month__gte=month_of(month_from))
+    if month_to:
+        cells = cells.filter(month__lte=month_of(month_to))
+
+    columns = GROUPINGS[group_by]
+    return list(
+        cells.values(*columns)
+        .annotate(**{metric: Sum(metric) for metric in METRICS})
+        .order_by(*columns)
+    )
+
+
+def cube_state():
+    """(last ChangeLog seq folded in, when) for 'data as of' labels."""
+    cursor = RollupCursor.objects.filter(name=CURSOR_NAME).first()
+    return (cursor.seq, cursor.refreshed_at) if cursor else (0, None)
@@ -0,0 +1,328 @@
+"""
+Read-only JSON API (v1) for partner dashboards and mobile apps.
+
+    GET /api/v1/<resource>/            collection
+    GET /api/v1/<resource>/<id>/       single record
+    GET /api/v1/analytics/             county / ward / month rollups
+
+Query parameters on collections:
+    fields=a,b,c      only return these fields (projection)
+    after=<id>        keyset pagination: rows with id greater than this
+    limit=<n>         page size (default 50, max 500)
+    <filter>=<value>  exact match on the filters listed per resource
+
+Every response carries a strong ETag and a Last-Modified header built from
+the row count, highest id and latest updated_at of the filtered rows, so a
+client that sends If-None-Match / If-Modified-Since gets 304 Not Modified
+without the rows being fetched or serialized. A deleted row leaves no
+updated_at behind, so a collection's Last-Modified is also no older than the
+resource's latest sync ChangeLog entry.
+"""
+import hashlib
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Max
+from django.http import JsonResponse
+from django.urls import reverse
+from django.utils.http import urlencode
+from django.views.decorators.http import condition, require_GET
+
+from . import analytics as cube
+from .models import PregnantWoman, Appointment, Delivery, Discharge, Transaction, ChangeLog
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+
+# ==========================================
+# Resource definitions
+# ==========================================
+class Resource:
+    """
+    One API collection: which model, which fields may be returned and which
+    query parameters may be used as filters (parameter -> ORM lookup).
+    """
+
+    def __init__(self, model, fields, filters):
+        self.model = model
+        self.fields = fields
+        self.filters = filters
+
+    def filtered(self, params):
+        queryset = self.model.objects.all()
+        lookups = {}
+        for param, lookup in self.filters.items():
+            value = params.get(param)
+            if value not in (None, ''):
+                lookups[lookup] = value
+        if lookups:
+            queryset = queryset.filter(**lookups)
+        return queryset
+
+
+COMMON_FILTERS = {
+    'updated_since': 'updated_at__gte',
+    'created_since': 'created_at__gte',
+}
+
+RESOURCES = {
+    'patients': Resource(
+        PregnantWoman,
+        fields=[
+            'id', 'full_name', 'phone', 'email', 'age', 'county', 'ward',
+            'lmp', 'expected_due_date', 'blood_type', 'gravida', 'parity',
+            'primary_reason', 'medical_history', 'risk_level',
+            'emergency_contact_name', 'emergency_contact_relation', 'emergency_contact_phone',
+            # Care summary (read-only, see counters.py)
+            'next_appointment_date', 'visits_attended', 'total_paid', 'last_delivery_date',
+            'created_at', 'updated_at',
+        ],
+        filters={
+            'risk_level': 'risk_level',
+            'county': 'county',
+            'ward': 'ward',
+            'phone': 'phone',
+            **COMMON_FILTERS,
+        },
+    ),
+    'appointments': Resource(
+        Appointment,
+        fields=[
+            'id', 'patient', 'date', 'time', 'purpose', 'notes', 'doctor', 'status',
+            'created_at', 'updated_at',
+        ],
+        filters={
+            'patient': 'patient_id',
+            'status': 'status',
+            'doctor': 'doctor',
+            'date': 'date',
+            'date_from': 'date__gte',
+            'date_to': 'date__lte',
+            **COMMON_FILTERS,
+        },
+    ),
+    'deliveries': Resource(
+        Delivery,
+        fields=[
+            'id', 'patient', 'edd', 'delivery_date', 'delivery_time', 'delivery_type',
+            'baby_gender', 'baby_weight', 'blood_group', 'attending_physician',
+            'emergency_contact', 'notes', 'created_at', 'updated_at',
+        ],
+        filters={
+            'patient': 'patient_id',
+            'delivery_type': 'delivery_type',
+            'date_from': 'delivery_date__gte',
+            'date_to': 'delivery_date__lte',
+            **COMMON_FILTERS,
+        },
+    ),
+    'discharges': Resource(
+        Discharge,
+        fields=[
+            'id', 'patient', 'admission_date', 'discharge_date', 'discharged_by',
+            'condition', 'billing_status', 'medications', 'notes', 'created_at', 'updated_at',
+        ],
+        filters={
+            'patient': 'patient_id',
+            'condition': 'condition',
+            'billing_status': 'billing_status',
+            'date_from': 'discharge_date__gte',
+            'date_to': 'discharge_date__lte',
+            **COMMON_FILTERS,
+        },
+    ),
+    'transactions': Resource(
+        Transaction,
+        fields=['id', 'patient', 'amount', 'transaction_id', 'status', 'created_at', 'updated_at'],
+        filters={
+            'patient': 'patient_id',
+            'status': 'status',
+            'transaction_id': 'transaction_id',
+            **COMMON_FILTERS,
+        },
+    ),
+}
+
+
+class BadRequest(Exception):
+    pass
+
+
+# ==========================================
+# Helpers
+# ==========================================
+def _error(message, status):
+    return JsonResponse({'error': message}, status=status)
+
+
+def _requested_fields(resource, params):
+    fields = params.get('fields')
+    if not fields:
+        return resource.fields
+    requested = [f.strip() for f in fields.split(',') if f.strip()]
+    unknown = [f for f in requested if f not in resource.fields]
+    if unknown:
+        raise BadRequest(f"Unknown field(s): {', '.join(unknown)}")
+    # Always return the id, clients need it for paging and links
+    if 'id' not in requested:
+        requested.insert(0, 'id')
+    return requested
+
+
+def _page_params(params):
+    try:
+        limit = int(params.get('limit', DEFAULT_LIMIT))
+        after = int(params['after']) if params.get('after') else None
+    except ValueError:
+        raise BadRequest("'limit' and 'after' must be whole numbers")
+    return min(max(limit, 1), MAX_LIMIT), after
+
+
+def _collection_state(request, resource_name, pk=None):
+    """
+    (etag, last_modified) for what this request would return, computed with
+    one aggregate query and cached on the request so the ETag and
+    Last-Modified callbacks share it.
+    """
+    cache_key = (resource_name, pk)
+    cached = getattr(request, '_api_state', {})
+    if cache_key in cached:
+        return cached[cache_key]
+
+    resource = RESOURCES.get(resource_name)
+    state = (None, None)
+    # No validators for anonymous users: they must get the 401, never a 304
+    if resource is not None and request.user.is_authenticated:
+        try:
+            if pk is not None:
+                queryset = resource.model.objects.filter(pk=pk)
+            else:
+                queryset = resource.filtered(request.GET)
+            stats = queryset.order_by().aggregate(
+                rows=Count('pk'), last_id=Max('pk'), latest=Max('updated_at'),
+            )
+        except (ValueError, ValidationError):
+            # Bad filter values: let the view itself answer 400
+            stats = None
+
+        if stats is not None:
+            # The query string is part of the tag: different projections or pages
+            # of the same rows must not share a cached body
+            fingerprint = '|'.join([
+                resource_name, str(pk), request.GET.urlencode(),
+                str(stats['rows']), str(stats['last_id']),
+                stats['latest'].isoformat() if stats['latest'] else '',
+            ])
+            last_modified = stats['latest']
+            if pk is None:
+                # Deletes (and rows edited out of the filter) only show in the change log
+                logged = (
+                    ChangeLog.objects.filter(resource=resource_name)
+                    .order_by('-seq').values_list('changed_at', flat=True).first()
+                )
+                if logged and (last_modified is None or logged > last_modified):
+                    last_modified = logged
+            state = (hashlib.sha1(fingerprint.encode()).hexdigest(), last_modified)
+
+    cached[cache_key] = state
+    request._api_state = cached
+    return state
+
+
+def _etag(request, resource, pk=None):
+    return _collection_state(request, resource, pk)[0]
+
+
+def _last_modified(request, resource, pk=None):
+    return _collection_state(request, resource, pk)[1]
+
+
+def _json(data, status=200):
+    return JsonResponse(data, status=status, encoder=DjangoJSONEncoder, json_dumps_params={'separators': (',', ':')})
+
+
+# ==========================================
+# Views
+# ==========================================
+@require_GET
+@condition(etag_func=_etag, last_modified_func=_last_modified)
+def collection(request, resource):
+    if not request.user.is_authenticated:
+        return _error("Authentication required", 401)
+    if resource not in RESOURCES:
+        return _error(f"Unknown resource '{resource}'", 404)
+
+    spec = RESOURCES[resource]
+    try:
+        fields = _requested_fields(spec, request.GET)
+        limit, after = _page_params(request.GET)
+        queryset = spec.filtered(request.GET).order_by('pk')
+        if after is not None:
+            queryset = queryset.filter(pk__gt=after)
+        # One extra row tells us whether there is a next page
+        rows = list(queryset.values(*fields)[:limit + 1])
+    except BadRequest as e:
+        return _error(str(e), 400)
+    except (ValueError, ValidationError) as e:
+        return _error(f"Invalid filter value: {e}", 400)
+
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        params = request.GET.copy()
+        params['after'] = rows[-1]['id']
+        next_url = f"{reverse('patients:api_collection', args=[resource])}?{urlencode(params, doseq=True)}"
+
+    return _json({'count': len(rows), 'next': next_url, 'results': rows})
+
+
+@require_GET
+@condition(etag_func=_etag, last_modified_func=_last_modified)
+def detail(request, resource, pk):
+    if not request.user.is_authenticated:
+        return _error("Authentication required", 401)
+    if resource not in RESOURCES:
+        return _error(f"Unknown resource '{resource}'", 404)
+
+    spec = RESOURCES[resource]
+    try:
+        fields = _requested_fields(spec, request.GET)
+    except BadRequest as e:
+        return _error(str(e), 400)
+
+    row = spec.model.objects.filter(pk=pk).values(*fields).first()
+    if row is None:
+        return _error("Not found", 404)
+    return _json(row)
+
+
+@require_GET
+def analytics(request):
+    """
+    Slices of the regional cube:
+        group=county|ward|month, county=, ward=, from=YYYY-MM, to=YYYY-MM
+    """
+    if not request.user.is_authenticated:
+        return _error("Authentication required", 401)
+    group_by = request.GET.get('group', 'county')
+    if group_by not in cube.GROUPINGS:
+        return _error(f"'group' must be one of: {', '.join(cube.GROUPINGS)}", 400)
+
+    bounds = {}
+    for param in ('from', 'to'):
+        if request.GET.get(param):
+            bounds[param] = cube.parse_month(request.GET[param])
+            if bounds[param] is None:
+                return _error(f"'{param}' must look like 2025-03", 400)
+
+    rows = cube.slice_cube(
+        group_by,
+        county=request.GET.get('county') or None,
+        ward=request.GET.get('ward') or None,
+        month_from=bounds.get('from'),
+        month_to=bounds.get('to'),
+    )
+    seq, refreshed_at = cube.cube_state()
+    return _json({'group': group_by, 'as_of_seq': seq, 'refreshed_at': refreshed_at, 'results': rows})
+
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class PatientsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'patients'
+
+    def ready(self):
+        # Change log for offline device sync
+        from . import signals  # noqa: F401
+        # Background tasks, so web processes and workers know them by name
+        from . import tasks  # noqa: F401
@@ -0,0 +1,230 @@
+"""
+Archive tier for closed pregnancies.
+
+A mother's episode is closed when she has delivered, every discharge is
+billing 'Cleared', no payment is still 'Pending', she has no upcoming
+scheduled appointment, no duplicate review is pending for her, and her
+last discharge is older than N days. Closed episodes are copied into
+ArchivedPatient and deleted from the hot tables in batches, one transaction
+per batch.
+
+An archived mother's file can be read straight from the archive
+(archived_history(), views.archived_patient) without restoring her.
+Restoring her (a POST from the patient list, see views.restore_patient) moves her back into the hot tables with her
+original IDs. If any of those IDs has been taken meanwhile the restore is
+refused and the archive entry kept.
+"""
+from datetime import timedelta
+
+from django.core import serializers
+from django.db import connection, transaction
+from django.db.models import Exists, Max, OuterRef, Q
+from django.utils import timezone
+
+from . import counters
+from .models import (
+    PregnantWoman, Appointment, Delivery, Discharge, Transaction, ArchivedPatient, ChangeLog, DuplicateCandidate,
+)
+
+HOT_MODELS = [PregnantWoman, Appointment, Delivery, Discharge, Transaction]
+
+# Related rows stored with each mother (restored after her, in this order).
+# Dismissed duplicate pairs are stored too, see _candidates()
+RELATED = ['appointments', 'deliveries', 'discharges', 'discharges__documents', 'transactions']
+
+
+class RestoreConflict(Exception):
+    """An archived record's ID now belongs to another row."""
+
+
+def closed_episodes(days, today=None):
+    """Mothers whose episode is closed and whose last discharge is older than `days`."""
+    today = today or timezone.now().date()
+    cutoff = today - timedelta(days=days)
+    return (
+        PregnantWoman.objects
+        .annotate(last_discharge=Max('discharges__discharge_date'))
+        .filter(
+            Exists(Delivery.objects.filter(patient=OuterRef('pk'))),
+            last_discharge__lt=cutoff,
+        )
+        .exclude(Exists(Discharge.objects.filter(patient=OuterRef('pk')).exclude(billing_status='Cleared')))
+        .exclude(Exists(Transaction.objects.filter(patient=OuterRef('pk'), status='Pending')))
+        .exclude(Exists(Appointment.objects.filter(patient=OuterRef('pk'), status='Scheduled', date__gte=today)))
+        .exclude(Exists(DuplicateCandidate.objects.filter(
+            Q(patient_a=OuterRef('pk')) | Q(patient_b=OuterRef('pk')), status='pending',
+        )))
+    )
+
+
+def _related(obj, path):
+    """The rows at the end of a RELATED path ('discharges__documents'), from the prefetch cache."""
+    attr, _, rest = path.partition('__')
+    for related in getattr(obj, attr).all():
+        if rest:
+            yield from _related(related, rest)
+        else:
+            yield related
+
+
+def _candidates(mothers):
+    """{mother id: [dismissed DuplicateCandidate]}, so a review decision outlives the archive."""
+    ids = [m.pk for m in mothers]
+    found = {}
+    for candidate in DuplicateCandidate.objects.filter(Q(patient_a__in=ids) | Q(patient_b__in=ids)):
+        for patient_id in (candidate.patient_a_id, candidate.patient_b_id):
+            found.setdefault(patient_id, []).append(candidate)
+    return found
+
+
+def archive_batch(patient_ids, days, today=None):
+    """
+    Archives one batch in a single transaction. The closed-episode check is
+    repeated under row locks so a record edited meanwhile is left alone.
+    Returns the number of mothers archived.
+    """
+    with transaction.atomic():
+        # Lock first: FOR UPDATE cannot be combined with the GROUP BY below
+        locked = list(PregnantWoman.objects.select_for_update().filter(pk__in=patient_ids).values_list('pk', flat=True))
+        mothers = list(
+            closed_episodes(days, today)
+            .filter(pk__in=locked)
+            .prefetch_related(*RELATED)
+        )
+        if not mothers:
+            return 0
+
+        candidates = _candidates(mothers)
+        archived = []
+        for mother in mothers:
+            records = [mother]
+            for path in RELATED:
+                records.extend(_related(mother, path))
+            records.extend(candidates.get(mother.pk, []))
+            archived.append(ArchivedPatient(
+                patient_id=mother.pk,
+                full_name=mother.full_name,
+                phone=mother.phone,
+                last_discharge_date=mother.last_discharge,
+                records=serializers.serialize('python', records),
+            ))
+        ArchivedPatient.objects.bulk_create(archived)
+
+        # CASCADE removes the related rows (and logs sync tombstones for them;
+        # the PDFs of discharge documents stay in storage for a restore);
+        # their mothers go too, so their care summaries need no refresh per row
+        with counters.deferred():
+            PregnantWoman.objects.filter(pk__in=[m.pk for m in mothers]).delete()
+        return len(mothers)
+
+
+def archive_closed_episodes(days, batch_size=200, today=None, progress=None):
+    """Archives every closed episode, `batch_size` mothers per transaction."""
+    ids = list(closed_episodes(days, today).order_by('pk').values_list('pk', flat=True))
+    total = 0
+    for start in range(0, len(ids), batch_size):
+        total += archive_batch(ids[start:start + batch_size], days, today)
+        if progress:
+            progress(total, len(ids))
+    return total
+
+
+def archived_history(patient_id):
+    """
+    (ArchivedPatient, the mother, {related name: [records]}) read from the
+    archive, or None if she is not in it. The records are unsaved instances
+    for display only: nothing is written and her IDs stay free.
+    """
+    entry = ArchivedPatient.objects.filter(patient_id=patient_id).first()
+    if entry is None:
+        return None
+
+    names = {Appointment: 'appointments', Delivery: 'deliveries', Discharge: 'discharges', Transaction: 'transactions'}
+    mother, related = None, {}
+    for item in serializers.deserialize('python', entry.records):
+        record = item.object
+        if isinstance(record, PregnantWoman):
+            mother = record
+        elif type(record) in names:
+            related.setdefault(names[type(record)], []).append(record)
+    return entry, mother, related
+
+
+@transaction.atomic
+def restore_patient(patient_id):
+    """
+    Moves an archived mother (and her records) back into the hot tables,
+    keeping the original IDs. Returns the PregnantWoman, or None if she
+    is not in the archive. Raises RestoreConflict (and restores nothing)
+    if one of the IDs has been given to another row meanwhile.
+    """
+    entry = ArchivedPatient.objects.select_for_update().filter(patient_id=patient_id).first()
+    if entry is None:
+        return None
+
+    items = list(serializers.deserialize('python', entry.records))
+    candidates = [item.object for item in items if isinstance(item.object, DuplicateCandidate)]
+    items = [item for item in items if not isinstance(item.object, DuplicateCandidate)]
+
+    wanted = {}
+    for item in items:
+        wanted.setdefault(item.object._meta.model, []).append(item.object.pk)
+    for model, pks in wanted.items():
+        taken = sorted(model._base_manager.filter(pk__in=pks).values_list('pk', flat=True))
+        if taken:
+            raise RestoreConflict(
+                f"Cannot restore patient #{patient_id}: {model._meta.verbose_name} ID(s) "
+                f"{', '.join(map(str, taken))} now belong to other records."
+            )
+
+    restored = {}
+    for item in items:
+        # raw save: keeps created_at/updated_at exactly as they were
+        item.save()
+        restored.setdefault(item.object._meta.model, []).append(item.object.pk)
+
+    # A dismissed pair comes back once both mothers are in the hot tables
+    # (under a new ID: the pair, not the row, is what matters)
+    present = set(PregnantWoman.objects.filter(
+        pk__in=[c.patient_a_id for c in candidates] + [c.patient_b_id for c in candidates],
+    ).values_list('pk', flat=True))
+    for candidate in candidates:
+        candidate.pk = None
+    DuplicateCandidate.objects.bulk_create(
+        [c for c in candidates if c.patient_a_id in present and c.patient_b_id in present], ignore_conflicts=True,
+    )
+    entry.delete()
+
+    # Raw saves send no sync signal, so tell devices about the rows here
+    for resource, model in (('patients', PregnantWoman), ('appointments', Appointment),
+                            ('deliveries', Delivery), ('discharges', Discharge),
+                            ('transactions', Transaction)):
+        if restored.get(model):
+            ChangeLog.record_many(resource, restored[model])
+    # Raw saves skip the summary signals too (and older archives lack the columns)
+    counters.refresh([patient_id])
+
+    return PregnantWoman.objects.get(pk=patient_id)
+
+
+def hot_table_sizes():
+    """
+    {table: (rows, bytes)} for the hot tables. Bytes come from MySQL's
+    information_schema and are None on other databases.
+    """
+    sizes = {}
+    for model in HOT_MODELS:
+        sizes[model._meta.db_table] = [model.objects.count(), None]
+
+    if connection.vendor == 'mysql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT table_name, data_length + index_length FROM information_schema.tables "
+                "WHERE table_schema = DATABASE() AND table_name IN (%s)" % ', '.join(['%s'] * len(sizes)),
+                list(sizes),
+            )
+            for table, size in cursor.fetchall():
+                if table in sizes:
+                    sizes[table][1] = size
+
+    return {table: tuple(value) for table, value in sizes.items()}
@@ -0,0 +1,362 @@
+"""
+Append-only audit log of clinical data edits.
+
+Signals (see signals.py) turn every save / delete of a mother, appointment,
+delivery, discharge or payment into an AuditEntry with a field-level diff.
+The old values are read just before an update (one primary key lookup per
+save), so loading rows for a page costs nothing extra.
+
+Entries are not written during the request. Once the surrounding transaction
+commits they are appended to this process's spill file in AUDIT_SPILL_DIR
+and to an in-memory buffer, and a background thread writes them with
+bulk_create() every AUDIT_FLUSH_INTERVAL seconds (or as soon as
+AUDIT_BATCH_SIZE are waiting). A spill file is deleted only after its
+entries are committed; while the database is down they are retried every
+interval. Spill files left by a process that crashed or was killed are
+written by the next writer thread to look (recover()). Each entry has a
+unique entry_id, so one written twice is stored once.
+
+A batch the database refuses while it is up is retried one entry at a time;
+entries still refused are moved to the dead-letter directory (`dead` under
+AUDIT_SPILL_DIR) so they cannot hold up the rest. While the database is down
+at most AUDIT_MAX_PENDING entries are kept in memory; past that they are
+left in their spill files for recover().
+"""
+import atexit
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from pathlib import Path
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, connection, router, transaction
+from django.utils.dateparse import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+# Clinician making the current request (set by AuditUserMiddleware)
+current_user = ContextVar('audit_current_user', default=None)
+
+# Bookkeeping columns that change on every save and say nothing clinical
+IGNORED_FIELDS = {'updated_at'}
+
+
+# ==========================================
+# Field snapshots and diffs
+# ==========================================
+def snapshot(instance):
+    """Loaded column values (deferred columns are skipped, never fetched)."""
+    loaded = instance.__dict__
+    return {
+        f.attname: loaded[f.attname]
+        for f in instance._meta.concrete_fields
+        if f.attname in loaded and f.attname not in IGNORED_FIELDS
+    }
+
+
+def stored(instance):
+    """The saved values of the columns loaded on `instance` (one query): the old side of a diff."""
+    model = type(instance)
+    return model._base_manager.using(router.db_for_write(model, instance=instance)).filter(
+        pk=instance.pk,
+    ).values(*snapshot(instance)).first() or {}
+
+
+def diff(old, new):
+    return {
+        field: [old.get(field), value]
+        for field, value in new.items()
+        if field not in old or old[field] != value
+    }
+
+
+def _jsonable(changes):
+    # Dates / Decimals as strings now, so later edits of the instance cannot leak in
+    return json.loads(json.dumps(changes, cls=DjangoJSONEncoder))
+
+
+def make_entry(resource, instance, action, changes):
+    from .models import AuditEntry, PregnantWoman
+
+    user = current_user.get()
+    if isinstance(instance, PregnantWoman):
+        patient_id = instance.pk
+    else:
+        patient_id = getattr(instance, 'patient_id', None)
+
+    return AuditEntry(
+        resource=resource,
+        object_id=instance.pk,
+        patient_id=patient_id,
+        action=action,
+        changes=_jsonable(changes),
+        user_id=getattr(user, 'pk', None),
+        username=getattr(user, 'username', '') or '',
+    )
+
+
+# ==========================================
+# Buffer + background writer
+# ==========================================
+def _dump(entry):
+    return json.dumps({
+        'entry_id': entry.entry_id,
+        'resource': entry.resource,
+        'object_id': entry.object_id,
+        'patient_id': entry.patient_id,
+        'action': entry.action,
+        'changes': entry.changes,
+        'user_id': entry.user_id,
+        'username': entry.username,
+        'created_at': entry.created_at,
+    }, cls=DjangoJSONEncoder) + '\n'
+
+
+def _load(line):
+    from .models import AuditEntry
+
+    data = json.loads(line)
+    data['created_at'] = parse_datetime(data['created_at'])
+    return AuditEntry(**data)
+
+
+class AuditBuffer:
+    def __init__(self):
+        self.pending = []
+        self.segments = set()   # spill files holding the pending entries
+        self.segment = None     # (path, open file) new entries are appended to
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+        self.stopped = False
+        self.recovered_at = 0.0
+
+    # --- settings (read each time so tests / settings overrides apply) ---
+    @property
+    def batch_size(self):
+        return getattr(settings, 'AUDIT_BATCH_SIZE', 200)
+
+    @property
+    def interval(self):
+        return getattr(settings, 'AUDIT_FLUSH_INTERVAL', 2.0)
+
+    @property
+    def spill_dir(self):
+        return Path(getattr(settings, 'AUDIT_SPILL_DIR', settings.BASE_DIR / 'audit_spill'))
+
+    @property
+    def dead_letter_dir(self):
+        return self.spill_dir / 'dead'
+
+    @property
+    def recover_after(self):
+        return getattr(settings, 'AUDIT_SPILL_RECOVER_SECONDS', 60)
+
+    @property
+    def max_pending(self):
+        return getattr(settings, 'AUDIT_MAX_PENDING', 10000)
+
+    def add(self, entry):
+        if not getattr(settings, 'AUDIT_ASYNC', True):
+            self.write([entry])
+            return
+
+        self.start()
+        line = _dump(entry)
+        with self.lock:
+            # Journal first: once add() returns the entry survives a crash
+            if self.segment is None:
+                self.spill_dir.mkdir(parents=True, exist_ok=True)
+                path = self.spill_dir / f"{self.token}-{next(self.sequence):06d}.jsonl"
+                self.segment = (path, open(path, 'a', encoding='utf-8'))
+                self.segments.add(path)
+            handle = self.segment[1]
+            handle.write(line)
+            handle.flush()
+            if getattr(settings, 'AUDIT_SPILL_FSYNC', False):
+                os.fsync(handle.fileno())
+            self.pending.append(entry)
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def start(self):
+        # A forked child (e.g. a preloading server's worker) starts its own writer
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.reset()
+            self.thread = threading.Thread(target=self.run, name='audit-writer', daemon=True)
+            self.thread.start()
+            atexit.register(self.shutdown)
+
+    def reset(self):
+        """Fresh state for this process; its spill files are named after `token`."""
+        self.pid = os.getpid()
+        self.token = f"{socket.gethostname()}-{self.pid}-{uuid.uuid4().hex[:8]}"
+        self.sequence = itertools.count()
+        self.pending, self.segments, self.segment = [], set(), None
+
+    def run(self):
+        while not self.stopped:
+            if time.monotonic() - self.recovered_at >= self.recover_after:
+                self.recover()
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def take(self):
+        """The pending entries and the spill files holding them; later entries go to a new file."""
+        with self.lock:
+            batch, segments = self.pending, self.segments
+            self.pending, self.segments = [], set()
+            if self.segment is not None:
+                self.segment[1].close()
+                self.segment = None
+        return batch, segments
+
+    def flush(self):
+        batch, segments = self.take()
+        if not batch:
+            return 0
+        try:
+            written = self.write_all(batch)
+        except DatabaseError:
+            with self.lock:
+                if len(self.pending) + len(batch) > self.max_pending:
+                    # Let go of them: their spill files are recovered once the database is back
+                    logger.exception("Audit flush failed; leaving %d entries to their spill files", len(batch))
+                else:
+                    logger.exception("Audit flush failed; keeping %d entries for the next attempt", len(batch))
+                    self.pending[:0] = batch
+                    self.segments |= segments
+            return 0
+        finally:
+            # Worker thread: don't keep a connection open between flushes
+            if threading.current_thread() is self.thread:
+                connection.close()
+        # Written (or dead-lettered): their spill files are no longer needed
+        for path in segments:
+            path.unlink(missing_ok=True)
+        return written
+
+    def write(self, batch):
+        from .models import AuditEntry
+        # entry_id is unique, so an entry written twice (see recover()) is stored once
+        AuditEntry.objects.bulk_create(batch, batch_size=self.batch_size, ignore_conflicts=True)
+
+    def write_all(self, entries):
+        """
+        Writes `entries` and returns how many were stored. If the database is
+        up but refuses the batch, they are written one at a time and the ones
+        still refused go to the dead-letter directory. Raises DatabaseError
+        while the database is down.
+        """
+        try:
+            with transaction.atomic():
+                self.write(entries)
+            return len(entries)
+        except DatabaseError:
+            if not self.database_up():
+                raise
+        written, refused = 0, []
+        for entry in entries:
+            try:
+                with transaction.atomic():
+                    self.write([entry])
+            except DatabaseError:
+                if not self.database_up():
+                    raise
+                refused.append(entry)
+            else:
+                written += 1
+        if refused:
+            self.dead_letter(refused)
+        return written
+
+    def database_up(self):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        except DatabaseError:
+            return False
+        return True
+
+    def dead_letter(self, entries):
+        """Moves entries the database refuses out of the way, for someone to look at."""
+        self.dead_letter_dir.mkdir(parents=True, exist_ok=True)
+        path = self.dead_letter_dir / f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl"
+        with open(path, 'w', encoding='utf-8') as handle:
+            handle.writelines(_dump(entry) for entry in entries)
+            handle.flush()
+            if getattr(settings, 'AUDIT_SPILL_FSYNC', False):
+                os.fsync(handle.fileno())
+        logger.error("%d audit entries were refused by the database; moved to %s", len(entries), path)
+
+    def shutdown(self):
+        """Final flush at exit; whatever cannot be written stays in the spill files."""
+        self.stopped = True
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Audit flush at exit failed; entries stay in %s", self.spill_dir)
+
+    # --- spill files ---
+    def recover(self):
+        """
+        Writes the entries of spill files left behind by processes that died
+        (or by this one, waiting for the database): files not touched for
+        AUDIT_SPILL_RECOVER_SECONDS. Each file is deleted once its entries are
+        committed or dead-lettered. Returns the number of entries recovered.
+        """
+        self.recovered_at = time.monotonic()
+        if not self.spill_dir.exists():
+            return 0
+        with self.lock:
+            mine = set(self.segments)
+        cutoff = time.time() - self.recover_after
+        recovered = 0
+        for path in sorted(self.spill_dir.glob('*.jsonl*')):
+            try:
+                if path in mine or path.stat().st_mtime > cutoff:
+                    continue
+                with open(path, encoding='utf-8') as handle:
+                    lines = handle.read().splitlines()
+            except FileNotFoundError:
+                continue   # recovered by another process meanwhile
+            entries = []
+            for line in lines:
+                try:
+                    entries.append(_load(line))
+                except ValueError:
+                    # Torn last line of a process killed mid-write
+                    logger.warning("Skipping unreadable audit spill line in %s", path)
+            try:
+                written = self.write_all(entries)
+            except DatabaseError:
+                logger.exception("Recovering %s failed; trying again later", path)
+                return recovered
+            finally:
+                if threading.current_thread() is self.thread:
+                    connection.close()
+            path.unlink(missing_ok=True)
+            recovered += written
+        return recovered
+
+
+buffer = AuditBuffer()
+
+
+def record(entry):
+    """Queue an audit entry once the current transaction commits."""
+    transaction.on_commit(lambda: buffer.add(entry))
@@ -0,0 +1,56 @@
+"""
+Authentication backend that keeps logged-in users in the cache.
+
+AuthenticationMiddleware loads request.user through the backend's
+get_user() on every request, which is one auth_user query per page. The
+cached copy is dropped whenever the user row is saved or deleted (see
+signals.py), so password changes, deactivation and permission edits made
+through the ORM take effect on the next request.
+
+It also throttles logins (see throttle.py): an attempt from a client over
+its limits is refused before the password is hashed.
+"""
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+
+from . import throttle
+
+KEY_PREFIX = 'auth-user:'
+
+
+def user_cache_key(user_id):
+    return f'{KEY_PREFIX}{user_id}'
+
+
+def forget_user(user_id):
+    cache.delete(user_cache_key(user_id))
+
+
+class CachedModelBackend(ModelBackend):
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        # Without a request (shell, management commands) there is no one to throttle
+        if request is None or not throttle.enabled():
+            return super().authenticate(request, username, password, **kwargs)
+        wait = throttle.allow(request, username)
+        if wait:
+            # Read by ThrottledAuthenticationForm; PermissionDenied stops
+            # django.contrib.auth.authenticate() trying any other backend
+            request.login_throttled = wait
+            raise PermissionDenied
+        user = super().authenticate(request, username, password, **kwargs)
+        throttle.record(request, username, succeeded=user is not None)
+        return user
+
+    def get_user(self, user_id):
+        key = user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            user = super().get_user(user_id)
+            if user is None:
+                return None
+            cache.set(key, user, getattr(settings, 'AUTH_USER_CACHE_TIMEOUT', 300))
+        # Same check ModelBackend.get_user() makes on the row it loads
+        return user if self.user_can_authenticate(user) else None
@@ -0,0 +1,150 @@
+"""
+Per-mother care summary stored on PregnantWoman.
+
+The patient list shows, sorts and filters by each mother's next visit,
+visits attended, amount paid and last delivery. Working those out per row
+would mean four aggregate queries per mother, so they are kept as indexed
+columns instead:
+
+    next_appointment_date   earliest appointment still 'Scheduled'
+    visits_attended         'Completed' appointments
+    total_paid              sum of 'Success' transactions
+    last_delivery_date      latest delivery
+
+They are never incremented: refresh() recomputes them from the mother's
+rows, so a status change, a deleted row or a row moved to another mother
+all come out right. A mother whose summary changed gets a new updated_at
+and a change-log entry, so devices (sync.py) and API clients (ETags) see
+the new values. Signals (signals.py) refresh the mother of every saved
+or deleted appointment, delivery and transaction right after the write (in
+the same transaction when the caller has one open); code writing with
+bulk_create() / update() (scheduling, payments, reconciliation, merges,
+archiving) calls refresh() itself. `manage.py
+repair_counters` recomputes every mother, e.g. after a raw SQL fix.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Appointment, ChangeLog, Delivery, PregnantWoman, Transaction
+
+# The columns each model's rows feed
+FIELDS = {
+    Appointment: ('next_appointment_date', 'visits_attended'),
+    Delivery: ('last_delivery_date',),
+    Transaction: ('total_paid',),
+}
+
+# Patient ids waiting for refresh() while deferred() is active
+_deferred = ContextVar('counters_deferred', default=None)
+
+
+def _total(queryset, aggregate, output_field, default):
+    # One grouped row for the outer mother, or the default when she has none
+    return Coalesce(
+        Subquery(queryset.values('patient').annotate(total=aggregate).values('total')[:1], output_field=output_field),
+        Value(default, output_field=output_field),
+    )
+
+
+def expressions():
+    """{column: expression computing it for the mother being updated}"""
+    mine = {'patient': OuterRef('pk')}
+    return {
+        'next_appointment_date': Subquery(
+            Appointment.objects.filter(**mine, status='Scheduled').order_by('date').values('date')[:1]
+        ),
+        'visits_attended': _total(
+            Appointment.objects.filter(**mine, status='Completed'), Count('pk'), IntegerField(), 0,
+        ),
+        'total_paid': _total(
+            Transaction.objects.filter(**mine, status='Success'), Sum('amount'),
+            DecimalField(max_digits=12, decimal_places=2), Decimal('0'),
+        ),
+        'last_delivery_date': Subquery(
+            Delivery.objects.filter(**mine).order_by('-delivery_date').values('delivery_date')[:1]
+        ),
+    }
+
+
+def refresh(patient_ids, models=None):
+    """
+    Recomputes the summary columns fed by `models` (default: all) for these
+    mothers, in the caller's transaction. Mothers whose values changed get
+    a new updated_at and a change-log entry. Returns the number of rows updated.
+    """
+    ids = sorted({pk for pk in patient_ids if pk is not None})
+    models = list(FIELDS) if models is None else models
+    if not ids:
+        return 0
+    pending = _deferred.get()
+    if pending is not None:
+        for model in models:
+            pending.setdefault(model, set()).update(ids)
+        return 0
+
+    wanted = {field for model in models for field in FIELDS[model]}
+    values = {field: expression for field, expression in expressions().items() if field in wanted}
+    columns = sorted(values)
+    with transaction.atomic():
+        # Lock the mothers first: the UPDATE that follows then sees every
+        # committed change to their rows, even one made while waiting
+        before = {
+            pk: current for pk, *current in
+            PregnantWoman.objects.select_for_update().filter(pk__in=ids).order_by('pk').values_list('pk', *columns)
+        }
+        updated = PregnantWoman.objects.filter(pk__in=ids).update(**values)
+        changed = [
+            pk for pk, *current in PregnantWoman.objects.filter(pk__in=before).values_list('pk', *columns)
+            if current != before[pk]
+        ]
+        if changed:
+            # update() leaves updated_at alone and sends no signal
+            PregnantWoman.objects.filter(pk__in=changed).update(updated_at=timezone.now())
+            ChangeLog.record_many('patients', changed)
+        return updated
+
+
+@contextmanager
+def deferred():
+    """
+    Collects the refreshes asked for inside the block and runs them once at
+    its end, per mother rather than per row: for cascading deletes and other
+    changes touching many rows of the same mothers.
+    """
+    if _deferred.get() is not None:
+        yield
+        return
+    pending = {}
+    token = _deferred.set(pending)
+    try:
+        yield
+    finally:
+        _deferred.reset(token)
+    for model, ids in pending.items():
+        refresh(ids, [model])
+
+
+def repair(batch_size=1000, progress=None):
+    """
+    Recomputes every mother, `batch_size` per transaction.
+    Returns (mothers checked, mothers whose summary was wrong).
+    """
+    columns = ['pk', *expressions()]
+    ids = list(PregnantWoman.objects.order_by('pk').values_list('pk', flat=True))
+    fixed = 0
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        with transaction.atomic():
+            before = set(PregnantWoman.objects.filter(pk__in=batch).values_list(*columns))
+            refresh(batch)
+            after = set(PregnantWoman.objects.filter(pk__in=batch).values_list(*columns))
+        fixed += len(after - before)
+        if progress:
+            progress(start + len(batch), len(ids))
+    return len(ids), fixed
@@ -0,0 +1,336 @@
+"""
+Duplicate patient detection and merging.
+
+A mother registered twice has her appointments and payments split between
+two records. find_duplicates() streams every mother once and files her
+under a few blocking keys:
+
+    ('phone', normalised phone)               0712 345678 == +254712345678
+    ('name', phonetic key of two name tokens, age band)
+
+Only mothers sharing a key are compared, so a scan costs about one
+comparison per mother instead of n² / 2. Pairs are scored with fuzzy name
+matching plus phone / age / LMP agreement, and those scoring DEDUPE_MIN_SCORE or
+more go into the DuplicateCandidate review queue.
+
+merge_patients() moves every appointment, delivery, discharge, payment and
+SMS of the duplicate to the record being kept with one UPDATE per table,
+inside a single transaction, hands its other review pairs to the kept
+record and then deletes the duplicate.
+"""
+import logging
+import unicodedata
+from collections import defaultdict, namedtuple
+from difflib import SequenceMatcher
+from functools import lru_cache
+from itertools import combinations
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import audit, counters
+from .models import (
+    PregnantWoman, Appointment, Delivery, Discharge, Transaction, SmsMessage, ChangeLog, DuplicateCandidate,
+)
+from .scheduling import contact_number
+from .sync import MODEL_RESOURCES
+
+logger = logging.getLogger(__name__)
+
+# Tables whose rows follow the mother on a merge (discharge documents hang
+# off their discharge and go with it). Moves of synced rows are logged for
+# devices and the audit trail.
+RELATED_MODELS = [Appointment, Delivery, Discharge, Transaction, SmsMessage]
+
+# Copied from the duplicate when the kept record has them blank
+FILL_FIELDS = [
+    'email', 'county', 'ward', 'expected_due_date', 'blood_type', 'primary_reason', 'medical_history',
+    'emergency_contact_name', 'emergency_contact_relation', 'emergency_contact_phone',
+]
+
+Mother = namedtuple('Mother', 'id tokens phone age lmp')
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# ==========================================
+# Normalising
+# ==========================================
+def normalize_phone(phone):
+    """Kenyan numbers in one form: '0712 345 678', '712345678', '+254712345678' -> '254712345678'."""
+    digits = ''.join(ch for ch in phone or '' if ch.isdigit())
+    if len(digits) == 10 and digits.startswith('0'):
+        digits = '254' + digits[1:]
+    elif len(digits) == 9 and digits[0] in '17':
+        digits = '254' + digits
+    return digits
+
+
+def name_tokens(name):
+    """Lower-case ASCII name parts: 'Wanjikũ  MARY-Ann' -> ['wanjiku', 'mary', 'ann']."""
+    ascii_name = unicodedata.normalize('NFKD', name or '').encode('ascii', 'ignore').decode()
+    cleaned = ''.join(ch if ch.isalpha() else ' ' for ch in ascii_name.lower())
+    return [token for token in cleaned.split() if len(token) > 1]
+
+
+_SOUNDEX = {ch: str(code) for code, letters in enumerate(
+    ['', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r'],
+) for ch in letters}
+
+
+def soundex(token):
+    """American Soundex: 'Achieng' and 'Akieng' both give 'A252'."""
+    first, code, last = token[0].upper(), [], _SOUNDEX.get(token[0], '')
+    for ch in token[1:]:
+        digit = _SOUNDEX.get(ch, '')
+        if digit and digit != last:
+            code.append(digit)
+        if ch not in 'hw':
+            last = digit
+    return (first + ''.join(code) + '000')[:4]
+
+
+def age_bands(age):
+    # Neighbouring 5-year bands, so 24 and 25 still meet
+    return {(age - 1) // 5, (age + 1) // 5} if age is not None else {None}
+
+
+def block_keys(mother):
+    keys = set()
+    if len(mother.phone) >= 9:
+        keys.add(('phone', mother.phone))
+    codes = sorted({soundex(token) for token in mother.tokens})
+    # Every pair of name parts: a dropped middle name or swapped order still matches
+    pairs = list(combinations(codes, 2)) or [tuple(codes)]
+    for pair in pairs:
+        for band in age_bands(mother.age):
+            keys.add(('name', pair, band))
+    return keys
+
+
+# ==========================================
+# Scoring
+# ==========================================
+# Weights of the evidence; a pair needs DEDUPE_MIN_SCORE of the total (1.0)
+NAME_WEIGHT, PHONE_WEIGHT, AGE_WEIGHT, LMP_WEIGHT = 0.5, 0.25, 0.1, 0.15
+
+
+@lru_cache(maxsize=200_000)
+def _ratio(a, b):
+    # Names repeat a lot, so most comparisons are cache hits
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def name_similarity(a, b):
+    """0..1; word order and a missing middle name cost little."""
+    if not a or not b:
+        return 0.0
+    whole = _ratio(' '.join(sorted(a)), ' '.join(sorted(b)))
+    shorter, longer = (a, b) if len(a) <= len(b) else (b, a)
+    parts = sum(max(_ratio(t, u) for u in longer) for t in shorter) / len(shorter)
+    return max(whole, parts * 0.95)
+
+
+def other_evidence(a, b):
+    """(points, reasons) from phone, age and LMP agreement: cheap, so scored first."""
+    points, reasons = 0.0, []
+    if a.phone and a.phone == b.phone:
+        points += PHONE_WEIGHT
+        reasons.append("same phone")
+    if a.age is not None and b.age is not None:
+        gap = abs(a.age - b.age)
+        points += AGE_WEIGHT if gap <= 1 else AGE_WEIGHT / 2 if gap <= 3 else 0
+        reasons.append(f"ages {a.age} / {b.age}")
+    if a.lmp and b.lmp and abs((a.lmp - b.lmp).days) <= 14:
+        # Registered twice for the same pregnancy
+        points += LMP_WEIGHT
+        reasons.append("same LMP")
+    return points, reasons
+
+
+def score(a, b, min_score=0.0):
+    """
+    (score 0..1, reasons) for two Mother tuples, or None when the pair
+    cannot reach `min_score` even with identical names (no name matching done).
+    """
+    points, reasons = other_evidence(a, b)
+    if points + NAME_WEIGHT < min_score:
+        return None
+    name = name_similarity(a.tokens, b.tokens)
+    reasons.insert(0, f"name {name:.0%} similar")
+    return round(points + NAME_WEIGHT * name, 3), ", ".join(reasons)
+
+
+# ==========================================
+# Finding candidates
+# ==========================================
+def load_mothers(queryset=None, chunk_size=2000):
+    """{id: Mother}, streamed so only the compact tuples are kept."""
+    queryset = queryset if queryset is not None else PregnantWoman.objects.all()
+    rows = queryset.values_list('pk', 'full_name', 'phone', 'age', 'lmp').order_by().iterator(chunk_size=chunk_size)
+    return {
+        pk: Mother(pk, name_tokens(name), normalize_phone(phone), age, lmp)
+        for pk, name, phone, age, lmp in rows
+    }
+
+
+def build_index(mothers):
+    """The blocking index: {key: [mother ids]}."""
+    index = defaultdict(list)
+    for mother in mothers.values():
+        for key in block_keys(mother):
+            index[key].append(mother.id)
+    return index
+
+
+def candidate_pairs(index, max_block=None):
+    """(id, id) pairs sharing a key, lower id first. Oversized blocks are skipped."""
+    max_block = max_block or _setting('DEDUPE_MAX_BLOCK', 50)
+    pairs, skipped = set(), []
+    for key, ids in index.items():
+        if len(ids) > max_block:
+            # e.g. a placeholder phone number entered for many mothers
+            skipped.append(key)
+            continue
+        pairs.update(combinations(sorted(ids), 2))
+    if skipped:
+        logger.warning("Skipped %d blocking key(s) shared by more than %d mothers, e.g. %s",
+                       len(skipped), max_block, skipped[0])
+    return pairs
+
+
+def find_duplicates(min_score=None, max_block=None):
+    """
+    Scans every mother and queues new likely duplicates for review.
+    Returns (pairs compared, candidates queued).
+    """
+    min_score = min_score if min_score is not None else _setting('DEDUPE_MIN_SCORE', 0.75)
+    mothers = load_mothers()
+    pairs = candidate_pairs(build_index(mothers), max_block)
+
+    known = set(DuplicateCandidate.objects.values_list('patient_a_id', 'patient_b_id').iterator())
+    found = []
+    for a, b in pairs - known:
+        scored = score(mothers[a], mothers[b], min_score)
+        if scored and scored[0] >= min_score:
+            found.append(DuplicateCandidate(patient_a_id=a, patient_b_id=b, score=scored[0], reasons=scored[1]))
+    # ignore_conflicts: a concurrent scan may queue the same pair
+    DuplicateCandidate.objects.bulk_create(found, batch_size=1000, ignore_conflicts=True)
+    return len(pairs), len(found)
+
+
+def review_queue():
+    return (
+        DuplicateCandidate.objects
+        .filter(status='pending')
+        .select_related('patient_a', 'patient_b')
+        .order_by('-score', 'pk')
+    )
+
+
+def dismiss(candidate, username=''):
+    DuplicateCandidate.objects.filter(pk=candidate.pk).update(
+        status='dismissed', reviewed_by=username, reviewed_at=timezone.now(),
+    )
+
+
+# ==========================================
+# Merging
+# ==========================================
+def _drop_double_bookings(patient_id, keep_ids):
+    """Both records had the same upcoming ANC contact booked: keep one of each."""
+    upcoming = Appointment.objects.filter(
+        patient_id=patient_id, status='Scheduled', date__gte=timezone.localdate(),
+    ).only('pk', 'purpose').order_by('date', 'pk')
+    seen, extra = {}, []
+    for appointment in upcoming:
+        number = contact_number(appointment.purpose)
+        if number is None:
+            continue
+        if number not in seen:
+            seen[number] = appointment.pk
+        elif appointment.pk in keep_ids and seen[number] not in keep_ids:
+            # Prefer the kept mother's own booking
+            extra.append(seen[number])
+            seen[number] = appointment.pk
+        else:
+            extra.append(appointment.pk)
+    if extra:
+        Appointment.objects.filter(pk__in=extra).delete()
+    return len(extra)
+
+
+def _involving(patient_id):
+    return Q(patient_a_id=patient_id) | Q(patient_b_id=patient_id)
+
+
+def _move_candidates(keep_id, duplicate_id):
+    """
+    The duplicate's review pairs with other mothers now concern the kept
+    record (patient_a stays the lower id). A pair the kept record already
+    has is left to be deleted with the duplicate.
+    """
+    existing = set(DuplicateCandidate.objects.filter(_involving(keep_id)).values_list('patient_a_id', 'patient_b_id'))
+    for candidate in DuplicateCandidate.objects.filter(_involving(duplicate_id)).exclude(_involving(keep_id)):
+        other = candidate.patient_b_id if candidate.patient_a_id == duplicate_id else candidate.patient_a_id
+        pair = (min(keep_id, other), max(keep_id, other))
+        if pair in existing:
+            continue
+        DuplicateCandidate.objects.filter(pk=candidate.pk).update(patient_a_id=pair[0], patient_b_id=pair[1])
+        existing.add(pair)
+
+
+@transaction.atomic
+def merge_patients(keep_id, duplicate_id):
+    """
+    Moves everything recorded against `duplicate_id` to `keep_id`, fills the
+    kept record's blank fields from the duplicate and deletes the duplicate.
+    Returns {resource: rows moved}.
+    """
+    if keep_id == duplicate_id:
+        raise ValueError("A mother cannot be merged into herself.")
+    # Lock both rows so neither is edited or merged elsewhere meanwhile
+    mothers = PregnantWoman.objects.select_for_update().in_bulk([keep_id, duplicate_id])
+    if len(mothers) != 2:
+        raise PregnantWoman.DoesNotExist("Both mothers must still be registered.")
+    keep, duplicate = mothers[keep_id], mothers[duplicate_id]
+
+    own_appointments = set(Appointment.objects.filter(patient_id=keep_id).values_list('pk', flat=True))
+    now = timezone.now()
+    moved = {}
+    for model in RELATED_MODELS:
+        resource = MODEL_RESOURCES.get(model)
+        ids = list(model.objects.filter(patient_id=duplicate_id).values_list('pk', flat=True))
+        if not ids:
+            continue
+        if resource is None:
+            model.objects.filter(pk__in=ids).update(patient_id=keep_id)
+            moved[model._meta.model_name] = len(ids)
+            continue
+        model.objects.filter(pk__in=ids).update(patient_id=keep_id, updated_at=now)
+        # update() sends no post_save: log the moves for device sync and the audit trail
+        ChangeLog.record_many(resource, ids)
+        for pk in ids:
+            audit.record(audit.make_entry(
+                resource, model(pk=pk, patient_id=keep_id), 'update', {'patient_id': [duplicate_id, keep_id]},
+            ))
+        moved[resource] = len(ids)
+
+    if moved.get('appointments'):
+        _drop_double_bookings(keep_id, own_appointments)
+    if moved:
+        counters.refresh([keep_id])
+    _move_candidates(keep_id, duplicate_id)
+
+    filled = [f for f in FILL_FIELDS if getattr(keep, f) in (None, '') and getattr(duplicate, f) not in (None, '')]
+    for field in filled:
+        setattr(keep, field, getattr(duplicate, field))
+    if filled:
+        keep.save(update_fields=filled + ['updated_at'])
+
+    duplicate.delete()
+    return moved
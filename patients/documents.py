@@ -0,0 +1,196 @@
+"""
+Discharge summary documents.
+
+PDFs are rendered by a process pool (DOCUMENT_WORKERS processes), never in
+the request: a view only asks for a summary and gets back a
+DischargeDocument to poll. The workers receive plain data and run
+pdf.render_discharge_summary(); the finished bytes are written to the
+default storage from this process.
+
+Documents are keyed by a hash of everything printed on them, so printing
+the same discharge again (or a whole day again) reuses the existing PDFs;
+editing the discharge, the mother or her delivery produces a new one.
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import Prefetch
+from django.utils import timezone
+
+from . import pdf
+from .models import Delivery, Discharge, DischargeDocument
+
+logger = logging.getLogger(__name__)
+
+# Bump when pdf.py's layout changes, so cached PDFs are rendered again
+LAYOUT_VERSION = 1
+
+PATIENT_FIELDS = ['full_name', 'age', 'phone', 'county', 'ward', 'gravida', 'parity', 'risk_level']
+DISCHARGE_FIELDS = ['admission_date', 'discharge_date', 'discharged_by', 'condition', 'billing_status', 'medications', 'notes']
+DELIVERY_FIELDS = ['delivery_date', 'delivery_type', 'baby_gender', 'baby_weight', 'attending_physician']
+
+
+# ==========================================
+# Summary content
+# ==========================================
+def summary_data(discharge):
+    """Everything printed on the summary, as JSON-safe plain data."""
+    patient = discharge.patient
+    # Deliveries come newest first (see with_summary_data)
+    deliveries = [d for d in patient.deliveries.all() if d.delivery_date <= discharge.discharge_date]
+    data = {
+        'facility': getattr(settings, 'DOCUMENT_FACILITY_NAME', ''),
+        'discharge_id': discharge.pk,
+        'patient': {f: getattr(patient, f) for f in PATIENT_FIELDS},
+        'discharge': {f: getattr(discharge, f) for f in DISCHARGE_FIELDS},
+        'delivery': {f: getattr(deliveries[0], f) for f in DELIVERY_FIELDS} if deliveries else None,
+    }
+    return json.loads(json.dumps(data, cls=DjangoJSONEncoder))
+
+
+def content_hash(data):
+    raw = json.dumps([LAYOUT_VERSION, data], sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def with_summary_data(discharges):
+    """Discharges with the mother and her deliveries loaded in 3 queries in total."""
+    return discharges.select_related('patient').prefetch_related(
+        Prefetch('patient__deliveries', queryset=Delivery.objects.order_by('-delivery_date', '-pk')),
+    )
+
+
+# ==========================================
+# Requesting summaries
+# ==========================================
+def request_summaries(discharges):
+    """
+    A DischargeDocument for each discharge (same order): the existing one if
+    its content is unchanged, otherwise a new one queued for rendering.
+    """
+    discharges = list(discharges)
+    payloads = {}
+    for discharge in discharges:
+        data = summary_data(discharge)
+        payloads[content_hash(data)] = (discharge, data)
+
+    existing = {doc.content_hash: doc for doc in DischargeDocument.objects.filter(content_hash__in=payloads)}
+    missing = [
+        DischargeDocument(discharge=discharge, content_hash=digest)
+        for digest, (discharge, _) in payloads.items() if digest not in existing
+    ]
+    # ignore_conflicts: another request may be creating the same document
+    DischargeDocument.objects.bulk_create(missing, ignore_conflicts=True)
+    documents = {doc.content_hash: doc for doc in DischargeDocument.objects.filter(content_hash__in=payloads)}
+
+    retry = [doc for doc in documents.values() if doc.status == 'failed']
+    if retry:
+        DischargeDocument.objects.filter(pk__in=[doc.pk for doc in retry]).update(status='queued', error='')
+        for doc in retry:
+            doc.status, doc.error = 'queued', ''
+    queued = [(doc.pk, payloads[digest][1]) for digest, doc in documents.items() if doc.status == 'queued']
+    if queued:
+        transaction.on_commit(lambda: submit(queued))
+
+    by_discharge = {payloads[digest][0].pk: doc for digest, doc in documents.items()}
+    return [by_discharge[discharge.pk] for discharge in discharges]
+
+
+def request_summary(discharge):
+    discharge = with_summary_data(Discharge.objects.filter(pk=discharge.pk)).get()
+    return request_summaries([discharge])[0]
+
+
+def request_day(day):
+    """Queues the summaries of every discharge on `day`; returns their documents."""
+    discharges = with_summary_data(Discharge.objects.filter(discharge_date=day).order_by('pk'))
+    return request_summaries(discharges)
+
+
+# ==========================================
+# Process pool
+# ==========================================
+_executor = None
+# document id -> Event set once its PDF is stored (or has failed)
+_pending = {}
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        # spawn: forking a threaded web process can copy held locks / open DB sockets
+        _executor = ProcessPoolExecutor(
+            max_workers=getattr(settings, 'DOCUMENT_WORKERS', 2),
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+    return _executor
+
+
+def submit(jobs):
+    """
+    Hands [(document id, summary data)] to the pool. Each document is
+    claimed first (queued -> rendering), so it is rendered only once.
+    """
+    for doc_id, data in jobs:
+        if not DischargeDocument.objects.filter(pk=doc_id, status='queued').update(status='rendering'):
+            continue
+        _pending[doc_id] = threading.Event()
+        future = _pool().submit(pdf.render_discharge_summary, data)
+        future.add_done_callback(lambda f, doc_id=doc_id, digest=content_hash(data): _store(doc_id, digest, f))
+
+
+def _store(doc_id, digest, future):
+    # Runs on the pool's result thread: its own DB connection, closed at the end
+    try:
+        try:
+            content = future.result()
+        except Exception as e:
+            logger.exception("Rendering discharge summary document %s failed", doc_id)
+            DischargeDocument.objects.filter(pk=doc_id).update(status='failed', error=str(e) or repr(e))
+            return
+
+        document = DischargeDocument.objects.get(pk=doc_id)
+        document.file.save(f"{digest}.pdf", ContentFile(content), save=False)
+        DischargeDocument.objects.filter(pk=doc_id).update(
+            status='ready', file=document.file.name, rendered_at=timezone.now(),
+        )
+    finally:
+        connection.close()
+        done = _pending.pop(doc_id, None)
+        if done is not None:
+            done.set()
+
+
+def wait_all(timeout=None):
+    """Blocks until every document submitted by this process is stored or failed."""
+    for done in list(_pending.values()):
+        done.wait(timeout)
+
+
+def requeue_stale():
+    """
+    Renders documents left 'queued' / 'rendering' by a process that stopped
+    (their pool went with it).
+    """
+    stale = DischargeDocument.objects.filter(status__in=('queued', 'rendering'))
+    docs = list(stale.values_list('pk', 'discharge_id', 'content_hash'))
+    discharges = with_summary_data(Discharge.objects.filter(pk__in={d[1] for d in docs})).in_bulk()
+
+    jobs = []
+    for doc_id, discharge_id, digest in docs:
+        data = summary_data(discharges[discharge_id])
+        if content_hash(data) != digest:
+            # Edited since: the next request creates the up-to-date document
+            DischargeDocument.objects.filter(pk=doc_id).update(status='failed', error="Discharge changed before rendering")
+            continue
+        DischargeDocument.objects.filter(pk=doc_id).update(status='queued')
+        jobs.append((doc_id, data))
+    submit(jobs)
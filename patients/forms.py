@@ -1,29 +1,213 @@
+import threading
+import uuid
+from collections import OrderedDict
+
 from django import forms
-from .models import PregnantWoman, Appointment, Delivery, Discharge
+from django.contrib.auth.forms import AuthenticationForm
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.forms.models import ModelChoiceIterator, ModelFormMetaclass
+from django.forms.utils import flatatt
+from django.utils.functional import cached_property
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+from .models import PregnantWoman, Appointment, Delivery, Discharge, Reconciliation
 
 
 # ------------------------------------------------------
-# PREGNANT WOMAN FORM
+# CACHED PATIENT DROPDOWN
 # ------------------------------------------------------
-class PregnantWomanForm(forms.ModelForm):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+# Evaluated choice lists, keyed by the SQL of the queryset, least recently
+# used first; at most CHOICE_CACHE_SIZE are kept per process.
+# 'version' is the model's choices generation (a token in the shared cache
+# that every save / delete of a mother replaces, see signals.py, so all
+# processes see it) plus (row count, latest updated_at), which also catches
+# writes that send no signal. 'options' holds the pre-rendered <option>
+# tags and is filled the first time the dropdown is drawn.
+CHOICE_CACHE_SIZE = 32
+_CHOICE_CACHE = OrderedDict()
+_CHOICE_CACHE_LOCK = threading.Lock()
+
+GENERATION_KEY_PREFIX = 'choices-generation:'
+
+
+def _generation_key(model):
+    return f'{GENERATION_KEY_PREFIX}{model._meta.label_lower}'
+
+
+def choices_generation(model):
+    key = _generation_key(model)
+    generation = cache.get(key)
+    if generation is None:
+        # First use, or evicted: a new token, so no list cached before matches
+        cache.add(key, uuid.uuid4().hex, None)
+        generation = cache.get(key)
+    return generation
+
+
+def forget_choices(model):
+    """Makes every process rebuild its cached choice lists of `model`."""
+    cache.set(_generation_key(model), uuid.uuid4().hex, None)
+
+
+class CachedModelChoiceIterator(ModelChoiceIterator):
+    """
+    Re-uses the evaluated (value, label) list between forms and requests.
+    Only a cheap COUNT/MAX query is run to check that the list is still fresh.
+    """
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        yield from self.cache_entry()['choices']
+
+    def __len__(self):
+        return len(self.cache_entry()['choices']) + (1 if self.field.empty_label is not None else 0)
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(self.cache_entry()['choices'])
+
+    def cache_entry(self):
+        # Several widgets may iterate the same field while one form renders
+        if getattr(self, '_entry', None) is not None:
+            return self._entry
+
+        key = str(self.queryset.query)
+        version = self.field.choices_version()
+        with _CHOICE_CACHE_LOCK:
+            entry = _CHOICE_CACHE.get(key)
+            if entry is not None:
+                _CHOICE_CACHE.move_to_end(key)
+
+        if version is None or entry is None or entry['version'] != version:
+            queryset = self.queryset
+            if not queryset._prefetch_related_lookups:
+                queryset = queryset.iterator()
+            entry = {
+                'version': version,
+                'choices': [self.choice(obj) for obj in queryset],
+                'options': None,
+            }
+            if version is not None:
+                with _CHOICE_CACHE_LOCK:
+                    _CHOICE_CACHE[key] = entry
+                    _CHOICE_CACHE.move_to_end(key)
+                    while len(_CHOICE_CACHE) > CHOICE_CACHE_SIZE:
+                        _CHOICE_CACHE.popitem(last=False)
+
+        self._entry = entry
+        return entry
+
+    def rendered_options(self):
+        """
+        Returns [(value, html, selected_html), ...] for every <option>,
+        including the empty label, built once per cached choice list.
+        """
+        entry = self.cache_entry()
+        if entry['options'] is None:
+            entry['options'] = [
+                (
+                    str(value),
+                    format_html('<option value="{}">{}</option>', value, label),
+                    format_html('<option value="{}" selected>{}</option>', value, label),
+                )
+                for value, label in self
+            ]
+        return entry['options']
+
+
+class CachedSelect(forms.Select):
+    """
+    Draws the patient dropdown from the pre-rendered <option> tags instead of
+    running the option template once per patient.
+    """
 
-        for field_name, field in self.fields.items():
+    def render(self, name, value, attrs=None, renderer=None):
+        if not isinstance(self.choices, CachedModelChoiceIterator):
+            return super().render(name, value, attrs, renderer)
+
+        final_attrs = self.build_attrs(self.attrs, attrs)
+        final_attrs['name'] = name
+        selected = set(self.format_value(value))
+
+        options = []
+        for option_value, html, selected_html in self.choices.rendered_options():
+            if option_value in selected:
+                options.append(selected_html)
+                if not self.allow_multiple_selected:
+                    selected = set()
+            else:
+                options.append(html)
+
+        return format_html('<select{}>\n{}\n</select>', flatatt(final_attrs), mark_safe('\n'.join(options)))
+
+
+class CachedModelChoiceField(forms.ModelChoiceField):
+    iterator = CachedModelChoiceIterator
+    widget = CachedSelect
+
+    # {pk: instance} already fetched by a formset, so each row can be
+    # validated without its own SELECT
+    known_objects = None
+
+    def to_python(self, value):
+        pk_name = self.queryset.model._meta.pk.name
+        if self.known_objects and self.to_field_name in (None, pk_name) and value not in self.empty_values:
+            try:
+                return self.known_objects[int(value)]
+            except (KeyError, TypeError, ValueError):
+                pass
+        return super().to_python(value)
+
+    def choices_version(self):
+        model = self.queryset.model
+        if not any(f.name == 'updated_at' for f in model._meta.concrete_fields):
+            return None
+        stats = self.queryset.order_by().aggregate(rows=Count('pk'), latest=Max('updated_at'))
+        return (choices_generation(model), stats['rows'], stats['latest'])
+
+
+# ------------------------------------------------------
+# BOOTSTRAP BASE FORM
+# ------------------------------------------------------
+class BootstrapModelFormMetaclass(ModelFormMetaclass):
+    """
+    Adds the Bootstrap classes to every widget ONCE, when the form class is built.
+    Django deep-copies base_fields for each form instance, so every form created
+    afterwards already has the right attrs without looping over fields in __init__.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        new_class = super().__new__(mcs, name, bases, attrs)
+
+        for field_name, field in new_class.base_fields.items():
             widget = field.widget
-            current_classes = widget.attrs.get('class', '')
 
             if isinstance(widget, (forms.CheckboxInput, forms.RadioSelect)):
                 continue
 
-            if isinstance(widget, forms.Select):
-                widget.attrs['class'] = (current_classes + ' form-select').strip()
-            else:
-                widget.attrs['class'] = (current_classes + ' form-control').strip()
+            current_classes = widget.attrs.get('class', '')
+            css_class = 'form-select' if isinstance(widget, forms.Select) else 'form-control'
+            if css_class not in current_classes.split():
+                widget.attrs['class'] = (current_classes + ' ' + css_class).strip()
 
-            if field.required:
+            if new_class.required_attr and field.required:
                 widget.attrs['required'] = 'required'
 
+        return new_class
+
+
+class BootstrapModelForm(forms.ModelForm, metaclass=BootstrapModelFormMetaclass):
+    # Set to True to write the 'required' attribute into the widget attrs as well
+    required_attr = False
+
+
+# ------------------------------------------------------
+# PREGNANT WOMAN FORM
+# ------------------------------------------------------
+class PregnantWomanForm(BootstrapModelForm):
+    required_attr = True
+
     class Meta:
         model = PregnantWoman
         fields = [
@@ -53,20 +237,11 @@ class PregnantWomanForm(forms.ModelForm):
 # ------------------------------------------------------
 # APPOINTMENT FORM
 # ------------------------------------------------------
-class AppointmentForm(forms.ModelForm):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        for field_name, field in self.fields.items():
-            widget = field.widget
-            current_classes = widget.attrs.get('class', '')
-
-            if isinstance(widget, forms.Select):
-                widget.attrs['class'] = (current_classes + ' form-select').strip()
-            elif not isinstance(widget, (forms.CheckboxInput, forms.RadioSelect)):
-                widget.attrs['class'] = (current_classes + ' form-control').strip()
-
+class AppointmentForm(BootstrapModelForm):
     class Meta:
         model = Appointment
+        # Patient dropdown re-uses the cached choice list
+        field_classes = {'patient': CachedModelChoiceField}
         fields = ['patient', 'date', 'time', 'purpose', 'status', 'notes']
         widgets = {
             'date': forms.DateInput(attrs={'type': 'date'}),
@@ -79,21 +254,11 @@ class AppointmentForm(forms.ModelForm):
 # ------------------------------------------------------
 # DELIVERY FORM (UPDATED WITH EDD)
 # ------------------------------------------------------
-class DeliveryForm(forms.ModelForm):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        for field_name, field in self.fields.items():
-            widget = field.widget
-            current_classes = widget.attrs.get('class', '')
-
-            if isinstance(widget, forms.Select):
-                widget.attrs['class'] = (current_classes + ' form-select').strip()
-            else:
-                widget.attrs['class'] = (current_classes + ' form-control').strip()
-
+class DeliveryForm(BootstrapModelForm):
     class Meta:
         model = Delivery
+        # Patient dropdown re-uses the cached choice list
+        field_classes = {'patient': CachedModelChoiceField}
         # Added 'edd' to the fields list below
         fields = [
             'patient', 'edd', 'delivery_date', 'delivery_time', 
@@ -114,24 +279,69 @@ class DeliveryForm(forms.ModelForm):
 
 
 # ------------------------------------------------------
-# DISCHARGE FORM (UPDATED)
+# BATCH DELIVERY FORMSET
 # ------------------------------------------------------
-class DischargeForm(forms.ModelForm):
+class BaseDeliveryFormSet(forms.BaseModelFormSet):
+    """
+    Many new deliveries in one POST (e.g. back-entering a whole shift).
+    All mothers referenced by the rows are fetched with one in_bulk() query.
+    """
+
     def __init__(self, *args, **kwargs):
+        # Only ever used to ADD records, never to edit existing ones
+        kwargs.setdefault('queryset', Delivery.objects.none())
         super().__init__(*args, **kwargs)
 
-        # Loop through fields to add Bootstrap classes automatically
-        for field_name, field in self.fields.items():
-            widget = field.widget
-            current_classes = widget.attrs.get('class', '')
+    @cached_property
+    def patients(self):
+        if not self.is_bound:
+            return {}
+        ids = set()
+        for i in range(self.total_form_count()):
+            value = self.data.get(self.add_prefix(i) + '-patient')
+            if value and str(value).isdigit():
+                ids.add(int(value))
+        return PregnantWoman.objects.in_bulk(ids)
 
-            if isinstance(widget, forms.Select):
-                widget.attrs['class'] = (current_classes + ' form-select').strip()
-            else:
-                widget.attrs['class'] = (current_classes + ' form-control').strip()
+    def _construct_form(self, i, **kwargs):
+        form = super()._construct_form(i, **kwargs)
+        form.fields['patient'].known_objects = self.patients
+        return form
 
+    def new_deliveries(self):
+        # Unsaved Delivery objects for every filled-in row
+        return [
+            form.save(commit=False)
+            for form in self.forms
+            if form.has_changed() and not self._should_delete_form(form)
+        ]
+
+
+class BatchDeliveryForm(DeliveryForm):
+    def _get_validation_exclusions(self):
+        # The mother was already looked up by the patient field itself, so skip
+        # the model's extra "does this ForeignKey exist?" query for every row
+        exclude = super()._get_validation_exclusions()
+        exclude.add('patient')
+        return exclude
+
+
+DeliveryFormSet = forms.modelformset_factory(
+    Delivery,
+    form=BatchDeliveryForm,
+    formset=BaseDeliveryFormSet,
+    extra=5,
+)
+
+
+# ------------------------------------------------------
+# DISCHARGE FORM (UPDATED)
+# ------------------------------------------------------
+class DischargeForm(BootstrapModelForm):
     class Meta:
         model = Discharge
+        # Patient dropdown re-uses the cached choice list
+        field_classes = {'patient': CachedModelChoiceField}
         fields = [
             'patient', 
             'admission_date', 
@@ -151,4 +361,41 @@ class DischargeForm(forms.ModelForm):
             # Specific placeholders requested in the UI
             'notes': forms.Textarea(attrs={'rows': 3, 'placeholder': 'Patient condition upon discharge...'}),
             'medications': forms.Textarea(attrs={'rows': 3, 'placeholder': 'List medications...'}),
-        }
\ No newline at end of file
+        }
+
+# ------------------------------------------------------
+# M-PESA STATEMENT UPLOAD
+# ------------------------------------------------------
+class StatementUploadForm(BootstrapModelForm):
+    class Meta:
+        model = Reconciliation
+        fields = ['statement', 'dry_run']
+        labels = {'dry_run': 'Report only (change no payments)'}
+
+    def clean_statement(self):
+        statement = self.cleaned_data['statement']
+        if not statement.name.lower().endswith(('.csv', '.xlsx', '.xls')):
+            raise forms.ValidationError("Upload the statement as CSV, XLSX or XLS.")
+        return statement
+
+
+# ------------------------------------------------------
+# LOGIN
+# ------------------------------------------------------
+class ThrottledAuthenticationForm(AuthenticationForm):
+    """Says how long to wait when the login was refused by throttle.py."""
+    error_messages = {
+        **AuthenticationForm.error_messages,
+        'throttled': "Too many login attempts. Try again in %(wait)s seconds.",
+    }
+
+    @property
+    def throttled(self):
+        return getattr(self.request, 'login_throttled', 0)
+
+    def get_invalid_login_error(self):
+        if self.throttled:
+            return forms.ValidationError(
+                self.error_messages['throttled'], code='throttled', params={'wait': self.throttled},
+            )
+        return super().get_invalid_login_error()
@@ -0,0 +1,267 @@
+"""
+Background jobs stored in the database.
+
+Slow work (payments, SMS, reports, imports) is described by a Job row and
+run by `manage.py runworkers`, so the request only pays for one INSERT. As
+the row is written in the request's transaction, a job exists exactly when
+the data it works on was committed.
+
+    @jobs.task(max_attempts=3)
+    def send_receipt(transaction_id): ...
+
+    jobs.enqueue(send_receipt, transaction_id=t.pk)
+    jobs.enqueue('send_receipt', priority=10, transaction_id=t.pk)
+
+Workers claim ready jobs, most urgent first, with SELECT ... FOR UPDATE
+SKIP LOCKED where the database has it (MySQL 8, PostgreSQL), so concurrent
+workers never wait on each other's rows. Elsewhere (SQLite, older MySQL and
+MariaDB) the ids are read first and claimed with an UPDATE that repeats the
+ready condition, so a row another worker took meanwhile is left alone. Each
+job's claim is renewed as it starts, so jobs waiting behind a slow one in
+the batch do not look abandoned to requeue_stale(). A failed job is retried
+with exponential backoff and, after max_attempts, left 'dead' (the
+dead-letter queue) with its error. Delivery is at least once: tasks must be
+safe to run twice.
+"""
+import logging
+import os
+import random
+import socket
+import time
+import traceback
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection, transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# task name -> (function, defaults for new jobs)
+TASKS = {}
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# ==========================================
+# Registering and queueing
+# ==========================================
+def task(func=None, *, name=None, queue='default', priority=0, max_attempts=5):
+    """Registers a function (called with the job's kwargs) as a background task."""
+    def register(func):
+        func.task_name = name or func.__name__
+        TASKS[func.task_name] = (func, {'queue': queue, 'priority': priority, 'max_attempts': max_attempts})
+        return func
+    return register(func) if func is not None else register
+
+
+def _job(task_ref, priority=None, delay=None, queue=None, **kwargs):
+    name = getattr(task_ref, 'task_name', task_ref)
+    if name not in TASKS:
+        raise KeyError(f"Unknown background task {name!r}")
+    defaults = TASKS[name][1]
+    return Job(
+        task=name,
+        kwargs=kwargs,
+        queue=queue or defaults['queue'],
+        priority=defaults['priority'] if priority is None else priority,
+        max_attempts=defaults['max_attempts'],
+        run_after=timezone.now() + timedelta(seconds=delay or 0),
+    )
+
+
+def enqueue(task_ref, priority=None, delay=None, queue=None, **kwargs):
+    """Queues one job; `delay` is in seconds. Returns the Job."""
+    job = _job(task_ref, priority, delay, queue, **kwargs)
+    job.save()
+    return job
+
+
+def enqueue_many(task_ref, kwargs_list, priority=None, delay=None, queue=None, batch_size=1000):
+    """Queues one job per kwargs dict with bulk_create()."""
+    jobs = [_job(task_ref, priority, delay, queue, **kwargs) for kwargs in kwargs_list]
+    return Job.objects.bulk_create(jobs, batch_size=batch_size)
+
+
+# ==========================================
+# Claiming
+# ==========================================
+def worker_name():
+    # Unique per process start, so a restarted worker never adopts old claims
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def claim_rows(ready, limit, **changes):
+    """
+    Applies `changes` (which must include a token unique to the caller, e.g.
+    locked_by=worker) to up to `limit` rows of the ordered queryset `ready`,
+    without two concurrent callers ever getting the same row. Returns the
+    pks claimed.
+    """
+    model = ready.model
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            # Rows locked by another worker's claim are skipped, not waited for
+            ids = list(ready.select_for_update(skip_locked=True).values_list('pk', flat=True)[:limit])
+            if ids:
+                model._default_manager.filter(pk__in=ids).update(**changes)
+        return ids
+
+    # No SKIP LOCKED (SQLite, MySQL < 8, MariaDB < 10.6, which also reject
+    # LIMIT in an IN subquery): read the ids, then claim only those still
+    # ready. A row another worker claimed in between fails the repeated
+    # condition and is left to it.
+    ids = list(ready.values_list('pk', flat=True)[:limit])
+    if not ids:
+        return []
+    ready.filter(pk__in=ids).update(**changes)
+    token = {name: value for name, value in changes.items() if not hasattr(value, 'resolve_expression')}
+    return list(model._default_manager.filter(pk__in=ids, **token).values_list('pk', flat=True))
+
+
+def claim(worker, queues=None, limit=1):
+    """Marks up to `limit` ready jobs as running for `worker` and returns them."""
+    now = timezone.now()
+    ready = Job.objects.filter(status='queued', run_after__lte=now)
+    if queues:
+        ready = ready.filter(queue__in=queues)
+    ready = ready.order_by('-priority', 'run_after', 'pk')
+    claim_rows(ready, limit, status='running', locked_by=worker, locked_at=now, attempts=F('attempts') + 1)
+    return list(Job.objects.filter(locked_by=worker, status='running').order_by('-priority', 'pk'))
+
+
+def backoff(attempts):
+    """Seconds before retry `attempts` + 1: doubles each time, with jitter, capped."""
+    base = _setting('JOB_RETRY_BASE_SECONDS', 10)
+    cap = _setting('JOB_RETRY_MAX_SECONDS', 3600)
+    return min(cap, base * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+
+
+# ==========================================
+# Running
+# ==========================================
+def run(job):
+    """
+    Runs one claimed job. On failure the job is rescheduled (or buried);
+    on success returns True and the caller marks it done with finish().
+    """
+    entry = TASKS.get(job.task)
+    try:
+        if entry is None:
+            raise LookupError(f"Unknown background task {job.task!r}")
+        entry[0](**job.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        logger.warning("Job %s (%s) failed, attempt %s of %s", job.pk, job.task, job.attempts, job.max_attempts)
+        if entry is None or job.attempts >= job.max_attempts:
+            Job.objects.filter(pk=job.pk).update(status='dead', last_error=error, finished_at=timezone.now())
+        else:
+            Job.objects.filter(pk=job.pk).update(
+                status='queued', last_error=error, locked_by='', locked_at=None,
+                run_after=timezone.now() + timedelta(seconds=backoff(job.attempts)),
+            )
+        return False
+    return True
+
+
+def start(worker, job, waiting=()):
+    """
+    Marks a claimed job as starting now, and renews the claim on the rest of
+    its batch (`waiting`: ids not started yet, or run but not yet finished).
+    requeue_stale() goes by locked_at, so a batch must not age from the
+    moment it was claimed. Returns False if the job is no longer ours
+    (requeued as stale while an earlier job of the batch ran).
+    """
+    ids = [job.pk, *waiting]
+    mine = Job.objects.filter(pk__in=ids, locked_by=worker, status='running')
+    if mine.update(locked_at=timezone.now()) == len(ids):
+        return True
+    return mine.filter(pk=job.pk).exists()
+
+
+def finish(job_ids):
+    # One UPDATE per batch. A worker killed before it lands leaves the jobs
+    # 'running', and requeue_stale() runs them again: tasks must be idempotent.
+    if job_ids:
+        Job.objects.filter(pk__in=job_ids).update(status='done', finished_at=timezone.now())
+
+
+def work(queues=None, batch_size=None, stop=None, burst=False, worker=None):
+    """
+    Worker loop: claim a batch, run it, repeat; sleeps JOB_POLL_INTERVAL when
+    idle. Returns when `stop` (an Event) is set, or in burst mode once no job
+    is ready. Returns the number of jobs run.
+    """
+    worker = worker or worker_name()
+    batch_size = batch_size or _setting('JOB_BATCH_SIZE', 10)
+    poll = _setting('JOB_POLL_INTERVAL', 1.0)
+    done = 0
+    while stop is None or not stop.is_set():
+        close_old_connections()
+        try:
+            batch = claim(worker, queues, batch_size)
+        except DatabaseError:
+            # e.g. SQLite 'database is locked' under heavy load: try again shortly
+            logger.exception("Claiming jobs failed")
+            batch = None
+        if not batch:
+            if burst and batch is not None:
+                break
+            time.sleep(poll)
+            continue
+        finished = []
+        for position, job in enumerate(batch):
+            if not start(worker, job, [j.pk for j in batch[position + 1:]] + finished):
+                continue
+            done += 1
+            if run(job):
+                finished.append(job.pk)
+        finish(finished)
+    return done
+
+
+# ==========================================
+# Maintenance
+# ==========================================
+def requeue_stale(timeout=None):
+    """
+    Jobs 'running' for longer than JOB_TIMEOUT seconds belonged to a worker
+    that died: queue them again (or bury them if out of attempts).
+    """
+    timeout = timeout or _setting('JOB_TIMEOUT', 600)
+    cutoff = timezone.now() - timedelta(seconds=timeout)
+    stale = Job.objects.filter(status='running', locked_at__lt=cutoff)
+    error = f"Worker stopped responding (running for more than {timeout}s)"
+    dead = stale.filter(attempts__gte=F('max_attempts')).update(
+        status='dead', last_error=error, finished_at=timezone.now(),
+    )
+    requeued = stale.update(status='queued', last_error=error, locked_by='', locked_at=None)
+    return requeued, dead
+
+
+def retry_dead(ids=None):
+    """Puts dead jobs back in the queue with fresh attempts."""
+    dead = Job.objects.filter(status='dead')
+    if ids is not None:
+        dead = dead.filter(pk__in=ids)
+    return dead.update(status='queued', attempts=0, run_after=timezone.now(), locked_by='', finished_at=None)
+
+
+def purge_done(days=None):
+    """Deletes finished jobs older than JOB_KEEP_DONE_DAYS (dead ones are kept)."""
+    days = days if days is not None else _setting('JOB_KEEP_DONE_DAYS', 7)
+    cutoff = timezone.now() - timedelta(days=days)
+    deleted, _ = Job.objects.filter(status='done', finished_at__lt=cutoff).delete()
+    return deleted
+
+
+def queue_stats():
+    """{(queue, status): count}"""
+    rows = Job.objects.values_list('queue', 'status').annotate(n=Count('pk')).order_by()
+    return {(queue, status): n for queue, status, n in rows}
@@ -0,0 +1,121 @@
+"""
+Shared helpers for the bench_* management commands.
+
+Benchmarks seed their own synthetic rows inside a transaction that is always
+rolled back, so they can be pointed at any database without leaving data behind.
+Benchmarks that need other connections to see the rows (threads, workers) seed
+with commits instead and call remove_seed() when done.
+"""
+import random
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from patients.models import PregnantWoman, Appointment, Delivery, Discharge, Transaction
+
+
+class Rollback(Exception):
+    """Raised at the end of a benchmark to undo the seeded rows."""
+
+
+def seed(patients=200, per_patient=2, rng=None):
+    """
+    Bulk-insert `patients` mothers, each with `per_patient` appointments and
+    transactions plus one delivery/discharge for roughly half of them.
+    """
+    rng = rng or random.Random(42)
+    today = date.today()
+
+    mothers = []
+    for i in range(patients):
+        lmp = today - timedelta(days=rng.randint(10, 300))
+        mothers.append(PregnantWoman(
+            full_name=f"Bench Mother {i:05d}",
+            phone=f"07{rng.randint(10000000, 99999999)}",
+            age=rng.randint(16, 45),
+            county=rng.choice(['Nairobi', 'Kiambu', 'Nakuru', 'Kisumu']),
+            ward=f"Ward {rng.randint(1, 12)}",
+            lmp=lmp,
+            expected_due_date=lmp + timedelta(days=280),
+            gravida=rng.randint(1, 5),
+            parity=rng.randint(0, 4),
+            risk_level=rng.choice(['Normal', 'High', 'Low']),
+        ))
+    mothers = PregnantWoman.objects.bulk_create(mothers)
+    if mothers and mothers[0].pk is None:
+        # Backends without RETURNING (MySQL) do not set primary keys on bulk_create
+        mothers = list(PregnantWoman.objects.filter(full_name__startswith="Bench Mother ").order_by('id'))
+
+    appointments, deliveries, discharges, payments = [], [], [], []
+    for mother in mothers:
+        for j in range(per_patient):
+            appointments.append(Appointment(
+                patient=mother,
+                date=today + timedelta(days=rng.randint(-60, 60)),
+                time='09:00',
+                purpose='ANC Visit',
+                doctor=rng.choice(['Dr. Otieno', 'Dr. Wanjiru', 'Dr. Mwangi']),
+                status=rng.choice(['Scheduled', 'Completed', 'Cancelled']),
+            ))
+            payments.append(Transaction(
+                patient=mother,
+                amount=Decimal(rng.choice([500, 1000, 2500])),
+                transaction_id=f"BENCH{mother.pk}X{j}",
+                status=rng.choice(['Success', 'Pending', 'Failed']),
+            ))
+        if rng.random() < 0.5:
+            delivered = today - timedelta(days=rng.randint(1, 90))
+            deliveries.append(Delivery(
+                patient=mother,
+                edd=mother.expected_due_date,
+                delivery_date=delivered,
+                delivery_type=rng.choice(['Normal Delivery', 'C-Section', 'Assisted Delivery']),
+                baby_gender=rng.choice(['Male', 'Female']),
+                baby_weight=Decimal(rng.randint(200, 450)) / 100,
+            ))
+            discharges.append(Discharge(
+                patient=mother,
+                admission_date=delivered,
+                discharge_date=delivered + timedelta(days=rng.randint(1, 5)),
+                condition=rng.choice(['Good', 'Fair', 'Critical']),
+                billing_status=rng.choice(['Cleared', 'Pending Clearance']),
+            ))
+
+    Appointment.objects.bulk_create(appointments)
+    Delivery.objects.bulk_create(deliveries)
+    Discharge.objects.bulk_create(discharges)
+    Transaction.objects.bulk_create(payments)
+    return mothers
+
+
+def remove_seed():
+    """Delete committed benchmark rows (related rows go with them via CASCADE)."""
+    PregnantWoman.objects.filter(full_name__startswith="Bench Mother ").delete()
+
+
+def timed(func, repeat=200):
+    """
+    Run `func` `repeat` times and return (microseconds per call, queries per call).
+    """
+    func()  # warm-up (imports, template compilation, first query)
+    with CaptureQueriesContext(connection) as ctx:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        elapsed = time.perf_counter() - start
+    return (elapsed / repeat) * 1_000_000, len(ctx.captured_queries) / repeat
+
+
+def run_rolled_back(func):
+    """Call `func` inside a transaction that is rolled back afterwards."""
+    result = None
+    try:
+        with transaction.atomic():
+            result = func()
+            raise Rollback
+    except Rollback:
+        pass
+    return result
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from patients.archive import archive_closed_episodes, closed_episodes, hot_table_sizes
+
+
+class Command(BaseCommand):
+    help = (
+        "Move closed pregnancies (delivered, discharged, billing cleared, last "
+        "discharge older than --days) out of the hot tables into the archive."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=180, help="Minimum days since the last discharge")
+        parser.add_argument('--batch-size', type=int, default=200, help="Mothers archived per transaction")
+        parser.add_argument('--dry-run', action='store_true', help="Only count what would be archived")
+
+    def handle(self, *args, **options):
+        before = hot_table_sizes()
+
+        if options['dry_run']:
+            count = closed_episodes(options['days']).count()
+            self.stdout.write(f"{count} closed episode(s) would be archived.")
+            self.report(before, before)
+            return
+
+        def progress(done, total):
+            self.stdout.write(f"  archived {done}/{total}")
+
+        archived = archive_closed_episodes(options['days'], options['batch_size'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(f"Archived {archived} closed episode(s)."))
+        self.report(before, hot_table_sizes())
+
+    def report(self, before, after):
+        self.stdout.write(f"{'table':<28}{'rows before':>12}{'rows after':>12}{'MB before':>11}{'MB after':>10}")
+        for table, (rows, size) in before.items():
+            rows_after, size_after = after[table]
+            mb = lambda b: f"{b / 1048576:.1f}" if b is not None else "-"
+            self.stdout.write(f"{table:<28}{rows:>12}{rows_after:>12}{mb(size):>11}{mb(size_after):>10}")
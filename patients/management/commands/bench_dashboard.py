@@ -0,0 +1,62 @@
+import asyncio
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client
+from django.urls import reverse
+
+from ._bench import seed, remove_seed
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare end-to-end latency of the sequential dashboard (WSGI handler) "
+        "with the async dashboard (ASGI handler) on seeded data."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=2000)
+        parser.add_argument('--repeat', type=int, default=30)
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help="Override DASHBOARD_QUERY_CONCURRENCY for this run")
+
+    def handle(self, *args, **options):
+        if options['concurrency']:
+            from django.conf import settings
+            settings.DASHBOARD_QUERY_CONCURRENCY = options['concurrency']
+
+        # Committed, so the async worker threads' own connections can see it
+        seed(patients=options['patients'], per_patient=3)
+        try:
+            sync_ms = self.measure_sync(options['repeat'])
+            async_ms = asyncio.run(self.measure_async(options['repeat']))
+        finally:
+            remove_seed()
+
+        self.stdout.write(f"{'view':<28}{'median ms':>12}{'p95 ms':>10}")
+        for label, samples in (("dashboard (WSGI, serial)", sync_ms), ("dashboard_async (ASGI)", async_ms)):
+            p95 = sorted(samples)[int(len(samples) * 0.95) - 1]
+            self.stdout.write(f"{label:<28}{statistics.median(samples):>12.2f}{p95:>10.2f}")
+
+    def measure_sync(self, repeat):
+        client = Client()
+        url = reverse('patients:dashboard')
+        client.get(url)  # warm-up
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            client.get(url)
+            samples.append((time.perf_counter() - start) * 1000)
+        return samples
+
+    async def measure_async(self, repeat):
+        client = AsyncClient()
+        url = reverse('patients:dashboard_async')
+        await client.get(url)  # warm-up
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await client.get(url)
+            samples.append((time.perf_counter() - start) * 1000)
+        return samples
@@ -0,0 +1,84 @@
+from datetime import date, timedelta
+
+from django import forms
+from django.core.management.base import BaseCommand
+
+from patients.forms import PregnantWomanForm, AppointmentForm, DeliveryForm, DischargeForm
+from patients.models import PregnantWoman
+
+from ._bench import seed, timed, run_rolled_back
+
+
+def legacy_form(form_class):
+    """
+    Rebuild `form_class` the old way: a plain ModelForm that walks every field
+    in __init__ and a patient dropdown that re-queries on every render.
+    """
+    meta_attrs = {k: v for k, v in vars(form_class.Meta).items() if not k.startswith('__')}
+    meta_attrs.pop('field_classes', None)
+
+    def __init__(self, *args, **kwargs):
+        forms.ModelForm.__init__(self, *args, **kwargs)
+        for field_name, field in self.fields.items():
+            widget = field.widget
+            current_classes = widget.attrs.get('class', '')
+            if isinstance(widget, forms.Select):
+                widget.attrs['class'] = (current_classes + ' form-select').strip()
+            else:
+                widget.attrs['class'] = (current_classes + ' form-control').strip()
+
+    return type('Legacy' + form_class.__name__, (forms.ModelForm,), {
+        'Meta': type('Meta', (), meta_attrs),
+        '__init__': __init__,
+    })
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark form construct / validate / render against the old per-instance forms."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=300, help="Seeded patients for the dropdowns")
+        parser.add_argument('--repeat', type=int, default=200)
+
+    def handle(self, *args, **options):
+        run_rolled_back(lambda: self.run(options))
+
+    def run(self, options):
+        seed(patients=options['patients'], per_patient=0)
+        patient = PregnantWoman.objects.first()
+        today = date.today()
+
+        samples = {
+            PregnantWomanForm: {
+                'full_name': 'Jane Doe', 'age': 28, 'phone': '0712345678',
+                'lmp': today - timedelta(days=100), 'risk_level': 'Normal',
+            },
+            AppointmentForm: {
+                'patient': patient.pk, 'date': today, 'time': '10:00',
+                'purpose': 'ANC Visit', 'status': 'Scheduled',
+            },
+            DeliveryForm: {
+                'patient': patient.pk, 'delivery_date': today, 'delivery_type': 'Normal Delivery',
+            },
+            DischargeForm: {
+                'patient': patient.pk, 'discharge_date': today, 'condition': 'Good',
+                'billing_status': 'Cleared',
+            },
+        }
+
+        self.stdout.write(f"{'form':<20}{'step':<10}{'legacy us':>12}{'q':>6}{'current us':>13}{'q':>6}{'saved':>8}")
+        for form_class, data in samples.items():
+            old_class = legacy_form(form_class)
+            steps = {
+                'construct': lambda cls: cls(),
+                'validate': lambda cls: cls(data).is_valid(),
+                'render': lambda cls: str(cls()),
+            }
+            for step, action in steps.items():
+                old_us, old_q = timed(lambda: action(old_class), options['repeat'])
+                new_us, new_q = timed(lambda: action(form_class), options['repeat'])
+                saved = (1 - new_us / old_us) * 100 if old_us else 0
+                self.stdout.write(
+                    f"{form_class.__name__:<20}{step:<10}{old_us:>12.1f}{old_q:>6.1f}"
+                    f"{new_us:>13.1f}{new_q:>6.1f}{saved:>7.0f}%"
+                )
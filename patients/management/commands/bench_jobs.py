@@ -0,0 +1,80 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from patients import jobs
+from patients.models import Job
+from patients.tasks import noop
+
+from .runworkers import worker_main
+
+
+class Command(BaseCommand):
+    help = (
+        "Throughput of the background job queue: enqueueing (one INSERT per job "
+        "and bulk), then draining no-op jobs with one in-process worker at "
+        "several batch sizes and with a pool of worker processes. Uses the "
+        "'bench' queue and deletes its jobs afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--jobs', type=int, default=2000)
+        parser.add_argument('--workers', type=int, default=4, help="Processes for the pool run")
+
+    def handle(self, *args, **options):
+        n = options['jobs']
+        self.clear()
+        try:
+            self.stdout.write(f"{'step':<40}{'jobs/s':>10}")
+
+            start = time.perf_counter()
+            for i in range(n):
+                jobs.enqueue(noop, i=i)   # autocommit: one transaction per job, like a request
+            self.report("enqueue, one per transaction", n, start)
+            self.drain_inline(1)
+
+            start = time.perf_counter()
+            with transaction.atomic():
+                jobs.enqueue_many(noop, [{'i': i} for i in range(n)])
+            self.report("enqueue_many (bulk)", n, start)
+
+            for batch_size in (1, 10, 50):
+                if batch_size != 1:
+                    jobs.enqueue_many(noop, [{'i': i} for i in range(n)])
+                self.drain_inline(batch_size)
+
+            jobs.enqueue_many(noop, [{'i': i} for i in range(n)])
+            self.drain_pool(options['workers'], n)
+        finally:
+            self.clear()
+
+    def report(self, label, n, start):
+        self.stdout.write(f"{label:<40}{n / (time.perf_counter() - start):>10.0f}")
+
+    def drain_inline(self, batch_size):
+        n = Job.objects.filter(queue='bench', status='queued').count()
+        start = time.perf_counter()
+        jobs.work(queues=['bench'], batch_size=batch_size, burst=True)
+        self.report(f"dequeue + run, 1 worker, batch {batch_size}", n, start)
+
+    def drain_pool(self, workers, n):
+        context = multiprocessing.get_context('spawn')
+        stop = context.Event()
+        processes = [
+            context.Process(target=worker_main, args=(['bench'], 10, True, stop)) for _ in range(workers)
+        ]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        # includes process start-up and django.setup() in each worker
+        self.report(f"dequeue + run, {workers} processes, batch 10", n, start)
+        left = Job.objects.filter(queue='bench').exclude(status='done').count()
+        if left:
+            self.stdout.write(self.style.WARNING(f"{left} bench job(s) not done"))
+
+    def clear(self):
+        Job.objects.filter(queue='bench')._raw_delete(Job.objects.db)
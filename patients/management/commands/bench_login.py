@@ -0,0 +1,196 @@
+import http.cookiejar
+import random
+import re
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.core.servers.basehttp import WSGIRequestHandler, WSGIServer
+from django.test.utils import override_settings
+from django.urls import reverse
+
+USERNAME = 'bench-login'
+PASSWORD = 'bench-login-correct-horse'
+CSRF_INPUT = re.compile(rb'name="csrfmiddlewaretoken" value="([^"]+)"')
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    """Serves requests on a fixed number of threads, like a deployment's worker count."""
+
+    def __init__(self, *args, workers=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = ThreadPoolExecutor(workers)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Browser:
+    """A cookie jar and the login form's CSRF token, coming from one client address."""
+
+    def __init__(self, url, ip):
+        self.url, self.ip = url, ip
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies), NoRedirect)
+        self.token = CSRF_INPUT.search(self.open(self.url).read()).group(1).decode()
+
+    def open(self, url, data=None):
+        request = urllib.request.Request(url, data, {'X-Forwarded-For': self.ip})
+        return self.opener.open(request, timeout=60)
+
+    def login(self, username, password):
+        """(status, seconds)"""
+        data = urllib.parse.urlencode({
+            'csrfmiddlewaretoken': self.token, 'username': username, 'password': password,
+        }).encode()
+        start = time.perf_counter()
+        try:
+            with self.open(self.url, data) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        return status, time.perf_counter() - start
+
+    def session_key(self):
+        return next((c.value for c in self.cookies if c.name == settings.SESSION_COOKIE_NAME), None)
+
+
+class Command(BaseCommand):
+    help = (
+        "Login latency of a legitimate user while attackers flood the login page "
+        "with wrong passwords (--rate a second, from --attacker-ips addresses), "
+        "with throttling off and on. "
+        "Runs a local server with a fixed number of worker threads; the legitimate "
+        "user logs in every --interval seconds from an address of their own. "
+        "Uses the configured LOGIN_THROTTLE limits; removes its user and sessions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=20, help="Length of each phase")
+        parser.add_argument('--warmup', type=float, default=10,
+                            help="Seconds the flood runs before logins are timed (attackers use up their allowance)")
+        parser.add_argument('--attackers', type=int, default=16, help="Attacking clients")
+        parser.add_argument('--rate', type=float, default=100,
+                            help="Attempts/second the attackers send between them (0: back to back)")
+        parser.add_argument('--attacker-ips', type=int, default=2, help="Addresses the attackers share")
+        parser.add_argument('--workers', type=int, default=4, help="Server threads")
+        parser.add_argument('--interval', type=float, default=0.5, help="Seconds between legitimate logins")
+        parser.add_argument('--port', type=int, default=8028)
+
+    def handle(self, *args, **options):
+        User.objects.filter(username=USERNAME).delete()
+        User.objects.create_user(USERNAME, password=PASSWORD)
+        self.sessions = []
+        url = f"http://127.0.0.1:{options['port']}{reverse('patients:login')}"
+        overrides = {'ALLOWED_HOSTS': ['127.0.0.1'], 'LOGIN_THROTTLE_IP_HEADER': 'HTTP_X_FORWARDED_FOR'}
+
+        server = PooledWSGIServer(('127.0.0.1', options['port']), QuietHandler, workers=options['workers'])
+        server.set_app(WSGIHandler())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.stdout.write(
+            f"{'phase':<28}{'logins':>7}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}"
+            f"{'attempts':>10}{'hashed':>8}{'429s':>7}"
+        )
+        try:
+            # Each phase uses fresh addresses, so counts left by the previous one don't matter
+            with override_settings(**overrides):
+                self.phase("no attack", url, 1, 0, options)
+            with override_settings(LOGIN_THROTTLE_ENABLED=False, **overrides):
+                self.phase("flood, throttling off", url, 2, options['attackers'], options)
+            with override_settings(LOGIN_THROTTLE_ENABLED=True, **overrides):
+                self.phase("flood, throttling on", url, 3, options['attackers'], options)
+        finally:
+            server.shutdown()
+            server.server_close()
+            self.clear()
+
+    def phase(self, label, url, number, attackers, options):
+        """Attackers flood from the start; the legitimate user's logins are timed after --warmup."""
+        stop = threading.Event()
+        outcomes = Counter()
+        legit, statuses = [], Counter()
+        ips = [f"198.51.100.{number * 50 + i}" for i in range(options['attacker_ips'])]
+
+        def attack(k):
+            rng = random.Random(k)
+            browser = Browser(url, ips[k % len(ips)])
+            every = attackers / options['rate'] if options['rate'] else 0
+            due = time.perf_counter() + rng.uniform(0, every)
+            while not stop.is_set():
+                # On schedule, or as fast as answers come once the server falls behind
+                if stop.wait(max(due - time.perf_counter(), 0)):
+                    break
+                due += every
+                # Stuffing: the real username among leaked ones, never the right password
+                username = USERNAME if rng.random() < 0.2 else f"leaked{rng.randrange(100_000)}"
+                status, _ = browser.login(username, f"guess{rng.randrange(10**9)}")
+                outcomes[status] += 1
+
+        threads = [threading.Thread(target=attack, args=(k,)) for k in range(attackers)]
+        for thread in threads:
+            thread.start()
+        if attackers:
+            time.sleep(options['warmup'])
+        deadline = time.perf_counter() + options['seconds']
+        try:
+            while time.perf_counter() < deadline:
+                # A fresh browser each time: a logged-in one would just be redirected
+                browser = Browser(url, f"192.0.2.{number}")
+                status, elapsed = browser.login(USERNAME, PASSWORD)
+                statuses[status] += 1
+                legit.append(elapsed)
+                self.sessions.append(browser.session_key())
+                time.sleep(options['interval'])
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        legit.sort()
+        p95 = legit[int((len(legit) - 1) * 0.95)]
+        attempts = sum(outcomes.values())
+        self.stdout.write(
+            f"{label:<28}{len(legit):>7}{statistics.median(legit) * 1000:>9.0f}{p95 * 1000:>9.0f}"
+            f"{legit[-1] * 1000:>9.0f}{attempts:>10}{attempts - outcomes[429]:>8}{outcomes[429]:>7}"
+        )
+        if set(statuses) != {302}:
+            self.stdout.write(self.style.WARNING(f"  legitimate logins answered {dict(statuses)} (302 = logged in)"))
+
+    def clear(self):
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        for key in filter(None, self.sessions):
+            store(key).delete()
+        User.objects.filter(username=USERNAME).delete()
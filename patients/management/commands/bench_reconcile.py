@@ -0,0 +1,113 @@
+import csv
+import os
+import random
+import tempfile
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from patients import reconcile
+from patients.models import Transaction
+from patients.payments import MPESA_TIMEZONE
+
+from ._bench import remove_seed, seed
+
+HEADER = ['Receipt No.', 'Completion Time', 'Initiation Time', 'Details', 'Transaction Status',
+          'Paid In', 'Withdrawn', 'Balance', 'Balance Confirmed', 'Reason Type', 'Other Party Info',
+          'Linked Transaction ID', 'A/C No.']
+
+
+class Command(BaseCommand):
+    help = (
+        "Time reconcile.reconcile() on a synthetic month: --lines statement lines "
+        "against as many recorded payments, with lost callbacks, failed-but-paid "
+        "payments, amount differences, unknown receipts, duplicate lines and "
+        "charges mixed in. Seeds committed rows and removes them afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int, default=300_000)
+        parser.add_argument('--mothers', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        rng = random.Random(11)
+        path = None
+        try:
+            start = time.perf_counter()
+            path, expected = self.seed(options['lines'], options['mothers'], rng)
+            self.stdout.write(f"Seeded {options['lines']} payments and statement in {time.perf_counter() - start:.1f}s")
+
+            start = time.perf_counter()
+            with open(path, 'rb') as handle:
+                counts, issues = reconcile.reconcile(reconcile.read_rows(handle, path))
+            elapsed = time.perf_counter() - start
+
+            for outcome, n in sorted(counts.items()):
+                self.stdout.write(f"  {outcome:<24}{n:>10}{expected.get(outcome, ''):>10}")
+            self.stdout.write(self.style.SUCCESS(
+                f"Reconciled {counts['lines']} lines in {elapsed:.1f}s ({counts['lines'] / elapsed:,.0f} lines/s)"
+            ))
+        finally:
+            if path:
+                os.unlink(path)
+            remove_seed()
+
+    def seed(self, n, mother_count, rng):
+        """Payments spread over the last 30 days and their statement. Returns (path, expected counts)."""
+        mothers = seed(patients=mother_count, per_patient=0, rng=rng)
+        now = timezone.now()
+        payments, rows, expected = [], [], {}
+
+        def line(receipt, at, amount, mother, status='Completed'):
+            local = at.astimezone(MPESA_TIMEZONE).strftime('%Y-%m-%d %H:%M:%S')
+            masked = f"{mother.phone[:4]}****{mother.phone[-3:]} - {mother.full_name.upper()}"
+            return [receipt, local, local, f"Pay Bill from {masked}", status, f"{amount:,.2f}", '', '', 'true',
+                    'Pay Bill Online', masked, '', str(mother.pk)]
+
+        for i in range(n):
+            mother = rng.choice(mothers)
+            at = now - timedelta(days=30) + timedelta(seconds=rng.uniform(0, 30 * 86400 - 600))
+            amount = Decimal(rng.choice([500, 1000, 1500, 2500, 3000]))
+            receipt = f"BR{i:08d}"
+            kind = rng.choices(
+                ['matched', 'matched_by_time', 'confirmed', 'amount_mismatch', 'not_in_system', 'missing_from_statement'],
+                [94, 3, 0.5, 0.5, 1, 1],
+            )[0]
+            expected[kind] = expected.get(kind, 0) + 1
+            paid_at = at + timedelta(seconds=rng.uniform(5, 120))
+            if kind != 'not_in_system':
+                payments.append(Transaction(
+                    patient=mother, amount=amount, created_at=at,
+                    transaction_id=None if kind == 'matched_by_time' else receipt,
+                    status={'matched_by_time': 'Pending', 'confirmed': 'Failed'}.get(kind, 'Success'),
+                ))
+            if kind != 'missing_from_statement':
+                paid = amount + 100 if kind == 'amount_mismatch' else amount
+                rows.append(line(receipt, paid_at, paid, mother))
+            if rng.random() < 0.001 and kind != 'missing_from_statement':
+                rows.append(rows[-1])
+                expected['duplicate_line'] = expected.get('duplicate_line', 0) + 1
+            if rng.random() < 0.05:
+                rows.append(line(f"BC{i:08d}", paid_at, Decimal('-33'), mother))  # a charge: ignored
+
+        # Backdate created_at (auto_now_add would stamp every payment with now)
+        field = Transaction._meta.get_field('created_at')
+        field.auto_now_add = False
+        try:
+            Transaction.objects.bulk_create(payments, batch_size=2000)
+        finally:
+            field.auto_now_add = True
+
+        rows.sort(key=lambda row: row[1])
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w', newline='') as out:
+            writer = csv.writer(out)
+            # Exports start with a few lines of account details
+            writer.writerow(['Account Holder', 'Genesis Maternal Health'])
+            writer.writerow([])
+            writer.writerow(HEADER)
+            writer.writerows(rows)
+        return path, expected
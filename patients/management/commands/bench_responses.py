@@ -0,0 +1,75 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils.text import compress_string
+
+from patients.storage import minify_html
+
+from ._bench import seed, run_rolled_back
+
+VIEWS = [
+    'patients:dashboard',
+    'patients:patient_list',
+    'patients:appointment_list',
+    'patients:delivery_list',
+    'patients:discharge_list',
+    'patients:billing_page',
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Bytes on the wire and CPU cost of HTML minification + gzip for the "
+        "main pages, on seeded data (rolled back afterwards)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=500)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        rows = run_rolled_back(lambda: self.measure(options['patients'], options['repeat']))
+
+        self.stdout.write(
+            f"{'view':<26}{'raw KB':>9}{'min KB':>9}{'gzip KB':>9}{'min+gz KB':>11}"
+            f"{'minify us':>11}{'gzip us':>10}"
+        )
+        for name, raw, minified, gzipped, both, minify_us, gzip_us in rows:
+            self.stdout.write(
+                f"{name:<26}{raw / 1024:>9.1f}{minified / 1024:>9.1f}{gzipped / 1024:>9.1f}"
+                f"{both / 1024:>11.1f}{minify_us:>11.0f}{gzip_us:>10.0f}"
+            )
+
+    def measure(self, patients, repeat):
+        seed(patients=patients, per_patient=2)
+        user = User.objects.create_user('bench-responses', password='unused')
+        client = Client()
+        client.force_login(user)
+
+        rows = []
+        for view_name in VIEWS:
+            # The page exactly as the view renders it
+            with override_settings(HTML_MINIFY=False):
+                html = client.get(reverse(view_name)).content
+
+            minified = minify_html(html.decode('utf-8')).encode('utf-8')
+            rows.append((
+                view_name.split(':')[1],
+                len(html),
+                len(minified),
+                len(compress_string(html)),
+                len(compress_string(minified)),
+                self.per_call(lambda: minify_html(html.decode('utf-8')), repeat),
+                self.per_call(lambda: compress_string(minified), repeat),
+            ))
+        return rows
+
+    def per_call(self, func, repeat):
+        func()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat * 1_000_000
@@ -0,0 +1,59 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from ._bench import run_rolled_back
+
+DB_BACKEND = 'django.contrib.auth.backends.ModelBackend'
+CACHED_BACKEND = 'patients.backends.CachedModelBackend'
+
+CONFIGS = [
+    ("db sessions, ModelBackend", 'django.contrib.sessions.backends.db', DB_BACKEND),
+    ("cached_db, ModelBackend", 'django.contrib.sessions.backends.cached_db', DB_BACKEND),
+    ("cached_db, CachedModelBackend", 'django.contrib.sessions.backends.cached_db', CACHED_BACKEND),
+    ("signed_cookies, CachedModelBackend", 'django.contrib.sessions.backends.signed_cookies', CACHED_BACKEND),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Queries per request spent on sessions and request.user for a "
+        "logged-in clinician, for each session backend / auth backend pair."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--url', default=None, help="Page to request (default: the audit log page)")
+
+    def handle(self, *args, **options):
+        url = options['url'] or reverse('patients:audit_log')
+        rows = run_rolled_back(lambda: [self.measure(config, url, options['repeat']) for config in CONFIGS])
+
+        self.stdout.write(f"{'configuration':<38}{'queries':>9}{'session':>9}{'auth_user':>11}")
+        for label, total, session, user in rows:
+            self.stdout.write(f"{label:<38}{total:>9.1f}{session:>9.1f}{user:>11.1f}")
+
+    def measure(self, config, url, repeat):
+        label, engine, backend = config
+        with override_settings(SESSION_ENGINE=engine, AUTHENTICATION_BACKENDS=[backend]):
+            cache.clear()
+            user, _ = User.objects.get_or_create(username='bench-sessions')
+            client = Client()
+            client.force_login(user)
+            client.get(url)  # warm-up: fills the caches
+
+            with CaptureQueriesContext(connection) as ctx:
+                for _ in range(repeat):
+                    client.get(url)
+            sql = [q['sql'] for q in ctx.captured_queries]
+
+        return (
+            label,
+            len(sql) / repeat,
+            sum('django_session' in s for s in sql) / repeat,
+            sum('FROM "auth_user"' in s or 'FROM `auth_user`' in s for s in sql) / repeat,
+        )
@@ -0,0 +1,74 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from patients import sms
+from patients.models import SmsMessage
+
+
+class Command(BaseCommand):
+    help = (
+        "Throughput of the SMS dispatcher against a local stand-in gateway: "
+        "one SMS per request versus coalesced, batched sending over one "
+        "kept-alive connection. The dispatcher's own limit (--send-rate) is set "
+        "above the gateway's (--gateway-rate) so its 429 answers are exercised. "
+        "Its messages are deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--recipients', type=int, default=500)
+        parser.add_argument('--gateway-rate', type=float, default=2000, help="Messages/s the stand-in accepts")
+        parser.add_argument('--send-rate', type=float, default=4000, help="Messages/s the dispatcher allows itself")
+        parser.add_argument('--latency', type=float, default=0.005, help="Seconds the stand-in adds per request")
+        parser.add_argument('--port', type=int, default=8026)
+
+    def handle(self, *args, **options):
+        if SmsMessage.objects.filter(status__in=('queued', 'sending')).exists():
+            raise CommandError("Real messages are waiting to be sent; run the benchmark once they are out.")
+
+        self.stdout.write(f"{'mode':<36}{'msg/s':>8}{'SMS':>7}{'requests':>10}{'429s':>6}{'conns':>7}")
+        try:
+            with override_settings(SMS_MAX_CHARS=1, SMS_BATCH_SIZE=1):
+                self.run("one SMS per request", options)
+            self.run("coalesced, batches of SMS_BATCH_SIZE", options)
+        finally:
+            SmsMessage.objects.filter(reference__startswith='bench:').delete()
+
+    def seed(self, n, recipients):
+        SmsMessage.objects.bulk_create([
+            SmsMessage(
+                recipient=f"25470{i * recipients // n:07d}", template='appointment_reminder', reference=f"bench:{i}",
+                body=f"Benchmark message {i}: a reminder of your ANC contact tomorrow at 09:00.",
+            )
+            for i in range(n)
+        ], batch_size=1000)
+
+    def run(self, label, options):
+        self.seed(options['messages'], options['recipients'])
+        server = sms.StandInGateway(
+            # The burst must hold a whole batch, or the gateway could never accept one
+            ('127.0.0.1', options['port']), rate=options['gateway_rate'],
+            burst=max(options['gateway_rate'] / 10, 2 * settings.SMS_BATCH_SIZE),
+            latency=options['latency'],
+        )
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            gateway = sms.HttpGateway(f"http://127.0.0.1:{options['port']}/")
+            bucket = sms.TokenBucket(options['send_rate'], options['send_rate'] / 10)
+            start = time.perf_counter()
+            stats = sms.dispatch(gateway, bucket)
+            elapsed = time.perf_counter() - start
+        finally:
+            server.shutdown()
+            server.server_close()
+        requests = server.requests['ok'] + server.requests['throttled']
+        self.stdout.write(
+            f"{label:<36}{stats['messages'] / elapsed:>8.0f}{stats['sms']:>7}{requests:>10}"
+            f"{server.requests['throttled']:>6}{server.connections:>7}"
+        )
+        SmsMessage.objects.filter(reference__startswith='bench:').delete()
@@ -0,0 +1,79 @@
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.urls import reverse
+
+from patients.models import Appointment, Delivery, Discharge, PregnantWoman
+
+from ._bench import run_rolled_back, seed
+
+VIEWS = [
+    'patients:patient_list',
+    'patients:appointment_list',
+    'patients:delivery_list',
+    'patients:discharge_list',
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Time to first byte, total time and peak Python memory of the four list "
+        "pages, rendered whole and streamed (?stream=1), at growing numbers of "
+        "seeded rows (rolled back afterwards)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000', help="Patients to seed, comma-separated")
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{'view':<18}{'patients':>9}{'rows':>8}{'mode':>8}{'TTFB ms':>9}{'total ms':>10}{'peak MB':>9}{'KB':>9}"
+        )
+        for size in [int(s) for s in options['sizes'].split(',')]:
+            for row in run_rolled_back(lambda: self.measure(size)):
+                view, rows, mode, ttfb, total, peak, length = row
+                self.stdout.write(
+                    f"{view:<18}{size:>9}{rows:>8}{mode:>8}{ttfb * 1000:>9.0f}{total * 1000:>10.0f}"
+                    f"{peak / 2**20:>9.1f}{length / 1024:>9.0f}"
+                )
+
+    def measure(self, patients):
+        seed(patients=patients, per_patient=2)
+        client = Client()
+        client.force_login(User.objects.create_user('bench-streaming', password='unused'))
+        counts = {
+            'patient_list': PregnantWoman.objects.count(),
+            'appointment_list': Appointment.objects.count(),
+            'delivery_list': Delivery.objects.count(),
+            'discharge_list': Discharge.objects.count(),
+        }
+
+        rows = []
+        for view_name in VIEWS:
+            name, url = view_name.split(':')[1], reverse(view_name)
+            client.get(url)  # warm-up
+            for mode, query in (('whole', ''), ('stream', '?stream=1')):
+                rows.append((name, counts[name], mode, *self.fetch(client, url + query)))
+        return rows
+
+    def fetch(self, client, url):
+        """(seconds to first byte, seconds in all, peak bytes allocated, bytes sent)"""
+        tracemalloc.start()
+        start = time.perf_counter()
+        response = client.get(url)
+        if response.streaming:
+            chunks = iter(response.streaming_content)
+            length = len(next(chunks))
+            ttfb = time.perf_counter() - start
+            # Read and dropped, as a WSGI server writes each chunk to the socket
+            length += sum(len(chunk) for chunk in chunks)
+        else:
+            ttfb = time.perf_counter() - start
+            length = len(response.content)
+        total = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return ttfb, total, peak, length
@@ -0,0 +1,153 @@
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.template import engines
+from django.template.backends.django import DjangoTemplates
+from django.test import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from patients import reports, templating, views
+from patients.forms import ThrottledAuthenticationForm
+from patients.models import Appointment, Delivery, Discharge, DischargeDocument, Reconciliation, ReportRun
+
+from ._bench import run_rolled_back, seed
+
+
+class Command(BaseCommand):
+    help = (
+        "Compile and render time of every page template, rendered with the "
+        "context its view builds from seeded data (rolled back afterwards): "
+        "compiling, rendering from the cached loader (production profile) and "
+        "loading + rendering on every request (development profile)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=200)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        rows = run_rolled_back(lambda: self.measure(options['patients'], options['repeat']))
+
+        self.stdout.write(
+            f"{'template':<36}{'compile ms':>11}{'cached us':>11}{'uncached us':>13}{'queries':>9}{'KB':>7}"
+        )
+        for name, compile_ms, cached_us, uncached_us, queries, size in rows:
+            self.stdout.write(
+                f"{name:<36}{compile_ms:>11.2f}{cached_us:>11.0f}{uncached_us:>13.0f}{queries:>9.1f}{size / 1024:>7.1f}"
+            )
+        cached, uncached = sum(row[2] for row in rows), sum(row[3] for row in rows)
+        self.stdout.write(self.style.SUCCESS(
+            f"All pages once: {cached / 1000:.1f} ms cached, {uncached / 1000:.1f} ms uncached "
+            f"({uncached / cached:.1f}x)"
+        ))
+
+    def measure(self, patients, repeat):
+        contexts = self.contexts(patients)
+        # base.html and the row partials are rendered as part of the pages
+        missing = {
+            name for name in templating.template_names()
+            if name.startswith('patients/') and '/rows/' not in name and name not in contexts
+        }
+        if missing:
+            self.stdout.write(self.style.WARNING(f"No seeded context for: {', '.join(sorted(missing))}"))
+
+        cached = engines['django']
+        uncached = DjangoTemplates({
+            'NAME': 'bench-uncached', 'DIRS': [], 'APP_DIRS': False,
+            'OPTIONS': {**settings.TEMPLATES[0]['OPTIONS'], 'loaders': settings.TEMPLATE_LOADERS},
+        })
+        templating.warm()
+
+        rows = []
+        for name, (context, request) in sorted(contexts.items()):
+            html = cached.get_template(name).render(context, request)
+            with CaptureQueriesContext(connection) as queries:
+                cached_us = self.per_call(lambda: cached.get_template(name).render(context, request), repeat)
+            rows.append((
+                name,
+                self.per_call(lambda: uncached.engine.find_template(name)[0], repeat) / 1000,
+                cached_us,
+                self.per_call(lambda: uncached.get_template(name).render(context, request), repeat),
+                len(queries.captured_queries) / (repeat + 1),
+                len(html.encode()),
+            ))
+        return rows
+
+    def contexts(self, patients):
+        """{template: (context, request)} as the views render them, on seeded rows."""
+        seed(patients=patients, per_patient=2)
+        discharge = Discharge.objects.select_related('patient').order_by('pk').first()
+        patient = discharge.patient
+        appointment = Appointment.objects.order_by('pk').first()
+        delivery = Delivery.objects.order_by('pk').first()
+        reconciliation = Reconciliation.objects.create(
+            statement='statements/bench.csv', status='done',
+            counts={'lines': 1200, 'matched': 1150, 'matched_by_time': 30, 'not_in_system': 20},
+        )
+        run = ReportRun.objects.create(
+            report='delivery_mix', params=reports.clean_params({'by': ['county']}), cache_key='bench', data_version=0,
+        )
+        reports.execute(run.pk)
+
+        pages = [
+            ('patients:dashboard', []),
+            ('patients:patient_list', []),
+            ('patients:add_patient', []),
+            ('patients:edit_patient', [patient.pk]),
+            ('patients:delete_patient', [patient.pk]),
+            ('patients:patient_timeline', [patient.pk]),
+            ('patients:patient_duplicates', []),
+            ('patients:appointment_list', []),
+            ('patients:add_appointment', []),
+            ('patients:edit_appointment', [appointment.pk]),
+            ('patients:delete_appointment', [appointment.pk]),
+            ('patients:add_delivery', []),
+            ('patients:add_delivery_batch', []),
+            ('patients:delivery_list', []),
+            ('patients:edit_delivery', [delivery.pk]),
+            ('patients:delete_delivery', [delivery.pk]),
+            ('patients:add_discharge', []),
+            ('patients:discharge_list', []),
+            ('patients:edit_discharge', [discharge.pk]),
+            ('patients:delete_discharge', [discharge.pk]),
+            ('patients:billing_page', []),
+            ('patients:reconciliations', []),
+            ('patients:reconciliation', [reconciliation.pk]),
+            ('patients:audit_log', []),
+            ('patients:analytics', []),
+            ('patients:report_list', []),
+            ('patients:report_run', [run.pk]),
+        ]
+        captured = {}
+        render = views.render
+
+        def capture(request, template_name, context=None, *args, **kwargs):
+            captured[template_name] = (context or {}, request)
+            return render(request, template_name, context, *args, **kwargs)
+
+        client = Client()
+        client.force_login(User.objects.create_user('bench-templates', password='unused'))
+        with mock.patch.object(views, 'render', capture):
+            for url_name, args in pages:
+                client.get(reverse(url_name, args=args))
+            client.get(f"{reverse('patients:summary_batch')}?date={discharge.discharge_date.isoformat()}")
+
+        # Not rendered by a plain GET: the login page (a class-based view) and
+        # the summary waiting page (its GET queues a PDF)
+        request = RequestFactory().get('/')
+        captured['patients/login.html'] = ({'form': ThrottledAuthenticationForm(request)}, request)
+        document = DischargeDocument.objects.create(discharge=discharge, content_hash='bench-templates')
+        captured['patients/discharge_summary.html'] = ({'discharge': discharge, 'document': document}, request)
+        return captured
+
+    def per_call(self, func, repeat):
+        func()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat * 1_000_000
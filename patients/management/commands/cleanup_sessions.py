@@ -0,0 +1,30 @@
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete expired rows from the django_session table in small batches "
+        "(unlike clearsessions, which removes them all in one long DELETE). "
+        "Run it daily from cron; with cached_db sessions the table only holds "
+        "fallback copies, with signed_cookies it stays empty."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Sessions deleted per statement")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        expired = Session.objects.filter(expire_date__lt=now)
+        deleted = 0
+        while True:
+            keys = list(expired.values_list('session_key', flat=True)[:options['batch_size']])
+            if not keys:
+                break
+            deleted += Session.objects.filter(session_key__in=keys).delete()[0]
+
+        remaining = Session.objects.count()
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {deleted} expired session(s); {remaining} active session(s) left in the database."
+        ))
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from patients.dedupe import find_duplicates
+
+
+class Command(BaseCommand):
+    help = (
+        "Scan all mothers for likely duplicate registrations (same phone, or a "
+        "similar name and age) and queue them for review on the Duplicates page. "
+        "Pairs already queued or dismissed are not queued again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-score', type=float, default=None, help="Queue pairs scoring at least this (0-1)")
+        parser.add_argument('--max-block', type=int, default=None, help="Skip blocking keys shared by more mothers than this")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        compared, queued = find_duplicates(options['min_score'], options['max_block'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Compared {compared} pair(s); queued {queued} possible duplicate(s) "
+            f"in {time.perf_counter() - start:.2f}s."
+        ))
@@ -0,0 +1,82 @@
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from patients.forms import DeliveryFormSet
+from patients.models import Delivery
+
+
+class Command(BaseCommand):
+    help = (
+        "Import deliveries from a CSV file. Columns match the delivery form "
+        "(patient = mother's ID, delivery_date, delivery_type, ...); emergency_name, "
+        "emergency_relationship and emergency_phone are combined like on the add form. "
+        "Rows are validated in chunks and inserted with bulk_create in one transaction."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file')
+        parser.add_argument('--chunk-size', type=int, default=500, help="Rows validated per formset")
+        parser.add_argument('--dry-run', action='store_true', help="Validate only, insert nothing")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        deliveries = []
+        failed = 0
+
+        try:
+            with open(options['csv_file'], newline='', encoding='utf-8-sig') as handle:
+                chunk = []
+                # Line 1 is the header, so data starts on line 2
+                for line_no, row in enumerate(csv.DictReader(handle), start=2):
+                    chunk.append((line_no, row))
+                    if len(chunk) >= chunk_size:
+                        failed += self.validate_chunk(chunk, deliveries)
+                        chunk = []
+                if chunk:
+                    failed += self.validate_chunk(chunk, deliveries)
+        except OSError as e:
+            raise CommandError(f"Cannot read {options['csv_file']}: {e}")
+
+        if failed:
+            raise CommandError(f"{failed} invalid row(s); nothing was imported.")
+
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f"{len(deliveries)} deliveries are valid (dry run)."))
+            return
+
+        Delivery.objects.bulk_register(deliveries)
+        self.stdout.write(self.style.SUCCESS(f"Imported {len(deliveries)} deliveries."))
+
+    def validate_chunk(self, chunk, deliveries):
+        """
+        Runs one chunk of CSV rows through DeliveryFormSet (same validation as
+        the batch entry page). Returns the number of invalid rows.
+        """
+        data = {
+            'form-TOTAL_FORMS': str(len(chunk)),
+            'form-INITIAL_FORMS': '0',
+        }
+        for i, (line_no, row) in enumerate(chunk):
+            row = {key.strip(): (value or '').strip() for key, value in row.items() if key}
+            if row.get('emergency_name') and not row.get('emergency_contact'):
+                row['emergency_contact'] = Delivery.format_emergency_contact(
+                    row['emergency_name'],
+                    row.get('emergency_relationship', ''),
+                    row.get('emergency_phone', ''),
+                )
+            for key, value in row.items():
+                data[f'form-{i}-{key}'] = value
+
+        formset = DeliveryFormSet(data)
+        if formset.is_valid():
+            deliveries.extend(formset.new_deliveries())
+            return 0
+
+        failed = 0
+        for (line_no, row), errors in zip(chunk, formset.errors):
+            if errors:
+                failed += 1
+                details = '; '.join(f"{field}: {' '.join(msgs)}" for field, msgs in errors.items())
+                self.stderr.write(f"Line {line_no}: {details}")
+        return failed
@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from patients import reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        "Reconcile an M-Pesa statement export (CSV, or XLSX / XLS with openpyxl / "
+        "xlrd installed) against the recorded payments: confirms payments whose "
+        "callback was lost and writes the lines needing a person (amount "
+        "differences, money with no payment record, ...) to an exceptions report."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('statement')
+        parser.add_argument('--report', help="Write the exceptions report (CSV) here")
+        parser.add_argument('--window', type=int, default=None, help="Minutes for matching by amount and time")
+        parser.add_argument('--dry-run', action='store_true', help="Report only, change nothing")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            with open(options['statement'], 'rb') as handle:
+                counts, issues = reconcile.reconcile(
+                    reconcile.read_rows(handle, options['statement']), options['window'], options['dry_run'],
+                )
+        except OSError as e:
+            raise CommandError(f"Cannot read {options['statement']}: {e}")
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['report']:
+            with open(options['report'], 'wb') as out:
+                out.write(reconcile.report_csv(issues))
+        for outcome, n in sorted(counts.items()):
+            self.stdout.write(f"{outcome:<24}{n:>10}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{counts['lines']} line(s) reconciled in {time.perf_counter() - start:.1f}s; "
+            f"{len(issues)} exception(s){' (dry run, nothing changed)' if options['dry_run'] else ''}."
+        ))
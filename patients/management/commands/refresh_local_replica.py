@@ -0,0 +1,30 @@
+import sqlite3
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from patients.routers import PRIMARY, replica_alias
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the primary SQLite database into the replica SQLite file "
+        "(local testing of read-replica routing, see MATERNAL_SQLITE_REPLICA)."
+    )
+
+    def handle(self, *args, **options):
+        alias = replica_alias()
+        if alias is None:
+            raise CommandError("No replica database is configured.")
+
+        primary = connections[PRIMARY].settings_dict
+        replica = connections[alias].settings_dict
+        if 'sqlite3' not in primary['ENGINE'] or 'sqlite3' not in replica['ENGINE']:
+            raise CommandError("Only SQLite primary/replica pairs can be refreshed by copying.")
+
+        connections[alias].close()
+        # SQLite's online backup API gives a consistent copy while the primary is in use
+        with sqlite3.connect(str(primary['NAME'])) as source, sqlite3.connect(str(replica['NAME'])) as target:
+            source.backup(target)
+
+        self.stdout.write(self.style.SUCCESS(f"Copied {primary['NAME']} -> {replica['NAME']}"))
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from patients.analytics import rebuild_rollups, refresh_all
+
+
+class Command(BaseCommand):
+    help = (
+        "Fold changed patients, deliveries, discharges and payments into the "
+        "county/ward/month analytics rollups (run from cron every few minutes). "
+        "--rebuild recomputes the whole cube from the current tables."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help="Recompute everything from scratch")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Change log entries per transaction")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        if options['rebuild']:
+            rebuild_rollups(options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt the rollups in {time.perf_counter() - start:.1f}s."))
+            return
+
+        def progress(done):
+            self.stdout.write(f"  {done} changes applied")
+
+        done = refresh_all(options['batch_size'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(
+            f"Applied {done} change(s) to the rollups in {time.perf_counter() - start:.2f}s."
+        ))
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from patients import documents
+
+
+class Command(BaseCommand):
+    help = (
+        "Render the discharge summary PDFs of one day's discharges in the "
+        "process pool (unchanged summaries that are already rendered are "
+        "reused), plus any left unfinished by a stopped web process."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help="Discharge date, YYYY-MM-DD (default: today)")
+
+    def handle(self, *args, **options):
+        day = parse_date(options['date']) if options['date'] else timezone.now().date()
+        if day is None:
+            raise CommandError("--date must look like 2025-03-14")
+
+        start = time.perf_counter()
+        documents.requeue_stale()
+        requested = documents.request_day(day)
+        documents.wait_all()
+
+        statuses = {}
+        for doc in requested:
+            doc.refresh_from_db()
+            statuses[doc.status] = statuses.get(doc.status, 0) + 1
+        summary = ', '.join(f"{count} {status}" for status, count in sorted(statuses.items())) or "none"
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(requested)} summaries for {day} ({summary}) in {time.perf_counter() - start:.1f}s."
+        ))
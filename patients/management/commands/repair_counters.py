@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from patients import counters
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute every mother's care summary (next visit, visits attended, "
+        "total paid, last delivery) from her appointments, payments and "
+        "deliveries, e.g. after rows were changed with raw SQL."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Mothers per transaction")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+
+        def progress(done, total):
+            self.stdout.write(f"  {done}/{total} mothers checked")
+
+        checked, fixed = counters.repair(options['batch_size'], progress=progress)
+        style = self.style.WARNING if fixed else self.style.SUCCESS
+        self.stdout.write(style(
+            f"Checked {checked} mother(s), corrected {fixed}, in {time.perf_counter() - start:.1f}s."
+        ))
@@ -0,0 +1,189 @@
+import json
+import random
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from patients import payments
+from patients.models import Job, PaymentCallback, SmsMessage, Transaction
+
+from ._bench import remove_seed, seed
+
+TOKEN = 'replay'
+
+
+def callback(checkout, code, receipt='', amount=None):
+    result = {
+        'MerchantRequestID': f"replay-{checkout}",
+        'CheckoutRequestID': checkout,
+        'ResultCode': code,
+        'ResultDesc': "The service request is processed successfully." if code == 0 else "Request cancelled by user",
+    }
+    if code == 0:
+        result['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': float(amount)},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+            {'Name': 'TransactionDate', 'Value': int(timezone.localtime().strftime('%Y%m%d%H%M%S'))},
+            {'Name': 'PhoneNumber', 'Value': 254712345678},
+        ]}
+    return {'Body': {'stkCallback': result}}
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a month-end burst of M-Pesa callbacks against a local server: "
+        "every payment's success is delivered, a share of them several times, a "
+        "share also gets a failure result (before or after the success), and a "
+        "share arrives before its transaction exists. Callbacks are applied by "
+        "payments.apply_pending() while the burst runs, as a worker would. Checks "
+        "every payment ends up paid once with one receipt SMS, then removes its rows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=2000)
+        parser.add_argument('--duplicates', type=float, default=0.3, help="Share of successes delivered 2-3 times")
+        parser.add_argument('--failures', type=float, default=0.1, help="Share also getting a failure result")
+        parser.add_argument('--early', type=float, default=0.05, help="Share arriving before their transaction exists")
+        parser.add_argument('--concurrency', type=int, default=16, help="Callbacks in flight at once")
+        parser.add_argument('--port', type=int, default=8027)
+
+    def handle(self, *args, **options):
+        rng = random.Random(7)
+        started = timezone.now()
+        run = started.strftime('%H%M%S')
+        with override_settings(PAYMENT_CALLBACK_TOKEN=TOKEN, PAYMENT_RETRY_SECONDS=1, ALLOWED_HOSTS=['127.0.0.1']):
+            try:
+                mother = seed(patients=1, per_patient=0, rng=rng)[0]
+                expected, bodies, early = self.plan(run, mother, options, rng)
+                url = f"http://127.0.0.1:{options['port']}{reverse('patients:mpesa_callback')}?token={TOKEN}"
+
+                server = ThreadedWSGIServer(('127.0.0.1', options['port']), QuietHandler)
+                server.set_app(WSGIHandler())
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                try:
+                    latencies, errors, elapsed, applied = self.fire(url, bodies, options['concurrency'])
+                finally:
+                    server.shutdown()
+                    server.server_close()
+
+                # The early ones' STK pushes are committed only now
+                Transaction.objects.bulk_create(early)
+                start = time.perf_counter()
+                while PaymentCallback.objects.filter(checkout_request_id__startswith=f"replay-{run}-", status='received').exists():
+                    applied.update(payments.apply_pending())
+                    time.sleep(0.2)
+                drain = time.perf_counter() - start
+
+                self.report(bodies, latencies, errors, elapsed, drain, applied)
+                self.verify(run, expected)
+            finally:
+                self.clear(run, started)
+
+    def plan(self, run, mother, options, rng):
+        """(checkout -> receipt, shuffled callback bodies, unsaved early transactions)"""
+        expected, bodies, pending, early = {}, [], [], []
+        for i in range(options['payments']):
+            checkout, receipt = f"replay-{run}-{i}", f"R{run}{i:06d}"
+            amount = Decimal(rng.choice([500, 1000, 2500]))
+            payment = Transaction(patient=mother, amount=amount, checkout_request_id=checkout, status='Pending')
+            (early if rng.random() < options['early'] else pending).append(payment)
+            expected[checkout] = receipt
+
+            success = callback(checkout, 0, receipt, amount)
+            bodies += [success] * (rng.randint(2, 3) if rng.random() < options['duplicates'] else 1)
+            if rng.random() < options['failures']:
+                bodies.append(callback(checkout, 1032))
+        Transaction.objects.bulk_create(pending)
+        rng.shuffle(bodies)
+        return expected, bodies, early
+
+    def fire(self, url, bodies, concurrency):
+        latencies, errors = [], []
+        done = threading.Event()
+        applied = Counter()
+
+        def post(body):
+            request = urllib.request.Request(url, json.dumps(body).encode(), {'Content-Type': 'application/json'})
+            start = time.perf_counter()
+            try:
+                urllib.request.urlopen(request, timeout=30).read()
+            except (urllib.error.URLError, OSError) as e:
+                errors.append(str(e))
+            latencies.append(time.perf_counter() - start)
+
+        def worker():
+            # Applies while the burst is still arriving, like runworkers would
+            while not done.is_set():
+                applied.update(payments.apply_pending())
+                time.sleep(0.2)
+
+        applier = threading.Thread(target=worker)
+        applier.start()
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(concurrency) as pool:
+                list(pool.map(post, bodies))
+        finally:
+            elapsed = time.perf_counter() - start
+            done.set()
+            applier.join()
+        return latencies, errors, elapsed, applied
+
+    def report(self, bodies, latencies, errors, elapsed, drain, applied):
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0
+        self.stdout.write(
+            f"Sent {len(bodies)} callbacks in {elapsed:.1f}s ({len(bodies) / elapsed:.0f}/s), "
+            f"latency median {statistics.median(latencies) * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms, "
+            f"{len(errors)} error(s)"
+        )
+        self.stdout.write(
+            f"Applied: {applied['applied']} applied, {applied['superseded']} superseded, "
+            f"{applied['unmatched']} unmatched; early ones drained {drain:.1f}s after the burst"
+        )
+
+    def verify(self, run, expected):
+        paid = dict(
+            Transaction.objects.filter(checkout_request_id__startswith=f"replay-{run}-")
+            .values_list('checkout_request_id', 'transaction_id')
+        )
+        wrong = [checkout for checkout, receipt in expected.items() if paid.get(checkout) != receipt]
+        stored = PaymentCallback.objects.filter(checkout_request_id__startswith=f"replay-{run}-").count()
+        receipts = SmsMessage.objects.filter(
+            reference__in=[f"transaction:{pk}" for pk in Transaction.objects.filter(
+                checkout_request_id__startswith=f"replay-{run}-").values_list('pk', flat=True)],
+        ).values_list('reference', flat=True)
+        texted = len(set(receipts))
+        self.stdout.write(f"Stored {stored} unique callbacks; {texted} receipt SMS for {len(expected)} payments")
+        if wrong or texted != len(expected) or len(receipts) != texted:
+            self.stdout.write(self.style.ERROR(
+                f"{len(wrong)} payment(s) not recorded as paid, e.g. {wrong[:3]}; "
+                f"{len(receipts) - texted} duplicate receipt(s)"
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS("Every payment recorded as paid exactly once."))
+
+    def clear(self, run, started):
+        SmsMessage.objects.filter(patient__full_name__startswith="Bench Mother ").delete()
+        PaymentCallback.objects.filter(checkout_request_id__startswith=f"replay-{run}-").delete()
+        Job.objects.filter(
+            task__in=['apply_payment_callbacks', 'dispatch_sms'], status='queued', created_at__gte=started,
+        ).delete()
+        remove_seed()
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from patients.models import ReportRun
+from patients.reports import execute, fail_stale
+
+
+class Command(BaseCommand):
+    help = (
+        "Compute queued outcome report runs in this process instead of "
+        "waiting for the workers; runs stuck for more than REPORT_TIMEOUT "
+        "are marked failed first."
+    )
+
+    def handle(self, *args, **options):
+        fail_stale()
+        queued = list(ReportRun.objects.filter(status='queued').order_by('pk').values_list('pk', flat=True))
+        for run_id in queued:
+            execute(run_id)
+            run = ReportRun.objects.only('status', 'report').get(pk=run_id)
+            self.stdout.write(f"  #{run_id} {run.report}: {run.status}")
+        self.stdout.write(self.style.SUCCESS(f"Processed {len(queued)} queued run(s)."))
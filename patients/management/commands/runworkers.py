@@ -0,0 +1,96 @@
+import logging
+import multiprocessing
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+logger = logging.getLogger(__name__)
+
+
+def worker_main(queues, batch_size, burst, stop):
+    # Runs in a fresh (spawned) process: set Django up before touching models
+    import django
+    django.setup()
+    from patients import jobs
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)   # the supervisor decides when to stop
+    jobs.work(queues=queues, batch_size=batch_size, stop=stop, burst=burst)
+
+
+class Command(BaseCommand):
+    help = (
+        "Run background job workers: a pool of processes that claim queued jobs "
+        "(most urgent first), retry failures with backoff and move jobs that keep "
+        "failing to 'dead'. Crashed workers are restarted; Ctrl+C / SIGTERM lets "
+        "running jobs finish, then stops."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help="Worker processes (default JOB_WORKERS)")
+        parser.add_argument('--queue', action='append', dest='queues', help="Only these queues (repeatable)")
+        parser.add_argument('--batch-size', type=int, default=None, help="Jobs claimed at a time per worker")
+        parser.add_argument('--burst', action='store_true', help="Exit once no job is ready")
+        parser.add_argument('--retry-dead', action='store_true', help="Requeue every dead job, then exit")
+
+    def handle(self, *args, **options):
+        from patients import jobs
+
+        if options['retry_dead']:
+            self.stdout.write(self.style.SUCCESS(f"Requeued {jobs.retry_dead()} dead job(s)."))
+            return
+
+        count = options['workers'] or getattr(settings, 'JOB_WORKERS', 2)
+        # spawn: workers get their own DB connections instead of copies of ours
+        context = multiprocessing.get_context('spawn')
+        stop = context.Event()
+        worker_args = (options['queues'], options['batch_size'], options['burst'], stop)
+
+        def start():
+            process = context.Process(target=worker_main, args=worker_args, daemon=True)
+            process.start()
+            return process
+
+        stopping = []
+
+        def shutdown(signum, frame):
+            # Only flag it: setting the Event here could deadlock with a wait on it
+            stopping.append(signum)
+
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+
+        started = time.perf_counter()
+        self.stdout.write(f"Starting {count} worker(s) on {', '.join(options['queues'] or ['all queues'])}.")
+        workers = [start() for _ in range(count)]
+        interval = getattr(settings, 'JOB_MAINTENANCE_INTERVAL', 60)
+        next_maintenance = 0
+
+        while not stopping:
+            if time.monotonic() >= next_maintenance:
+                requeued, dead = jobs.requeue_stale()
+                if requeued or dead:
+                    logger.warning("Requeued %s stale job(s), %s out of attempts", requeued, dead)
+                jobs.purge_done()
+                next_maintenance = time.monotonic() + interval
+
+            for i, process in enumerate(workers):
+                if process is None or process.is_alive():
+                    continue
+                if options['burst'] and process.exitcode == 0:
+                    workers[i] = None
+                else:
+                    logger.error("Worker %s exited with code %s; restarting it", process.pid, process.exitcode)
+                    workers[i] = start()
+            if not any(workers):
+                break
+            time.sleep(0.5)
+
+        if stopping:
+            self.stdout.write("Stopping after the running jobs...")
+        stop.set()
+        for process in workers:
+            if process is not None:
+                process.join()
+        self.stdout.write(self.style.SUCCESS(f"Workers stopped after {time.perf_counter() - started:.1f}s."))
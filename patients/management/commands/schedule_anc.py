@@ -0,0 +1,45 @@
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from patients.scheduling import active_pregnancies, schedule_cohort
+
+
+class Command(BaseCommand):
+    help = (
+        "Book the missing WHO 8-contact ANC appointments for every mother who "
+        "has not delivered yet, respecting each doctor's daily capacity. "
+        "Safe to re-run: contacts already booked are skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Mothers per transaction")
+        parser.add_argument('--county', help="Only mothers from this county")
+        parser.add_argument('--memory', action='store_true', help="Report peak Python memory (slower)")
+
+    def handle(self, *args, **options):
+        mothers = active_pregnancies()
+        if options['county']:
+            mothers = mothers.filter(county=options['county'])
+
+        def progress(done, created):
+            self.stdout.write(f"  {done} mothers, {created} appointments")
+
+        if options['memory']:
+            tracemalloc.start()
+        start = time.perf_counter()
+        done, created, unplaced = schedule_cohort(mothers, options['chunk_size'], progress=progress)
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Booked {created} appointment(s) for {done} mother(s) in {elapsed:.1f}s."
+        ))
+        if unplaced:
+            self.stdout.write(self.style.WARNING(
+                f"{unplaced} contact(s) found no free doctor within ANC_SEARCH_DAYS; "
+                f"add doctors or raise ANC_DOCTOR_DAILY_CAPACITY."
+            ))
+        if options['memory']:
+            self.stdout.write(f"Peak Python memory: {tracemalloc.get_traced_memory()[1] / 1048576:.1f} MB")
+            tracemalloc.stop()
@@ -0,0 +1,40 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from patients import sms
+
+
+class Command(BaseCommand):
+    help = (
+        "Send every queued SMS now through the configured gateway (normally the "
+        "'dispatch_sms' background job does this). With --reminders, first queue "
+        "the appointment reminders for a day (default tomorrow)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reminders', nargs='?', const='', default=None, metavar='DATE',
+                            help="Queue reminders for DATE (YYYY-MM-DD, default tomorrow) first")
+
+    def handle(self, *args, **options):
+        if options['reminders'] is not None:
+            try:
+                day = parse_date(options['reminders']) if options['reminders'] else None
+            except ValueError:
+                day = None
+            if options['reminders'] and day is None:
+                raise CommandError("--reminders takes a date as YYYY-MM-DD")
+            day = day or timezone.localdate() + timedelta(days=1)
+            queued = sms.queue_appointment_reminders(day)
+            self.stdout.write(f"Queued {queued} reminder(s) for {day:%Y-%m-%d}.")
+
+        try:
+            stats = sms.dispatch()
+        except sms.GatewayError as e:
+            raise CommandError(f"{e} (unsent messages stay queued)")
+        self.stdout.write(self.style.SUCCESS(
+            f"{stats['messages']} message(s) sent as {stats['sms']} SMS: "
+            f"{stats['sent']} accepted, {stats['failed']} rejected, gateway asked to slow down {stats['throttled']} time(s)."
+        ))
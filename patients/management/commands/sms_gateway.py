@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from patients.sms import StandInGateway
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local stand-in SMS gateway (HttpGateway's protocol) for offline "
+        "testing: it rate-limits like a real provider (HTTP 429 + Retry-After) "
+        "and can reject a share of messages. Point SMS_GATEWAY at "
+        "http://127.0.0.1:<port>/ (e.g. MATERNAL_SMS_URL)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8025)
+        parser.add_argument('--rate', type=float, default=50, help="Messages accepted per second")
+        parser.add_argument('--burst', type=int, default=100, help="Messages accepted at once")
+        parser.add_argument('--latency', type=float, default=0.02, help="Seconds added to every request")
+        parser.add_argument('--reject-rate', type=float, default=0.0, help="Share of messages rejected (0-1)")
+
+    def handle(self, *args, **options):
+        server = StandInGateway(
+            ('127.0.0.1', options['port']), rate=options['rate'], burst=options['burst'],
+            latency=options['latency'], reject_rate=options['reject_rate'],
+        )
+        self.stdout.write(f"Stand-in SMS gateway on http://127.0.0.1:{options['port']}/ (Ctrl+C to stop)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        self.stdout.write(
+            f"{sum(server.received.values())} SMS accepted over {server.connections} connection(s); "
+            f"{server.requests['throttled']} request(s) throttled."
+        )
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from patients import templating
+
+
+class Command(BaseCommand):
+    help = (
+        "Compile every template in patients/templates and report how long each "
+        "took. Fails if any does not compile, so run it as a deploy step. Web "
+        "processes warm their own template cache at startup (TEMPLATE_WARMUP)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--slowest', type=int, default=5, help="Templates to list by compile time")
+
+    def handle(self, *args, **options):
+        timings, errors = templating.warm()
+        for name, seconds in sorted(timings.items(), key=lambda item: -item[1])[:options['slowest']]:
+            self.stdout.write(f"  {name:<44}{seconds * 1000:>8.1f} ms")
+        self.stdout.write(
+            f"Compiled {len(timings)} templates in {sum(timings.values()) * 1000:.0f} ms "
+            f"(profile: {getattr(settings, 'TEMPLATE_PROFILE', 'production')})"
+        )
+        if errors:
+            for name, error in errors.items():
+                self.stderr.write(f"{name}: {error}")
+            raise CommandError(f"{len(errors)} template(s) do not compile")
@@ -0,0 +1,234 @@
+import mimetypes
+import os
+import re
+import time
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.db import DatabaseError
+from django.http import FileResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+from . import audit, routers
+from .storage import minify_html
+
+
+# ------------------------------------------------------
+# READ-REPLICA ROUTING
+# ------------------------------------------------------
+class ReplicaRoutingMiddleware:
+    """
+    Sends the reads of read-only pages (settings.REPLICA_READ_VIEWS) to the
+    replica database.
+
+    - Read-your-writes: after a POST/PUT/DELETE that did not fail (status
+      below 400) the session is pinned to the primary for
+      REPLICA_STICKY_SECONDS, so the page you are redirected to shows what
+      you just saved.
+    - Lag / errors: if the replica is behind by more than REPLICA_MAX_LAG or a
+      query on it fails, the page is served from the primary instead.
+    """
+    session_key = '_primary_until'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            response = self.get_response(request)
+        finally:
+            token = getattr(request, '_replica_token', None)
+            if token is not None:
+                routers.reset_replica(token)
+                request._replica_token = None
+        if request.method not in ('GET', 'HEAD') and response.status_code < 400:
+            # A refused write (throttled login, bad token, error) has nothing
+            # to read back: pinning it would only save a session for nothing
+            self.pin_to_primary(request, getattr(request, '_write_view', None))
+        return response
+
+    def pin_to_primary(self, request, view_func=None):
+        if not hasattr(request, 'session'):
+            return
+        if getattr(view_func, 'csrf_exempt', False) and request.session.session_key is None:
+            # A machine callback (payment gateway, SMS reports) without a
+            # session: pinning would write a new session row on every call
+            return
+        request.session[self.session_key] = time.time() + getattr(settings, 'REPLICA_STICKY_SECONDS', 15)
+
+    def is_pinned(self, request):
+        if not hasattr(request, 'session'):
+            return False
+        return request.session.get(self.session_key, 0) > time.time()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            # Pinned once the response shows the write went through (see __call__)
+            request._write_view = view_func
+            return None
+        alias = routers.replica_alias()
+        if alias is None:
+            return None
+        if request.resolver_match.view_name not in getattr(settings, 'REPLICA_READ_VIEWS', ()):
+            return None
+        if self.is_pinned(request) or not routers.replica_is_healthy(alias):
+            return None
+
+        request._replica_token = routers.use_replica(alias)
+        request._replica_view = (view_func, view_args, view_kwargs)
+        return None
+
+    def process_exception(self, request, exception):
+        token = getattr(request, '_replica_token', None)
+        if token is None or not isinstance(exception, DatabaseError):
+            return None
+
+        # The replica failed mid-request: stop using it and re-run the
+        # (read-only) view against the primary
+        routers.mark_replica_unhealthy()
+        routers.reset_replica(token)
+        request._replica_token = None
+        view_func, view_args, view_kwargs = request._replica_view
+        response = view_func(request, *view_args, **view_kwargs)
+        if hasattr(response, 'render') and callable(response.render):
+            response = response.render()
+        return response
+
+
+# ------------------------------------------------------
+# AUDIT LOG: WHO MADE THE CHANGE
+# ------------------------------------------------------
+class AuditUserMiddleware:
+    """Makes request.user available to the audit signals (must come after AuthenticationMiddleware)."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # Lazy: request.user is only resolved if something is actually audited
+        token = audit.current_user.set(request.user if hasattr(request, 'user') else None)
+        try:
+            return self.get_response(request)
+        finally:
+            audit.current_user.reset(token)
+
+
+# ------------------------------------------------------
+# STATIC FILES WITH PRECOMPRESSED VARIANTS
+# ------------------------------------------------------
+# Names written by ManifestStaticFilesStorage: main.3f2a1b9c0d4e.css
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+
+# Preferred first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def accepted_encodings(header):
+    """Codings the client accepts (q=0 means refused)."""
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        q = re.search(r'q\s*=\s*([0-9.]+)', params)
+        if coding and not (q and float(q.group(1) or 0) == 0):
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+class StaticAssetMiddleware:
+    """
+    Serves STATIC_ROOT (filled by collectstatic) without a separate web server:
+    picks the .br / .gz file built at collectstatic time according to
+    Accept-Encoding, and marks content-hashed files as cacheable forever.
+    Un-hashed names get a short max-age plus Last-Modified revalidation.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.static_url = settings.STATIC_URL if settings.STATIC_URL.startswith('/') else '/' + settings.STATIC_URL
+        self.root = str(settings.STATIC_ROOT) if settings.STATIC_ROOT else None
+
+    def __call__(self, request):
+        if (
+            self.root
+            and request.method in ('GET', 'HEAD')
+            and request.path.startswith(self.static_url)
+        ):
+            response = self.serve(request, request.path[len(self.static_url):])
+            if response is not None:
+                return response
+        return self.get_response(request)
+
+    def serve(self, request, name):
+        try:
+            path = safe_join(self.root, name)
+        except SuspiciousFileOperation:
+            return None
+        if not os.path.isfile(path):
+            return None
+
+        stat = os.stat(path)
+        if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime):
+            return HttpResponseNotModified()
+
+        content_type, _ = mimetypes.guess_type(path)
+        accepted = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        chosen_path, encoding = path, None
+        for coding, suffix in ENCODINGS:
+            if coding in accepted and os.path.isfile(path + suffix):
+                chosen_path, encoding = path + suffix, coding
+                break
+
+        response = FileResponse(open(chosen_path, 'rb'), content_type=content_type or 'application/octet-stream')
+        response['Content-Length'] = os.path.getsize(chosen_path)
+        response['Last-Modified'] = http_date(stat.st_mtime)
+        if encoding:
+            response['Content-Encoding'] = encoding
+        # Same URL, different bytes depending on Accept-Encoding
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        if HASHED_NAME.search(name):
+            response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            response['Cache-Control'] = f"public, max-age={getattr(settings, 'STATIC_UNHASHED_MAX_AGE', 60)}"
+        return response
+
+
+# ------------------------------------------------------
+# HTML MINIFICATION
+# ------------------------------------------------------
+class HtmlMinifyMiddleware:
+    """
+    Minifies the HTML pages rendered by the patients app before
+    GZipMiddleware compresses them (see settings.HTML_MINIFY).
+
+    Streaming responses are left alone (a <pre> may be split across
+    chunks); GZipMiddleware still compresses them.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if self.should_minify(request, response):
+            charset = response.charset
+            response.content = minify_html(response.content.decode(charset)).encode(charset)
+            if response.has_header('Content-Length'):
+                response['Content-Length'] = str(len(response.content))
+        return response
+
+    def should_minify(self, request, response):
+        if not getattr(settings, 'HTML_MINIFY', True):
+            return False
+        match = getattr(request, 'resolver_match', None)
+        if match is None or match.app_name != 'patients':
+            return False
+        return (
+            response.status_code == 200
+            and not response.streaming
+            and not response.has_header('Content-Encoding')
+            and response.get('Content-Type', '').startswith('text/html')
+        )
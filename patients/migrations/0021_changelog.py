@@ -0,0 +1,49 @@
+# Generated by Django 4.2.30 on 2026-10-18 22:23
+
+from django.db import migrations, models
+
+
+# Existing rows get one 'upsert' entry each, so a device starting from
+# cursor 0 downloads the current registry through the normal sync path.
+SYNCED_MODELS = [
+    ('PregnantWoman', 'patients'),
+    ('Appointment', 'appointments'),
+    ('Delivery', 'deliveries'),
+    ('Discharge', 'discharges'),
+    ('Transaction', 'transactions'),
+]
+
+
+def backfill_changelog(apps, schema_editor):
+    ChangeLog = apps.get_model('patients', 'ChangeLog')
+    for model_name, resource in SYNCED_MODELS:
+        model = apps.get_model('patients', model_name)
+        batch = []
+        for pk in model.objects.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=2000):
+            batch.append(ChangeLog(resource=resource, object_id=pk, action='upsert'))
+            if len(batch) >= 1000:
+                ChangeLog.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            ChangeLog.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0020_updated_at_timestamps'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False)),
+                ('resource', models.CharField(max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('action', models.CharField(choices=[('upsert', 'Created / Updated'), ('delete', 'Deleted')], max_length=6)),
+                ('changed_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RunPython(backfill_changelog, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-18 22:28
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0021_changelog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedPatient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('patient_id', models.BigIntegerField(unique=True)),
+                ('full_name', models.CharField(db_index=True, max_length=200)),
+                ('phone', models.CharField(db_index=True, max_length=20)),
+                ('last_discharge_date', models.DateField(blank=True, null=True)),
+                ('records', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-18 22:29
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0022_archivedpatient'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource', models.CharField(max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('patient_id', models.BigIntegerField(blank=True, null=True)),
+                ('action', models.CharField(choices=[('create', 'Created'), ('update', 'Updated'), ('delete', 'Deleted')], max_length=6)),
+                ('changes', models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('user_id', models.IntegerField(blank=True, null=True)),
+                ('username', models.CharField(blank=True, max_length=150)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['patient_id', '-created_at'], name='audit_patient_idx'), models.Index(fields=['user_id', '-created_at'], name='audit_user_idx')],
+            },
+        ),
+    ]
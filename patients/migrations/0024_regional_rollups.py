@@ -0,0 +1,70 @@
+# Generated by Django 4.2.30 on 2026-10-18 22:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0023_auditentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegionalRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('county', models.CharField(blank=True, max_length=100)),
+                ('ward', models.CharField(blank=True, max_length=100)),
+                ('month', models.DateField()),
+                ('registrations', models.IntegerField(default=0)),
+                ('high_risk', models.IntegerField(default=0)),
+                ('deliveries_normal', models.IntegerField(default=0)),
+                ('deliveries_c_section', models.IntegerField(default=0)),
+                ('deliveries_assisted', models.IntegerField(default=0)),
+                ('discharges_good', models.IntegerField(default=0)),
+                ('discharges_fair', models.IntegerField(default=0)),
+                ('discharges_critical', models.IntegerField(default=0)),
+                ('discharges_deceased', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RollupCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('seq', models.BigIntegerField(default=0)),
+                ('refreshed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RollupContribution',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource', models.CharField(max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('patient_id', models.BigIntegerField()),
+                ('county', models.CharField(blank=True, max_length=100)),
+                ('ward', models.CharField(blank=True, max_length=100)),
+                ('month', models.DateField()),
+                ('metric', models.CharField(max_length=30)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['patient_id'], name='rollup_contrib_patient_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='rollupcontribution',
+            constraint=models.UniqueConstraint(fields=('resource', 'object_id', 'metric'), name='rollup_contribution_unique'),
+        ),
+        migrations.AddIndex(
+            model_name='regionalrollup',
+            index=models.Index(fields=['month', 'county'], name='rollup_month_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='regionalrollup',
+            constraint=models.UniqueConstraint(fields=('county', 'ward', 'month'), name='rollup_cell_unique'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 22:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0025_report_runs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DischargeDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64, unique=True)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('rendering', 'Rendering'), ('ready', 'Ready'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('file', models.FileField(blank=True, upload_to='discharge_summaries/')),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('rendered_at', models.DateTimeField(blank=True, null=True)),
+                ('discharge', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='documents', to='patients.discharge')),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.30 on 2026-10-18 22:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0026_discharge_documents'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DuplicateCandidate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('reasons', models.CharField(blank=True, max_length=255)),
+                ('status', models.CharField(choices=[('pending', 'Pending review'), ('dismissed', 'Not a duplicate')], default='pending', max_length=10)),
+                ('found_at', models.DateTimeField(auto_now_add=True)),
+                ('reviewed_by', models.CharField(blank=True, max_length=150)),
+                ('reviewed_at', models.DateTimeField(blank=True, null=True)),
+                ('patient_a', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='patients.pregnantwoman')),
+                ('patient_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='patients.pregnantwoman')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', '-score'], name='duplicate_queue_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='duplicatecandidate',
+            constraint=models.UniqueConstraint(fields=('patient_a', 'patient_b'), name='duplicate_pair_unique'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0028_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SmsMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient', models.CharField(max_length=20)),
+                ('template', models.CharField(max_length=50)),
+                ('body', models.TextField()),
+                ('reference', models.CharField(blank=True, db_index=True, max_length=100)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('sending', 'Sending'), ('sent', 'Sent'), ('delivered', 'Delivered'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('claimed_by', models.CharField(blank=True, max_length=100)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('gateway_id', models.CharField(blank=True, db_index=True, max_length=100)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('delivered_at', models.DateTimeField(blank=True, null=True)),
+                ('patient', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='sms_messages', to='patients.pregnantwoman')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='sms_status_idx'), models.Index(fields=['claimed_by'], name='sms_claimed_by_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:20
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0029_sms_messages'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='checkout_request_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.CreateModel(
+            name='PaymentCallback',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dedupe_key', models.CharField(max_length=150, unique=True)),
+                ('checkout_request_id', models.CharField(db_index=True, max_length=100)),
+                ('result_code', models.IntegerField()),
+                ('result_desc', models.CharField(blank=True, max_length=255)),
+                ('receipt', models.CharField(blank=True, max_length=100)),
+                ('amount', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('phone', models.CharField(blank=True, max_length=20)),
+                ('paid_at', models.DateTimeField(blank=True, null=True)),
+                ('payload', models.JSONField()),
+                ('status', models.CharField(choices=[('received', 'Received'), ('applying', 'Applying'), ('applied', 'Applied'), ('superseded', 'Superseded'), ('unmatched', 'Unmatched')], default='received', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('claimed_by', models.CharField(blank=True, max_length=100)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('retry_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('error', models.TextField(blank=True)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('applied_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'retry_after'], name='callback_ready_idx'), models.Index(fields=['claimed_by'], name='callback_claimed_by_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0030_payment_callbacks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Reconciliation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('statement', models.FileField(upload_to='statements/')),
+                ('dry_run', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('counts', models.JSONField(default=dict)),
+                ('report', models.FileField(blank=True, upload_to='reconciliation/')),
+                ('error', models.TextField(blank=True)),
+                ('uploaded_by', models.CharField(blank=True, max_length=150)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 4.2.30 on 2026-10-19 00:04
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+# Same expressions as counters.expressions(), on the historical models
+def backfill_counters(apps, schema_editor):
+    PregnantWoman = apps.get_model('patients', 'PregnantWoman')
+    Appointment = apps.get_model('patients', 'Appointment')
+    Delivery = apps.get_model('patients', 'Delivery')
+    Transaction = apps.get_model('patients', 'Transaction')
+    mine = {'patient': OuterRef('pk')}
+
+    def total(queryset, aggregate, output_field, default):
+        return Coalesce(
+            Subquery(queryset.values('patient').annotate(total=aggregate).values('total')[:1], output_field=output_field),
+            Value(default, output_field=output_field),
+        )
+
+    PregnantWoman.objects.update(
+        next_appointment_date=Subquery(
+            Appointment.objects.filter(**mine, status='Scheduled').order_by('date').values('date')[:1]
+        ),
+        visits_attended=total(
+            Appointment.objects.filter(**mine, status='Completed'), Count('pk'), models.IntegerField(), 0,
+        ),
+        total_paid=total(
+            Transaction.objects.filter(**mine, status='Success'), Sum('amount'),
+            models.DecimalField(max_digits=12, decimal_places=2), Decimal('0'),
+        ),
+        last_delivery_date=Subquery(
+            Delivery.objects.filter(**mine).order_by('-delivery_date').values('delivery_date')[:1]
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0031_reconciliations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pregnantwoman',
+            name='last_delivery_date',
+            field=models.DateField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='pregnantwoman',
+            name='next_appointment_date',
+            field=models.DateField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='pregnantwoman',
+            name='total_paid',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='pregnantwoman',
+            name='visits_attended',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
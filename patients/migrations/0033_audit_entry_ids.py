@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-19 00:21
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0032_patient_counters'),
+    ]
+
+    operations = [
+        # Added without a default first, so existing entries keep NULL rather
+        # than all sharing one (unique) value
+        migrations.AddField(
+            model_name='auditentry',
+            name='entry_id',
+            field=models.UUIDField(editable=False, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='auditentry',
+            name='entry_id',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, null=True, unique=True),
+        ),
+    ]
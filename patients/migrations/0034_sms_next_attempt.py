@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 00:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0033_audit_entry_ids'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='smsmessage',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-19 00:57
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0034_sms_next_attempt'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLogGap',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first', models.BigIntegerField()),
+                ('last', models.BigIntegerField()),
+                ('found_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -1,6 +1,51 @@
-from django.db import models
+import uuid
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, models, router, transaction
+from django.utils import timezone
 from datetime import timedelta
 
+from . import audit
+
+# ------------------------------------------------------
+# BULK INSERTS
+# ------------------------------------------------------
+def bulk_create_with_pks(model, objs, match_fields, batch_size=None):
+    """
+    bulk_create() that leaves every object with its pk on every backend.
+
+    PostgreSQL, SQLite and MariaDB 10.5+ return the new ids; MySQL does not.
+    There the rows are read back instead: those above the highest pk seen
+    just before the insert, paired with the objects by `match_fields`
+    (attnames, e.g. ['patient_id', 'date']). Call it inside a transaction, so
+    that read sees this insert and not other writers' rows.
+    """
+    using = router.db_for_write(model)
+    manager = model._default_manager.db_manager(using)
+    if connections[using].features.can_return_rows_from_bulk_insert:
+        return manager.bulk_create(objs, batch_size=batch_size)
+
+    last_pk = manager.aggregate(last=models.Max('pk'))['last'] or 0
+    created = manager.bulk_create(objs, batch_size=batch_size)
+    fields = [model._meta.get_field(name) for name in match_fields]
+
+    waiting = {}
+    for obj in created:
+        key = tuple(field.to_python(getattr(obj, field.attname)) for field in fields)
+        waiting.setdefault(key, []).append(obj)
+    first = fields[0].attname
+    rows = (
+        manager.filter(pk__gt=last_pk, **{f'{first}__in': {key[0] for key in waiting}})
+        .order_by('pk').values_list('pk', *(field.attname for field in fields))
+    )
+    for pk, *key in rows:
+        objs_with_key = waiting.get(tuple(key))
+        if objs_with_key:
+            objs_with_key.pop(0).pk = pk
+    return created
+
+
 # ------------------------------------------------------
 # PREGNANT WOMAN MODEL
 # ------------------------------------------------------
@@ -46,14 +91,30 @@ class PregnantWoman(models.Model):
     emergency_contact_relation = models.CharField(max_length=50, blank=True, null=True)
     emergency_contact_phone = models.CharField(max_length=20, blank=True, null=True)
 
+    # --- Care summary (kept up to date by counters.py, never edited) ---
+    # Earliest appointment still 'Scheduled' (a past date means overdue)
+    next_appointment_date = models.DateField(null=True, blank=True, editable=False, db_index=True)
+    visits_attended = models.PositiveIntegerField(default=0, editable=False, db_index=True)
+    total_paid = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False, db_index=True)
+    last_delivery_date = models.DateField(null=True, blank=True, editable=False, db_index=True)
+
     # --- Timestamps ---
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    # Written only by counters.refresh(). Edits load the mother with these
+    # deferred, so saving the form writes back just the columns it loaded
+    SUMMARY_FIELDS = ('next_appointment_date', 'visits_attended', 'total_paid', 'last_delivery_date')
 
     def save(self, *args, **kwargs):
         # Automatic Logic: If LMP is provided but Due Date is missing, calculate it (LMP + 280 days)
         if self.lmp and not self.expected_due_date:
             self.expected_due_date = self.lmp + timedelta(days=280)
+        if self._state.adding:
+            # Registration and the ANC bookings made on it (signals.py) commit together
+            using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+            with transaction.atomic(using=using):
+                return super().save(*args, **kwargs)
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -84,6 +145,7 @@ class Appointment(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='Scheduled')
 
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return f"{self.patient.full_name} - {self.date}"
@@ -92,6 +154,45 @@ class Appointment(models.Model):
 # ------------------------------------------------------
 # DELIVERY MODEL
 # ------------------------------------------------------
+class DeliveryManager(models.Manager):
+    def bulk_register(self, deliveries, batch_size=500):
+        """
+        Inserts many deliveries in ONE transaction.
+        bulk_create() skips Delivery.save(), so the missing EDDs are filled here
+        from the mothers' records, fetched with a single in_bulk() query.
+        """
+        deliveries = list(deliveries)
+        patient_field = self.model.patient
+
+        missing = {
+            d.patient_id for d in deliveries
+            if not d.edd and not patient_field.is_cached(d)
+        }
+        mothers = PregnantWoman.objects.in_bulk(missing) if missing else {}
+
+        for delivery in deliveries:
+            if delivery.edd:
+                continue
+            if patient_field.is_cached(delivery):
+                mother = delivery.patient
+            else:
+                mother = mothers.get(delivery.patient_id)
+            if mother and mother.expected_due_date:
+                delivery.edd = mother.expected_due_date
+
+        with transaction.atomic(using=self.db):
+            created = bulk_create_with_pks(self.model, deliveries, ['patient_id', 'delivery_date'], batch_size)
+            # bulk_create() sends no post_save, so log the rows for device sync
+            # and the audit trail here
+            ChangeLog.record_many('deliveries', [d.pk for d in created if d.pk is not None])
+            for delivery in created:
+                audit.record(audit.make_entry('deliveries', delivery, 'create', audit.diff({}, audit.snapshot(delivery))))
+            # Imported here: counters.py imports the models
+            from . import counters
+            counters.refresh({d.patient_id for d in created}, [Delivery])
+            return created
+
+
 class Delivery(models.Model):
     DELIVERY_TYPES = [
         ('Normal Delivery', 'Normal Delivery'),
@@ -138,6 +239,16 @@ class Delivery(models.Model):
     notes = models.TextField(blank=True, null=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = DeliveryManager()
+
+    @staticmethod
+    def format_emergency_contact(name, relation='', phone=''):
+        # Single text column: "Name (Relation) - Phone"
+        if not name:
+            return ''
+        return f"{name} ({relation}) - {phone}"
 
     def save(self, *args, **kwargs):
         # SMART LOGIC: If user didn't fill in EDD on the delivery form, 
@@ -194,6 +305,7 @@ class Discharge(models.Model):
     notes = models.TextField(blank=True, null=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return f"Discharge - {self.patient.full_name} ({self.condition})"
@@ -217,6 +329,8 @@ class Transaction(models.Model):
     
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     transaction_id = models.CharField(max_length=100, null=True, blank=True, unique=True)
+    # Daraja's CheckoutRequestID for an STK push; its callback is matched on this
+    checkout_request_id = models.CharField(max_length=100, null=True, blank=True, unique=True)
     
     status = models.CharField(
         max_length=20, 
@@ -225,6 +339,501 @@ class Transaction(models.Model):
     )
     
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.patient.full_name} - KES {self.amount} ({self.status})"
+
+# ------------------------------------------------------
+# CHANGE LOG (Offline sync for CHW devices)
+# ------------------------------------------------------
+class ChangeLog(models.Model):
+    """
+    One row per saved / deleted record. The auto-increment 'seq' is the
+    monotonic sync cursor: a device asks for everything after the last seq it saw.
+    """
+    ACTION_CHOICES = [
+        ('upsert', 'Created / Updated'),
+        ('delete', 'Deleted'),
+    ]
+
+    seq = models.BigAutoField(primary_key=True)
+    resource = models.CharField(max_length=20)   # API name, e.g. 'patients'
+    object_id = models.BigIntegerField()
+    action = models.CharField(max_length=6, choices=ACTION_CHOICES)
+    changed_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def record_many(cls, resource, object_ids, action='upsert'):
+        # For bulk_create()/update() paths, which do not send model signals
+        cls.objects.bulk_create(
+            [cls(resource=resource, object_id=pk, action=action) for pk in object_ids],
+            batch_size=1000,
+        )
+
+    @classmethod
+    def read_after(cls, cursor, limit, settle_seconds):
+        """
+        Up to `limit` entries after seq `cursor`, oldest first, as
+        [(seq, resource, object_id, action)], and whether more follow.
+
+        Seqs are taken when a change is written, not when its transaction
+        commits, so a gap may be a change still on its way. Reading stops
+        before a gap until the entry after it is `settle_seconds` old; a gap
+        passed after that is noted in ChangeLogGap, and relog_late() logs
+        again whatever commits into it later (a long import or merge).
+        """
+        cls.relog_late()
+        settle = timezone.now() - timedelta(seconds=settle_seconds)
+        rows = list(
+            cls.objects.filter(seq__gt=cursor)
+            .order_by('seq')
+            .values_list('seq', 'resource', 'object_id', 'action', 'changed_at')[:limit + 1]
+        )
+        entries, gaps = [], []
+        for seq, resource, object_id, action, changed_at in rows[:limit]:
+            expected = entries[-1][0] + 1 if entries else cursor + 1
+            if seq != expected:
+                if changed_at > settle:
+                    # The missing seqs may still commit: reading past them
+                    # would move the caller's cursor beyond them
+                    break
+                gaps.append(ChangeLogGap(first=expected, last=seq - 1))
+            entries.append((seq, resource, object_id, action))
+        ChangeLogGap.objects.bulk_create(gaps)
+        return entries, len(entries) == limit and len(rows) > limit
+
+    @classmethod
+    def relog_late(cls):
+        """
+        Entries that committed into a noted gap after readers went past it
+        are logged again under new seqs, so every cursor still reaches them.
+        Gaps older than CHANGELOG_GAP_WATCH_SECONDS are taken as rollbacks.
+        """
+        watch = timedelta(seconds=getattr(settings, 'CHANGELOG_GAP_WATCH_SECONDS', 86400))
+        ChangeLogGap.objects.filter(found_at__lt=timezone.now() - watch).delete()
+        gaps = list(ChangeLogGap.objects.all())
+        if not gaps:
+            return 0
+        ranges = models.Q()
+        for gap in gaps:
+            ranges |= models.Q(seq__range=(gap.first, gap.last))
+        late = set(cls.objects.filter(ranges).values_list('seq', flat=True))
+
+        relogged = 0
+        for gap in gaps:
+            if not any(gap.first <= seq <= gap.last for seq in late):
+                continue
+            with transaction.atomic():
+                # Locked: two readers must not both log the same entries again
+                if not ChangeLogGap.objects.select_for_update().filter(pk=gap.pk).exists():
+                    continue
+                found = list(
+                    cls.objects.filter(seq__range=(gap.first, gap.last))
+                    .order_by('seq').values_list('seq', 'resource', 'object_id', 'action')
+                )
+                cls.objects.bulk_create([
+                    cls(resource=resource, object_id=object_id, action=action) for _, resource, object_id, action in found
+                ])
+                # Keep watching the seqs still missing
+                holes, start = [], gap.first
+                for seq, *_ in found:
+                    if seq > start:
+                        holes.append(ChangeLogGap(first=start, last=seq - 1, found_at=gap.found_at))
+                    start = seq + 1
+                if start <= gap.last:
+                    holes.append(ChangeLogGap(first=start, last=gap.last, found_at=gap.found_at))
+                gap.delete()
+                ChangeLogGap.objects.bulk_create(holes)
+                relogged += len(found)
+        return relogged
+
+    def __str__(self):
+        return f"#{self.seq} {self.action} {self.resource}:{self.object_id}"
+
+
+class ChangeLogGap(models.Model):
+    """Seqs first..last were missing from ChangeLog when a reader went past them."""
+    first = models.BigIntegerField()
+    last = models.BigIntegerField()
+    found_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+
+# ------------------------------------------------------
+# ARCHIVE (Closed pregnancies moved out of the hot tables)
+# ------------------------------------------------------
+class ArchivedPatient(models.Model):
+    """
+    A closed episode (delivered, discharged, bills cleared) moved out of the hot
+    tables by `manage.py archive_episodes`. `records` holds the mother and all
+    her appointments, deliveries, discharges and transactions in Django's
+    serializer format, so she can be restored with the same IDs.
+    """
+    patient_id = models.BigIntegerField(unique=True)
+    full_name = models.CharField(max_length=200, db_index=True)
+    phone = models.CharField(max_length=20, db_index=True)
+    last_discharge_date = models.DateField(null=True, blank=True)
+    records = models.JSONField(encoder=DjangoJSONEncoder)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Archived - {self.full_name} (#{self.patient_id})"
+
+
+# ------------------------------------------------------
+# AUDIT LOG (Append-only record of clinical data edits)
+# ------------------------------------------------------
+class AuditEntry(models.Model):
+    ACTION_CHOICES = [
+        ('create', 'Created'),
+        ('update', 'Updated'),
+        ('delete', 'Deleted'),
+    ]
+
+    # Makes writing an entry idempotent (spill files may be written twice);
+    # entries from before it was added have none
+    entry_id = models.UUIDField(default=uuid.uuid4, unique=True, null=True, editable=False)
+    resource = models.CharField(max_length=20)   # API name, e.g. 'deliveries'
+    object_id = models.BigIntegerField()
+    patient_id = models.BigIntegerField(null=True, blank=True)
+    action = models.CharField(max_length=6, choices=ACTION_CHOICES)
+    # {field: [old value, new value]}
+    changes = models.JSONField(encoder=DjangoJSONEncoder, default=dict)
+    user_id = models.IntegerField(null=True, blank=True)
+    username = models.CharField(max_length=150, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['patient_id', '-created_at'], name='audit_patient_idx'),
+            models.Index(fields=['user_id', '-created_at'], name='audit_user_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.action} {self.resource}:{self.object_id} by {self.username or 'system'}"
+
+
+# ------------------------------------------------------
+# REGIONAL ANALYTICS (County / ward / month rollups)
+# ------------------------------------------------------
+class RegionalRollup(models.Model):
+    """
+    One cell of the analytics cube: totals for a county, ward and month.
+    Maintained incrementally by analytics.refresh_rollups(); never edit by hand.
+    """
+    county = models.CharField(max_length=100, blank=True)   # '' = not recorded
+    ward = models.CharField(max_length=100, blank=True)
+    month = models.DateField()                              # first day of the month
+
+    registrations = models.IntegerField(default=0)
+    high_risk = models.IntegerField(default=0)
+    deliveries_normal = models.IntegerField(default=0)
+    deliveries_c_section = models.IntegerField(default=0)
+    deliveries_assisted = models.IntegerField(default=0)
+    discharges_good = models.IntegerField(default=0)
+    discharges_fair = models.IntegerField(default=0)
+    discharges_critical = models.IntegerField(default=0)
+    discharges_deceased = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['county', 'ward', 'month'], name='rollup_cell_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['month', 'county'], name='rollup_month_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.county or '-'} / {self.ward or '-'} / {self.month:%Y-%m}"
+
+
+class RollupContribution(models.Model):
+    """
+    What one source row currently adds to the cube, so a change can be
+    applied as (new contribution - old contribution) without regrouping.
+    """
+    resource = models.CharField(max_length=20)
+    object_id = models.BigIntegerField()
+    patient_id = models.BigIntegerField()
+    county = models.CharField(max_length=100, blank=True)
+    ward = models.CharField(max_length=100, blank=True)
+    month = models.DateField()
+    metric = models.CharField(max_length=30)   # RegionalRollup field name
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['resource', 'object_id', 'metric'], name='rollup_contribution_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['patient_id'], name='rollup_contrib_patient_idx'),
+        ]
+
+
+class RollupCursor(models.Model):
+    """Last ChangeLog seq folded into the rollups."""
+    name = models.CharField(max_length=50, unique=True)
+    seq = models.BigIntegerField(default=0)
+    refreshed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.seq}"
+
+
+# ------------------------------------------------------
+# OUTCOME REPORTS (Cached report results)
+# ------------------------------------------------------
+class ReportRun(models.Model):
+    """
+    One computed outcome report. `cache_key` covers the report name, its
+    parameters and the data version it was computed at, so an identical
+    request against unchanged data reuses the finished run.
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    report = models.CharField(max_length=50)
+    params = models.JSONField(default=dict)
+    cache_key = models.CharField(max_length=40, db_index=True)
+    data_version = models.BigIntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    # {'columns': [...], 'rows': [[...], ...]}
+    result = models.JSONField(encoder=DjangoJSONEncoder, null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.report} #{self.pk} ({self.status})"
+
+
+# ------------------------------------------------------
+# DISCHARGE SUMMARY DOCUMENTS (Rendered PDFs)
+# ------------------------------------------------------
+class DischargeDocument(models.Model):
+    """
+    A rendered discharge summary PDF. `content_hash` is computed from
+    everything printed on it, so an unchanged discharge reuses its PDF and
+    an edited one gets a new document.
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('rendering', 'Rendering'),
+        ('ready', 'Ready'),
+        ('failed', 'Failed'),
+    ]
+
+    discharge = models.ForeignKey(Discharge, on_delete=models.CASCADE, related_name='documents')
+    content_hash = models.CharField(max_length=64, unique=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    file = models.FileField(upload_to='discharge_summaries/', blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    rendered_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Summary for discharge #{self.discharge_id} ({self.status})"
+
+
+# ------------------------------------------------------
+# DUPLICATE PATIENTS (Review queue)
+# ------------------------------------------------------
+class DuplicateCandidate(models.Model):
+    """
+    Two registrations that look like the same mother, found by
+    `manage.py find_duplicates`. patient_a is always the lower id. Dismissed
+    pairs are kept so later scans do not queue them again; merging deletes
+    the duplicate registration and, with it, its candidate rows.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending review'),
+        ('dismissed', 'Not a duplicate'),
+    ]
+
+    patient_a = models.ForeignKey(PregnantWoman, on_delete=models.CASCADE, related_name='+')
+    patient_b = models.ForeignKey(PregnantWoman, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+    reasons = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    found_at = models.DateTimeField(auto_now_add=True)
+    reviewed_by = models.CharField(max_length=150, blank=True)
+    reviewed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['patient_a', 'patient_b'], name='duplicate_pair_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['status', '-score'], name='duplicate_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f"#{self.patient_a_id} / #{self.patient_b_id} ({self.score:.2f}, {self.status})"
+
+
+# ------------------------------------------------------
+# BACKGROUND JOBS (Queue stored in the database)
+# ------------------------------------------------------
+class Job(models.Model):
+    """
+    One unit of background work for `manage.py runworkers` (see jobs.py).
+    Higher `priority` runs first; a failed job is retried after a backoff
+    until `max_attempts`, then left as 'dead' for a person to look at.
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('dead', 'Dead (gave up)'),
+    ]
+
+    queue = models.CharField(max_length=50, default='default')
+    task = models.CharField(max_length=100)      # name registered with @jobs.task
+    kwargs = models.JSONField(encoder=DjangoJSONEncoder, default=dict)
+    priority = models.SmallIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    run_after = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    last_error = models.TextField(blank=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # The dequeue query: ready jobs of a queue, most urgent first
+            models.Index(fields=['status', 'queue', '-priority', 'run_after'], name='job_ready_idx'),
+            models.Index(fields=['locked_by'], name='job_locked_by_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.task} #{self.pk} ({self.status})"
+
+
+# ------------------------------------------------------
+# SMS NOTIFICATIONS (Visit reminders, payment receipts)
+# ------------------------------------------------------
+class SmsMessage(models.Model):
+    """
+    One notification for one phone number (see sms.py). Messages queued for
+    the same number close together are sent as a single SMS; they then
+    share the gateway's message id.
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('delivered', 'Delivered'),
+        ('failed', 'Failed'),
+    ]
+
+    patient = models.ForeignKey(PregnantWoman, on_delete=models.SET_NULL, null=True, blank=True, related_name='sms_messages')
+    recipient = models.CharField(max_length=20)           # normalised, e.g. 254712345678
+    template = models.CharField(max_length=50)
+    body = models.TextField()
+    # What the message is about, e.g. 'transaction:42', so it is never queued twice
+    reference = models.CharField(max_length=100, blank=True, db_index=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    claimed_by = models.CharField(max_length=100, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    # A message the gateway rejected waits until then before it is sent again
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    gateway_id = models.CharField(max_length=100, blank=True, db_index=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='sms_status_idx'),
+            models.Index(fields=['claimed_by'], name='sms_claimed_by_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.template} to {self.recipient} ({self.status})"
+
+
+# ------------------------------------------------------
+# M-PESA PAYMENT CALLBACKS
+# ------------------------------------------------------
+class PaymentCallback(models.Model):
+    """
+    One M-Pesa STK push result as received (see payments.py). Stored before
+    anything else happens and applied to its Transaction in batches later;
+    `dedupe_key` makes a redelivered callback a no-op.
+    """
+    STATUS_CHOICES = [
+        ('received', 'Received'),
+        ('applying', 'Applying'),
+        ('applied', 'Applied'),
+        ('superseded', 'Superseded'),    # another result for the same payment won
+        ('unmatched', 'Unmatched'),      # no transaction with this checkout id
+    ]
+
+    dedupe_key = models.CharField(max_length=150, unique=True)
+    checkout_request_id = models.CharField(max_length=100, db_index=True)
+    result_code = models.IntegerField()
+    result_desc = models.CharField(max_length=255, blank=True)
+    receipt = models.CharField(max_length=100, blank=True)      # MpesaReceiptNumber
+    amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    phone = models.CharField(max_length=20, blank=True)
+    paid_at = models.DateTimeField(null=True, blank=True)
+    payload = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='received')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    claimed_by = models.CharField(max_length=100, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    retry_after = models.DateTimeField(default=timezone.now)
+    error = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    applied_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'retry_after'], name='callback_ready_idx'),
+            models.Index(fields=['claimed_by'], name='callback_claimed_by_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.checkout_request_id} result {self.result_code} ({self.status})"
+
+
+# ------------------------------------------------------
+# M-PESA STATEMENT RECONCILIATION
+# ------------------------------------------------------
+class Reconciliation(models.Model):
+    """
+    One uploaded M-Pesa statement matched against Transaction (see
+    reconcile.py). `counts` holds the outcome totals; the lines that need a
+    person (amount differences, money with no payment record, ...) are in
+    the `report` CSV.
+    """
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    statement = models.FileField(upload_to='statements/')
+    dry_run = models.BooleanField(default=False)      # report only, change nothing
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    counts = models.JSONField(default=dict)
+    report = models.FileField(upload_to='reconciliation/', blank=True)
+    error = models.TextField(blank=True)
+    uploaded_by = models.CharField(max_length=150, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
-        return f"{self.patient.full_name} - KES {self.amount} ({self.status})"
\ No newline at end of file
+        return f"Reconciliation #{self.pk} ({self.status})"
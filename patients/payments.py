@@ -0,0 +1,370 @@
+"""
+M-Pesa STK push payments and their callbacks.
+
+start_stk_push() asks Daraja (settings.MPESA_STK) to prompt the mother's
+phone and records a 'Pending' Transaction holding the CheckoutRequestID
+Daraja answers with. The payment becomes 'Success' or 'Failed' only when
+the result of that push comes back as a callback.
+
+Safaricom posts the result of every STK push to our callback URL, and posts
+it again whenever it does not get a quick answer. At month end thousands
+arrive in bursts, some more than once and some before the Transaction of
+their push is even committed. The callback view therefore only stores the
+result, as one INSERT of a PaymentCallback row (skipped when a row with the
+same dedupe key exists), and makes sure an 'apply_payment_callbacks'
+background job is waiting (see jobs.py / tasks.py).
+
+That job claims received callbacks in batches of PAYMENT_APPLY_BATCH and
+applies each batch in one transaction: one SELECT ... FOR UPDATE of the
+matching transactions, then one bulk UPDATE of those and one of the
+callbacks. The rules make the arrival order irrelevant:
+
+  - success wins: a successful payment is never changed again, and a failed
+    one becomes successful if a success result turns up later;
+  - among results for the same push in one batch, a success beats failures
+    and otherwise the latest failure counts;
+  - a result is matched on its CheckoutRequestID, or failing that on its
+    MpesaReceiptNumber (a payment recorded by hand or by reconciliation);
+  - a result whose transaction does not exist yet is retried every
+    PAYMENT_RETRY_SECONDS for PAYMENT_MATCH_WINDOW seconds, then left
+    'unmatched' for a person to look at.
+
+`manage.py replay_callbacks` fires thousands of callbacks (duplicates,
+out-of-order and early ones included) at a local server to test all this.
+"""
+import base64
+import json
+import logging
+import urllib.request
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Min
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import audit, counters, jobs, sms
+from .models import ChangeLog, Job, PaymentCallback, Transaction
+from .sync import MODEL_RESOURCES
+
+logger = logging.getLogger(__name__)
+
+# M-Pesa timestamps (TransactionDate) are East Africa Time
+MPESA_TIMEZONE = ZoneInfo('Africa/Nairobi')
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# ==========================================
+# Starting payments
+# ==========================================
+class StkPushError(Exception):
+    pass
+
+
+class BaseStkPush:
+    """An STK push client: push() prompts the phone and returns the CheckoutRequestID."""
+
+    def push(self, phone, amount, reference):
+        raise NotImplementedError
+
+    def pushed(self, payment):
+        """Called once the payment is recorded (inside its transaction)."""
+
+
+class SimulatedStkPush(BaseStkPush):
+    """
+    Development default: no phone is prompted. The push is answered with a
+    successful callback, so the payment goes through the same pipeline as
+    a real one.
+    """
+
+    def push(self, phone, amount, reference):
+        return f"ws_CO_sim_{uuid.uuid4().hex[:20]}"
+
+    def pushed(self, payment):
+        payload = simulated_callback(payment.checkout_request_id, f"SIM{uuid.uuid4().hex[:7].upper()}", payment.amount)
+        transaction.on_commit(lambda: ingest([payload]))
+
+
+class DarajaStkPush(BaseStkPush):
+    """Safaricom Daraja's Lipa na M-Pesa Online (STK push) API."""
+
+    def __init__(self, base_url, consumer_key, consumer_secret, shortcode, passkey, callback_url, timeout=15):
+        self.base_url = base_url.rstrip('/')
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.shortcode = shortcode
+        self.passkey = passkey
+        self.callback_url = callback_url
+        self.timeout = timeout
+
+    def _call(self, path, body=None, headers=None):
+        request = urllib.request.Request(
+            self.base_url + path, data=json.dumps(body).encode() if body is not None else None,
+            headers={'Content-Type': 'application/json', **(headers or {})},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except (OSError, ValueError) as e:
+            raise StkPushError(f"Daraja request failed: {e}") from e
+
+    def _token(self):
+        credentials = base64.b64encode(f"{self.consumer_key}:{self.consumer_secret}".encode()).decode()
+        data = self._call('/oauth/v1/generate?grant_type=client_credentials', headers={'Authorization': f"Basic {credentials}"})
+        return data['access_token']
+
+    def push(self, phone, amount, reference):
+        stamp = datetime.now(MPESA_TIMEZONE).strftime('%Y%m%d%H%M%S')
+        password = base64.b64encode(f"{self.shortcode}{self.passkey}{stamp}".encode()).decode()
+        data = self._call('/mpesa/stkpush/v1/processrequest', {
+            'BusinessShortCode': self.shortcode, 'Password': password, 'Timestamp': stamp,
+            'TransactionType': 'CustomerPayBillOnline', 'Amount': int(amount),
+            'PartyA': phone, 'PartyB': self.shortcode, 'PhoneNumber': phone,
+            'CallBackURL': self.callback_url, 'AccountReference': reference[:12], 'TransactionDesc': 'Payment',
+        }, headers={'Authorization': f"Bearer {self._token()}"})
+        if str(data.get('ResponseCode')) != '0' or not data.get('CheckoutRequestID'):
+            raise StkPushError(data.get('errorMessage') or data.get('ResponseDescription') or "STK push refused")
+        return data['CheckoutRequestID']
+
+
+def get_stk_client():
+    config = _setting('MPESA_STK', {'BACKEND': 'patients.payments.SimulatedStkPush'})
+    return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+
+def simulated_callback(checkout, receipt, amount, result_code=0, paid_at=None):
+    """A Daraja STK push callback body (for the simulated client and tests)."""
+    result = {
+        'MerchantRequestID': f"sim-{checkout}", 'CheckoutRequestID': checkout,
+        'ResultCode': result_code, 'ResultDesc': "The service request is processed successfully." if result_code == 0 else "Request cancelled by user",
+    }
+    if result_code == 0:
+        paid_at = paid_at or timezone.now()
+        result['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': float(amount)},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+            {'Name': 'TransactionDate', 'Value': int(paid_at.astimezone(MPESA_TIMEZONE).strftime('%Y%m%d%H%M%S'))},
+        ]}
+    return {'Body': {'stkCallback': result}}
+
+
+def start_stk_push(patient, amount, client=None):
+    """
+    Prompts the mother's phone for `amount` and records the payment as
+    'Pending' with the push's CheckoutRequestID; its callback settles it.
+    Raises StkPushError (nothing recorded) if Daraja refuses the push.
+    """
+    amount = _amount(amount)
+    if amount is None or not amount.is_finite() or amount <= 0:
+        raise StkPushError("Enter an amount in shillings")
+    phone = sms.recipient_number(patient.phone)
+    if not phone:
+        raise StkPushError(f"{patient.phone or 'No phone number'} is not an M-Pesa number")
+    client = client or get_stk_client()
+    checkout = client.push(phone, amount, f"P{patient.pk}")
+    with transaction.atomic():
+        payment = Transaction.objects.create(patient=patient, amount=amount, status='Pending', checkout_request_id=checkout)
+        client.pushed(payment)
+    return payment
+
+
+# ==========================================
+# Receiving
+# ==========================================
+def _amount(value):
+    try:
+        return Decimal(str(value)) if value is not None else None
+    except InvalidOperation:
+        return None
+
+
+def _paid_at(value):
+    try:
+        return datetime.strptime(str(value), '%Y%m%d%H%M%S').replace(tzinfo=MPESA_TIMEZONE)
+    except ValueError:
+        return None
+
+
+def parse(payload):
+    """An unsaved PaymentCallback from a Daraja STK push callback body. Raises ValueError."""
+    try:
+        result = payload['Body']['stkCallback']
+        checkout = str(result['CheckoutRequestID'])
+        code = int(result['ResultCode'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError("Not an STK push callback") from e
+    metadata = result.get('CallbackMetadata') or {}
+    items = {item.get('Name'): item.get('Value') for item in metadata.get('Item', []) if isinstance(item, dict)}
+    receipt = str(items.get('MpesaReceiptNumber') or '')
+    if code == 0 and not receipt:
+        raise ValueError("Successful callback without an MpesaReceiptNumber")
+
+    return PaymentCallback(
+        # A receipt number is unique per payment; a failure can only be reported once per push
+        dedupe_key=f"receipt:{receipt}" if code == 0 else f"result:{checkout}:{code}",
+        checkout_request_id=checkout,
+        result_code=code,
+        result_desc=str(result.get('ResultDesc') or '')[:255],
+        receipt=receipt,
+        amount=_amount(items.get('Amount')),
+        phone=str(items.get('PhoneNumber') or ''),
+        paid_at=_paid_at(items.get('TransactionDate')),
+        payload=payload,
+    )
+
+
+def schedule_apply(delay=None):
+    """One waiting apply job is enough: it applies everything received by then."""
+    if not Job.objects.filter(task='apply_payment_callbacks', status='queued').exists():
+        delay = _setting('PAYMENT_APPLY_DELAY', 1) if delay is None else delay
+        jobs.enqueue('apply_payment_callbacks', delay=delay)
+
+
+def ingest(payloads):
+    """
+    Stores callback bodies for applying later. Redelivered callbacks are
+    ignored by the database (unique dedupe_key), so this is safe to repeat.
+    Raises ValueError (nothing stored) if one is not a valid callback.
+    """
+    callbacks = [parse(payload) for payload in payloads]
+    PaymentCallback.objects.bulk_create(callbacks, ignore_conflicts=True)
+    schedule_apply()
+    return len(callbacks)
+
+
+# ==========================================
+# Applying
+# ==========================================
+def _winner(results):
+    # A success beats failures; otherwise the latest failure
+    return min(results, key=lambda c: (c.result_code != 0, -c.pk))
+
+
+@transaction.atomic
+def apply_batch(callbacks):
+    """Applies claimed callbacks to their transactions. Returns Counter of callback outcomes."""
+    now = timezone.now()
+    window = timedelta(seconds=_setting('PAYMENT_MATCH_WINDOW', 3600))
+    retry = timedelta(seconds=_setting('PAYMENT_RETRY_SECONDS', 5))
+
+    # Write before reading: on SQLite this takes the write lock up front, so a
+    # concurrent writer makes this wait (busy timeout) instead of failing later
+    PaymentCallback.objects.filter(pk__in=[c.pk for c in callbacks]).update(claimed_at=now)
+
+    by_checkout = defaultdict(list)
+    for callback in callbacks:
+        by_checkout[callback.checkout_request_id].append(callback)
+    payments = {
+        t.checkout_request_id: t
+        for t in Transaction.objects.select_for_update().filter(checkout_request_id__in=by_checkout)
+    }
+    # Payments already holding a callback's receipt: the fallback match, and
+    # kept so a bad callback cannot break transaction_id's uniqueness
+    receipts = {c.receipt for c in callbacks if c.receipt}
+    recorded = {
+        t.transaction_id: t
+        for t in Transaction.objects.select_for_update().filter(transaction_id__in=receipts)
+    }
+
+    changed = {}
+    for checkout, results in by_checkout.items():
+        payment = payments.get(checkout) or next(
+            (recorded[c.receipt] for c in results if c.receipt in recorded), None,
+        )
+        if payment is None:
+            for callback in results:
+                if now - callback.received_at < window:
+                    # Its STK push may not be committed yet: look again shortly
+                    callback.status, callback.claimed_by, callback.retry_after = 'received', '', now + retry
+                else:
+                    callback.status, callback.error = 'unmatched', "No transaction with this CheckoutRequestID or receipt"
+            continue
+
+        winner = _winner(results)
+        for callback in results:
+            callback.status, callback.applied_at = 'superseded', now
+        if payment.status == 'Success':
+            # Paid already: redeliveries and late failures change nothing
+            continue
+        if winner.result_code == 0:
+            if recorded.get(winner.receipt, payment).pk != payment.pk:
+                winner.status, winner.error = 'unmatched', f"Receipt {winner.receipt} is recorded on another payment"
+                continue
+            changes = {'status': [payment.status, 'Success'], 'transaction_id': [payment.transaction_id, winner.receipt]}
+            if payment.checkout_request_id is None:
+                # Matched on its receipt: remember the push it was paid through
+                changes['checkout_request_id'] = [None, checkout]
+                payment.checkout_request_id = checkout
+            changed[payment.pk] = (payment, changes)
+            payment.status, payment.transaction_id = 'Success', winner.receipt
+            if winner.amount is not None and winner.amount != payment.amount:
+                winner.error = f"Paid KES {winner.amount}, KES {payment.amount} was requested"
+                logger.warning("M-Pesa payment %s: %s", winner.receipt, winner.error)
+        elif payment.status != 'Failed':
+            changed[payment.pk] = (payment, {'status': [payment.status, 'Failed']})
+            payment.status = 'Failed'
+        winner.status = 'applied'
+
+    if changed:
+        updated = [payment for payment, _ in changed.values()]
+        for payment in updated:
+            payment.updated_at = now
+        Transaction.objects.bulk_update(updated, ['status', 'transaction_id', 'checkout_request_id', 'updated_at'])
+        # bulk_update() sends no post_save: log for device sync and the audit trail, and send receipts
+        resource = MODEL_RESOURCES[Transaction]
+        ChangeLog.record_many(resource, list(changed))
+        for payment, changes in changed.values():
+            audit.record(audit.make_entry(resource, payment, 'update', changes))
+        counters.refresh({payment.patient_id for payment in updated}, [Transaction])
+        if _setting('SMS_RECEIPTS', True):
+            sms.queue_receipts(
+                Transaction.objects.filter(pk__in=[p.pk for p in updated if p.status == 'Success']).select_related('patient')
+            )
+
+    PaymentCallback.objects.bulk_update(callbacks, ['status', 'error', 'applied_at', 'claimed_by', 'retry_after'])
+    return Counter(callback.status for callback in callbacks)
+
+
+def requeue_stale(minutes=10):
+    """Callbacks left 'applying' by a worker that died go back to the queue."""
+    cutoff = timezone.now() - timedelta(minutes=minutes)
+    return PaymentCallback.objects.filter(status='applying', claimed_at__lt=cutoff).update(status='received', claimed_by='')
+
+
+def apply_pending(batch_size=None):
+    """
+    Applies every received callback that is due, a batch at a time.
+    Returns Counter of outcomes ('applied', 'superseded', 'unmatched',
+    'received' = still waiting for its transaction).
+    """
+    batch_size = batch_size or _setting('PAYMENT_APPLY_BATCH', 200)
+    worker = jobs.worker_name()
+    stats = Counter()
+
+    requeue_stale()
+    while True:
+        now = timezone.now()
+        ready = PaymentCallback.objects.filter(status='received', retry_after__lte=now).order_by('pk')
+        jobs.claim_rows(
+            ready, batch_size,
+            status='applying', claimed_by=worker, claimed_at=now, attempts=F('attempts') + 1,
+        )
+        claimed = list(PaymentCallback.objects.filter(status='applying', claimed_by=worker).order_by('pk'))
+        if not claimed:
+            break
+        stats.update(apply_batch(claimed))
+
+    # Callbacks still waiting for their transaction: come back when the first is due
+    due = PaymentCallback.objects.filter(status='received').aggregate(due=Min('retry_after'))['due']
+    if due is not None:
+        schedule_apply(max((due - timezone.now()).total_seconds(), 0))
+    return stats
@@ -0,0 +1,102 @@
+"""
+Discharge summary PDF rendering.
+
+This module must not import Django models: it runs inside the document
+process pool (see documents.py), whose workers only receive plain data.
+PDFs are written directly (text only, built-in Helvetica fonts), so
+rendering needs no third-party package.
+"""
+import textwrap
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842   # A4 in points
+MARGIN = 50
+LINE_HEIGHT = 14
+WRAP = 95                            # characters per line at 10pt
+
+
+def _escape(text):
+    text = str(text).replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    # Built-in fonts use WinAnsi: anything else becomes '?'
+    return text.encode('cp1252', 'replace').decode('latin-1')
+
+
+def summary_lines(data):
+    """[(font size, bold, text)] for a discharge summary built by documents.summary_data()."""
+    patient, discharge, delivery = data['patient'], data['discharge'], data.get('delivery')
+    lines = [
+        (16, True, "Discharge Summary"),
+        (10, False, data.get('facility', '')),
+        (10, False, ''),
+        (12, True, "Mother"),
+        (10, False, f"Name: {patient['full_name']}    Age: {patient['age']}    Phone: {patient['phone']}"),
+        (10, False, f"County / Ward: {patient['county'] or '-'} / {patient['ward'] or '-'}"),
+        (10, False, f"Gravida / Parity: {patient['gravida']} / {patient['parity']}    Risk level: {patient['risk_level']}"),
+        (10, False, ''),
+        (12, True, "Admission & Discharge"),
+        (10, False, f"Admitted: {discharge['admission_date'] or '-'}    Discharged: {discharge['discharge_date']}"),
+        (10, False, f"Condition: {discharge['condition']}    Discharged by: {discharge['discharged_by'] or '-'}"),
+        (10, False, f"Billing: {discharge['billing_status']}"),
+    ]
+    if delivery:
+        lines += [
+            (10, False, ''),
+            (12, True, "Delivery"),
+            (10, False, f"Date: {delivery['delivery_date']}    Type: {delivery['delivery_type']}"),
+            (10, False, f"Baby: {delivery['baby_gender'] or '-'}, {delivery['baby_weight'] or '-'} kg    "
+                        f"Attending: {delivery['attending_physician'] or '-'}"),
+        ]
+    for title, text in (("Medications", discharge['medications']), ("Notes", discharge['notes'])):
+        lines += [(10, False, ''), (12, True, title)]
+        for paragraph in (text or '-').splitlines() or ['-']:
+            for line in textwrap.wrap(paragraph, WRAP) or ['']:
+                lines.append((10, False, line))
+    return lines
+
+
+def render_discharge_summary(data):
+    """PDF bytes for one discharge summary."""
+    pages, current, y = [], [], PAGE_HEIGHT - MARGIN
+    for size, bold, text in summary_lines(data):
+        if y < MARGIN:
+            pages.append(current)
+            current, y = [], PAGE_HEIGHT - MARGIN
+        font = 'F2' if bold else 'F1'
+        current.append(f"BT /{font} {size} Tf {MARGIN} {y} Td ({_escape(text)}) Tj ET")
+        y -= LINE_HEIGHT + (size - 10)
+    pages.append(current)
+    return _build_pdf(pages)
+
+
+def _build_pdf(pages):
+    # Objects: 1 catalog, 2 page tree, 3-4 fonts, then (page, content) per page
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        None,
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>",
+    ]
+    page_refs = []
+    for commands in pages:
+        stream = "\n".join(commands).encode('latin-1')
+        page_number = len(objects) + 1
+        page_refs.append(f"{page_number} 0 R")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+            f"/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents {page_number + 1} 0 R >>"
+        )
+        objects.append((f"<< /Length {len(stream)} >>\nstream\n".encode('latin-1') + stream + b"\nendstream"))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(page_refs)}] /Count {len(pages)} >>"
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        if isinstance(body, str):
+            body = body.encode('latin-1')
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
@@ -0,0 +1,414 @@
+"""
+Reconciling M-Pesa statements against Transaction.
+
+Finance uploads the paybill statement export (CSV, or XLSX / XLS when
+openpyxl / xlrd is installed). The file is read row by row, keeping only a
+small tuple per money-in line. The transactions of the statement's period
+are then loaded in chunks into two in-memory indexes:
+
+    by receipt number                   RKL12ABC3D -> transaction
+    unpaid ones, by amount and time     500.00 -> sorted [(created, transaction)]
+
+and every line is matched in one pass, without a query per line:
+
+  - matched          receipt recorded with the same amount (nothing to do)
+  - confirmed        receipt recorded on a Pending / Failed payment: now Success
+  - matched_by_time  no receipt recorded, but an unpaid payment of the same
+                     amount started within RECONCILE_WINDOW_MINUTES (a lost
+                     callback): marked Success with the receipt
+
+The changes are written with a few bulk UPDATEs in one transaction, after
+the matched payments are locked and re-checked. What needs a person goes into
+the exceptions report: amount_mismatch, not_in_system (money with no payment
+record), duplicate_line, unreadable, missing_from_statement (recorded as
+paid, but not on the statement) and changed_meanwhile (a callback updated the
+payment while the statement was being read; it is left as the callback set it).
+"""
+import csv
+import io
+import logging
+import os
+import re
+from bisect import bisect_left
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
+
+from . import audit, counters
+from .dedupe import normalize_phone
+from .models import ChangeLog, Reconciliation, Transaction
+from .payments import MPESA_TIMEZONE
+from .sync import MODEL_RESOURCES
+
+try:
+    import openpyxl
+except ImportError:  # optional: without it only CSV / XLS statements can be read
+    openpyxl = None
+
+try:
+    import xlrd
+except ImportError:  # optional: without it only CSV / XLSX statements can be read
+    xlrd = None
+
+logger = logging.getLogger(__name__)
+
+# Statement column -> accepted header names (lower case)
+COLUMNS = {
+    'receipt': ('receipt no.', 'receipt no', 'receipt', 'transaction id'),
+    'time': ('completion time', 'transaction date', 'date'),
+    'status': ('transaction status', 'status'),
+    'paid_in': ('paid in', 'amount', 'credit'),
+    'party': ('other party info', 'details', 'description'),
+}
+TIME_FORMATS = ['%d-%m-%Y %H:%M:%S', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M', '%Y/%m/%d %H:%M:%S']
+
+Line = namedtuple('Line', 'number receipt at amount party')
+Record = namedtuple('Record', 'pk patient_id transaction_id amount status at phone')
+Issue = namedtuple('Issue', 'issue line receipt time amount other_party transaction recorded_amount recorded_status detail')
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# ==========================================
+# Reading statements
+# ==========================================
+def read_rows(handle, name):
+    """The rows (lists of cells) of a statement file opened in binary mode."""
+    suffix = os.path.splitext(name)[1].lower()
+    if suffix == '.xlsx':
+        if openpyxl is None:
+            raise ValueError("Reading .xlsx statements needs openpyxl installed; export the statement as CSV instead.")
+        book = openpyxl.load_workbook(handle, read_only=True, data_only=True)
+        try:
+            yield from book.worksheets[0].iter_rows(values_only=True)
+        finally:
+            book.close()
+    elif suffix == '.xls':
+        if xlrd is None:
+            raise ValueError("Reading .xls statements needs xlrd installed; export the statement as CSV instead.")
+        book = xlrd.open_workbook(file_contents=handle.read())
+        sheet = book.sheet_by_index(0)
+        for i in range(sheet.nrows):
+            yield [
+                xlrd.xldate_as_datetime(cell.value, book.datemode) if cell.ctype == xlrd.XL_CELL_DATE else cell.value
+                for cell in sheet.row(i)
+            ]
+    else:
+        yield from csv.reader(io.TextIOWrapper(handle, encoding='utf-8-sig', newline=''))
+
+
+def _header(row):
+    names = [str(cell or '').strip().lower() for cell in row]
+    found = {}
+    for column, aliases in COLUMNS.items():
+        for alias in aliases:
+            if alias in names:
+                found[column] = names.index(alias)
+                break
+    return found if {'receipt', 'time', 'paid_in'} <= found.keys() else None
+
+
+def _amount(value):
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    try:
+        return Decimal(str(value or '').replace(',', '').strip() or '0')
+    except InvalidOperation:
+        return None
+
+
+def _time(value):
+    """Statement times are East Africa Time. Returns a POSIX timestamp or None."""
+    if not isinstance(value, datetime):
+        text = str(value or '').strip()
+        try:
+            value = datetime.fromisoformat(text)
+        except ValueError:
+            for fmt in TIME_FORMATS:
+                try:
+                    value = datetime.strptime(text, fmt)
+                    break
+                except ValueError:
+                    continue
+            else:
+                return None
+    return value.replace(tzinfo=MPESA_TIMEZONE).timestamp()
+
+
+def statement_lines(rows, counts, issues):
+    """
+    The money-in lines of a statement as Line tuples. The header row is
+    found by its column names (exports start with a few lines of account
+    details). Other lines (withdrawals, charges, failed or blank ones) are
+    only counted as 'ignored'.
+    """
+    columns = None
+    for number, row in enumerate(rows, start=1):
+        if columns is None:
+            columns = _header(row)
+            continue
+        cells = dict.fromkeys(COLUMNS, '')
+        for column, index in columns.items():
+            if index < len(row) and row[index] is not None:
+                cells[column] = row[index]
+
+        receipt = str(cells['receipt']).strip().upper()
+        status = str(cells['status']).strip().lower()
+        if not receipt or status not in ('', 'completed'):
+            counts['ignored'] += 1
+            continue
+        amount, at = _amount(cells['paid_in']), _time(cells['time'])
+        if amount is None or at is None:
+            issues.append(Issue('unreadable', number, receipt, cells['time'], cells['paid_in'], '', '', '', '', "Unreadable time or amount"))
+            continue
+        if amount <= 0:
+            counts['ignored'] += 1
+            continue
+        yield Line(number, receipt, at, amount, str(cells['party']).strip())
+
+    if columns is None:
+        raise ValueError("No header row with 'Receipt No.', 'Completion Time' and 'Paid In' columns was found.")
+
+
+# ==========================================
+# Index of recorded payments
+# ==========================================
+def _record(row):
+    pk, patient_id, transaction_id, amount, status, created_at, phone = row
+    return Record(pk, patient_id, transaction_id or '', amount, status, created_at.timestamp(), normalize_phone(phone))
+
+
+class PaymentIndex:
+    """Recorded payments of a period, by receipt and (for unpaid ones) by amount and time."""
+    FIELDS = ('pk', 'patient_id', 'transaction_id', 'amount', 'status', 'created_at', 'patient__phone')
+
+    def __init__(self):
+        self.records = {}
+        self.by_receipt = {}
+        self.unpaid = defaultdict(list)   # amount -> [(created timestamp, pk)], sorted
+
+    def add(self, record):
+        self.records[record.pk] = record
+        if record.transaction_id:
+            self.by_receipt[record.transaction_id] = record.pk
+        elif record.status != 'Success':
+            self.unpaid[record.amount].append((record.at, record.pk))
+
+    def load(self, start, end, chunk_size=5000):
+        rows = (
+            Transaction.objects.filter(created_at__gte=start, created_at__lte=end)
+            .values_list(*self.FIELDS).order_by().iterator(chunk_size=chunk_size)
+        )
+        for row in rows:
+            self.add(_record(row))
+        for candidates in self.unpaid.values():
+            candidates.sort()
+        # Parallel lists of times, for bisect
+        self.unpaid_times = {amount: [at for at, _ in c] for amount, c in self.unpaid.items()}
+
+    def load_receipts(self, receipts, chunk_size=1000):
+        """Receipts recorded outside the loaded period (a payment started before the statement)."""
+        receipts = list(receipts)
+        for i in range(0, len(receipts), chunk_size):
+            rows = Transaction.objects.filter(transaction_id__in=receipts[i:i + chunk_size]).values_list(*self.FIELDS)
+            for row in rows:
+                record = _record(row)
+                self.records[record.pk] = record
+                self.by_receipt[record.transaction_id] = record.pk
+
+    def nearest_unpaid(self, line, window, taken):
+        """The unpaid payment of the line's amount started closest to it (same phone first), or None."""
+        times = self.unpaid_times.get(line.amount)
+        if not times:
+            return None
+        candidates = self.unpaid[line.amount]
+        match = re.search(r'\*+(\d{2,})', line.party)
+        suffix = match.group(1) if match else ''
+        best = None
+        for i in range(bisect_left(times, line.at - window), len(times)):
+            at, pk = candidates[i]
+            if at > line.at + window:
+                break
+            if pk in taken:
+                continue
+            key = (not (suffix and self.records[pk].phone.endswith(suffix)), abs(at - line.at))
+            if best is None or key < best[0]:
+                best = (key, pk)
+        return best[1] if best else None
+
+
+# ==========================================
+# Matching
+# ==========================================
+def _issue(kind, line, record=None, detail=''):
+    return Issue(
+        kind, line.number if line else '', line.receipt if line else (record.transaction_id if record else ''),
+        datetime.fromtimestamp(line.at, MPESA_TIMEZONE).strftime('%Y-%m-%d %H:%M:%S') if line else '',
+        line.amount if line else '', line.party if line else '',
+        record.pk if record else '', record.amount if record else '', record.status if record else '', detail,
+    )
+
+
+def reconcile(rows, window_minutes=None, dry_run=False):
+    """
+    Matches statement rows (from read_rows) against the recorded payments and,
+    unless `dry_run`, applies the changes. Returns (Counter of outcomes, [Issue]).
+    """
+    window = 60 * (window_minutes or _setting('RECONCILE_WINDOW_MINUTES', 15))
+    counts, issues = Counter(), []
+    lines = list(statement_lines(rows, counts, issues))
+    counts['lines'] = len(lines) + counts['ignored'] + len(issues)
+    if not lines:
+        return counts, issues
+
+    start = datetime.fromtimestamp(min(line.at for line in lines), MPESA_TIMEZONE)
+    end = datetime.fromtimestamp(max(line.at for line in lines), MPESA_TIMEZONE)
+    index = PaymentIndex()
+    index.load(start - timedelta(seconds=window), end + timedelta(seconds=window))
+    index.load_receipts({line.receipt for line in lines} - index.by_receipt.keys())
+
+    seen, matched, confirm, assign = set(), set(), [], []
+    for line in lines:
+        if line.receipt in seen:
+            issues.append(_issue('duplicate_line', line, detail="Receipt appears more than once on the statement"))
+            continue
+        seen.add(line.receipt)
+
+        pk = index.by_receipt.get(line.receipt)
+        if pk is not None:
+            record = index.records[pk]
+            matched.add(pk)
+            if record.amount != line.amount:
+                issues.append(_issue('amount_mismatch', line, record, f"Statement KES {line.amount}, recorded KES {record.amount}"))
+            elif record.status != 'Success':
+                confirm.append((record, line))
+                counts['confirmed'] += 1
+            else:
+                counts['matched'] += 1
+            continue
+
+        pk = index.nearest_unpaid(line, window, matched)
+        if pk is not None:
+            matched.add(pk)
+            assign.append((index.records[pk], line))
+            counts['matched_by_time'] += 1
+        else:
+            issues.append(_issue('not_in_system', line, detail="No recorded payment for this receipt"))
+
+    # Recorded as paid during the statement's period, but no money arrived
+    first, last = start.timestamp(), end.timestamp()
+    for record in index.records.values():
+        if record.status == 'Success' and record.pk not in matched and first <= record.at <= last:
+            issues.append(_issue('missing_from_statement', None, record, "Recorded as paid but not on the statement"))
+
+    if not dry_run and (confirm or assign):
+        lost = apply_changes(confirm, assign)
+        lost_pks = {issue.transaction for issue in lost}
+        counts['confirmed'] -= sum(record.pk in lost_pks for record, _ in confirm)
+        counts['matched_by_time'] -= sum(record.pk in lost_pks for record, _ in assign)
+        issues.extend(lost)
+    for issue in issues:
+        counts[issue.issue] += 1
+    return counts, issues
+
+
+def _recheck(confirm, assign, chunk_size):
+    """
+    Locks the matched payments and keeps the pairs whose payment is still as
+    the index saw it (and whose receipt is not recorded elsewhere by now).
+    Returns (confirm, [(record, receipt)], [Issue] for the others).
+    """
+    pks = [record.pk for record, _ in confirm + assign]
+    current = {}
+    for i in range(0, len(pks), chunk_size):
+        rows = Transaction.objects.select_for_update().filter(pk__in=pks[i:i + chunk_size])
+        for pk, status, receipt in rows.values_list('pk', 'status', 'transaction_id'):
+            current[pk] = (status, receipt or '')
+    receipts = [line.receipt for _, line in assign]
+    taken = set()
+    for i in range(0, len(receipts), chunk_size):
+        taken.update(
+            Transaction.objects.filter(transaction_id__in=receipts[i:i + chunk_size]).values_list('transaction_id', flat=True)
+        )
+
+    keep_confirm, keep_assign, lost = [], [], []
+    for record, line in confirm + assign:
+        if current.get(record.pk) != (record.status, record.transaction_id):
+            lost.append(_issue('changed_meanwhile', line, record, "Payment was updated while the statement was reconciled"))
+        elif record.transaction_id:
+            keep_confirm.append(record)
+        elif line.receipt in taken:
+            lost.append(_issue('changed_meanwhile', line, record, "Receipt was recorded on another payment meanwhile"))
+        else:
+            keep_assign.append((record, line.receipt))
+    return keep_confirm, keep_assign, lost
+
+
+@transaction.atomic
+def apply_changes(confirm, assign, chunk_size=1000):
+    """
+    Marks the matched [(record, line)] payments paid with bulk UPDATEs,
+    logging them for sync and the audit trail. The records come from an
+    index read earlier: payments a callback changed since are left alone and
+    returned as 'changed_meanwhile' Issues.
+    """
+    confirm, assign, lost = _recheck(confirm, assign, chunk_size)
+    now = timezone.now()
+    ids = [record.pk for record in confirm]
+    for i in range(0, len(ids), chunk_size):
+        Transaction.objects.filter(pk__in=ids[i:i + chunk_size]).update(status='Success', updated_at=now)
+    Transaction.objects.bulk_update(
+        [Transaction(pk=record.pk, status='Success', transaction_id=receipt, updated_at=now) for record, receipt in assign],
+        ['status', 'transaction_id', 'updated_at'], batch_size=500,
+    )
+
+    # Receipts are not texted: these payments were made days or weeks ago
+    resource = MODEL_RESOURCES[Transaction]
+    ChangeLog.record_many(resource, ids + [record.pk for record, _ in assign])
+    for record in confirm:
+        audit.record(audit.make_entry(
+            resource, Transaction(pk=record.pk, patient_id=record.patient_id), 'update', {'status': [record.status, 'Success']},
+        ))
+    for record, receipt in assign:
+        audit.record(audit.make_entry(
+            resource, Transaction(pk=record.pk, patient_id=record.patient_id), 'update',
+            {'status': [record.status, 'Success'], 'transaction_id': [record.transaction_id or None, receipt]},
+        ))
+    counters.refresh([record.patient_id for record in confirm] + [record.patient_id for record, _ in assign], [Transaction])
+    return lost
+
+
+def report_csv(issues):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(Issue._fields)
+    writer.writerows(issues)
+    return buffer.getvalue().encode('utf-8')
+
+
+# ==========================================
+# Uploaded statements
+# ==========================================
+def run(reconciliation_id):
+    """Reconciles an uploaded statement (the 'reconcile_statement' background task)."""
+    if not Reconciliation.objects.filter(pk=reconciliation_id, status='queued').update(status='running'):
+        return
+    reconciliation = Reconciliation.objects.get(pk=reconciliation_id)
+    try:
+        with reconciliation.statement.open('rb') as handle:
+            counts, issues = reconcile(read_rows(handle, reconciliation.statement.name), dry_run=reconciliation.dry_run)
+        reconciliation.report.save(f"reconciliation-{reconciliation.pk}.csv", ContentFile(report_csv(issues)), save=False)
+    except Exception as e:
+        logger.exception("Reconciliation %s failed", reconciliation_id)
+        Reconciliation.objects.filter(pk=reconciliation_id).update(status='failed', error=str(e) or repr(e), finished_at=timezone.now())
+        return
+    Reconciliation.objects.filter(pk=reconciliation_id).update(
+        status='done', counts=dict(counts), report=reconciliation.report.name, finished_at=timezone.now(),
+    )
@@ -0,0 +1,250 @@
+"""
+Maternal outcome reports.
+
+Each report counts one outcome (delivery type, baby weight band, discharge
+condition) broken down by any of the mother's risk level, age band and
+parity. A report compiles to ONE GROUP BY query over Delivery / Discharge
+joined to PregnantWoman; the rows are pivoted in Python.
+
+Results are stored in ReportRun under a key made of the report, its
+parameters and the data version (last ChangeLog seq), so repeating a report
+on unchanged data costs one indexed lookup. New runs are computed by a
+'run_report' background job (see jobs.py / tasks.py), so a run survives the
+web process that asked for it; the page waits REPORT_INLINE_WAIT seconds and
+then switches to polling. A run still queued or running after
+REPORT_TIMEOUT seconds is given up as failed and asked for again.
+"""
+import csv
+import hashlib
+import io
+import json
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Case, CharField, Count, F, Q, Value, When
+from django.utils import timezone
+
+from . import jobs
+from .models import Delivery, Discharge, ChangeLog, ReportRun
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # optional: without it exports use the columnar JSON format
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+
+# ==========================================
+# Dimensions and reports
+# ==========================================
+def _bands(field, bands, output=CharField()):
+    """CASE expression mapping a number to a band label; bands = [(upper bound, label)], last upper is None."""
+    whens = [When(**{f'{field}__isnull': True}, then=Value('Not recorded'))]
+    whens += [When(**{f'{field}__lt': upper}, then=Value(label)) for upper, label in bands if upper is not None]
+    return Case(*whens, default=Value(bands[-1][1]), output_field=output)
+
+
+# Breakdown columns, as expressions over the mother ('patient__...')
+DIMENSIONS = {
+    'risk_level': lambda: F('patient__risk_level'),
+    'age_band': lambda: _bands('patient__age', [(20, 'Under 20'), (35, '20-34'), (None, '35+')]),
+    'parity': lambda: _bands('patient__parity', [(1, '0'), (3, '1-2'), (5, '3-4'), (None, '5+')]),
+}
+
+
+class Report:
+    def __init__(self, title, model, date_field, outcome, outcome_labels):
+        self.title = title
+        self.model = model
+        self.date_field = date_field
+        self.outcome = outcome                  # callable -> expression
+        self.outcome_labels = outcome_labels    # column order
+
+    def queryset(self, params):
+        rows = self.model.objects.all()
+        if params.get('date_from'):
+            rows = rows.filter(**{f'{self.date_field}__gte': params['date_from']})
+        if params.get('date_to'):
+            rows = rows.filter(**{f'{self.date_field}__lte': params['date_to']})
+        if params.get('county'):
+            rows = rows.filter(patient__county=params['county'])
+        return rows
+
+    def compile(self, params):
+        """The single GROUP BY query: (dimensions..., outcome, n) rows."""
+        dims = params['by']
+        return (
+            self.queryset(params)
+            .annotate(**{f'dim_{d}': DIMENSIONS[d]() for d in dims}, outcome=self.outcome())
+            .values(*[f'dim_{d}' for d in dims], 'outcome')
+            .annotate(n=Count('pk'))
+            .order_by()
+        )
+
+    def run(self, params):
+        """{'columns': [...], 'rows': [[...]]}, one row per combination of the dimensions."""
+        dims = params['by']
+        pivot = {}
+        for row in self.compile(params):
+            key = tuple(row[f'dim_{d}'] or 'Not recorded' for d in dims)
+            pivot.setdefault(key, {})[row['outcome']] = row['n']
+
+        columns = dims + self.outcome_labels + ['total']
+        rows = []
+        for key in sorted(pivot):
+            counts = pivot[key]
+            values = [counts.get(label, 0) for label in self.outcome_labels]
+            rows.append(list(key) + values + [sum(values)])
+        return {'columns': columns, 'rows': rows}
+
+
+REPORTS = {
+    'delivery_mix': Report(
+        "Delivery type mix", Delivery, 'delivery_date',
+        outcome=lambda: F('delivery_type'),
+        outcome_labels=[label for label, _ in Delivery.DELIVERY_TYPES],
+    ),
+    'baby_weight': Report(
+        "Baby weight distribution", Delivery, 'delivery_date',
+        outcome=lambda: Case(
+            When(baby_weight__isnull=True, then=Value('Not weighed')),
+            When(baby_weight__lt=1.5, then=Value('Under 1.5 kg')),
+            When(baby_weight__lt=2.5, then=Value('1.5-2.5 kg')),
+            When(baby_weight__lt=4, then=Value('2.5-4 kg')),
+            default=Value('4 kg and over'),
+            output_field=CharField(),
+        ),
+        outcome_labels=['Under 1.5 kg', '1.5-2.5 kg', '2.5-4 kg', '4 kg and over', 'Not weighed'],
+    ),
+    'discharge_condition': Report(
+        "Discharge condition", Discharge, 'discharge_date',
+        outcome=lambda: F('condition'),
+        outcome_labels=[label for label, _ in Discharge.CONDITION_CHOICES],
+    ),
+}
+
+
+def clean_params(data):
+    """Report parameters from a query dict; unknown dimensions are dropped."""
+    by = data.getlist('by') if hasattr(data, 'getlist') else data.get('by', [])
+    return {
+        'by': [d for d in DIMENSIONS if d in by],
+        'date_from': data.get('date_from') or '',
+        'date_to': data.get('date_to') or '',
+        'county': data.get('county') or '',
+    }
+
+
+# ==========================================
+# Result cache
+# ==========================================
+def data_version():
+    """Last ChangeLog seq: moves on every save/delete of clinical data (one index lookup)."""
+    return ChangeLog.objects.order_by('-seq').values_list('seq', flat=True).first() or 0
+
+
+def cache_key(report, params, version):
+    raw = json.dumps([report, params, version], sort_keys=True)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def fail_stale(timeout=None):
+    """Runs queued or running for longer than REPORT_TIMEOUT seconds are marked failed."""
+    timeout = timeout or getattr(settings, 'REPORT_TIMEOUT', 900)
+    cutoff = timezone.now() - timedelta(seconds=timeout)
+    return ReportRun.objects.filter(
+        Q(status='queued', created_at__lt=cutoff) | Q(status='running', started_at__lt=cutoff),
+    ).update(status='failed', error=f"Did not finish within {timeout}s", finished_at=timezone.now())
+
+
+def get_or_submit(report, params):
+    """
+    The ReportRun for this report/params at the current data version: a
+    finished or in-progress one if it exists, otherwise a new queued run
+    with its 'run_report' job.
+    """
+    version = data_version()
+    key = cache_key(report, params, version)
+    fail_stale()
+    run = ReportRun.objects.filter(cache_key=key).exclude(status='failed').order_by('-pk').first()
+    if run is not None:
+        return run
+
+    run = ReportRun.objects.create(report=report, params=params, cache_key=key, data_version=version)
+    submit(run.pk)
+    return run
+
+
+# ==========================================
+# Background worker
+# ==========================================
+def submit(run_id):
+    # Written in the caller's transaction: the job exists iff the run does
+    jobs.enqueue('run_report', run_id=run_id)
+
+
+def wait(run_id, timeout, poll=0.2):
+    """Waits up to `timeout` seconds for a run to finish (or fail)."""
+    deadline = time.monotonic() + timeout
+    while ReportRun.objects.filter(pk=run_id, status__in=('queued', 'running')).exists():
+        if time.monotonic() >= deadline:
+            return
+        time.sleep(poll)
+
+
+def execute(run_id):
+    """Computes one queued run ('run_report' job or `manage.py run_reports`)."""
+    # Claim it: only one worker may move it from queued to running
+    claimed = ReportRun.objects.filter(pk=run_id, status='queued').update(status='running', started_at=timezone.now())
+    if not claimed:
+        return
+    run = ReportRun.objects.get(pk=run_id)
+    try:
+        result = REPORTS[run.report].run(run.params)
+    except Exception as e:
+        logger.exception("Report run %s failed", run_id)
+        ReportRun.objects.filter(pk=run_id).update(status='failed', error=str(e), finished_at=timezone.now())
+        return
+    # Dates / Decimals as JSON-safe values
+    result = json.loads(json.dumps(result, cls=DjangoJSONEncoder))
+    ReportRun.objects.filter(pk=run_id).update(status='done', result=result, finished_at=timezone.now())
+
+
+# ==========================================
+# Export
+# ==========================================
+def to_csv(result):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(result['columns'])
+    writer.writerows(result['rows'])
+    return buffer.getvalue().encode('utf-8')
+
+
+def to_columns(result):
+    """Column-oriented JSON: {'columns': [...], 'data': {column: [values]}}."""
+    data = {column: [row[i] for row in result['rows']] for i, column in enumerate(result['columns'])}
+    return json.dumps({'columns': result['columns'], 'data': data}, separators=(',', ':')).encode('utf-8')
+
+
+def to_parquet(result):
+    table = pyarrow.table({
+        column: [row[i] for row in result['rows']] for i, column in enumerate(result['columns'])
+    })
+    buffer = io.BytesIO()
+    pyarrow.parquet.write_table(table, buffer)
+    return buffer.getvalue()
+
+
+# format -> (function, content type, file extension)
+EXPORTS = {
+    'csv': (to_csv, 'text/csv', 'csv'),
+    'columns': (to_columns, 'application/json', 'columns.json'),
+}
+if pyarrow is not None:
+    EXPORTS['parquet'] = (to_parquet, 'application/vnd.apache.parquet', 'parquet')
@@ -0,0 +1,104 @@
+"""
+Read-replica routing.
+
+Reads of the 'patients' app tables go to the replica ONLY while a request for
+one of settings.REPLICA_READ_VIEWS is being handled (see
+ReplicaRoutingMiddleware). Everything else - writes, sessions, auth, reads
+inside a transaction, and any request after the replica failed or lagged -
+stays on 'default'.
+"""
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections, DatabaseError
+from django.utils import timezone
+
+PRIMARY = 'default'
+
+# Alias to read from for the current request/task, or None for the primary
+_read_alias = ContextVar('replica_read_alias', default=None)
+
+# Per-process cache of the last health check: {'checked': monotonic time, 'ok': bool}
+_health = {'checked': 0.0, 'ok': False}
+
+
+def replica_alias():
+    alias = getattr(settings, 'REPLICA_DATABASE', None)
+    return alias if alias and alias in settings.DATABASES else None
+
+
+def use_replica(alias):
+    """Route reads to `alias` until reset_replica(token) is called."""
+    return _read_alias.set(alias)
+
+
+def reset_replica(token):
+    _read_alias.reset(token)
+
+
+def mark_replica_unhealthy():
+    _health['checked'] = time.monotonic()
+    _health['ok'] = False
+
+
+def replica_lag_seconds(alias):
+    """
+    How far the replica is behind, using the sync ChangeLog as a heartbeat:
+    the age of the oldest change the primary has but the replica does not.
+    """
+    from .models import ChangeLog
+
+    replica_seq = ChangeLog.objects.using(alias).order_by('-seq').values_list('seq', flat=True).first() or 0
+    missing_since = (
+        ChangeLog.objects.using(PRIMARY)
+        .filter(seq__gt=replica_seq)
+        .order_by('seq')
+        .values_list('changed_at', flat=True)
+        .first()
+    )
+    if missing_since is None:
+        return 0.0
+    return max((timezone.now() - missing_since).total_seconds(), 0.0)
+
+
+def replica_is_healthy(alias):
+    """
+    True if the replica answers and is within REPLICA_MAX_LAG seconds.
+    Re-checked at most every REPLICA_CHECK_INTERVAL seconds per process.
+    """
+    now = time.monotonic()
+    if now - _health['checked'] < getattr(settings, 'REPLICA_CHECK_INTERVAL', 5):
+        return _health['ok']
+
+    try:
+        ok = replica_lag_seconds(alias) <= getattr(settings, 'REPLICA_MAX_LAG', 10)
+    except DatabaseError:
+        ok = False
+    _health['checked'] = now
+    _health['ok'] = ok
+    return ok
+
+
+class ReadReplicaRouter:
+    route_app_labels = {'patients'}
+
+    def db_for_read(self, model, **hints):
+        alias = _read_alias.get()
+        if alias is None or model._meta.app_label not in self.route_app_labels:
+            return None
+        # Reads inside a transaction must see that transaction's writes
+        if connections[PRIMARY].in_atomic_block:
+            return PRIMARY
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replica rows are copies of primary rows
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica gets its schema from the primary, never from migrate
+        return db == PRIMARY
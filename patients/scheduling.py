@@ -0,0 +1,230 @@
+"""
+Antenatal care (ANC) visit schedules.
+
+The WHO 2016 model has 8 contacts, at 12, 20, 26, 30, 34, 36, 38 and 40
+weeks of gestation (counted from the LMP). For each mother the contacts that
+are still ahead of her are booked on the first clinic day on/after the target
+date where a doctor has a free slot (settings.ANC_DOCTORS,
+ANC_DOCTOR_DAILY_CAPACITY), looking up to ANC_SEARCH_DAYS ahead.
+
+Doctor load is kept in a DoctorCalendar: one GROUP BY query loads the
+already-booked counts for the whole date range, so booking itself runs no
+queries. Mothers are processed in pk-ordered chunks, each chunk written with
+bulk_create() in its own transaction, so memory stays the same for a cohort
+of 50 or 50,000 (the calendar holds at most days x doctors counters).
+
+Contacts are recognised by their purpose ("ANC contact 3 of 8"), so running
+the scheduler again only books the contacts that are missing. A contact
+whose date has passed is booked for today only while its window is open
+(until the next contact is due, or LAST_CONTACT_WINDOW after the last one);
+a mother registered late is not booked for the contacts she has missed.
+"""
+import re
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef
+from django.utils import timezone
+
+from . import audit, counters
+from .models import PregnantWoman, Appointment, Delivery, ChangeLog, bulk_create_with_pks
+
+# Gestational week of each WHO contact
+ANC_CONTACT_WEEKS = [12, 20, 26, 30, 34, 36, 38, 40]
+
+# How long after its date the last contact can still be booked
+LAST_CONTACT_WINDOW = timedelta(weeks=2)
+
+PURPOSE = "ANC contact {number} of {total} ({weeks} weeks)"
+PURPOSE_PREFIX = "ANC contact "
+_PURPOSE_NUMBER = re.compile(r'^ANC contact (\d+) of ')
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def contact_number(purpose):
+    match = _PURPOSE_NUMBER.match(purpose or '')
+    return int(match.group(1)) if match else None
+
+
+def contact_dates(lmp):
+    """[(contact number, weeks, target date)] for a pregnancy with this LMP."""
+    return [(i, weeks, lmp + timedelta(weeks=weeks)) for i, weeks in enumerate(ANC_CONTACT_WEEKS, start=1)]
+
+
+# ==========================================
+# Doctor capacity
+# ==========================================
+class DoctorCalendar:
+    """Booked appointments per (date, doctor) between `start` and `end`."""
+
+    def __init__(self, start, end, doctors=None, capacity=None, clinic_days=None):
+        self.start = start
+        self.end = end
+        self.doctors = list(doctors or _setting('ANC_DOCTORS', []))
+        self.capacity = capacity or _setting('ANC_DOCTOR_DAILY_CAPACITY', 16)
+        self.clinic_days = set(clinic_days if clinic_days is not None else _setting('ANC_CLINIC_DAYS', range(5)))
+        self.booked = {}
+
+    def load(self):
+        """One query: scheduled appointments per day and doctor in the range."""
+        rows = (
+            Appointment.objects
+            .filter(date__range=(self.start, self.end), status='Scheduled', doctor__in=self.doctors)
+            .values_list('date', 'doctor')
+            .annotate(n=Count('id'))
+        )
+        self.booked = {(day, doctor): n for day, doctor, n in rows}
+        return self
+
+    def book(self, target, search_days=None):
+        """
+        Reserves a slot on the first clinic day from `target` on.
+        Returns (date, doctor, slot index) or None if every doctor is full.
+        """
+        search_days = _setting('ANC_SEARCH_DAYS', 7) if search_days is None else search_days
+        for offset in range(search_days + 1):
+            day = target + timedelta(days=offset)
+            if day > self.end:
+                return None
+            if day.weekday() not in self.clinic_days:
+                continue
+            # Least busy doctor that day spreads the load evenly
+            doctor = min(self.doctors, key=lambda d: self.booked.get((day, d), 0), default=None)
+            if doctor is None:
+                return None
+            slot = self.booked.get((day, doctor), 0)
+            if slot < self.capacity:
+                self.booked[(day, doctor)] = slot + 1
+                return day, doctor, slot
+        return None
+
+
+def slot_time(slot):
+    start = datetime.strptime(_setting('ANC_CLINIC_START', '08:00'), '%H:%M')
+    return (start + timedelta(minutes=slot * _setting('ANC_SLOT_MINUTES', 20))).time()
+
+
+# ==========================================
+# Schedule generation
+# ==========================================
+def plan(mother, calendar, booked_numbers=(), today=None):
+    """
+    Unsaved Appointments for the contacts `mother` still needs.
+    Returns (appointments, number of contacts that found no free slot).
+    """
+    today = today or timezone.now().date()
+    contacts = contact_dates(mother.lmp)
+    appointments, unplaced = [], 0
+    for number, weeks, target in contacts:
+        if number in booked_numbers:
+            continue
+        if mother.expected_due_date and target > mother.expected_due_date + timedelta(weeks=2):
+            continue
+        if target < today:
+            # Overdue: booked for today while its window is open, otherwise missed
+            closes = contacts[number][2] if number < len(contacts) else target + LAST_CONTACT_WINDOW
+            if closes <= today:
+                continue
+            target = today
+        slot = calendar.book(target)
+        if slot is None:
+            unplaced += 1
+            continue
+        day, doctor, index = slot
+        appointments.append(Appointment(
+            patient_id=mother.pk,
+            date=day,
+            time=slot_time(index),
+            purpose=PURPOSE.format(number=number, total=len(ANC_CONTACT_WEEKS), weeks=weeks),
+            doctor=doctor,
+            status='Scheduled',
+        ))
+    return appointments, unplaced
+
+
+def booked_contacts(patient_ids):
+    """{patient id: {contact numbers already on the books (not cancelled)}}"""
+    booked = {}
+    rows = (
+        Appointment.objects
+        .filter(patient_id__in=patient_ids, purpose__startswith=PURPOSE_PREFIX)
+        .exclude(status='Cancelled')
+        .values_list('patient_id', 'purpose')
+    )
+    for patient_id, purpose in rows:
+        number = contact_number(purpose)
+        if number:
+            booked.setdefault(patient_id, set()).add(number)
+    return booked
+
+
+def save_appointments(appointments, batch_size=500):
+    """bulk_create() plus the sync change log and audit entries it does not send."""
+    with transaction.atomic():
+        created = bulk_create_with_pks(Appointment, appointments, ['patient_id', 'date', 'time'], batch_size)
+        ChangeLog.record_many('appointments', [a.pk for a in created if a.pk is not None])
+        for appointment in created:
+            audit.record(audit.make_entry('appointments', appointment, 'create', audit.diff({}, audit.snapshot(appointment))))
+        counters.refresh({a.patient_id for a in created}, [Appointment])
+    return created
+
+
+def schedule_patient(mother, today=None):
+    """Books the missing ANC contacts of one (newly registered) mother."""
+    today = today or timezone.now().date()
+    calendar = DoctorCalendar(today, mother.lmp + timedelta(weeks=ANC_CONTACT_WEEKS[-1] + 2)).load()
+    appointments, unplaced = plan(mother, calendar, booked_contacts([mother.pk]).get(mother.pk, ()), today)
+    if appointments:
+        save_appointments(appointments)
+    return len(appointments), unplaced
+
+
+def active_pregnancies(today=None):
+    """Mothers who have not delivered and whose last contact is still ahead."""
+    today = today or timezone.now().date()
+    return (
+        PregnantWoman.objects
+        .filter(lmp__gt=today - timedelta(weeks=ANC_CONTACT_WEEKS[-1]))
+        .exclude(Exists(Delivery.objects.filter(patient=OuterRef('pk'))))
+        .only('id', 'lmp', 'expected_due_date')
+    )
+
+
+def schedule_cohort(queryset=None, chunk_size=1000, today=None, progress=None):
+    """
+    Books the missing ANC contacts of every mother in `queryset` (default:
+    active_pregnancies()). Walks the mothers by pk in chunks so only one
+    chunk of mothers and appointments is in memory at a time.
+    Returns (mothers processed, appointments created, contacts left unplaced).
+    """
+    today = today or timezone.now().date()
+    queryset = (queryset if queryset is not None else active_pregnancies(today)).order_by('pk')
+    # Latest possible contact: 40 weeks after today's LMP, plus the search window
+    calendar = DoctorCalendar(today, today + timedelta(weeks=ANC_CONTACT_WEEKS[-1] + 2)).load()
+
+    mothers_done = created = unplaced = 0
+    last_pk = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1].pk
+        booked = booked_contacts([m.pk for m in chunk])
+
+        appointments = []
+        for mother in chunk:
+            planned, missed = plan(mother, calendar, booked.get(mother.pk, ()), today)
+            appointments.extend(planned)
+            unplaced += missed
+        if appointments:
+            save_appointments(appointments)
+
+        mothers_done += len(chunk)
+        created += len(appointments)
+        if progress:
+            progress(mothers_done, created)
+    return mothers_done, created, unplaced
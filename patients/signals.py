@@ -0,0 +1,157 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import m2m_changed, pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from . import audit, counters, forms, scheduling, sms
+from .backends import forget_user
+from .models import Appointment, ChangeLog, Delivery, PregnantWoman, Transaction
+from .sync import MODEL_RESOURCES
+
+
+# ------------------------------------------------------
+# CHANGE LOG FOR OFFLINE SYNC
+# ------------------------------------------------------
+# Every save / delete of a synced record (including cascaded deletes, e.g. the
+# appointments removed by delete_patient) appends one ChangeLog row.
+
+@receiver(post_save)
+def log_save(sender, instance, raw=False, **kwargs):
+    resource = MODEL_RESOURCES.get(sender)
+    if resource and not raw:
+        ChangeLog.objects.create(resource=resource, object_id=instance.pk, action='upsert')
+
+
+@receiver(post_delete)
+def log_delete(sender, instance, **kwargs):
+    resource = MODEL_RESOURCES.get(sender)
+    if resource:
+        ChangeLog.objects.create(resource=resource, object_id=instance.pk, action='delete')
+
+
+# ------------------------------------------------------
+# AUDIT LOG
+# ------------------------------------------------------
+# pre_save reads the stored values of a row about to be updated; post_save /
+# post_delete compare against them and queue an AuditEntry (written in
+# batches, see audit.py). Rows only loaded, never saved, cost nothing.
+
+def audit_original(sender, instance, raw=False, **kwargs):
+    adding = raw or instance._state.adding or instance.pk is None
+    instance._audit_original = {} if adding else audit.stored(instance)
+
+
+def audit_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    current = audit.snapshot(instance)
+    if created:
+        changes = audit.diff({}, current)
+    else:
+        changes = audit.diff(getattr(instance, '_audit_original', {}), current)
+        if not changes:
+            return
+    audit.record(audit.make_entry(MODEL_RESOURCES[sender], instance, 'create' if created else 'update', changes))
+
+
+def audit_delete(sender, instance, **kwargs):
+    # Keep the deleted values: [old, None] for every field
+    changes = {field: [value, None] for field, value in audit.snapshot(instance).items()}
+    audit.record(audit.make_entry(MODEL_RESOURCES[sender], instance, 'delete', changes))
+
+
+for _model in MODEL_RESOURCES:
+    pre_save.connect(audit_original, sender=_model, dispatch_uid=f'audit_original_{_model.__name__}')
+    post_save.connect(audit_save, sender=_model, dispatch_uid=f'audit_save_{_model.__name__}')
+    post_delete.connect(audit_delete, sender=_model, dispatch_uid=f'audit_delete_{_model.__name__}')
+
+
+# ------------------------------------------------------
+# CACHED LOGGED-IN USERS
+# ------------------------------------------------------
+# CachedModelBackend keeps users in the cache; drop the copy whenever the
+# account (password, is_active, groups, permissions) changes.
+
+@receiver([post_save, post_delete], sender=User)
+def forget_cached_user(sender, instance, **kwargs):
+    forget_user(instance.pk)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def forget_cached_user_access(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            forget_user(instance.pk)
+        return
+
+    # group.user_set.add(...) etc.: instance is the group / permission
+    if action == 'pre_clear':
+        # pk_set is None for clear(), so look the members up before they go
+        field = 'groups' if sender is User.groups.through else 'user_permissions'
+        pk_set = User.objects.filter(**{field: instance}).values_list('pk', flat=True)
+    elif action not in ('post_add', 'post_remove'):
+        return
+    for user_id in pk_set:
+        forget_user(user_id)
+
+
+# ------------------------------------------------------
+# CACHED PATIENT DROPDOWNS
+# ------------------------------------------------------
+# The patient <select> lists are cached per process (forms.py); a saved or
+# deleted mother tells every process to rebuild them once it is committed.
+
+@receiver([post_save, post_delete], sender=PregnantWoman)
+def forget_patient_choices(sender, **kwargs):
+    transaction.on_commit(lambda: forms.forget_choices(sender))
+
+
+# ------------------------------------------------------
+# ANC SCHEDULE FOR NEW MOTHERS
+# ------------------------------------------------------
+# Registering a mother books her WHO ANC contacts in the same transaction
+# (PregnantWoman.save() opens one for an insert).
+
+@receiver(post_save, sender=PregnantWoman)
+def schedule_anc_contacts(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and getattr(settings, 'ANC_AUTO_SCHEDULE', True):
+        scheduling.schedule_patient(instance)
+
+
+# ------------------------------------------------------
+# SMS RECEIPTS
+# ------------------------------------------------------
+# A payment that is (or becomes) successful texts the mother a receipt; the
+# message's reference makes sure each payment is only receipted once.
+
+@receiver(post_save, sender=Transaction)
+def text_payment_receipt(sender, instance, raw=False, **kwargs):
+    if instance.status == 'Success' and not raw and getattr(settings, 'SMS_RECEIPTS', True):
+        sms.queue_receipt(instance)
+
+
+# ------------------------------------------------------
+# PATIENT CARE SUMMARY
+# ------------------------------------------------------
+# A saved or deleted appointment / delivery / payment recomputes its mother's
+# summary columns (see counters.py); a row moved to another mother updates both.
+
+@receiver(pre_save, sender=Appointment)
+@receiver(pre_save, sender=Delivery)
+@receiver(pre_save, sender=Transaction)
+def remember_counted_patient(sender, instance, raw=False, **kwargs):
+    # The mother the row is stored with (read by audit_original, connected first)
+    instance._counted_patient_id = getattr(instance, '_audit_original', {}).get('patient_id')
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_save, sender=Delivery)
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Appointment)
+@receiver(post_delete, sender=Delivery)
+@receiver(post_delete, sender=Transaction)
+def refresh_patient_counters(sender, instance, raw=False, **kwargs):
+    if not raw:
+        counters.refresh([instance.patient_id, getattr(instance, '_counted_patient_id', None)], [sender])
@@ -0,0 +1,602 @@
+"""
+SMS notifications: visit reminders and payment receipts.
+
+queue() renders a template into an SmsMessage row and makes sure a
+'dispatch_sms' background job is waiting (see jobs.py / tasks.py). The job
+runs SMS_COALESCE_SECONDS later, so several messages for the same phone in
+that window leave as one SMS. dispatch() claims the queued rows, coalesces
+them per recipient and sends them in batches through the configured
+gateway (settings.SMS_GATEWAY), which keeps one connection open for the
+whole run. A token bucket holds sending to SMS_RATE_PER_SECOND; when the
+gateway itself answers "slow down" (HTTP 429) the dispatcher waits as told
+and retries the same batch. Messages the gateway rejects are queued again
+with an exponential backoff (next_attempt_at), and every SMS carries an id
+built from its messages, so a gateway can drop one it already accepted.
+
+Statuses: queued -> sending -> sent (accepted by the gateway) -> delivered
+or failed (delivery reports, see views.sms_delivery_report).
+
+For offline testing, `manage.py sms_gateway` runs StandInGateway, a local
+HTTP server speaking HttpGateway's protocol with its own rate limit.
+"""
+import hashlib
+import http.client
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db.models import F, Min, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import jobs
+from .dedupe import normalize_phone
+from .models import Appointment, Job, SmsMessage
+
+logger = logging.getLogger(__name__)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# ==========================================
+# Templates
+# ==========================================
+TEMPLATES = {
+    'appointment_reminder': (
+        "Hello {name}, a reminder of your {purpose} on {date:%a %d %b} at {time:%H:%M}. "
+        "Reply or call us if you cannot come. - {facility}"
+    ),
+    'contact_reminder': (
+        "Hello {contact}, {name} has a {purpose} on {date:%a %d %b} at {time:%H:%M}. "
+        "Please help her attend. - {facility}"
+    ),
+    'payment_receipt': (
+        "Payment received: KES {amount:,.0f}, ref {code}, {date:%d %b %Y}. "
+        "Thank you, {name}. - {facility}"
+    ),
+}
+
+
+def render(template, **context):
+    context.setdefault('facility', _setting('SMS_SIGNATURE', _setting('DOCUMENT_FACILITY_NAME', '')))
+    return TEMPLATES[template].format(**context)
+
+
+def recipient_number(phone):
+    """'0712 345678' -> '254712345678'; '' if it is not a Kenyan mobile number."""
+    number = normalize_phone(phone)
+    return number if len(number) == 12 and number[:4] in ('2547', '2541') else ''
+
+
+# ==========================================
+# Queueing
+# ==========================================
+def _make(template, phone, patient=None, reference='', **context):
+    recipient = recipient_number(phone)
+    if not recipient:
+        return None
+    return SmsMessage(
+        patient=patient, recipient=recipient, template=template,
+        body=render(template, **context), reference=reference,
+    )
+
+
+def schedule_dispatch(delay=None):
+    """
+    Makes sure a dispatch job runs within `delay` seconds (default
+    SMS_COALESCE_SECONDS). One waiting job is enough: it sends everything
+    queued by then.
+    """
+    delay = _setting('SMS_COALESCE_SECONDS', 30) if delay is None else delay
+    run_by = timezone.now() + timedelta(seconds=delay)
+    if not Job.objects.filter(task='dispatch_sms', status='queued', run_after__lte=run_by).exists():
+        jobs.enqueue('dispatch_sms', delay=delay)
+
+
+def queue(template, phone, patient=None, reference='', **context):
+    """
+    Queues one message. Returns it, or None if the number is unusable or a
+    message with this reference was already queued for the number.
+    """
+    message = _make(template, phone, patient, reference, **context)
+    if message is None:
+        return None
+    if reference and SmsMessage.objects.filter(reference=reference, recipient=message.recipient).exists():
+        return None
+    message.save()
+    schedule_dispatch()
+    return message
+
+
+def queue_receipts(payments):
+    """
+    Texts each mother a receipt for her successful payment (once per payment,
+    `patient` should be loaded). Returns the messages queued.
+    """
+    messages = []
+    for payment in payments:
+        if payment.status != 'Success':
+            continue
+        mother = payment.patient
+        message = _make(
+            'payment_receipt', mother.phone, mother, f"transaction:{payment.pk}",
+            name=mother.full_name.split()[0], amount=payment.amount,
+            code=payment.transaction_id or '-', date=timezone.localtime(payment.created_at),
+        )
+        if message is not None:
+            messages.append(message)
+    sent = set(
+        SmsMessage.objects.filter(reference__in=[m.reference for m in messages]).values_list('reference', 'recipient')
+    ) if messages else set()
+    messages = [m for m in messages if (m.reference, m.recipient) not in sent]
+
+    SmsMessage.objects.bulk_create(messages, batch_size=500)
+    if messages:
+        schedule_dispatch()
+    return messages
+
+
+def queue_receipt(payment):
+    queued = queue_receipts([payment])
+    return queued[0] if queued else None
+
+
+def queue_appointment_reminders(day):
+    """
+    Reminders for every scheduled appointment on `day`: to the mother, and
+    for high-risk mothers to her emergency contact too. Appointments already
+    reminded are skipped. Returns the number of messages queued.
+    """
+    appointments = list(
+        Appointment.objects.filter(date=day, status='Scheduled').select_related('patient').order_by('time', 'pk')
+    )
+    references = {f"appointment:{a.pk}:{day.isoformat()}" for a in appointments}
+    sent = set(SmsMessage.objects.filter(reference__in=references).values_list('reference', 'recipient'))
+
+    messages = []
+    for appointment in appointments:
+        mother = appointment.patient
+        reference = f"appointment:{appointment.pk}:{day.isoformat()}"
+        context = {
+            'name': mother.full_name.split()[0], 'purpose': appointment.purpose,
+            'date': appointment.date, 'time': appointment.time,
+        }
+        candidates = [_make('appointment_reminder', mother.phone, mother, reference, **context)]
+        if mother.risk_level == 'High' and mother.emergency_contact_phone:
+            contact = (mother.emergency_contact_name or 'there').split()[0]
+            candidates.append(_make(
+                'contact_reminder', mother.emergency_contact_phone, mother, reference, contact=contact, **context,
+            ))
+        messages += [m for m in candidates if m is not None and (m.reference, m.recipient) not in sent]
+
+    SmsMessage.objects.bulk_create(messages, batch_size=500)
+    if messages:
+        schedule_dispatch()
+    return len(messages)
+
+
+# ==========================================
+# Rate limiting
+# ==========================================
+class TokenBucket:
+    """
+    `rate` tokens per second, bursts of up to `capacity`. take(n) sleeps
+    until n tokens are available (n may exceed the capacity: the debt is
+    paid by waiting). try_take(n) never waits; n beyond the capacity counts
+    as a full bucket, or it could never succeed.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, n=1):
+        """Takes n tokens if they are there; otherwise returns the seconds until they would be."""
+        n = min(n, self.capacity)
+        with self.lock:
+            self._refill()
+            if self.tokens >= n:
+                self.tokens -= n
+                return 0.0
+            return (n - self.tokens) / self.rate
+
+    def take(self, n=1):
+        """Returns the seconds waited."""
+        with self.lock:
+            self._refill()
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            self.sleep(wait)
+        return wait
+
+
+# ==========================================
+# Gateways
+# ==========================================
+class GatewayError(Exception):
+    pass
+
+
+class GatewayBusy(GatewayError):
+    """The gateway asked us to slow down (HTTP 429)."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Gateway busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class BaseGateway:
+    """
+    A gateway client. Used as a context manager around a dispatch run, so a
+    client can keep its connection open across batches.
+    """
+    max_batch = 100
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send_batch(self, messages):
+        """
+        [(client id, recipient, text)] -> [(gateway message id, error)], same
+        order; id is '' on error. The client id is the same every time an SMS
+        is sent, so a gateway that knows it can drop repeats.
+        """
+        raise NotImplementedError
+
+
+class LogGateway(BaseGateway):
+    """Development default: writes messages to the log instead of sending them."""
+
+    def send_batch(self, messages):
+        for _, recipient, text in messages:
+            logger.info("SMS to %s: %s", recipient, text)
+        return [(f"log-{uuid.uuid4().hex[:12]}", '') for _ in messages]
+
+
+class HttpGateway(BaseGateway):
+    """
+    JSON over one kept-alive HTTP(S) connection:
+
+        POST <url>  {"messages": [{"client_id": "...", "to": "+254712345678", "text": "..."}]}
+                    (Idempotency-Key header: the same for the same messages)
+        200 -> {"results": [{"id": "...", "error": ""}, ...]}
+        429 -> slow down (Retry-After header, seconds)
+
+    A request is only sent again when it never reached the gateway. Once it
+    has been sent, a lost answer (e.g. a read timeout) is an error: the
+    gateway may have accepted the batch.
+
+    Subclass and override payload() / results() for a provider's own format.
+    """
+
+    def __init__(self, url, api_key='', timeout=10, max_batch=100):
+        self.url = urlsplit(url)
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_batch = max_batch
+        self.connection = None
+
+    def open(self):
+        connection_class = http.client.HTTPSConnection if self.url.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(self.url.hostname, self.url.port, timeout=self.timeout)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def payload(self, messages):
+        return {'messages': [
+            {'client_id': client_id, 'to': f"+{recipient}", 'text': text} for client_id, recipient, text in messages
+        ]}
+
+    def results(self, data):
+        return [(item.get('id') or '', item.get('error') or '') for item in data['results']]
+
+    def send_batch(self, messages):
+        body = json.dumps(self.payload(messages))
+        key = hashlib.sha256('\n'.join(client_id for client_id, _, _ in messages).encode()).hexdigest()
+        headers = {
+            'Content-Type': 'application/json', 'Authorization': f"Bearer {self.api_key}", 'Idempotency-Key': key,
+        }
+        for attempt in (1, 2):
+            reused = self.connection is not None
+            if not reused:
+                self.open()
+            try:
+                self.connection.request('POST', self.url.path or '/', body, headers)
+            except (http.client.HTTPException, OSError) as e:
+                # Not sent (refused, or a dead kept-alive connection): reconnect once
+                self.close()
+                if attempt == 2:
+                    raise GatewayError(f"Gateway unreachable: {e}") from e
+                continue
+            try:
+                response = self.connection.getresponse()
+                data = response.read()
+                break
+            except http.client.RemoteDisconnected as e:
+                # An idle kept-alive connection the gateway had closed before
+                # reading the request; a fresh connection is tried once
+                self.close()
+                if not reused or attempt == 2:
+                    raise GatewayError(f"Gateway closed the connection: {e}") from e
+            except (http.client.HTTPException, OSError) as e:
+                # Sent but unanswered: sending again could deliver the SMS twice
+                self.close()
+                raise GatewayError(f"No answer from the gateway: {e}") from e
+
+        if response.status == 429:
+            raise GatewayBusy(float(response.getheader('Retry-After') or 1))
+        if response.status >= 400:
+            raise GatewayError(f"Gateway answered HTTP {response.status}: {data[:200]!r}")
+        return self.results(json.loads(data))
+
+
+def get_gateway():
+    config = _setting('SMS_GATEWAY', {'BACKEND': 'patients.sms.LogGateway'})
+    return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+
+# ==========================================
+# Dispatching
+# ==========================================
+def coalesce(messages, max_chars=None):
+    """
+    Groups claimed messages per recipient into outgoing SMS texts of at most
+    `max_chars`: [(recipient, text, [SmsMessage])], oldest first.
+    """
+    max_chars = max_chars or _setting('SMS_MAX_CHARS', 459)   # 3 concatenated segments
+    outgoing, current = [], {}
+    for message in messages:
+        group = current.get(message.recipient)
+        if group is not None and len(group[1]) + 1 + len(message.body) <= max_chars:
+            group[1] += '\n' + message.body
+            group[2].append(message)
+            continue
+        group = current[message.recipient] = [message.recipient, message.body, [message]]
+        outgoing.append(group)
+    return [tuple(group) for group in outgoing]
+
+
+def client_id(messages):
+    """The id an SMS is sent with: the same for the same messages, whenever it is sent."""
+    pks = ','.join(str(message.pk) for message in messages)
+    return f"sms-{hashlib.sha256(pks.encode()).hexdigest()[:24]}"
+
+
+def _send(gateway, batch, bucket, stats):
+    """Sends one batch, waiting out 'slow down' answers. Returns the gateway's results."""
+    bucket.take(len(batch))
+    messages = [(client_id(grouped), recipient, text) for recipient, text, grouped in batch]
+    for _ in range(_setting('SMS_BUSY_RETRIES', 5)):
+        try:
+            return gateway.send_batch(messages)
+        except GatewayBusy as busy:
+            stats['throttled'] += 1
+            time.sleep(busy.retry_after)
+    raise GatewayError("Gateway stayed busy")
+
+
+def retry_delay(attempts):
+    """Seconds before attempt `attempts` + 1: doubles each time, with jitter, capped."""
+    base = _setting('SMS_RETRY_BASE_SECONDS', 60)
+    cap = _setting('SMS_RETRY_MAX_SECONDS', 3600)
+    return min(cap, base * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+
+
+def _requeue(message, error, now):
+    message.status, message.error, message.claimed_by = 'queued', error, ''
+    message.next_attempt_at = now + timedelta(seconds=retry_delay(message.attempts))
+
+
+RECORDED_FIELDS = ['status', 'gateway_id', 'sent_at', 'error', 'claimed_by', 'next_attempt_at']
+
+
+def _record(batch, results, now):
+    """Stores the outcome of one sent batch with a single bulk UPDATE."""
+    max_attempts = _setting('SMS_MAX_ATTEMPTS', 3)
+    changed = []
+    for (_, _, messages), (gateway_id, error) in zip(batch, results):
+        for message in messages:
+            if gateway_id:
+                message.status, message.gateway_id, message.sent_at, message.error = 'sent', gateway_id, now, ''
+                message.claimed_by, message.next_attempt_at = '', None
+            elif message.attempts >= max_attempts:
+                message.status, message.error, message.claimed_by = 'failed', error or "Rejected by the gateway", ''
+            else:
+                _requeue(message, error or "Rejected by the gateway", now)
+            changed.append(message)
+    SmsMessage.objects.bulk_update(changed, RECORDED_FIELDS, batch_size=500)
+
+
+def schedule_retries():
+    """Makes sure a dispatch job runs when the next message waiting for a retry is due."""
+    due = SmsMessage.objects.filter(status='queued').aggregate(due=Min('next_attempt_at'))['due']
+    if due is not None:
+        schedule_dispatch(delay=max(0.0, (due - timezone.now()).total_seconds()))
+
+
+def requeue_stale(minutes=10):
+    """Messages left 'sending' by a dispatcher that died go back to the queue."""
+    cutoff = timezone.now() - timedelta(minutes=minutes)
+    return SmsMessage.objects.filter(status='sending', claimed_at__lt=cutoff).update(status='queued', claimed_by='')
+
+
+def dispatch(gateway=None, bucket=None, claim_size=None):
+    """
+    Sends everything queued. Returns Counter(messages=, sms=, sent=, failed=, throttled=).
+    Raises GatewayError if the gateway is down (the claimed messages go back to the queue).
+    """
+    gateway = gateway or get_gateway()
+    bucket = bucket or TokenBucket(_setting('SMS_RATE_PER_SECOND', 20), _setting('SMS_BURST', 40))
+    claim_size = claim_size or _setting('SMS_CLAIM_SIZE', 500)
+    batch_size = min(gateway.max_batch, _setting('SMS_BATCH_SIZE', 50))
+    worker = jobs.worker_name()
+    stats = Counter()
+
+    requeue_stale()
+    with gateway:
+        while True:
+            queued = SmsMessage.objects.filter(
+                Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=timezone.now()), status='queued',
+            ).order_by('pk')
+            jobs.claim_rows(
+                queued, claim_size,
+                status='sending', claimed_by=worker, claimed_at=timezone.now(), attempts=F('attempts') + 1,
+            )
+            claimed = list(SmsMessage.objects.filter(status='sending', claimed_by=worker).order_by('pk'))
+            if not claimed:
+                schedule_retries()
+                return stats
+
+            outgoing = coalesce(claimed)
+            stats['messages'] += len(claimed)
+            stats['sms'] += len(outgoing)
+            for start in range(0, len(outgoing), batch_size):
+                batch = outgoing[start:start + batch_size]
+                try:
+                    results = _send(gateway, batch, bucket, stats)
+                except GatewayError as e:
+                    # Put back everything not sent yet, to be retried after a backoff
+                    now = timezone.now()
+                    unsent = [message for _, _, messages in outgoing[start:] for message in messages]
+                    for message in unsent:
+                        _requeue(message, str(e), now)
+                    SmsMessage.objects.bulk_update(unsent, RECORDED_FIELDS, batch_size=500)
+                    schedule_retries()
+                    raise
+                _record(batch, results, timezone.now())
+                sent = sum(1 for gateway_id, _ in results if gateway_id)
+                stats['sent'] += sent
+                stats['failed'] += len(results) - sent
+
+
+def apply_delivery_reports(reports):
+    """[{'id': gateway id, 'status': 'delivered' | 'failed', 'error': ''}] -> messages updated."""
+    updated = 0
+    now = timezone.now()
+    for status in ('delivered', 'failed'):
+        ids = [r['id'] for r in reports if r.get('status') == status and r.get('id')]
+        if not ids:
+            continue
+        changes = {'status': status, 'delivered_at': now} if status == 'delivered' else {'status': status}
+        if status == 'failed':
+            changes['error'] = "Not delivered (delivery report)"
+        updated += SmsMessage.objects.filter(gateway_id__in=ids, status__in=('sent', 'delivered')).update(**changes)
+    return updated
+
+
+# ==========================================
+# Local gateway stand-in
+# ==========================================
+class StandInGateway(ThreadingHTTPServer):
+    """
+    A local HTTP server speaking HttpGateway's protocol, for testing
+    throughput and backpressure offline. It accepts at most `rate` messages
+    per second in bursts of up to `burst` (429 + Retry-After beyond that),
+    adds `latency` seconds per request and rejects a `reject_rate` share of
+    messages.
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 8025), rate=50, burst=100, latency=0.02, reject_rate=0.0):
+        super().__init__(address, _StandInHandler)
+        self.bucket = TokenBucket(rate, burst)
+        self.latency = latency
+        self.reject_rate = reject_rate
+        self.lock = threading.Lock()
+        self.received = Counter()    # recipient -> SMS accepted
+        self.accepted = {}           # client id -> gateway id, to drop repeats
+        self.requests = Counter()    # 'ok' / 'throttled'
+        self.connections = 0
+
+    def handle_error(self, request, client_address):
+        # A client that stopped waiting (read timeout) is not the server's error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive, like a real gateway
+    disable_nagle_algorithm = True  # headers and body are written separately
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        server = self.server
+        data = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        messages = data.get('messages', [])
+        time.sleep(server.latency)
+
+        retry_after = server.bucket.try_take(len(messages))
+        if retry_after:
+            with server.lock:
+                server.requests['throttled'] += 1
+            self._reply(429, {'error': 'rate limited'}, {'Retry-After': f"{retry_after:.2f}"})
+            return
+
+        results = []
+        with server.lock:
+            server.requests['ok'] += 1
+            for message in messages:
+                if message.get('client_id') in server.accepted:
+                    results.append({'id': server.accepted[message['client_id']], 'error': ''})
+                    continue
+                if random.random() < server.reject_rate:
+                    results.append({'id': '', 'error': 'Invalid destination'})
+                    continue
+                server.received[message['to']] += 1
+                gateway_id = uuid.uuid4().hex
+                if message.get('client_id'):
+                    server.accepted[message['client_id']] = gateway_id
+                results.append({'id': gateway_id, 'error': ''})
+        self._reply(200, {'results': results})
+
+    def _reply(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
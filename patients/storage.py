@@ -0,0 +1,148 @@
+"""
+Static files pipeline used by `collectstatic`.
+
+1. CSS/JS are minified as they are copied into STATIC_ROOT.
+2. ManifestStaticFilesStorage adds the content hash to every file name
+   (css/main.css -> css/main.3f2a1b9c0d4e.css) and rewrites url() references.
+3. Every text asset gets precompressed .gz (and .br if the optional `brotli`
+   package is installed) siblings, so StaticAssetMiddleware can send them
+   without compressing on each request.
+"""
+import gzip
+import re
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+
+try:
+    import brotli
+except ImportError:  # optional: only .gz variants are built without it
+    brotli = None
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.map', '.txt', '.xml', '.html')
+
+# Not worth compressing below this many bytes
+MIN_COMPRESS_SIZE = 256
+
+
+# ------------------------------------------------------
+# MINIFIERS
+# ------------------------------------------------------
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+_CSS_SPACE = re.compile(r'\s+')
+# ':' is left alone on purpose: 'a :hover' and 'a:hover' are different selectors
+_CSS_AROUND = re.compile(r'\s*([{};,>])\s*')
+
+
+def minify_css(text):
+    text = _CSS_COMMENT.sub('', text)
+    text = _CSS_SPACE.sub(' ', text)
+    text = _CSS_AROUND.sub(r'\1', text)
+    return text.replace(';}', '}').strip()
+
+
+def minify_js(text):
+    """
+    Conservative: drops indentation, blank lines and whole-line // comments.
+    Files with template literals (which may span lines) are left untouched.
+    """
+    if '`' in text:
+        return text
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('//'):
+            continue
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+# <pre>, <textarea>, <script> and <style> keep their whitespace
+_HTML_PROTECTED = re.compile(r'(<(pre|textarea|script|style)\b.*?</\2\s*>)', re.S | re.I)
+# Keeps IE conditional comments (<!--[if ...]>)
+_HTML_COMMENT = re.compile(r'<!--(?!\[if).*?-->', re.S)
+
+
+def _collapse_whitespace(chunk):
+    # str.split()/join runs in C: several times faster than re.sub on large pages
+    if not chunk or chunk.isspace():
+        return ' ' if chunk else ''
+    collapsed = ' '.join(chunk.split())
+    # Keep one space at the edges so neighbouring words don't merge
+    if chunk[0].isspace():
+        collapsed = ' ' + collapsed
+    if chunk[-1].isspace():
+        collapsed += ' '
+    return collapsed
+
+
+def minify_html(text):
+    """
+    Removes comments and collapses runs of whitespace to a single space.
+    A space is always kept where there was one, so inline elements
+    (<b>a</b> <i>b</i>) still render the same.
+    """
+    parts = _HTML_PROTECTED.split(text)
+    out = []
+    # split() with 2 groups gives: text, block, tag name, text, block, tag name, ...
+    for i in range(0, len(parts), 3):
+        out.append(_collapse_whitespace(_HTML_COMMENT.sub('', parts[i])))
+        if i + 1 < len(parts):
+            out.append(parts[i + 1])
+    return ''.join(out).strip()
+
+
+MINIFIERS = {
+    '.css': minify_css,
+    '.js': minify_js,
+    '.html': minify_html,
+}
+
+
+# ------------------------------------------------------
+# STORAGE
+# ------------------------------------------------------
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+
+    def _save(self, name, content):
+        minifier = next((func for ext, func in MINIFIERS.items() if name.endswith(ext)), None)
+        if minifier is not None and not name.endswith(('.min.css', '.min.js')):
+            content.seek(0)
+            raw = content.read()
+            try:
+                text = raw.decode('utf-8')
+            except UnicodeDecodeError:
+                content = ContentFile(raw)
+            else:
+                content = ContentFile(minifier(text).encode('utf-8'))
+        return super()._save(name, content)
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+
+        names = set(paths) | set(self.hashed_files.values())
+        for name in sorted(names):
+            if name.endswith(COMPRESSIBLE) and self.exists(name):
+                self.compress(name)
+
+    def compress(self, name):
+        with self.open(name) as handle:
+            data = handle.read()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return
+
+        # mtime=0 so the .gz is byte-identical between builds
+        variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants['.br'] = brotli.compress(data, quality=11)
+
+        for suffix, compressed in variants.items():
+            if len(compressed) >= len(data):
+                continue
+            if self.exists(name + suffix):
+                self.delete(name + suffix)
+            # FileSystemStorage._save, not self._save: the bytes must not be minified again
+            FileSystemStorage._save(self, name + suffix, ContentFile(compressed))
@@ -0,0 +1,68 @@
+"""
+Streamed list pages.
+
+The list views render every row into one string before the first byte goes
+out, so an unfiltered list of a few years' deliveries takes seconds and as
+much memory as the page is large. With ?stream=1 they return a
+StreamingHttpResponse instead: the page around the table is sent first, then
+the rows, LIST_STREAM_CHUNK at a time, read with QuerySet.iterator() (a
+server-side cursor on PostgreSQL). Time to first byte and memory no longer
+depend on the number of rows.
+
+A list template marks where its rows go with
+
+    {% if streaming %}<!--stream-rows-->{% else %}{% include rows_template %}{% endif %}
+
+and keeps the rows (a {% for %} with its {% empty %} state) in rows_template,
+so the normal and the streamed page are the same markup.
+"""
+from itertools import islice
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.template.loader import get_template, render_to_string
+
+from .storage import minify_html
+
+ROWS_MARKER = '<!--stream-rows-->'
+
+
+def wants_stream(request):
+    return request.GET.get('stream') == '1'
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def stream_list(request, template_name, rows_template, name, queryset, context=None):
+    """
+    Streams `template_name` with the rows of `queryset`, passed to
+    `rows_template` as `name` one chunk at a time.
+    """
+    chunk_size = getattr(settings, 'LIST_STREAM_CHUNK', 500)
+    context = {**(context or {}), 'streaming': True}
+    head, marker, tail = render_to_string(template_name, context, request).partition(ROWS_MARKER)
+    if not marker:
+        raise ValueError(f"{template_name} has no {ROWS_MARKER} for its rows")
+    rows = get_template(rows_template)
+    # HtmlMinifyMiddleware leaves streamed pages alone: minify piece by piece
+    # (each is whole elements, so nothing protected like a <pre> is split)
+    minify = minify_html if getattr(settings, 'HTML_MINIFY', True) else str
+    # Rows are read after the view returns, when ReplicaRoutingMiddleware has
+    # already stopped routing: fix the database the view would have read from
+    queryset = queryset.using(queryset.db)
+
+    def content():
+        yield minify(head)
+        empty = True
+        for chunk in _chunks(queryset.iterator(chunk_size=chunk_size), chunk_size):
+            empty = False
+            yield minify(rows.render({**context, name: chunk}, request))
+        if empty:
+            yield minify(rows.render({**context, name: []}, request))
+        yield minify(tail)
+
+    return StreamingHttpResponse(content(), content_type='text/html; charset=utf-8')
@@ -0,0 +1,257 @@
+"""
+Delta sync for offline community health worker (CHW) devices.
+
+    GET  /api/v1/sync/?cursor=<seq>&limit=<n>
+        Changes recorded after `cursor`, oldest first, collapsed so each record
+        appears once per batch: {"resource", "id", "op": "upsert", "data"} or a
+        tombstone {"resource", "id", "op": "delete"}. Keep calling with
+        `next_cursor` until `has_more` is false.
+
+        Sequence numbers are taken when a change is written, not when its
+        transaction commits, so a gap in them may be a change still on its
+        way. A batch stops before such a gap until it is SYNC_SETTLE_SECONDS
+        old, and the cursor waits there. Past that the gap is served over but
+        watched: a change that commits into it later (a long import or merge)
+        is logged again with a new sequence number, so devices still get it
+        (see ChangeLog.read_after).
+
+    POST /api/v1/sync/  {"changes": [...]}
+        Applies a batch of offline edits in one transaction. Each change is
+        {"ref", "resource", "id" (omit to create), "op": "upsert"|"delete",
+         "base_updated_at" (the updated_at the device last saw), "data": {...}}.
+        If the server copy changed since base_updated_at the change is NOT
+        applied and is returned under "conflicts" with the server's version.
+        A change that cannot be read (bad id, data that is not an object...)
+        is returned under "errors"; the others are still applied.
+
+Cost is proportional to the number of changes, not to the size of the registry.
+"""
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.forms.models import model_to_dict
+from django.http import JsonResponse
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import require_http_methods
+
+from .api import RESOURCES
+from .forms import PregnantWomanForm, AppointmentForm, DeliveryForm, DischargeForm
+from .models import ChangeLog
+
+DEFAULT_BATCH = 500
+MAX_BATCH = 2000
+MAX_UPLOAD = 500
+
+# Models followed by the change log, and the form used to validate device edits.
+# Transactions are download-only: payments are never created offline.
+SYNC_FORMS = {
+    'patients': PregnantWomanForm,
+    'appointments': AppointmentForm,
+    'deliveries': DeliveryForm,
+    'discharges': DischargeForm,
+}
+SYNC_RESOURCES = {name: resource.model for name, resource in RESOURCES.items()}
+MODEL_RESOURCES = {model: name for name, model in SYNC_RESOURCES.items()}
+
+
+def _json(data, status=200):
+    return JsonResponse(data, status=status, encoder=DjangoJSONEncoder, json_dumps_params={'separators': (',', ':')})
+
+
+# ==========================================
+# Download: changes since a cursor
+# ==========================================
+def changes_since(cursor, limit):
+    """
+    Returns (changes, next_cursor, has_more). Reads one slice of the change
+    log, then one values() query per resource for the records still alive.
+    """
+    entries, has_more = ChangeLog.read_after(cursor, limit, getattr(settings, 'SYNC_SETTLE_SECONDS', 10))
+    if not entries:
+        return [], cursor, False
+
+    # Latest action per record wins inside this batch
+    latest = {}
+    for seq, resource, object_id, action in entries:
+        latest.pop((resource, object_id), None)
+        latest[(resource, object_id)] = action
+
+    wanted = {}
+    for (resource, object_id), action in latest.items():
+        if action == 'upsert':
+            wanted.setdefault(resource, []).append(object_id)
+
+    rows = {}
+    for resource, ids in wanted.items():
+        spec = RESOURCES.get(resource)
+        if spec is None:
+            continue
+        for row in spec.model.objects.filter(pk__in=ids).values(*spec.fields):
+            rows[(resource, row['id'])] = row
+
+    changes = []
+    for (resource, object_id), action in latest.items():
+        if action == 'delete':
+            changes.append({'resource': resource, 'id': object_id, 'op': 'delete'})
+        elif (resource, object_id) in rows:
+            changes.append({'resource': resource, 'id': object_id, 'op': 'upsert',
+                            'data': rows[(resource, object_id)]})
+        # else: deleted after this entry was logged; its tombstone comes later
+
+    return changes, entries[-1][0], has_more
+
+
+# ==========================================
+# Upload: apply offline edits
+# ==========================================
+def _server_version(instance):
+    spec = RESOURCES[MODEL_RESOURCES[type(instance)]]
+    return spec.model.objects.filter(pk=instance.pk).values(*spec.fields).first()
+
+
+def _is_stale(instance, base_updated_at):
+    """
+    True if the record changed on the server since the device last saw it.
+    The JSON we send carries milliseconds only, so compare at that precision.
+    """
+    base = parse_datetime(str(base_updated_at)) if base_updated_at else None
+    if base is None:
+        return True
+    current = instance.updated_at
+    return current.replace(microsecond=current.microsecond // 1000 * 1000) != base
+
+
+def _clean(change):
+    """
+    (object_id, data) of a change, or raises ValueError with a message per
+    key. JSON numbers in data become strings, as a submitted form has them.
+    """
+    errors = {}
+    object_id = change.get('id')
+    if object_id is not None:
+        try:
+            if isinstance(object_id, bool) or not isinstance(object_id, (int, str)):
+                raise ValueError
+            object_id = int(object_id)
+        except ValueError:
+            errors['id'] = ["Must be a whole number"]
+    if change.get('op', 'upsert') not in ('upsert', 'delete'):
+        errors['op'] = ["Must be 'upsert' or 'delete'"]
+    base = change.get('base_updated_at')
+    try:
+        if base is not None and (not isinstance(base, str) or parse_datetime(base) is None):
+            raise ValueError
+    except ValueError:
+        errors['base_updated_at'] = ["Must be an ISO 8601 date and time"]
+
+    data = change.get('data') or {}
+    if not isinstance(data, dict):
+        errors['data'] = ["Must be an object"]
+        data = {}
+    cleaned = {}
+    for field, value in data.items():
+        if isinstance(value, (dict, list)):
+            errors[field] = ["Must be a single value"]
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            cleaned[field] = str(value)
+        else:
+            cleaned[field] = value
+    if errors:
+        raise ValueError(errors)
+    return object_id, cleaned
+
+
+def apply_change(change):
+    """
+    Applies one device change. Returns ('applied' | 'conflict' | 'error', payload).
+    Must be called inside a transaction.
+    """
+    ref = change.get('ref')
+    resource = change.get('resource')
+    op = change.get('op', 'upsert')
+    form_class = SYNC_FORMS.get(resource) if isinstance(resource, str) else None
+    if form_class is None:
+        return 'error', {'ref': ref, 'errors': {'resource': [f"'{resource}' cannot be changed from a device"]}}
+    try:
+        object_id, data = _clean(change)
+    except ValueError as e:
+        return 'error', {'ref': ref, 'id': change.get('id'), 'errors': e.args[0]}
+
+    model = form_class._meta.model
+    instance = None
+    if object_id is not None:
+        # Columns kept by the server (care summary) are not loaded, so not saved back
+        editable = model.objects.select_for_update().defer(*getattr(model, 'SUMMARY_FIELDS', ()))
+        instance = editable.filter(pk=object_id).first()
+        if instance is None:
+            if op == 'delete':
+                # Already gone: deleting twice is not a conflict
+                return 'applied', {'ref': ref, 'id': object_id, 'op': 'delete'}
+            return 'conflict', {'ref': ref, 'id': object_id, 'server': None}
+        if _is_stale(instance, change.get('base_updated_at')):
+            return 'conflict', {'ref': ref, 'id': instance.pk, 'server': _server_version(instance)}
+
+    if op == 'delete':
+        if instance is None:
+            return 'error', {'ref': ref, 'errors': {'id': ["An id is required to delete"]}}
+        object_id = instance.pk
+        instance.delete()
+        return 'applied', {'ref': ref, 'id': object_id, 'op': 'delete'}
+
+    # Partial edits: fields the device did not send keep their server values
+    data = {**(model_to_dict(instance, fields=form_class._meta.fields) if instance else {}), **data}
+    form = form_class(data, instance=instance)
+    if not form.is_valid():
+        return 'error', {'ref': ref, 'id': object_id, 'errors': form.errors}
+    saved = form.save()
+    return 'applied', {'ref': ref, 'id': saved.pk, 'op': 'upsert', 'updated_at': saved.updated_at}
+
+
+# ==========================================
+# View
+# ==========================================
+@require_http_methods(['GET', 'POST'])
+def sync(request):
+    if not request.user.is_authenticated:
+        return _json({'error': "Authentication required"}, status=401)
+
+    if request.method == 'GET':
+        try:
+            cursor = int(request.GET.get('cursor') or 0)
+            limit = min(max(int(request.GET.get('limit', DEFAULT_BATCH)), 1), MAX_BATCH)
+        except ValueError:
+            return _json({'error': "'cursor' and 'limit' must be whole numbers"}, status=400)
+
+        changes, next_cursor, has_more = changes_since(cursor, limit)
+        return _json({'changes': changes, 'next_cursor': next_cursor, 'has_more': has_more})
+
+    try:
+        payload = json.loads(request.body or b'{}')
+        changes = payload['changes']
+        if not isinstance(changes, list):
+            raise TypeError
+    except (ValueError, KeyError, TypeError):
+        return _json({'error': "Body must be JSON: {\"changes\": [...]}"}, status=400)
+    if len(changes) > MAX_UPLOAD:
+        return _json({'error': f"At most {MAX_UPLOAD} changes per upload"}, status=413)
+
+    result = {'applied': [], 'conflict': [], 'error': []}
+    with transaction.atomic():
+        for change in changes:
+            if not isinstance(change, dict):
+                result['error'].append({'ref': None, 'errors': {'change': ["Must be an object"]}})
+                continue
+            # A savepoint per change, so one bad row does not undo the others
+            with transaction.atomic():
+                outcome, payload = apply_change(change)
+                result[outcome].append(payload)
+
+    # No cursor is returned: the device keeps downloading from its own cursor,
+    # so edits made by others meanwhile are never skipped
+    return _json({
+        'applied': result['applied'],
+        'conflicts': result['conflict'],
+        'errors': result['error'],
+    })
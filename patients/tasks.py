@@ -0,0 +1,53 @@
+"""
+Background tasks run by `manage.py runworkers` (see jobs.py).
+
+Queue one with jobs.enqueue(tasks.refresh_rollups) or by name,
+jobs.enqueue('run_report', run_id=run.pk).
+"""
+from datetime import date, timedelta
+
+from django.utils import timezone
+
+from . import analytics, dedupe, jobs, payments, reconcile, reports, sms
+
+
+@jobs.task(queue='reports', max_attempts=3)
+def run_report(run_id):
+    reports.execute(run_id)
+
+
+@jobs.task(queue='reports', max_attempts=1)
+def reconcile_statement(reconciliation_id):
+    reconcile.run(reconciliation_id)
+
+
+@jobs.task(max_attempts=3)
+def refresh_rollups():
+    analytics.refresh_all()
+
+
+@jobs.task(priority=-10, max_attempts=2)
+def find_duplicates():
+    dedupe.find_duplicates()
+
+
+@jobs.task(queue='payments', priority=10)
+def apply_payment_callbacks():
+    payments.apply_pending()
+
+
+@jobs.task(queue='sms', priority=5)
+def dispatch_sms():
+    sms.dispatch()
+
+
+@jobs.task(queue='sms')
+def appointment_reminders(day=None):
+    """Queues reminders for `day` (ISO date, default tomorrow)."""
+    day = timezone.localdate() + timedelta(days=1) if day is None else date.fromisoformat(day)
+    sms.queue_appointment_reminders(day)
+
+
+@jobs.task(queue='bench', max_attempts=1)
+def noop(**kwargs):
+    """Does nothing: used by bench_jobs to measure the queue itself."""
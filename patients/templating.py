@@ -0,0 +1,55 @@
+"""
+Template warm-up.
+
+With the 'production' template profile (settings.TEMPLATE_PROFILE) each
+process compiles a template the first time it renders it and keeps it in
+the cached loader. A freshly started worker would therefore spend its first
+requests compiling: warm() compiles every template of the app up front.
+
+wsgi.py and asgi.py call warm_on_startup(); under a pre-forking server that
+loads the app before forking, the workers inherit the compiled templates.
+`manage.py warm_templates` runs the same compilation and reports failures,
+so a broken template is caught by the deploy rather than a user.
+"""
+import logging
+import time
+from pathlib import Path
+
+from django.apps import apps
+from django.conf import settings
+from django.template import TemplateSyntaxError, engines
+
+logger = logging.getLogger(__name__)
+
+
+def template_names():
+    """Every template in patients/templates, as loaded: 'base.html', 'patients/dashboard.html', ..."""
+    root = Path(apps.get_app_config('patients').path) / 'templates'
+    return sorted(path.relative_to(root).as_posix() for path in root.rglob('*.html'))
+
+
+def warm(names=None):
+    """
+    Compiles `names` (default: all of them) with the default engine.
+    Returns ({name: seconds}, {name: error}).
+    """
+    engine = engines['django']
+    timings, errors = {}, {}
+    for name in template_names() if names is None else names:
+        start = time.perf_counter()
+        try:
+            engine.get_template(name)
+        except TemplateSyntaxError as e:
+            errors[name] = e
+            continue
+        timings[name] = time.perf_counter() - start
+    return timings, errors
+
+
+def warm_on_startup():
+    if not getattr(settings, 'TEMPLATE_WARMUP', False):
+        return
+    timings, errors = warm()
+    for name, error in errors.items():
+        logger.error("Template %s does not compile: %s", name, error)
+    logger.info("Compiled %d templates in %.0f ms", len(timings), sum(timings.values()) * 1000)
@@ -1,3 +1,2145 @@
-from django.test import TestCase
+"""
+Run with the local SQLite setup:
 
-# Create your tests here.
+    MATERNAL_SQLITE_REPLICA=1 python manage.py test patients
+"""
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import Group, Permission, User
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, connection, transaction
+from django.db.models.query import QuerySet
+from django.http import HttpResponse
+from django.core.management import CommandError, call_command
+from django.template import engines
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    analytics, archive, audit, backends, counters, dedupe, documents, forms, jobs, payments, pdf, reconcile, reports,
+    routers, scheduling, sms, streaming, sync, templating, throttle, timeline, views,
+)
+from .storage import minify_html
+from .middleware import ReplicaRoutingMiddleware, accepted_encodings
+from .models import (
+    Appointment, ArchivedPatient, AuditEntry, ChangeLog, ChangeLogGap, Delivery, Discharge, DischargeDocument, DuplicateCandidate,
+    Job, PaymentCallback, PregnantWoman, Reconciliation, ReportRun, SmsMessage, Transaction,
+)
+
+
+# Pages render without collectstatic's manifest, audit entries are written at
+# commit (AuditBufferTests drives the background buffer itself) and every read
+# goes to the primary (ReplicaRoutingMiddlewareTests covers the replica)
+TEST_SETTINGS = override_settings(
+    STORAGES={**settings.STORAGES, 'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}},
+    AUDIT_ASYNC=False,
+    REPLICA_DATABASE=None,
+)
+
+
+def make_mother(**fields):
+    values = {
+        'full_name': "Achieng Otieno", 'phone': '0712345678', 'age': 27,
+        'lmp': timezone.now().date() - timedelta(weeks=10), 'county': 'Kisumu', 'ward': 'Kondele',
+    }
+    values.update(fields)
+    return PregnantWoman.objects.create(**values)
+
+
+# ==========================================
+# M-Pesa payments (payments.py)
+# ==========================================
+class FakeStkPush(payments.BaseStkPush):
+    def __init__(self, checkout='ws_CO_test_1', error=None):
+        self.checkout, self.error, self.pushes = checkout, error, []
+
+    def push(self, phone, amount, reference):
+        if self.error:
+            raise payments.StkPushError(self.error)
+        self.pushes.append((phone, amount, reference))
+        return self.checkout
+
+
+@TEST_SETTINGS
+@override_settings(SMS_RECEIPTS=False, PAYMENT_MATCH_WINDOW=3600)
+class PaymentTests(TestCase):
+    def setUp(self):
+        self.mother = make_mother()
+
+    def callback(self, checkout, receipt='', code=0, amount=500):
+        payments.ingest([payments.simulated_callback(checkout, receipt, amount, result_code=code)])
+        return payments.apply_pending()
+
+    def test_stk_push_records_a_pending_payment_with_its_checkout_id(self):
+        client = FakeStkPush()
+        payment = payments.start_stk_push(self.mother, '500', client=client)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'Pending')
+        self.assertEqual(payment.checkout_request_id, 'ws_CO_test_1')
+        self.assertIsNone(payment.transaction_id)
+        self.assertEqual(client.pushes, [('254712345678', Decimal('500'), f"P{self.mother.pk}")])
+
+    def test_stk_push_refused_records_nothing(self):
+        with self.assertRaises(payments.StkPushError):
+            payments.start_stk_push(self.mother, 500, client=FakeStkPush(error="Invalid PhoneNumber"))
+        for amount in ('', 'abc', '-5', 'NaN'):
+            with self.assertRaises(payments.StkPushError):
+                payments.start_stk_push(self.mother, amount, client=FakeStkPush())
+        self.mother.phone = '12345'
+        with self.assertRaises(payments.StkPushError):
+            payments.start_stk_push(self.mother, 500, client=FakeStkPush())
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_success_callback_confirms_the_payment(self):
+        payment = payments.start_stk_push(self.mother, 500, client=FakeStkPush())
+        stats = self.callback('ws_CO_test_1', 'QAB1CD2EF3')
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.transaction_id), ('Success', 'QAB1CD2EF3'))
+        self.assertEqual(stats['applied'], 1)
+
+    def test_failure_then_success_and_redelivery(self):
+        payment = payments.start_stk_push(self.mother, 500, client=FakeStkPush())
+        self.callback('ws_CO_test_1', code=1032)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'Failed')
+
+        self.callback('ws_CO_test_1', 'QAB1CD2EF3')
+        self.callback('ws_CO_test_1', 'QAB1CD2EF3')   # redelivered: ignored on insert
+        self.callback('ws_CO_test_1', code=1)         # late failure: success wins
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.transaction_id), ('Success', 'QAB1CD2EF3'))
+        self.assertEqual(PaymentCallback.objects.filter(receipt='QAB1CD2EF3').count(), 1)
+
+    def test_callback_matched_on_receipt_when_the_checkout_is_unknown(self):
+        payment = Transaction.objects.create(patient=self.mother, amount=500, status='Pending', transaction_id='QRC9XY')
+        self.callback('ws_CO_elsewhere', 'QRC9XY')
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'Success')
+        self.assertEqual(payment.checkout_request_id, 'ws_CO_elsewhere')
+
+    def test_receipt_already_on_another_payment_is_not_applied(self):
+        Transaction.objects.create(patient=self.mother, amount=500, status='Success', transaction_id='QDUP1')
+        payment = payments.start_stk_push(self.mother, 500, client=FakeStkPush())
+        self.callback('ws_CO_test_1', 'QDUP1')
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'Pending')
+        self.assertEqual(PaymentCallback.objects.get(receipt='QDUP1').status, 'unmatched')
+
+    def test_unknown_callback_waits_then_is_left_unmatched(self):
+        self.callback('ws_CO_missing', 'QNONE1')
+        callback = PaymentCallback.objects.get()
+        self.assertEqual(callback.status, 'received')
+
+        PaymentCallback.objects.update(received_at=timezone.now() - timedelta(hours=2), retry_after=timezone.now())
+        payments.apply_pending()
+        self.assertEqual(PaymentCallback.objects.get().status, 'unmatched')
+
+    def test_billing_page_push_settles_through_the_simulated_callback(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('patients:initiate_stk_push'), {'patient_id': self.mother.pk, 'amount': '1500'})
+        payment = Transaction.objects.get()
+        self.assertEqual(payment.status, 'Pending')
+        self.assertTrue(payment.checkout_request_id)
+
+        payments.apply_pending()
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'Success')
+        self.assertTrue(payment.transaction_id.startswith('SIM'))
+
+    @override_settings(PAYMENT_CALLBACK_TOKEN='secret')
+    def test_callback_view_checks_token_and_body(self):
+        url = reverse('patients:mpesa_callback')
+        body = payments.simulated_callback('ws_CO_x', 'QV1', 500)
+        self.assertEqual(self.client.post(f"{url}?token=wrong", body, content_type='application/json').status_code, 403)
+        self.assertEqual(self.client.post(f"{url}?token=secret", {'Body': {}}, content_type='application/json').status_code, 400)
+        self.assertEqual(self.client.post(f"{url}?token=secret", body, content_type='application/json').status_code, 200)
+        self.assertEqual(PaymentCallback.objects.count(), 1)
+
+
+# ==========================================
+# Device sync (sync.py)
+# ==========================================
+@TEST_SETTINGS
+class SyncTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('chw', password='unused'))
+        self.url = reverse('patients:api_sync')
+
+    def upload(self, *changes):
+        response = self.client.post(self.url, {'changes': list(changes)}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def latest_seq(self):
+        return ChangeLog.objects.order_by('-seq').values_list('seq', flat=True).first() or 0
+
+    def test_download_returns_upserts_and_tombstones_after_the_cursor(self):
+        cursor = self.latest_seq()
+        mother = make_mother()
+        changes, next_cursor, has_more = sync.changes_since(cursor, 500)
+        self.assertIn({'resource': 'patients', 'id': mother.pk, 'op': 'upsert'},
+                      [{k: c[k] for k in ('resource', 'id', 'op')} for c in changes])
+        self.assertFalse(has_more)
+
+        mother_id = mother.pk
+        mother.delete()
+        changes, _, _ = sync.changes_since(next_cursor, 500)
+        self.assertIn({'resource': 'patients', 'id': mother_id, 'op': 'delete'}, changes)
+
+    def test_download_pages_with_has_more(self):
+        cursor = self.latest_seq()
+        ChangeLog.record_many('patients', [999001, 999002, 999003], action='delete')
+        first, cursor, has_more = sync.changes_since(cursor, 2)
+        self.assertEqual((len(first), has_more), (2, True))
+        rest, _, has_more = sync.changes_since(cursor, 2)
+        self.assertEqual((len(rest), has_more), (1, False))
+
+    @override_settings(SYNC_SETTLE_SECONDS=60)
+    def test_download_waits_at_a_young_gap_in_the_sequence(self):
+        cursor = self.latest_seq()
+        ChangeLog.objects.create(seq=cursor + 1, resource='patients', object_id=1, action='delete')
+        # cursor + 2 is taken by a transaction that has not committed yet
+        ChangeLog.objects.create(seq=cursor + 3, resource='patients', object_id=3, action='delete')
+
+        changes, next_cursor, has_more = sync.changes_since(cursor, 500)
+        self.assertEqual([c['id'] for c in changes], [1])
+        self.assertEqual((next_cursor, has_more), (cursor + 1, False))
+
+        # It commits: served in order from the held cursor
+        ChangeLog.objects.create(seq=cursor + 2, resource='patients', object_id=2, action='delete')
+        changes, next_cursor, _ = sync.changes_since(next_cursor, 500)
+        self.assertEqual([c['id'] for c in changes], [2, 3])
+        self.assertEqual(next_cursor, cursor + 3)
+
+    @override_settings(SYNC_SETTLE_SECONDS=60)
+    def test_download_skips_a_gap_once_it_has_settled(self):
+        cursor = self.latest_seq()
+        ChangeLog.objects.create(seq=cursor + 2, resource='patients', object_id=2, action='delete')
+        ChangeLog.objects.filter(seq=cursor + 2).update(changed_at=timezone.now() - timedelta(minutes=5))
+        changes, next_cursor, _ = sync.changes_since(cursor, 500)
+        self.assertEqual(([c['id'] for c in changes], next_cursor), ([2], cursor + 2))
+
+    @override_settings(SYNC_SETTLE_SECONDS=60)
+    def test_a_late_commit_into_a_settled_gap_is_sent_again(self):
+        cursor = self.latest_seq()
+        ChangeLog.objects.create(seq=cursor + 3, resource='patients', object_id=3, action='delete')
+        ChangeLog.objects.filter(seq=cursor + 3).update(changed_at=timezone.now() - timedelta(minutes=5))
+        changes, next_cursor, _ = sync.changes_since(cursor, 500)
+        self.assertEqual(next_cursor, cursor + 3)
+        self.assertEqual(list(ChangeLogGap.objects.values_list('first', 'last')), [(cursor + 1, cursor + 2)])
+
+        # A long import holding cursor + 2 finally commits
+        ChangeLog.objects.create(seq=cursor + 2, resource='patients', object_id=2, action='delete')
+        changes, next_cursor, _ = sync.changes_since(next_cursor, 500)
+        self.assertEqual([c['id'] for c in changes], [2])
+        self.assertGreater(next_cursor, cursor + 3)
+        self.assertEqual(list(ChangeLogGap.objects.values_list('first', 'last')), [(cursor + 1, cursor + 1)])
+
+    @override_settings(SYNC_SETTLE_SECONDS=60, CHANGELOG_GAP_WATCH_SECONDS=3600)
+    def test_gaps_are_dropped_after_the_watch_window(self):
+        cursor = self.latest_seq()
+        ChangeLogGap.objects.create(first=cursor + 1, last=cursor + 1, found_at=timezone.now() - timedelta(hours=2))
+        ChangeLog.objects.create(seq=cursor + 1, resource='patients', object_id=1, action='delete')
+        self.assertEqual(ChangeLog.relog_late(), 0)
+        self.assertFalse(ChangeLogGap.objects.exists())
+        self.assertEqual(self.latest_seq(), cursor + 1)
+
+    def test_upload_creates_and_detects_conflicts(self):
+        result = self.upload({'ref': 'a', 'resource': 'patients', 'data': {
+            'full_name': "Wanjiku Kamau", 'age': 24, 'phone': '0722000111', 'lmp': '2026-08-01', 'risk_level': 'Normal',
+        }})
+        self.assertEqual(result['errors'], [])
+        mother = PregnantWoman.objects.get(pk=result['applied'][0]['id'])
+        self.assertEqual(mother.age, 24)
+
+        stale = (mother.updated_at - timedelta(minutes=1)).isoformat()
+        result = self.upload({'ref': 'b', 'resource': 'patients', 'id': mother.pk, 'base_updated_at': stale, 'data': {'age': 25}})
+        self.assertEqual(result['conflicts'][0]['server']['age'], 24)
+
+    def test_upload_reports_bad_changes_per_change(self):
+        mother = make_mother()
+        result = self.upload(
+            {'ref': 'id', 'resource': 'patients', 'id': 'abc', 'data': {'age': 30}},
+            {'ref': 'list', 'resource': 'patients', 'data': ['age', 30]},
+            {'ref': 'nested', 'resource': 'patients', 'data': {'lmp': {'y': 2026}}},
+            {'ref': 'base', 'resource': 'patients', 'id': mother.pk, 'base_updated_at': '2026-13-45T00:00:00Z'},
+            {'ref': 'op', 'resource': 'patients', 'id': mother.pk, 'op': 'merge'},
+            {'ref': 'resource', 'resource': ['patients']},
+            'not an object',
+            {'ref': 'number date', 'resource': 'patients', 'data': {
+                'full_name': "Njeri", 'age': 22, 'phone': '0733000222', 'lmp': 20260801, 'risk_level': 'Normal',
+            }},
+            {'ref': 'ok', 'resource': 'patients', 'data': {
+                'full_name': "Akinyi", 'age': 31, 'phone': '0733000333', 'lmp': '2026-07-01', 'risk_level': 'Low',
+            }},
+        )
+        self.assertEqual([e['ref'] for e in result['errors']],
+                         ['id', 'list', 'nested', 'base', 'op', 'resource', None, 'number date'])
+        self.assertEqual([a['ref'] for a in result['applied']], ['ok'])
+        self.assertTrue(PregnantWoman.objects.filter(full_name="Akinyi").exists())
+
+    def test_requires_login_and_a_json_body(self):
+        self.assertEqual(self.client.post(self.url, 'nope', content_type='application/json').status_code, 400)
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+
+
+# ==========================================
+# Outcome reports (reports.py)
+# ==========================================
+@TEST_SETTINGS
+class ReportTests(TestCase):
+    def setUp(self):
+        for i, (risk, kind) in enumerate([('High', 'C-Section'), ('Normal', 'Normal Delivery'), ('Normal', 'C-Section')]):
+            mother = make_mother(full_name=f"Mother {i}", risk_level=risk)
+            Delivery.objects.create(patient=mother, delivery_date=date(2026, 9, 1), delivery_type=kind)
+        self.params = reports.clean_params({'by': ['risk_level']})
+
+    def test_new_run_is_computed_by_a_background_job_and_reused(self):
+        run = reports.get_or_submit('delivery_mix', self.params)
+        self.assertEqual(run.status, 'queued')
+        job = Job.objects.get(task='run_report')
+        self.assertEqual(job.kwargs, {'run_id': run.pk})
+
+        jobs.work(queues=['reports'], burst=True)
+        run.refresh_from_db()
+        self.assertEqual(run.status, 'done')
+        self.assertEqual(reports.get_or_submit('delivery_mix', self.params).pk, run.pk)
+        self.assertEqual(Job.objects.filter(task='run_report').count(), 1)
+
+        response = self.client.get(reverse('patients:report_export', args=[run.pk, 'csv']))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'C-Section', response.content)
+
+    def test_changed_data_gets_a_new_run(self):
+        run = reports.get_or_submit('delivery_mix', self.params)
+        make_mother(full_name="Late registration")
+        self.assertNotEqual(reports.get_or_submit('delivery_mix', self.params).pk, run.pk)
+
+    @override_settings(REPORT_TIMEOUT=60)
+    def test_stuck_runs_are_failed_and_submitted_again(self):
+        queued = reports.get_or_submit('delivery_mix', self.params)
+        ReportRun.objects.filter(pk=queued.pk).update(created_at=timezone.now() - timedelta(minutes=5))
+        again = reports.get_or_submit('delivery_mix', self.params)
+        self.assertNotEqual(again.pk, queued.pk)
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, 'failed')
+
+        ReportRun.objects.filter(pk=again.pk).update(status='running', started_at=timezone.now() - timedelta(minutes=5))
+        third = reports.get_or_submit('delivery_mix', self.params)
+        self.assertNotIn(third.pk, (queued.pk, again.pk))
+        self.assertEqual(Job.objects.filter(task='run_report').count(), 3)
+
+    def test_a_job_for_a_run_already_claimed_does_nothing(self):
+        run = reports.get_or_submit('delivery_mix', self.params)
+        ReportRun.objects.filter(pk=run.pk).update(status='running', started_at=timezone.now())
+        reports.execute(run.pk)
+        run.refresh_from_db()
+        self.assertEqual((run.status, run.result), ('running', None))
+
+    @override_settings(REPORT_INLINE_WAIT=0)
+    def test_pages(self):
+        response = self.client.get(reverse('patients:report_list'), {'report': 'delivery_mix', 'by': 'risk_level'})
+        run = ReportRun.objects.get()
+        self.assertRedirects(response, reverse('patients:report_run', args=[run.pk]))
+        self.assertEqual(self.client.get(reverse('patients:report_run', args=[run.pk])).status_code, 200)
+
+
+# ==========================================
+# Audit log (audit.py)
+# ==========================================
+@TEST_SETTINGS
+class AuditTests(TestCase):
+    def test_update_records_old_and_new_values(self):
+        mother = make_mother(age=27)
+        loaded = PregnantWoman.objects.get(pk=mother.pk)
+        self.assertFalse(hasattr(loaded, '_audit_original'))   # loading takes no snapshot
+
+        loaded.age, loaded.risk_level = 28, 'High'
+        with self.captureOnCommitCallbacks(execute=True):
+            loaded.save()
+        entry = AuditEntry.objects.filter(resource='patients', action='update').get()
+        self.assertEqual(entry.changes, {'age': [27, 28], 'risk_level': ['Normal', 'High']})
+        self.assertEqual(entry.patient_id, mother.pk)
+
+    def test_diff_is_against_the_stored_row(self):
+        mother = make_mother(age=27)
+        first, second = PregnantWoman.objects.get(pk=mother.pk), PregnantWoman.objects.get(pk=mother.pk)
+        first.age = 30
+        first.save()
+        second.full_name = "Achieng O."
+        with self.captureOnCommitCallbacks(execute=True):
+            second.save()
+        latest = AuditEntry.objects.filter(action='update').order_by('-pk').first()
+        # The save put the loaded age back: that is recorded too
+        self.assertEqual(latest.changes['age'], [30, 27])
+
+    def test_unchanged_save_records_nothing_and_delete_keeps_the_values(self):
+        mother = make_mother()
+        with self.captureOnCommitCallbacks(execute=True):
+            PregnantWoman.objects.get(pk=mother.pk).save()
+        self.assertFalse(AuditEntry.objects.filter(action='update').exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            mother.delete()
+        entry = AuditEntry.objects.get(resource='patients', action='delete')
+        self.assertEqual(entry.changes['full_name'], ["Achieng Otieno", None])
+
+    def test_audit_log_page_filters_by_patient(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            mother = make_mother()
+        response = self.client.get(reverse('patients:audit_log'), {'patient': mother.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'patients')
+
+
+class ManualAuditBuffer(audit.AuditBuffer):
+    """The buffer without its writer thread: the test calls flush() / recover()."""
+
+    def start(self):
+        if self.pid != os.getpid():
+            self.reset()
+
+
+@TEST_SETTINGS
+class AuditBufferTests(TestCase):
+    def setUp(self):
+        self.spill_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.spill_dir, ignore_errors=True)
+        overrides = override_settings(AUDIT_ASYNC=True, AUDIT_SPILL_DIR=self.spill_dir, AUDIT_SPILL_RECOVER_SECONDS=0)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.mother = make_mother()
+
+    def entry(self, age):
+        return audit.make_entry('patients', self.mother, 'update', {'age': [age - 1, age]})
+
+    def spilled(self):
+        return sorted(self.spill_dir.glob('*.jsonl'))
+
+    def test_entries_are_journaled_until_written(self):
+        buffer = ManualAuditBuffer()
+        buffer.add(self.entry(28))
+        buffer.add(self.entry(29))
+        self.assertEqual(len(self.spilled()), 1)
+        self.assertEqual(len(self.spilled()[0].read_text().splitlines()), 2)
+        self.assertFalse(AuditEntry.objects.filter(action='update').exists())
+
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(AuditEntry.objects.filter(action='update').count(), 2)
+        self.assertEqual(self.spilled(), [])
+
+    def test_failed_write_keeps_the_entries_and_their_file(self):
+        buffer = ManualAuditBuffer()
+        buffer.add(self.entry(28))
+        with mock.patch.object(ManualAuditBuffer, 'write', side_effect=DatabaseError("down")), \
+                mock.patch.object(ManualAuditBuffer, 'database_up', return_value=False):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(len(self.spilled()), 1)
+
+        buffer.add(self.entry(29))   # goes to a second file
+        self.assertEqual(len(self.spilled()), 2)
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(self.spilled(), [])
+        self.assertEqual(AuditEntry.objects.filter(action='update').count(), 2)
+
+    def refusing(self, poisoned):
+        """write() as a database that is up but refuses the batches holding `poisoned`."""
+        write = audit.AuditBuffer.write
+
+        def refuse(buffer, batch):
+            if any(str(entry.entry_id) == str(poisoned.entry_id) for entry in batch):
+                raise DatabaseError("value too long")
+            write(buffer, batch)
+        return mock.patch.object(ManualAuditBuffer, 'write', autospec=True, side_effect=refuse)
+
+    def dead_letters(self):
+        return [line for path in (self.spill_dir / 'dead').glob('*.jsonl') for line in path.read_text().splitlines()]
+
+    def test_a_refused_entry_is_dead_lettered_and_the_rest_written(self):
+        buffer = ManualAuditBuffer()
+        poisoned = self.entry(29)
+        for entry in (self.entry(28), poisoned, self.entry(30)):
+            buffer.add(entry)
+        with self.refusing(poisoned), self.assertLogs('patients.audit', 'ERROR'):
+            self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(AuditEntry.objects.filter(action='update').count(), 2)
+        self.assertEqual([json.loads(line)['entry_id'] for line in self.dead_letters()], [str(poisoned.entry_id)])
+        self.assertEqual((self.spilled(), buffer.pending), ([], []))
+
+    def test_a_refused_entry_in_a_spill_file_does_not_block_recovery(self):
+        dead, poisoned = ManualAuditBuffer(), self.entry(29)
+        dead.add(poisoned)
+        dead.add(self.entry(30))
+        with self.refusing(poisoned), self.assertLogs('patients.audit', 'ERROR'):
+            self.assertEqual(ManualAuditBuffer().recover(), 1)
+        self.assertEqual(self.spilled(), [])
+        self.assertEqual(len(self.dead_letters()), 1)
+
+    @override_settings(AUDIT_MAX_PENDING=1)
+    def test_backlog_over_the_cap_waits_in_its_spill_files(self):
+        buffer = ManualAuditBuffer()
+        buffer.add(self.entry(28))
+        buffer.add(self.entry(29))
+        with mock.patch.object(ManualAuditBuffer, 'write', side_effect=DatabaseError("down")), \
+                mock.patch.object(ManualAuditBuffer, 'database_up', return_value=False), \
+                self.assertLogs('patients.audit', 'ERROR'):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual((buffer.pending, buffer.segments), ([], set()))
+        self.assertEqual(len(self.spilled()), 1)
+
+        # The database is back: the next recovery round writes them
+        self.assertEqual(buffer.recover(), 2)
+        self.assertEqual(AuditEntry.objects.filter(action='update').count(), 2)
+
+    def test_spill_of_a_killed_process_is_recovered_once(self):
+        dead = ManualAuditBuffer()
+        dead.add(self.entry(28))
+        dead.add(self.entry(29))
+        # Killed mid-write: a torn last line
+        with open(self.spilled()[0], 'a') as handle:
+            handle.write('{"entry_id": "d7c1')
+
+        self.assertEqual(ManualAuditBuffer().recover(), 2)
+        self.assertEqual(self.spilled(), [])
+        self.assertEqual(AuditEntry.objects.filter(action='update').count(), 2)
+
+        # Had it lived, its own flush writes the same entries: stored once
+        dead.flush()
+        self.assertEqual(AuditEntry.objects.filter(action='update').count(), 2)
+
+    def test_a_live_buffers_files_are_left_alone(self):
+        buffer = ManualAuditBuffer()
+        buffer.add(self.entry(28))
+        self.assertEqual(buffer.recover(), 0)
+        with override_settings(AUDIT_SPILL_RECOVER_SECONDS=3600):
+            self.assertEqual(ManualAuditBuffer().recover(), 0)
+        self.assertEqual(len(self.spilled()), 1)
+
+
+# ==========================================
+# SMS notifications (sms.py)
+# ==========================================
+class FakeGateway(sms.BaseGateway):
+    """Accepts every SMS, except those to `reject`; raises `error` instead if set."""
+
+    def __init__(self, reject=(), error=None):
+        self.reject, self.error, self.sent = set(reject), error, []
+
+    def send_batch(self, messages):
+        if self.error:
+            raise self.error
+        self.sent += messages
+        return [('', 'Invalid destination') if to in self.reject else (f"gw-{cid}", '') for cid, to, _ in messages]
+
+
+def queued_sms(recipient='254712345678', body="Hello"):
+    return SmsMessage.objects.create(recipient=recipient, template='appointment_reminder', body=body)
+
+
+@TEST_SETTINGS
+@override_settings(SMS_MAX_ATTEMPTS=3, SMS_RETRY_BASE_SECONDS=60, SMS_RETRY_MAX_SECONDS=3600)
+class SmsDispatchTests(TestCase):
+    def dispatch(self, gateway):
+        return sms.dispatch(gateway, sms.TokenBucket(1000))
+
+    def test_coalesced_messages_leave_as_one_sms(self):
+        first, second = queued_sms(body="One"), queued_sms(body="Two")
+        gateway = FakeGateway()
+        stats = self.dispatch(gateway)
+        self.assertEqual((stats['messages'], stats['sms'], stats['sent']), (2, 1, 1))
+        self.assertEqual(gateway.sent, [(sms.client_id([first, second]), '254712345678', "One\nTwo")])
+        self.assertEqual(set(SmsMessage.objects.values_list('status', flat=True)), {'sent'})
+
+    def test_rejected_message_waits_before_the_next_attempt(self):
+        message = queued_sms(recipient='254722000000')
+        gateway = FakeGateway(reject={'254722000000'})
+        before = timezone.now()
+        self.dispatch(gateway)
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), ('queued', 1))
+        self.assertGreater(message.next_attempt_at, before + timedelta(seconds=45))
+        # A dispatch job is waiting for it
+        self.assertTrue(Job.objects.filter(
+            task='dispatch_sms', status='queued', run_after__gte=message.next_attempt_at - timedelta(seconds=1),
+        ).exists())
+
+        # Not due yet: not sent again
+        self.dispatch(gateway)
+        self.assertEqual(len(gateway.sent), 1)
+
+        SmsMessage.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        self.dispatch(FakeGateway())
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts, message.next_attempt_at), ('sent', 2, None))
+
+    def test_backoff_doubles_and_gives_up_after_max_attempts(self):
+        with mock.patch('patients.sms.random.uniform', return_value=1.0):
+            self.assertEqual([sms.retry_delay(n) for n in (1, 2, 3, 8)], [60, 120, 240, 3600])
+
+        message = queued_sms(recipient='254722000000')
+        for _ in range(3):
+            SmsMessage.objects.update(next_attempt_at=None)
+            self.dispatch(FakeGateway(reject={'254722000000'}))
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), ('failed', 3))
+
+    def test_gateway_down_puts_messages_back_with_a_backoff(self):
+        message = queued_sms()
+        with self.assertRaises(sms.GatewayError):
+            self.dispatch(FakeGateway(error=sms.GatewayError("down")))
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.claimed_by, message.error), ('queued', '', "down"))
+        self.assertGreater(message.next_attempt_at, timezone.now())
+
+    def test_client_id_is_stable_per_message_set(self):
+        first, second = queued_sms(), queued_sms()
+        self.assertEqual(sms.client_id([first, second]), sms.client_id(list(SmsMessage.objects.order_by('pk'))))
+        self.assertNotEqual(sms.client_id([first]), sms.client_id([first, second]))
+
+
+class TokenBucketTests(TestCase):
+    def test_try_take_beyond_capacity_takes_a_full_bucket(self):
+        now = [0.0]
+        bucket = sms.TokenBucket(10, 20, clock=lambda: now[0])
+        self.assertEqual(bucket.try_take(50), 0.0)
+        self.assertEqual(bucket.try_take(50), 2.0)   # empty: 20 tokens take 2 seconds
+        now[0] = 2.0
+        self.assertEqual(bucket.try_take(50), 0.0)
+
+    def test_take_waits_off_the_debt(self):
+        waits = []
+        bucket = sms.TokenBucket(10, 20, clock=lambda: 0.0, sleep=waits.append)
+        self.assertEqual(bucket.take(30), 1.0)
+        self.assertEqual(waits, [1.0])
+
+
+class HttpGatewayTests(TestCase):
+    def serve(self, **options):
+        server = sms.StandInGateway(('127.0.0.1', 0), **options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+    def test_sends_over_one_connection_and_drops_repeated_ids(self):
+        server, url = self.serve(latency=0)
+        with sms.HttpGateway(url) as gateway:
+            first = gateway.send_batch([('sms-a', '254712345678', "Hi"), ('sms-b', '254722000000', "Hi")])
+            again = gateway.send_batch([('sms-a', '254712345678', "Hi")])
+        self.assertTrue(all(gateway_id and not error for gateway_id, error in first))
+        self.assertEqual(again[0][0], first[0][0])
+        self.assertEqual(sum(server.received.values()), 2)
+        self.assertEqual(server.connections, 1)
+
+    def test_read_timeout_is_not_sent_again(self):
+        server, url = self.serve(latency=0.5)
+        with sms.HttpGateway(url, timeout=0.1) as gateway:
+            with self.assertRaisesMessage(sms.GatewayError, "No answer"):
+                gateway.send_batch([('sms-a', '254712345678', "Hi")])
+        time.sleep(0.8)   # the handler finishes; nothing else arrives
+        self.assertEqual(server.requests['ok'], 1)
+        self.assertEqual(sum(server.received.values()), 1)
+
+    def test_unreachable_gateway(self):
+        server, url = self.serve()
+        server.server_close()
+        with sms.HttpGateway(url, timeout=1) as gateway:
+            with self.assertRaisesMessage(sms.GatewayError, "unreachable"):
+                gateway.send_batch([('sms-a', '254712345678', "Hi")])
+
+
+# ==========================================
+# Archive (archive.py)
+# ==========================================
+@TEST_SETTINGS
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('nurse', password='pw')
+        self.client.force_login(self.user)
+
+    def closed_mother(self, **fields):
+        """A delivered mother, discharged 120 days ago with her bill cleared."""
+        mother = make_mother(**fields)
+        Appointment.objects.filter(patient=mother).update(status='Completed')
+        Delivery.objects.create(patient=mother, delivery_date=date(2026, 5, 1), delivery_type='Normal Delivery')
+        discharge = Discharge.objects.create(
+            patient=mother, discharge_date=timezone.now().date() - timedelta(days=120),
+            condition='Good', billing_status='Cleared',
+        )
+        DischargeDocument.objects.create(discharge=discharge, content_hash=f"hash-{mother.pk}", status='ready')
+        return mother
+
+    def test_archive_and_restore_keep_every_record(self):
+        mother = self.closed_mother()
+        other = make_mother(full_name="Akinyi Odhiambo")
+        DuplicateCandidate.objects.create(patient_a=mother, patient_b=other, score=0.8, status='dismissed')
+
+        self.assertEqual(archive.archive_closed_episodes(days=90), 1)
+        self.assertFalse(PregnantWoman.objects.filter(pk=mother.pk).exists())
+        self.assertFalse(DischargeDocument.objects.exists())
+        self.assertFalse(DuplicateCandidate.objects.exists())
+
+        restored = archive.restore_patient(mother.pk)
+        self.assertEqual(restored.pk, mother.pk)
+        self.assertEqual(restored.discharges.get().documents.get().content_hash, f"hash-{mother.pk}")
+        self.assertTrue(DuplicateCandidate.objects.filter(patient_a=mother, patient_b=other, status='dismissed').exists())
+        self.assertFalse(ArchivedPatient.objects.exists())
+
+    def test_pending_duplicate_review_blocks_archiving(self):
+        mother = self.closed_mother()
+        DuplicateCandidate.objects.create(patient_a=make_mother(full_name="Akinyi Odhiambo"), patient_b=mother, score=0.9)
+        self.assertEqual(archive.archive_closed_episodes(days=90), 0)
+        self.assertTrue(PregnantWoman.objects.filter(pk=mother.pk).exists())
+
+    def test_restore_is_refused_when_an_id_was_reused(self):
+        mother = self.closed_mother()
+        archive.archive_closed_episodes(days=90)
+        make_mother(id=mother.pk, full_name="Wanjiru Kamau")
+
+        with self.assertRaises(archive.RestoreConflict):
+            archive.restore_patient(mother.pk)
+        self.assertEqual(PregnantWoman.objects.get(pk=mother.pk).full_name, "Wanjiru Kamau")
+        self.assertTrue(ArchivedPatient.objects.filter(patient_id=mother.pk).exists())
+
+        response = self.client.post(reverse('patients:restore_patient', args=[mother.pk]), follow=True)
+        self.assertContains(response, "Cannot restore patient")
+
+    def test_restore_needs_a_post(self):
+        mother = self.closed_mother()
+        archive.archive_closed_episodes(days=90)
+
+        self.assertEqual(self.client.get(reverse('patients:edit_patient', args=[mother.pk])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('patients:restore_patient', args=[mother.pk])).status_code, 405)
+        self.assertTrue(ArchivedPatient.objects.exists())
+
+        response = self.client.post(reverse('patients:restore_patient', args=[mother.pk]))
+        self.assertRedirects(response, reverse('patients:edit_patient', args=[mother.pk]))
+        self.assertTrue(PregnantWoman.objects.filter(pk=mother.pk).exists())
+        self.assertEqual(self.client.post(reverse('patients:restore_patient', args=[mother.pk])).status_code, 404)
+
+    def test_archived_file_is_readable_without_a_restore(self):
+        mother = self.closed_mother(full_name="Auma Were")
+        archive.archive_closed_episodes(days=90)
+
+        response = self.client.get(reverse('patients:patient_list'), {'q': "Auma"})
+        self.assertContains(response, reverse('patients:archived_patient', args=[mother.pk]))
+        response = self.client.get(reverse('patients:archived_patient', args=[mother.pk]))
+        self.assertContains(response, "Auma Were")
+        self.assertLessEqual({'delivery', 'discharge'}, {event.kind for event in response.context['events']})
+        self.assertTrue(ArchivedPatient.objects.filter(patient_id=mother.pk).exists())
+        self.assertFalse(PregnantWoman.objects.filter(pk=mother.pk).exists())
+        self.assertEqual(self.client.get(reverse('patients:archived_patient', args=[mother.pk + 1])).status_code, 404)
+
+
+# ==========================================
+# ANC scheduling (scheduling.py)
+# ==========================================
+@TEST_SETTINGS
+@override_settings(ANC_AUTO_SCHEDULE=True, ANC_DOCTORS=['Dr. A', 'Dr. B'], ANC_CLINIC_DAYS=range(7))
+class AncSchedulingTests(TestCase):
+    def contacts(self, mother):
+        return sorted(
+            scheduling.contact_number(purpose)
+            for purpose in Appointment.objects.filter(patient=mother).values_list('purpose', flat=True)
+        )
+
+    def test_registration_books_every_contact_ahead(self):
+        mother = make_mother(lmp=timezone.now().date() - timedelta(weeks=10))
+        self.assertEqual(self.contacts(mother), [1, 2, 3, 4, 5, 6, 7, 8])
+
+    def test_overdue_contact_is_booked_today_while_its_window_is_open(self):
+        today = timezone.now().date()
+        mother = make_mother(lmp=today - timedelta(weeks=27))
+        self.assertEqual(self.contacts(mother), [3, 4, 5, 6, 7, 8])   # 26-week contact is open until week 30
+        self.assertEqual(Appointment.objects.get(patient=mother, purpose__startswith="ANC contact 3 ").date, today)
+
+    def test_contacts_whose_window_closed_are_skipped(self):
+        today = timezone.now().date()
+        self.assertEqual(self.contacts(make_mother(lmp=today - timedelta(weeks=41))), [8])
+        self.assertEqual(self.contacts(make_mother(lmp=today - timedelta(weeks=43))), [])
+        self.assertEqual(self.contacts(make_mother(lmp=today - timedelta(days=700))), [])
+
+    def test_booked_visits_are_logged_when_the_backend_returns_no_ids(self):
+        # MySQL: bulk_create() leaves the pks unset
+        with mock.patch.object(type(connection.features), 'can_return_rows_from_bulk_insert', False), \
+                self.captureOnCommitCallbacks(execute=True):
+            mother = make_mother()
+        booked = set(Appointment.objects.filter(patient=mother).values_list('pk', flat=True))
+        self.assertEqual(len(booked), 8)
+        self.assertEqual(set(ChangeLog.objects.filter(resource='appointments').values_list('object_id', flat=True)), booked)
+        self.assertEqual(
+            set(AuditEntry.objects.filter(resource='appointments').values_list('object_id', flat=True)), booked,
+        )
+
+    def test_registration_rolls_back_when_booking_fails(self):
+        with mock.patch.object(scheduling, 'save_appointments', side_effect=DatabaseError("full")):
+            with self.assertRaises(DatabaseError):
+                make_mother()
+        self.assertFalse(PregnantWoman.objects.exists())
+
+
+# ==========================================
+# Duplicate patients (dedupe.py)
+# ==========================================
+@TEST_SETTINGS
+@override_settings(ANC_AUTO_SCHEDULE=False)
+class MergeTests(TestCase):
+    def setUp(self):
+        self.keep = make_mother()
+        self.duplicate = make_mother(full_name="Achieng Otieno A.", phone='+254712345678')
+
+    def test_merge_moves_every_patient_row(self):
+        Appointment.objects.create(patient=self.duplicate, date=date(2026, 11, 2), time='09:00', purpose="Scan")
+        discharge = Discharge.objects.create(patient=self.duplicate, discharge_date=date(2026, 9, 1), condition='Good')
+        document = DischargeDocument.objects.create(discharge=discharge, content_hash='abc')
+        message = SmsMessage.objects.create(patient=self.duplicate, recipient='254712345678', template='x', body="Hi")
+
+        moved = dedupe.merge_patients(self.keep.pk, self.duplicate.pk)
+
+        self.assertEqual(moved, {'appointments': 1, 'discharges': 1, 'smsmessage': 1})
+        self.assertFalse(PregnantWoman.objects.filter(pk=self.duplicate.pk).exists())
+        message.refresh_from_db()
+        self.assertEqual(message.patient_id, self.keep.pk)
+        self.assertEqual(DischargeDocument.objects.get(pk=document.pk).discharge.patient_id, self.keep.pk)
+        self.assertTrue(ChangeLog.objects.filter(resource='discharges', object_id=discharge.pk).exists())
+
+    def test_other_review_pairs_move_to_the_kept_record(self):
+        third, fourth = make_mother(full_name="Atieno Otieno"), make_mother(full_name="Achieng Oti")
+        DuplicateCandidate.objects.create(patient_a=self.keep, patient_b=self.duplicate, score=0.95)
+        moved_pair = DuplicateCandidate.objects.create(patient_a=self.duplicate, patient_b=third, score=0.7)
+        DuplicateCandidate.objects.create(patient_a=self.keep, patient_b=fourth, score=0.8, status='dismissed')
+        DuplicateCandidate.objects.create(patient_a=self.duplicate, patient_b=fourth, score=0.8)
+
+        dedupe.merge_patients(self.keep.pk, self.duplicate.pk)
+
+        self.assertEqual(
+            set(DuplicateCandidate.objects.values_list('patient_a_id', 'patient_b_id', 'status')),
+            {(self.keep.pk, third.pk, 'pending'), (self.keep.pk, fourth.pk, 'dismissed')},
+        )
+        self.assertTrue(DuplicateCandidate.objects.filter(pk=moved_pair.pk).exists())
+
+    def test_merging_a_mother_into_herself_is_refused(self):
+        with self.assertRaises(ValueError):
+            dedupe.merge_patients(self.keep.pk, self.keep.pk)
+
+
+# ==========================================
+# Background jobs (jobs.py)
+# ==========================================
+RUNS = []
+
+
+@jobs.task(queue='test-jobs')
+def record_run(label):
+    job = Job.objects.get(kwargs__label=label, status='running')
+    RUNS.append((label, job.locked_at))
+
+
+@jobs.task(queue='test-jobs')
+def slow_run(label, requeue=False):
+    """Stands in for a job that ran an hour: the rest of its batch ages meanwhile."""
+    RUNS.append((label, None))
+    Job.objects.filter(task='record_run').update(locked_at=timezone.now() - timedelta(hours=1))
+    if requeue:
+        jobs.requeue_stale(timeout=600)
+
+
+@jobs.task(queue='test-jobs', max_attempts=2)
+def failing_run():
+    raise RuntimeError("Out of paper")
+
+
+@TEST_SETTINGS
+class JobTests(TestCase):
+    def setUp(self):
+        RUNS.clear()
+
+    def work(self):
+        return jobs.work(queues=['test-jobs'], batch_size=10, burst=True, worker='worker-1')
+
+    def test_each_job_renews_its_claim_when_it_starts(self):
+        jobs.enqueue(slow_run, priority=1, label='slow')
+        jobs.enqueue(record_run, label='next')
+        started = timezone.now()
+        self.assertEqual(self.work(), 2)
+        self.assertEqual([label for label, _ in RUNS], ['slow', 'next'])
+        self.assertGreaterEqual(RUNS[1][1], started)
+        self.assertEqual(set(Job.objects.values_list('status', flat=True)), {'done'})
+
+    def test_jobs_requeued_meanwhile_are_left_to_their_next_claim(self):
+        jobs.enqueue(slow_run, priority=1, label='slow', requeue=True)
+        jobs.enqueue(record_run, label='next')
+        with mock.patch.object(jobs, 'claim', wraps=jobs.claim) as claim:
+            self.assertEqual(self.work(), 2)
+        # 'next' was requeued while 'slow' ran: it ran once, from a second claim
+        self.assertEqual([label for label, _ in RUNS], ['slow', 'next'])
+        self.assertEqual(claim.call_count, 3)
+        self.assertEqual(Job.objects.get(kwargs__label='next').attempts, 2)
+
+    def test_a_row_claimed_by_another_worker_meanwhile_is_left_to_it(self):
+        taken = jobs.enqueue(record_run, label='taken')
+        free = jobs.enqueue(record_run, label='free')
+        update, rivals = QuerySet.update, []
+
+        def rival_first(queryset, **changes):
+            # worker-2 claims 'taken' between our read of the ids and our UPDATE
+            if not rivals:
+                rivals.append(update(Job.objects.filter(pk=taken.pk), status='running', locked_by='worker-2'))
+            return update(queryset, **changes)
+
+        ready = Job.objects.filter(status='queued').order_by('pk')
+        with CaptureQueriesContext(connection) as queries, \
+                mock.patch.object(QuerySet, 'update', autospec=True, side_effect=rival_first):
+            claimed = jobs.claim_rows(ready, 10, status='running', locked_by='worker-1')
+        self.assertEqual(claimed, [free.pk])
+        self.assertEqual(Job.objects.get(pk=taken.pk).locked_by, 'worker-2')
+        # Older MySQL / MariaDB reject LIMIT inside an IN subquery
+        claim_sql = [q['sql'] for q in queries if q['sql'].startswith('UPDATE')][-1]
+        self.assertNotIn('LIMIT', claim_sql)
+
+    def test_failed_job_is_retried_with_backoff_then_buried(self):
+        job = jobs.enqueue(failing_run)
+        self.work()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertGreater(job.run_after, timezone.now())
+
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        self.work()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('dead', 2))
+        self.assertIn("Out of paper", job.last_error)
+
+
+# ==========================================
+# Care summary columns (counters.py)
+# ==========================================
+@TEST_SETTINGS
+@override_settings(ANC_AUTO_SCHEDULE=False)
+class CareSummaryTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('nurse', password='unused'))
+        self.mother = make_mother()
+
+    def visit(self, status='Completed', day=date(2026, 9, 1)):
+        return Appointment.objects.create(patient=self.mother, date=day, time='09:00', purpose="Check-up", status=status)
+
+    def test_changed_summary_bumps_updated_at_and_is_synced(self):
+        before = PregnantWoman.objects.get(pk=self.mother.pk).updated_at
+        cursor = ChangeLog.objects.order_by('-seq').values_list('seq', flat=True).first()
+        self.visit()
+
+        mother = PregnantWoman.objects.get(pk=self.mother.pk)
+        self.assertEqual(mother.visits_attended, 1)
+        self.assertGreater(mother.updated_at, before)
+        changes, _, _ = sync.changes_since(cursor, 500)
+        synced = [c for c in changes if c['resource'] == 'patients' and c['id'] == mother.pk]
+        self.assertEqual(synced[0]['data']['visits_attended'], 1)
+
+    def test_unchanged_summary_leaves_the_mother_alone(self):
+        before = PregnantWoman.objects.get(pk=self.mother.pk).updated_at
+        logged = ChangeLog.objects.count()
+        counters.refresh([self.mother.pk])
+        self.assertEqual(PregnantWoman.objects.get(pk=self.mother.pk).updated_at, before)
+        self.assertEqual(ChangeLog.objects.count(), logged)
+
+    def test_edit_form_does_not_write_back_a_stale_summary(self):
+        url = reverse('patients:edit_patient', args=[self.mother.pk])
+        form = self.client.get(url).context['form']
+        self.visit()   # while the form is open
+
+        data = {name: value for name, value in form.initial.items() if value is not None}
+        data['age'] = 28
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        mother = PregnantWoman.objects.get(pk=self.mother.pk)
+        self.assertEqual((mother.age, mother.visits_attended), (28, 1))
+
+    def test_device_edit_cannot_set_the_summary(self):
+        self.visit()
+        mother = PregnantWoman.objects.get(pk=self.mother.pk)
+        with transaction.atomic():
+            status, _ = sync.apply_change({
+                'resource': 'patients', 'id': mother.pk, 'op': 'upsert',
+                'base_updated_at': DjangoJSONEncoder().default(mother.updated_at),
+                'data': {'age': 29, 'visits_attended': 7, 'total_paid': '100000'},
+            })
+        self.assertEqual(status, 'applied')
+        mother.refresh_from_db()
+        self.assertEqual((mother.age, mother.visits_attended, mother.total_paid), (29, 1, 0))
+
+    def test_plain_saves_behave_like_any_model(self):
+        loaded = PregnantWoman.objects.get(pk=self.mother.pk)
+        PregnantWoman.objects.filter(pk=loaded.pk).delete()
+        loaded.save()   # deleted meanwhile: saved again, not an error
+        self.assertTrue(PregnantWoman.objects.filter(pk=loaded.pk).exists())
+
+        PregnantWoman(
+            pk=loaded.pk, full_name="Achieng Otieno", phone=loaded.phone, age=30, lmp=loaded.lmp,
+            created_at=loaded.created_at,
+        ).save()
+        self.assertEqual(PregnantWoman.objects.get(pk=loaded.pk).age, 30)
+
+
+# ==========================================
+# Batch delivery entry
+# ==========================================
+@TEST_SETTINGS
+@override_settings(ANC_AUTO_SCHEDULE=False)
+class DeliveryBatchTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('midwife', password='unused'))
+        self.first, self.second = make_mother(), make_mother(full_name="Wanjiru Kamau", phone='0722000111')
+
+    def post(self, *rows):
+        data = {'form-TOTAL_FORMS': str(len(rows)), 'form-INITIAL_FORMS': '0'}
+        for i, row in enumerate(rows):
+            data.update({f'form-{i}-{key}': value for key, value in row.items()})
+        return self.client.post(reverse('patients:add_delivery_batch'), data)
+
+    def test_batch_is_saved_with_edds_from_the_mothers(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.post(
+                {'patient': self.first.pk, 'delivery_date': '2026-09-01', 'delivery_type': 'Normal Delivery'},
+                {'patient': self.second.pk, 'delivery_date': '2026-09-02', 'delivery_type': 'C-Section'},
+                {},   # a blank row is skipped
+            )
+        self.assertRedirects(response, reverse('patients:delivery_list'))
+        deliveries = Delivery.objects.order_by('delivery_date')
+        self.assertEqual([d.patient_id for d in deliveries], [self.first.pk, self.second.pk])
+        self.assertEqual(deliveries[0].edd, self.first.expected_due_date)
+        self.assertEqual(ChangeLog.objects.filter(resource='deliveries').count(), 2)
+
+    def test_batch_is_logged_when_the_backend_returns_no_ids(self):
+        # MySQL: bulk_create() leaves the pks unset
+        with mock.patch.object(type(connection.features), 'can_return_rows_from_bulk_insert', False), \
+                self.captureOnCommitCallbacks(execute=True):
+            created = Delivery.objects.bulk_register([
+                Delivery(patient=self.first, delivery_date=date(2026, 9, 1), delivery_type='Normal Delivery'),
+                Delivery(patient=self.first, delivery_date=date(2026, 9, 1), delivery_type='C-Section'),
+                Delivery(patient_id=self.second.pk, delivery_date=date(2026, 9, 2), delivery_type='C-Section'),
+            ])
+        saved = dict(Delivery.objects.values_list('pk', 'delivery_type'))
+        self.assertEqual({d.pk: d.delivery_type for d in created}, saved)
+        self.assertEqual(set(ChangeLog.objects.filter(resource='deliveries').values_list('object_id', flat=True)), set(saved))
+        self.assertEqual(set(AuditEntry.objects.filter(resource='deliveries').values_list('object_id', flat=True)), set(saved))
+
+    def test_an_invalid_row_saves_nothing(self):
+        response = self.post(
+            {'patient': self.first.pk, 'delivery_date': '2026-09-01', 'delivery_type': 'Normal Delivery'},
+            {'patient': 999999, 'delivery_date': '2026-09-02', 'delivery_type': 'C-Section'},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Failed to record deliveries")
+        self.assertFalse(Delivery.objects.exists())
+
+    def test_csv_import(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as handle:
+            handle.write("patient,delivery_date,delivery_type,emergency_name,emergency_relationship,emergency_phone\n")
+            handle.write(f"{self.first.pk},2026-09-01,Normal Delivery,Otieno,Husband,0711000222\n")
+            handle.write(f"{self.second.pk},2026-09-02,C-Section,,,\n")
+        self.addCleanup(os.unlink, handle.name)
+
+        call_command('import_deliveries', handle.name, '--dry-run', stdout=StringIO())
+        self.assertFalse(Delivery.objects.exists())
+        call_command('import_deliveries', handle.name, stdout=StringIO())
+        self.assertEqual(Delivery.objects.get(patient=self.first).emergency_contact, "Otieno (Husband) - 0711000222")
+
+        with open(handle.name, 'a') as more:
+            more.write("999999,2026-09-03,Normal Delivery,,,\n")
+        with self.assertRaisesMessage(CommandError, "1 invalid row(s)"):
+            call_command('import_deliveries', handle.name, stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(Delivery.objects.count(), 2)
+
+
+# ==========================================
+# Cached patient dropdowns (forms.py)
+# ==========================================
+@TEST_SETTINGS
+@override_settings(ANC_AUTO_SCHEDULE=False)
+class ChoiceCacheTests(TestCase):
+    def setUp(self):
+        forms._CHOICE_CACHE.clear()
+        self.mother = make_mother()
+
+    def labels(self, queryset=None):
+        field = forms.AppointmentForm().fields['patient']
+        if queryset is not None:
+            field.queryset = queryset
+        return [label for value, label in field.choices if value]
+
+    def test_choice_list_is_reused_until_a_mother_changes(self):
+        first = forms.AppointmentForm().fields['patient'].choices.cache_entry()
+        self.assertIs(forms.DischargeForm().fields['patient'].choices.cache_entry(), first)
+
+        self.mother.full_name = "Achieng Atieno"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.mother.save()
+        self.assertEqual(self.labels(), ["Achieng Atieno"])
+
+    def test_generation_catches_writes_the_row_stats_miss(self):
+        self.assertEqual(self.labels(), ["Achieng Otieno"])
+        # No signal and no new updated_at: count and latest updated_at look unchanged
+        PregnantWoman.objects.filter(pk=self.mother.pk).update(full_name="Renamed Elsewhere")
+        self.assertEqual(self.labels(), ["Achieng Otieno"])
+
+        forms.forget_choices(PregnantWoman)   # e.g. from another process
+        self.assertEqual(self.labels(), ["Renamed Elsewhere"])
+
+    def test_cache_is_bounded_least_recently_used_first(self):
+        with mock.patch.object(forms, 'CHOICE_CACHE_SIZE', 2):
+            for age in (20, 21, 22):
+                self.labels(PregnantWoman.objects.filter(age__gte=age))
+            self.labels(PregnantWoman.objects.filter(age__gte=21))   # used again
+            self.labels(PregnantWoman.objects.filter(age__gte=23))
+        self.assertEqual(len(forms._CHOICE_CACHE), 2)
+        kept = ' '.join(forms._CHOICE_CACHE)
+        self.assertIn('>= 21', kept)
+        self.assertIn('>= 23', kept)
+
+
+# ==========================================
+# JSON API (api.py)
+# ==========================================
+@TEST_SETTINGS
+@override_settings(ANC_AUTO_SCHEDULE=False)
+class ApiTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('partner', password='unused'))
+        self.mothers = [
+            make_mother(full_name=f"Mother {n}", county='Kisumu' if n % 2 else 'Siaya') for n in range(5)
+        ]
+        self.url = reverse('patients:api_collection', args=['patients'])
+
+    def test_collection_projects_filters_and_pages_by_id(self):
+        response = self.client.get(self.url, {'fields': 'full_name', 'county': 'Kisumu', 'limit': 1})
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['results'], [{'id': self.mothers[1].pk, 'full_name': "Mother 1"}])
+
+        body = self.client.get(body['next']).json()
+        self.assertEqual([r['id'] for r in body['results']], [self.mothers[3].pk])
+        self.assertIsNone(body['next'])
+
+    def test_unchanged_collection_answers_304(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(
+            self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304,
+        )
+        # A different projection is a different body
+        self.assertEqual(self.client.get(self.url, {'fields': 'age'}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        self.mothers[0].age = 31
+        self.mothers[0].save()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_a_delete_moves_last_modified_on(self):
+        an_hour_ago = timezone.now() - timedelta(hours=1)
+        PregnantWoman.objects.update(updated_at=an_hour_ago)
+        ChangeLog.objects.update(changed_at=an_hour_ago)
+        last_modified = self.client.get(self.url)['Last-Modified']
+
+        self.mothers[2].delete()
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 4)
+
+    def test_detail_and_errors(self):
+        mother = self.mothers[0]
+        detail = reverse('patients:api_detail', args=['patients', mother.pk])
+        self.assertEqual(self.client.get(detail).json()['full_name'], "Mother 0")
+        self.assertEqual(self.client.get(reverse('patients:api_detail', args=['patients', 999999])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('patients:api_collection', args=['users'])).status_code, 404)
+        self.assertEqual(self.client.get(self.url, {'fields': 'password'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'limit': 'many'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'updated_since': 'yesterday'}).status_code, 400)
+
+    def test_anonymous_clients_get_401_not_304(self):
+        etag = self.client.get(self.url)['ETag']
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 401)
+
+
+# ==========================================
+# Read-replica routing (routers.py, ReplicaRoutingMiddleware)
+# ==========================================
+class ReadReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.router = routers.ReadReplicaRouter()
+        routers._health.update(checked=0.0, ok=False)
+
+    def test_reads_follow_the_request_alias_only_for_patient_tables(self):
+        self.assertIsNone(self.router.db_for_read(PregnantWoman))
+        token = routers.use_replica('replica')
+        try:
+            self.assertEqual(self.router.db_for_read(PregnantWoman), 'replica')
+            self.assertIsNone(self.router.db_for_read(User))
+            self.assertEqual(self.router.db_for_write(PregnantWoman), routers.PRIMARY)
+        finally:
+            routers.reset_replica(token)
+        self.assertIsNone(self.router.db_for_read(PregnantWoman))
+
+    def test_reads_inside_a_transaction_stay_on_the_primary(self):
+        token = routers.use_replica('replica')
+        try:
+            with mock.patch.object(routers.connections[routers.PRIMARY], 'in_atomic_block', True):
+                self.assertEqual(self.router.db_for_read(PregnantWoman), routers.PRIMARY)
+        finally:
+            routers.reset_replica(token)
+
+    @override_settings(REPLICA_MAX_LAG=10, REPLICA_CHECK_INTERVAL=60)
+    def test_health_check_is_cached_and_fails_closed(self):
+        with mock.patch.object(routers, 'replica_lag_seconds', side_effect=DatabaseError("down")) as lag:
+            self.assertFalse(routers.replica_is_healthy('replica'))
+            self.assertFalse(routers.replica_is_healthy('replica'))
+        self.assertEqual(lag.call_count, 1)
+
+        routers._health['checked'] = 0.0
+        with mock.patch.object(routers, 'replica_lag_seconds', return_value=30):
+            self.assertFalse(routers.replica_is_healthy('replica'))
+        routers._health['checked'] = 0.0
+        with mock.patch.object(routers, 'replica_lag_seconds', return_value=2):
+            self.assertTrue(routers.replica_is_healthy('replica'))
+
+
+@TEST_SETTINGS
+@override_settings(REPLICA_STICKY_SECONDS=15)
+class ReplicaRoutingMiddlewareTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('nurse', password='unused'))
+        # The read itself stays on the primary (the test runs in a transaction);
+        # what is checked is whether the page asked for the replica
+        patches = [
+            mock.patch.object(routers, 'replica_alias', return_value='replica'),
+            mock.patch.object(routers, 'replica_is_healthy', return_value=True),
+            mock.patch.object(routers, 'use_replica', wraps=routers.use_replica),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def routed(self, url):
+        routers.use_replica.reset_mock()
+        self.assertEqual(self.client.get(url).status_code, 200)
+        return routers.use_replica.called
+
+    def test_only_listed_read_views_use_the_replica(self):
+        self.assertTrue(self.routed(reverse('patients:patient_list')))
+        self.assertFalse(self.routed(reverse('patients:add_patient')))
+
+    def test_successful_write_pins_the_session_to_the_primary(self):
+        mother = make_mother()
+        self.client.post(reverse('patients:delete_patient', args=[mother.pk]))
+        self.assertFalse(self.routed(reverse('patients:patient_list')))
+
+        session = self.client.session
+        session[ReplicaRoutingMiddleware.session_key] = time.time() - 1
+        session.save()
+        self.assertTrue(self.routed(reverse('patients:patient_list')))
+
+    def test_refused_write_does_not_pin(self):
+        response = self.client.post(reverse('patients:restore_patient', args=[999999]))
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(self.routed(reverse('patients:patient_list')))
+
+    def test_unhealthy_replica_is_skipped(self):
+        routers.replica_is_healthy.return_value = False
+        self.assertFalse(self.routed(reverse('patients:patient_list')))
+
+    def test_replica_error_reruns_the_view_on_the_primary(self):
+        seen = []
+
+        def view(request):
+            seen.append(routers._read_alias.get())
+            if len(seen) == 1:
+                raise DatabaseError("replica gone")
+            return HttpResponse("ok")
+
+        request = RequestFactory().get('/patients/')
+        request.resolver_match = mock.Mock(view_name='patients:patient_list')
+        middleware = ReplicaRoutingMiddleware(lambda request: None)
+        middleware.process_view(request, view, (), {})
+        try:
+            view(request)
+        except DatabaseError as exc:
+            with mock.patch.object(routers, 'mark_replica_unhealthy') as unhealthy:
+                response = middleware.process_exception(request, exc)
+        self.assertEqual(response.content, b"ok")
+        self.assertEqual(seen, ['replica', None])
+        unhealthy.assert_called_once()
+
+
+# ==========================================
+# Dashboard (sync and concurrent variants)
+# ==========================================
+@TEST_SETTINGS
+@override_settings(ANC_AUTO_SCHEDULE=False)
+class DashboardTests(TestCase):
+    def test_counts_and_trimester_split(self):
+        today = timezone.now().date()
+        make_mother(risk_level='High', expected_due_date=today + timedelta(days=30))
+        make_mother(expected_due_date=today + timedelta(days=120))
+        make_mother(expected_due_date=today + timedelta(days=200))
+        make_mother(expected_due_date=today + timedelta(days=250))
+
+        context = views.dashboard_stats(today)
+        self.assertEqual(context['total_patients'], 4)
+        self.assertEqual(context['high_risk_patients'], 1)
+        self.assertEqual(context['urgent_patient'].risk_level, 'High')
+        self.assertEqual(
+            (context['first_trimester'], context['second_trimester'], context['third_trimester']), (2, 1, 1),
+        )
+        self.assertEqual(context['first_trimester_percent'], 50)
+
+        self.client.force_login(User.objects.create_user('nurse', password='unused'))
+        self.assertEqual(self.client.get(reverse('patients:dashboard')).status_code, 200)
+
+    def test_no_pregnancies_gives_zero_percentages(self):
+        context = views.dashboard_stats(timezone.now().date())
+        self.assertEqual(context['first_trimester_percent'], 0)
+        self.assertEqual(context['total_patients'], 0)
+
+
+class AsyncDashboardTests(SimpleTestCase):
+    """The query functions are stand-ins: worker-thread connections can't see test transactions."""
+
+    def fake_queries(self, delay=0.05, fail=None):
+        running, peak, lock = [0], [0], threading.Lock()
+
+        def query(name):
+            def run(today):
+                with lock:
+                    running[0] += 1
+                    peak[0] = max(peak[0], running[0])
+                time.sleep(delay)
+                with lock:
+                    running[0] -= 1
+                if name == fail:
+                    raise DatabaseError("query failed")
+                if name == 'trimesters':
+                    return {'t1': 1, 't2': 1, 't3': 2}
+                return name
+            return run
+
+        return {name: query(name) for name in views.DASHBOARD_QUERIES}, peak
+
+    def test_runs_queries_concurrently_within_the_limit(self):
+        queries, peak = self.fake_queries()
+        today = date(2026, 1, 1)
+        with mock.patch.dict(views.DASHBOARD_QUERIES, queries), \
+                mock.patch.object(views, 'close_old_connections') as close:
+            context = async_to_sync(views.dashboard_stats_async)(today, concurrency=3)
+            self.assertEqual(context, views.dashboard_stats(today))
+        self.assertEqual(peak[0], 3)
+        self.assertEqual(close.call_count, len(queries))
+        self.assertEqual(context['third_trimester_percent'], 50)
+
+    def test_a_failing_query_fails_the_page_and_still_releases_connections(self):
+        queries, _ = self.fake_queries(delay=0, fail='total_deliveries')
+        with mock.patch.dict(views.DASHBOARD_QUERIES, queries), \
+                mock.patch.object(views, 'close_old_connections') as close:
+            with self.assertRaises(DatabaseError):
+                async_to_sync(views.dashboard_stats_async)(date(2026, 1, 1), concurrency=2)
+        self.assertGreaterEqual(close.call_count, 1)
+
+
+# ==========================================
+# Static assets (storage.py, StaticAssetMiddleware)
+# ==========================================
+class StaticAssetTests(SimpleTestCase):
+    def setUp(self):
+        tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, tmp)
+        (tmp / 'src' / 'css').mkdir(parents=True)
+        self.css = "/* layout */\nbody {\n    margin: 0;\n}\n" + "".join(
+            f".card-{n} {{\n    padding: {n}px;\n    color: #333;\n}}\n" for n in range(30)
+        )
+        (tmp / 'src' / 'css' / 'site.css').write_text(self.css)
+        (tmp / 'src' / 'css' / 'tiny.css').write_text("p { margin: 0; }")
+
+        settings_override = override_settings(
+            STATICFILES_DIRS=[tmp / 'src'], STATIC_ROOT=tmp / 'root', STATIC_UNHASHED_MAX_AGE=60,
+            STORAGES={**settings.STORAGES, 'staticfiles': {
+                'BACKEND': 'patients.storage.CompressedManifestStaticFilesStorage',
+            }},
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+        manifest = json.loads((tmp / 'root' / 'staticfiles.json').read_text())['paths']
+        self.hashed = manifest['css/site.css']
+        self.root = tmp / 'root'
+
+    def test_collectstatic_minifies_hashes_and_precompresses(self):
+        built = (self.root / self.hashed).read_bytes()
+        self.assertNotIn(b"/* layout */", built)
+        self.assertIn(b"body{margin: 0}.card-0{", built)
+        self.assertEqual(gzip.decompress((self.root / (self.hashed + '.gz')).read_bytes()), built)
+        # Too small to be worth a compressed copy
+        self.assertFalse(list(self.root.glob('css/tiny*.gz')))
+
+    def test_serves_the_gzip_variant_with_immutable_caching(self):
+        response = self.client.get('/static/' + self.hashed, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        body = b''.join(response.streaming_content)
+        self.assertEqual(gzip.decompress(body), (self.root / self.hashed).read_bytes())
+        self.assertEqual(int(response['Content-Length']), len(body))
+
+    def test_identity_and_unhashed_names(self):
+        response = self.client.get('/static/css/site.css', HTTP_ACCEPT_ENCODING='identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        self.assertEqual(response['Content-Type'], 'text/css')
+
+        revalidated = self.client.get('/static/css/site.css', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_missing_and_escaping_paths_fall_through(self):
+        self.assertEqual(self.client.get('/static/css/missing.css').status_code, 404)
+        self.assertEqual(self.client.get('/static/../manage.py').status_code, 404)
+
+    def test_accepted_encodings(self):
+        self.assertEqual(accepted_encodings('br;q=1.0, GZIP , identity;q=0'), {'br', 'gzip'})
+        self.assertEqual(accepted_encodings(''), set())
+
+
+# ==========================================
+# HTML minification (HtmlMinifyMiddleware)
+# ==========================================
+class MinifyHtmlTests(SimpleTestCase):
+    def test_collapses_whitespace_and_drops_comments(self):
+        html = "<div>\n    <!-- card -->\n    <b>a</b>   <i>b</i>\n</div>\n<!--[if IE]><p>old</p><![endif]-->"
+        self.assertEqual(minify_html(html), "<div> <b>a</b> <i>b</i> </div> <!--[if IE]><p>old</p><![endif]-->")
+
+    def test_keeps_preformatted_blocks(self):
+        html = "<pre>\n  a\n    b</pre>\n\n<textarea>x\n  y</textarea><script>\n  // keep\n</script>"
+        self.assertEqual(
+            minify_html(html), "<pre>\n  a\n    b</pre> <textarea>x\n  y</textarea><script>\n  // keep\n</script>",
+        )
+
+
+@TEST_SETTINGS
+class HtmlMinifyMiddlewareTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('nurse', password='unused'))
+        self.url = reverse('patients:add_delivery')
+
+    @override_settings(HTML_MINIFY=True)
+    def test_patients_pages_are_minified_then_gzipped(self):
+        response = self.client.get(self.url)
+        self.assertNotIn(b"<!-- White Card Container -->", response.content)
+        self.assertNotIn(b"\n    ", response.content)
+
+        compressed = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        body = gzip.decompress(compressed.content)
+        self.assertNotIn(b"\n    ", body)
+        self.assertLess(len(compressed.content), len(body))
+
+    @override_settings(HTML_MINIFY=False)
+    def test_can_be_turned_off(self):
+        self.assertIn(b"<!-- White Card Container -->", self.client.get(self.url).content)
+
+    @override_settings(HTML_MINIFY=True)
+    def test_other_apps_are_left_alone(self):
+        self.client.logout()
+        self.assertIn(b"\n", self.client.get(reverse('admin:login')).content)
+
+
+# ==========================================
+# Sessions, messages and cached users (backends.py)
+# ==========================================
+@TEST_SETTINGS
+@override_settings(
+    SESSION_ENGINE='django.contrib.sessions.backends.cached_db',
+    AUTHENTICATION_BACKENDS=['patients.backends.CachedModelBackend'],
+)
+class CachedUserTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create_user('nurse', password='unused')
+        self.backend = backends.CachedModelBackend()
+
+    def test_user_is_loaded_once_then_served_from_the_cache(self):
+        self.assertEqual(self.backend.get_user(self.user.pk), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.backend.get_user(self.user.pk), self.user)
+        self.assertIsNone(self.backend.get_user(999999))
+
+    def test_account_changes_drop_the_cached_copy(self):
+        self.backend.get_user(self.user.pk)
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+        self.user.is_active = True
+        self.user.save()
+        group = Group.objects.create(name='midwives')
+        for change in (
+            lambda: self.user.groups.add(group),
+            lambda: group.user_set.remove(self.user),
+            lambda: self.user.user_permissions.add(Permission.objects.first()),
+            lambda: group.user_set.add(self.user),
+            lambda: group.user_set.clear(),
+        ):
+            self.backend.get_user(self.user.pk)
+            change()
+            self.assertIsNone(cache.get(backends.user_cache_key(self.user.pk)))
+
+    def test_logged_in_page_skips_session_and_user_queries(self):
+        self.client.force_login(self.user)
+        url = reverse('patients:audit_log')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        sql = ' '.join(q['sql'] for q in ctx.captured_queries)
+        self.assertNotIn('django_session', sql)
+        self.assertNotIn('"auth_user"', sql)
+
+    def test_flash_messages_travel_in_a_cookie(self):
+        self.client.force_login(self.user)
+        mother = make_mother()
+        response = self.client.post(reverse('patients:delete_patient', args=[mother.pk]))
+        self.assertIn('messages', response.cookies)
+
+
+@TEST_SETTINGS
+class CleanupSessionsTests(TestCase):
+    def test_deletes_only_expired_sessions_in_batches(self):
+        for n in range(5):
+            session = SessionStore()
+            session['n'] = n
+            session.set_expiry(-60 if n < 3 else 3600)
+            session.save()
+
+        out = StringIO()
+        call_command('cleanup_sessions', batch_size=2, stdout=out)
+        self.assertEqual(Session.objects.count(), 2)
+        self.assertIn("Deleted 3 expired session(s); 2 active", out.getvalue())
+
+
+# ==========================================
+# Regional analytics cube (analytics.py)
+# ==========================================
+@TEST_SETTINGS
+@override_settings(ANC_AUTO_SCHEDULE=False, SMS_RECEIPTS=False, ANALYTICS_SETTLE_SECONDS=0)
+class AnalyticsTests(TestCase):
+    def setUp(self):
+        self.mother = make_mother(risk_level='High')
+        make_mother(full_name="Atieno", ward='Nyalenda')
+        make_mother(full_name="Akinyi", county='Siaya', ward='Ugunja')
+        Delivery.objects.create(patient=self.mother, delivery_date=date(2026, 9, 1), delivery_type='C-Section')
+        Transaction.objects.create(patient=self.mother, amount=500, status='Success', transaction_id='QAN1')
+        Transaction.objects.create(patient=self.mother, amount=900, status='Failed', transaction_id='QAN2')
+
+    def by_county(self):
+        return {row['county']: row for row in analytics.slice_cube('county')}
+
+    def test_incremental_refresh_counts_each_region(self):
+        self.assertGreater(analytics.refresh_all(batch_size=2), 0)
+        kisumu, siaya = self.by_county()['Kisumu'], self.by_county()['Siaya']
+        self.assertEqual((kisumu['registrations'], kisumu['high_risk']), (2, 1))
+        self.assertEqual((kisumu['deliveries_c_section'], kisumu['revenue']), (1, Decimal('500')))
+        self.assertEqual((siaya['registrations'], siaya['deliveries_c_section']), (1, 0))
+
+        wards = {(row['county'], row['ward']) for row in analytics.slice_cube('ward', county='Kisumu')}
+        self.assertEqual(wards, {('Kisumu', 'Kondele'), ('Kisumu', 'Nyalenda')})
+        self.assertEqual(analytics.refresh_rollups(), 0)
+
+    def test_a_mother_who_moves_takes_her_rows_with_her(self):
+        analytics.refresh_all()
+        self.mother.county, self.mother.ward = 'Siaya', 'Ugunja'
+        self.mother.save()
+        analytics.refresh_all()
+
+        cube = self.by_county()
+        self.assertEqual((cube['Siaya']['registrations'], cube['Siaya']['deliveries_c_section']), (2, 1))
+        self.assertEqual(cube['Siaya']['revenue'], Decimal('500'))
+        self.assertEqual((cube['Kisumu']['registrations'], cube['Kisumu']['revenue']), (1, 0))
+
+        incremental = analytics.slice_cube('ward')
+        analytics.rebuild_rollups()
+        self.assertEqual(analytics.slice_cube('ward'), [row for row in incremental if row['registrations']])
+
+    @override_settings(ANALYTICS_SETTLE_SECONDS=60)
+    def test_changes_wait_at_a_young_gap(self):
+        # The mother's entry is held by a transaction that has not committed yet
+        held = ChangeLog.objects.filter(resource='patients', object_id=self.mother.pk).earliest('seq').seq
+        ChangeLog.objects.filter(seq=held).delete()
+        analytics.refresh_all()
+        self.assertEqual(analytics.cube_state()[0], held - 1)
+        self.assertFalse(ChangeLogGap.objects.exists())
+
+    @override_settings(ANALYTICS_SETTLE_SECONDS=60)
+    def test_a_late_commit_into_a_settled_gap_is_counted(self):
+        ChangeLog.objects.update(changed_at=timezone.now() - timedelta(minutes=5))
+        analytics.refresh_all()
+        mother = make_mother(full_name="Adhiambo", county='Siaya', ward='Ugunja')
+        # Her entry is held by a long transaction: the rollups go past its seq
+        late_seq = ChangeLog.objects.get(resource='patients', object_id=mother.pk).seq
+        ChangeLog.objects.filter(resource='patients', object_id=mother.pk).delete()
+        ChangeLog.objects.create(seq=late_seq + 1, resource='patients', object_id=999999, action='delete')
+        ChangeLog.objects.filter(seq=late_seq + 1).update(changed_at=timezone.now() - timedelta(minutes=5))
+        analytics.refresh_all()
+        self.assertEqual(self.by_county()['Siaya']['registrations'], 1)
+
+        ChangeLog.objects.create(seq=late_seq, resource='patients', object_id=mother.pk, action='upsert')
+        analytics.refresh_all()
+        self.assertEqual(self.by_county()['Siaya']['registrations'], 2)
+
+    def test_page_and_api(self):
+        analytics.refresh_all()
+        self.client.force_login(User.objects.create_user('analyst', password='unused'))
+        page = self.client.get(reverse('patients:analytics'), {'group': 'nonsense', 'from': 'bad'})
+        self.assertEqual(page.context['group_by'], 'county')
+        self.assertEqual(page.context['totals']['registrations'], 3)
+
+        url = reverse('patients:api_analytics')
+        month = timezone.localtime().strftime('%Y-%m')
+        body = self.client.get(url, {'group': 'month', 'from': month}).json()
+        self.assertEqual([row['registrations'] for row in body['results']], [3])
+        self.assertEqual(body['as_of_seq'], ChangeLog.objects.latest('seq').seq)
+        self.assertEqual(self.client.get(url, {'group': 'mother'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'to': '2026-13'}).status_code, 400)
+
+
+# ==========================================
+# Discharge summary documents (documents.py, pdf.py)
+# ==========================================
+@TEST_SETTINGS
+@override_settings(ANC_AUTO_SCHEDULE=False)
+class DischargeDocumentTests(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        media_override = override_settings(MEDIA_ROOT=media)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+
+        # The pool is replaced: what is checked is what gets queued
+        submit = mock.patch.object(documents, 'submit')
+        self.submit = submit.start()
+        self.addCleanup(submit.stop)
+
+        self.mother = make_mother()
+        Delivery.objects.create(patient=self.mother, delivery_date=date(2026, 5, 1), delivery_type='Normal Delivery')
+        self.discharge = Discharge.objects.create(
+            patient=self.mother, discharge_date=date(2026, 5, 4), condition='Good', billing_status='Cleared',
+        )
+        self.client.force_login(User.objects.create_user('nurse', password='unused'))
+
+    def store(self, document, content=None, error=None):
+        future = Future()
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(content)
+        # _store closes its (pool thread's) connection; here that is the test's own
+        with mock.patch.object(documents, 'connection'):
+            if error:
+                with self.assertLogs('patients.documents', 'ERROR'):
+                    documents._store(document.pk, document.content_hash, future)
+            else:
+                documents._store(document.pk, document.content_hash, future)
+        document.refresh_from_db()
+        return document
+
+    def test_same_content_reuses_the_document_and_edits_create_a_new_one(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            document = documents.request_summary(self.discharge)
+        self.assertEqual(document.status, 'queued')
+        [[(doc_id, data)]] = self.submit.call_args.args
+        self.assertEqual(doc_id, document.pk)
+        self.assertEqual(data['delivery']['delivery_type'], 'Normal Delivery')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(documents.request_summary(self.discharge).pk, document.pk)
+
+        self.discharge.condition = 'Fair'
+        self.discharge.save()
+        self.assertNotEqual(documents.request_summary(self.discharge).pk, document.pk)
+
+    def test_rendered_pdf_is_stored_and_downloaded(self):
+        document = documents.request_summary(self.discharge)
+        data = documents.summary_data(documents.with_summary_data(Discharge.objects.all()).get())
+        content = pdf.render_discharge_summary(data)
+        self.assertTrue(content.startswith(b'%PDF'))
+
+        document = self.store(document, content)
+        self.assertEqual(document.status, 'ready')
+        status = self.client.get(reverse('patients:summary_status', args=[document.pk])).json()
+        self.assertEqual(status['download_url'], reverse('patients:summary_download', args=[document.pk]))
+
+        response = self.client.get(reverse('patients:discharge_summary', args=[self.discharge.pk]))
+        self.assertRedirects(response, status['download_url'], fetch_redirect_response=False)
+        download = self.client.get(status['download_url'])
+        self.assertEqual(b''.join(download.streaming_content), content)
+        self.assertIn('attachment', download['Content-Disposition'])
+
+    def test_failed_render_is_reported_and_retried(self):
+        document = self.store(documents.request_summary(self.discharge), error=ValueError("bad font"))
+        self.assertEqual(document.status, 'failed')
+        status = self.client.get(reverse('patients:summary_status', args=[document.pk])).json()
+        self.assertEqual(status, {'status': 'failed', 'error': "bad font"})
+        self.assertEqual(self.client.get(reverse('patients:summary_download', args=[document.pk])).status_code, 404)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            retried = documents.request_summary(self.discharge)
+        self.assertEqual((retried.pk, retried.status), (document.pk, 'queued'))
+        self.submit.assert_called_once()
+
+    def test_batch_queues_every_discharge_of_the_day(self):
+        other = Discharge.objects.create(
+            patient=make_mother(full_name="Akinyi"), discharge_date=date(2026, 5, 4), condition='Fair',
+        )
+        url = reverse('patients:summary_batch')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url, {'date': '2026-05-04'})
+        [jobs] = self.submit.call_args.args
+        self.assertEqual({data['discharge_id'] for _, data in jobs}, {self.discharge.pk, other.pk})
+
+        page = self.client.get(url, {'date': '2026-05-04'})
+        self.assertTrue(page.context['pending'])
+        self.assertEqual(len(page.context['rows']), 2)
+
+    def test_stale_documents_are_requeued_unless_edited(self):
+        kept = documents.request_summary(self.discharge)
+        DischargeDocument.objects.filter(pk=kept.pk).update(status='rendering')
+        edited = DischargeDocument.objects.create(discharge=self.discharge, content_hash='old-content')
+
+        documents.requeue_stale()
+        [jobs] = self.submit.call_args.args
+        self.assertEqual([doc_id for doc_id, _ in jobs], [kept.pk])
+        edited.refresh_from_db()
+        self.assertEqual(edited.status, 'failed')
+
+
+# ==========================================
+# Patient timeline (timeline.py)
+# ==========================================
+@TEST_SETTINGS
+@override_settings(ANC_AUTO_SCHEDULE=False, SMS_RECEIPTS=False)
+class TimelineTests(TestCase):
+    def setUp(self):
+        self.mother = make_mother()
+        self.client.force_login(User.objects.create_user('nurse', password='unused'))
+
+    def add_history(self, mother, visits):
+        for n in range(visits):
+            Appointment.objects.create(
+                patient=mother, date=date(2026, 1, 5) + timedelta(weeks=n), time='09:00', purpose=f"Visit {n}",
+            )
+        Delivery.objects.create(
+            patient=mother, delivery_date=date(2026, 3, 1), delivery_time='04:30', delivery_type='Normal Delivery',
+        )
+        Discharge.objects.create(patient=mother, discharge_date=date(2026, 3, 3), condition='Good')
+        payment = Transaction.objects.create(patient=mother, amount=500, status='Success', transaction_id=f'QTL{Transaction.objects.count()}')
+        Transaction.objects.filter(pk=payment.pk).update(created_at=timezone.make_aware(datetime(2026, 3, 2, 10, 0)))
+
+    def test_events_are_merged_oldest_first(self):
+        self.add_history(self.mother, visits=8)
+        with self.assertNumQueries(5):
+            events = list(timeline.events(timeline.patient_with_history(self.mother.pk)))
+        self.assertEqual(len(events), 11)
+        self.assertEqual([e.when for e in events], sorted(e.when for e in events))
+        self.assertEqual([e.kind for e in events[-3:]], ['delivery', 'payment', 'discharge'])
+        self.assertEqual(events[0].title, "Visit 0")
+
+    def test_page_query_count_does_not_grow_with_history(self):
+        url = reverse('patients:patient_timeline', args=[self.mother.pk])
+        self.add_history(self.mother, visits=1)
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(url)
+
+        self.add_history(self.mother, visits=30)
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(url)
+        self.assertEqual(len(response.context['events']), 31 + 6)
+        self.assertEqual(len(large), len(small))
+
+    def test_missing_and_archived_mothers_are_not_found(self):
+        self.assertIsNone(timeline.patient_with_history(999999))
+        ArchivedPatient.objects.create(patient_id=999999, full_name="Archived", phone='0700000000', records=[])
+        response = self.client.get(reverse('patients:patient_timeline', args=[999999]))
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(ArchivedPatient.objects.filter(patient_id=999999).exists())
+
+
+# ==========================================
+# M-Pesa statement reconciliation (reconcile.py)
+# ==========================================
+STATEMENT_HEADER = ['Receipt No.', 'Completion Time', 'Details', 'Transaction Status', 'Paid In', 'Withdrawn']
+
+
+def statement_csv(lines):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["Account Name", "Genesis Clinic"])
+    writer.writerow(STATEMENT_HEADER)
+    writer.writerows(lines)
+    return buffer.getvalue().encode('utf-8')
+
+
+@TEST_SETTINGS
+@override_settings(ANC_AUTO_SCHEDULE=False, SMS_RECEIPTS=False, RECONCILE_WINDOW_MINUTES=15)
+class ReconcileTests(TestCase):
+    def setUp(self):
+        self.mother = make_mother()
+
+    def payment(self, amount, status, receipt='', at=(2026, 9, 1, 10, 0)):
+        payment = Transaction.objects.create(patient=self.mother, amount=amount, status=status, transaction_id=receipt or None)
+        Transaction.objects.filter(pk=payment.pk).update(created_at=datetime(*at, tzinfo=payments.MPESA_TIMEZONE))
+        return payment
+
+    def statement(self):
+        return [
+            ['RKL0MATCH1', '01-09-2026 10:00:30', 'Achieng', 'Completed', '500.00', ''],
+            ['RKL0CONF01', '01-09-2026 10:05:00', 'Achieng', 'Completed', '1,200.00', ''],
+            ['RKL0TIME01', '01-09-2026 10:14:00', '2547****5678 Achieng', 'Completed', '300', ''],
+            ['RKL0WRONG1', '01-09-2026 10:20:00', 'Achieng', 'Completed', '750', ''],
+            ['RKL0NEW001', '01-09-2026 11:00:00', 'Stranger', 'Completed', '100', ''],
+            ['RKL0MATCH1', '01-09-2026 10:00:30', 'Achieng', 'Completed', '500.00', ''],
+            ['RKL0BAD001', 'yesterday', 'Achieng', 'Completed', '100', ''],
+            ['RKL0OUT001', '01-09-2026 12:00:00', 'Charge', 'Completed', '', '30'],
+        ]
+
+    def test_matches_confirms_and_reports_exceptions(self):
+        matched = self.payment(500, 'Success', 'RKL0MATCH1')
+        confirmed = self.payment(1200, 'Pending', 'RKL0CONF01', at=(2026, 9, 1, 10, 4))
+        by_time = self.payment(300, 'Pending', at=(2026, 9, 1, 10, 2))
+        self.payment(300, 'Pending', at=(2026, 8, 31, 9, 0))
+        self.payment(600, 'Success', 'RKL0WRONG1', at=(2026, 9, 1, 10, 19))
+        missing = self.payment(900, 'Success', 'RKL0GONE01', at=(2026, 9, 1, 10, 30))
+
+        counts, issues = reconcile.reconcile(reconcile.read_rows(BytesIO(statement_csv(self.statement())), 'mpesa.csv'))
+        self.assertEqual(
+            {k: counts[k] for k in ('lines', 'matched', 'confirmed', 'matched_by_time', 'ignored')},
+            {'lines': 8, 'matched': 1, 'confirmed': 1, 'matched_by_time': 1, 'ignored': 1},
+        )
+        self.assertEqual(sorted((i.issue, i.receipt) for i in issues), [
+            ('amount_mismatch', 'RKL0WRONG1'), ('duplicate_line', 'RKL0MATCH1'),
+            ('missing_from_statement', 'RKL0GONE01'), ('not_in_system', 'RKL0NEW001'), ('unreadable', 'RKL0BAD001'),
+        ])
+        self.assertEqual([i.transaction for i in issues if i.issue == 'missing_from_statement'], [missing.pk])
+
+        for payment, status, receipt in (
+            (matched, 'Success', 'RKL0MATCH1'), (confirmed, 'Success', 'RKL0CONF01'), (by_time, 'Success', 'RKL0TIME01'),
+        ):
+            payment.refresh_from_db()
+            self.assertEqual((payment.status, payment.transaction_id), (status, receipt))
+        self.mother.refresh_from_db()
+        self.assertEqual(self.mother.total_paid, Decimal('3500'))
+        self.assertTrue(ChangeLog.objects.filter(resource='transactions', object_id=by_time.pk).exists())
+
+    def test_payments_changed_by_a_callback_meanwhile_are_left_alone(self):
+        paid_meanwhile = self.payment(300, 'Pending', at=(2026, 9, 1, 10, 2))
+        other = self.payment(400, 'Pending', at=(2026, 9, 1, 10, 3))
+        statement = [
+            STATEMENT_HEADER,
+            ['RKL0TIME01', '01-09-2026 10:04:00', 'Achieng', 'Completed', '300', ''],
+            ['RKL0TIME02', '01-09-2026 10:05:00', 'Achieng', 'Completed', '400', ''],
+        ]
+        recheck = reconcile._recheck
+
+        def callbacks_arrive_first(*args):
+            Transaction.objects.filter(pk=paid_meanwhile.pk).update(status='Success', transaction_id='RKL0CB0001')
+            Transaction.objects.create(patient=self.mother, amount=400, status='Success', transaction_id='RKL0TIME02')
+            return recheck(*args)
+
+        with mock.patch.object(reconcile, '_recheck', side_effect=callbacks_arrive_first):
+            counts, issues = reconcile.reconcile(statement)
+        self.assertEqual((counts['matched_by_time'], counts['changed_meanwhile']), (0, 2))
+        self.assertEqual(sorted(i.transaction for i in issues), [paid_meanwhile.pk, other.pk])
+        paid_meanwhile.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(paid_meanwhile.transaction_id, 'RKL0CB0001')
+        self.assertEqual((other.status, other.transaction_id), ('Pending', None))
+
+    def test_dry_run_changes_nothing(self):
+        pending = self.payment(1200, 'Pending', 'RKL0CONF01', at=(2026, 9, 1, 10, 4))
+        counts, _ = reconcile.reconcile([STATEMENT_HEADER, self.statement()[1]], dry_run=True)
+        self.assertEqual(counts['confirmed'], 1)
+        pending.refresh_from_db()
+        self.assertEqual(pending.status, 'Pending')
+
+    def test_statement_without_a_header_is_refused(self):
+        with self.assertRaisesMessage(ValueError, "No header row"):
+            reconcile.reconcile([['a', 'b'], ['c', 'd']])
+
+
+@TEST_SETTINGS
+@override_settings(ANC_AUTO_SCHEDULE=False, SMS_RECEIPTS=False)
+class ReconciliationUploadTests(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        media_override = override_settings(MEDIA_ROOT=media)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        self.client.force_login(User.objects.create_user('finance', password='unused'))
+
+    def upload(self, name, content):
+        response = self.client.post(reverse('patients:reconciliations'), {
+            'statement': SimpleUploadedFile(name, content), 'dry_run': 'on',
+        })
+        return response
+
+    def test_upload_is_reconciled_in_the_background_with_a_report(self):
+        content = statement_csv([['RKL0NEW001', '01-09-2026 11:00:00', 'Stranger', 'Completed', '100', '']])
+        response = self.upload('statement.csv', content)
+        reconciliation = Reconciliation.objects.get()
+        self.assertRedirects(response, reverse('patients:reconciliation', args=[reconciliation.pk]))
+        self.assertTrue(Job.objects.filter(task='reconcile_statement').exists())
+
+        reconcile.run(reconciliation.pk)
+        reconciliation.refresh_from_db()
+        self.assertEqual(reconciliation.status, 'done')
+        self.assertEqual(reconciliation.counts['not_in_system'], 1)
+        report = self.client.get(reverse('patients:reconciliation', args=[reconciliation.pk]), {'download': 'report'})
+        rows = list(csv.reader(StringIO(b''.join(report.streaming_content).decode())))
+        self.assertEqual((rows[1][0], rows[1][2]), ('not_in_system', 'RKL0NEW001'))
+
+        # Already run: a second worker picking it up does nothing
+        reconcile.run(reconciliation.pk)
+
+    def test_uploads_need_a_login(self):
+        self.client.logout()
+        response = self.upload('statement.csv', statement_csv([]))
+        self.assertRedirects(response, f"{reverse('patients:login')}?next={reverse('patients:reconciliations')}")
+        self.assertFalse(Reconciliation.objects.exists())
+
+    def test_bad_files(self):
+        response = self.upload('statement.pdf', b'%PDF')
+        self.assertFormError(response.context['form'], 'statement', "Upload the statement as CSV, XLSX or XLS.")
+
+        self.upload('statement.csv', b'nothing,useful\n1,2\n')
+        reconciliation = Reconciliation.objects.get()
+        with self.assertLogs('patients.reconcile', 'ERROR'):
+            reconcile.run(reconciliation.pk)
+        reconciliation.refresh_from_db()
+        self.assertEqual(reconciliation.status, 'failed')
+        self.assertIn("No header row", reconciliation.error)
+
+
+# ==========================================
+# Login throttling (throttle.py)
+# ==========================================
+class SlidingWindowTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.window = throttle.SlidingWindow('test', limit=4, seconds=60)
+
+    def test_previous_window_counts_for_its_remaining_overlap(self):
+        for _ in range(4):
+            self.window.hit('client', now=600)
+        self.assertEqual(self.window.count('client', now=610), 4)
+        # Half-way into the next window, half of the previous one still counts
+        self.assertEqual(self.window.count('client', now=690), 2)
+        self.assertEqual(self.window.count('client', now=720), 0)
+        self.assertEqual(self.window.retry_after('client', now=610), 50)
+
+    def test_refunds_never_go_below_zero(self):
+        self.window.refund('client', now=600)
+        self.window.hit('client', now=600)
+        self.window.refund('client', now=600)
+        self.window.refund('client', now=600)
+        self.assertEqual(self.window.count('client', now=600), 0)
+        self.assertEqual(self.window.count('client', now=630), 0)
+
+
+@TEST_SETTINGS
+@override_settings(
+    LOGIN_THROTTLE_ENABLED=True,
+    LOGIN_THROTTLE={'ip': [(4, 60)], 'username': [(2, 300)]},
+    LOGIN_THROTTLE_IP_HEADER='HTTP_X_FORWARDED_FOR',
+    AUTHENTICATION_BACKENDS=['patients.backends.CachedModelBackend'],
+)
+class LoginThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        User.objects.create_user('nurse', password='correct horse')
+        self.url = reverse('patients:login')
+
+    def login(self, username='nurse', password='wrong', ip='10.0.0.1', forwarded_for='203.0.113.7'):
+        # What the client sent, then the address our proxy saw
+        self.client.logout()
+        return self.client.post(
+            self.url, {'username': username, 'password': password}, HTTP_X_FORWARDED_FOR=f'{forwarded_for}, {ip}',
+        )
+
+    def test_failed_attempts_lock_the_username_without_hashing(self):
+        self.assertEqual(self.login().status_code, 200)
+        self.assertEqual(self.login(ip='10.0.0.2').status_code, 200)
+
+        with mock.patch.object(User, 'check_password') as check:
+            response = self.login(password='correct horse', ip='10.0.0.3')
+        check.assert_not_called()
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 0)
+        self.assertContains(response, "Too many login attempts", status_code=429)
+
+        # Other accounts are not affected
+        self.assertEqual(self.login(username='midwife', ip='10.0.0.4').status_code, 200)
+
+    def test_an_address_is_limited_but_successful_logins_are_refunded(self):
+        for _ in range(6):
+            self.assertEqual(self.login(password='correct horse').status_code, 302)
+        for username in ('a', 'b', 'c', 'd'):
+            self.login(username=username)
+        self.assertEqual(self.login(username='e').status_code, 429)
+        self.assertEqual(self.login(username='e', ip='10.0.0.9').status_code, 200)
+
+    def test_a_forged_forwarded_for_does_not_dodge_the_address_limit(self):
+        for n in range(4):
+            self.login(username=f'user{n}', forwarded_for=f'198.51.100.{n}')
+        self.assertEqual(self.login(username='e', forwarded_for='198.51.100.99').status_code, 429)
+
+    def test_the_address_is_counted_proxy_hops_from_the_right(self):
+        request = RequestFactory().get('/', HTTP_X_FORWARDED_FOR='1.1.1.1, 10.0.0.5, 172.16.0.1')
+        self.assertEqual(throttle.client_ip(request), '172.16.0.1')
+        with override_settings(LOGIN_THROTTLE_PROXY_HOPS=2):
+            self.assertEqual(throttle.client_ip(request), '10.0.0.5')
+        with override_settings(LOGIN_THROTTLE_PROXY_HOPS=5):
+            self.assertEqual(throttle.client_ip(request), '1.1.1.1')
+
+    @override_settings(LOGIN_THROTTLE_ENABLED=False)
+    def test_can_be_turned_off(self):
+        for _ in range(4):
+            self.login()
+        self.assertEqual(self.login(password='correct horse').status_code, 302)
+
+
+# ==========================================
+# Template warm-up (templating.py)
+# ==========================================
+class TemplateWarmupTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        Path(tmp, 'broken.html').write_text("{% if %}")
+        # The production profile: compiled templates are kept by the cached loader
+        templates = override_settings(TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'DIRS': [tmp],
+            'OPTIONS': {'loaders': [('django.template.loaders.cached.Loader', [
+                'django.template.loaders.filesystem.Loader', 'django.template.loaders.app_directories.Loader',
+            ])]},
+        }])
+        templates.enable()
+        self.addCleanup(templates.disable)
+
+    def cached_names(self):
+        loader = engines['django'].engine.template_loaders[0]
+        return {key.split('-')[0] for key in loader.get_template_cache}
+
+    def test_every_app_template_is_compiled_into_the_cache(self):
+        names = templating.template_names()
+        self.assertIn('patients/dashboard.html', names)
+        timings, errors = templating.warm()
+        self.assertEqual(errors, {})
+        self.assertEqual(sorted(timings), names)
+        self.assertLessEqual(set(names), self.cached_names())
+
+    def test_command_fails_on_a_broken_template(self):
+        out, err = StringIO(), StringIO()
+        with mock.patch.object(templating, 'template_names', return_value=['broken.html', 'base.html']):
+            with self.assertRaisesMessage(CommandError, "1 template(s) do not compile"):
+                call_command('warm_templates', stdout=out, stderr=err)
+        self.assertIn("Compiled 1 templates", out.getvalue())
+        self.assertIn("broken.html", err.getvalue())
+
+    def test_startup_warmup_follows_the_setting(self):
+        with override_settings(TEMPLATE_WARMUP=False), mock.patch.object(templating, 'warm') as warm:
+            templating.warm_on_startup()
+        warm.assert_not_called()
+
+        with override_settings(TEMPLATE_WARMUP=True), \
+                mock.patch.object(templating, 'template_names', return_value=['broken.html', 'base.html']):
+            with self.assertLogs('patients.templating', 'INFO') as logs:
+                templating.warm_on_startup()
+        self.assertIn("Template broken.html does not compile", logs.output[0])
+        self.assertIn("Compiled 1 templates", logs.output[1])
+
+
+# ==========================================
+# Streamed list pages (streaming.py)
+# ==========================================
+@TEST_SETTINGS
+@override_settings(ANC_AUTO_SCHEDULE=False, LIST_STREAM_CHUNK=2, HTML_MINIFY=True)
+class StreamingListTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('nurse', password='unused'))
+        self.url = reverse('patients:patient_list')
+
+    def names(self, html):
+        """The mothers listed in `html`, in page order."""
+        return sorted((name for name in (f"Mother {n}" for n in range(5)) if name in html), key=html.index)
+
+    def test_streamed_page_has_the_same_rows_in_chunks(self):
+        for n in range(5):
+            make_mother(full_name=f"Mother {n}")
+        normal = self.client.get(self.url).content.decode()
+
+        response = self.client.get(self.url, {'stream': '1'})
+        self.assertTrue(response.streaming)
+        pieces = [piece.decode() for piece in response.streaming_content]
+        # Page head, three chunks of rows, page tail
+        self.assertEqual(len(pieces), 5)
+        self.assertEqual(self.names(''.join(pieces)), self.names(normal))
+        self.assertEqual(len(self.names(pieces[1])), 2)
+        self.assertIn('</html>', pieces[-1])
+
+    def test_filters_and_empty_state_carry_over(self):
+        make_mother(full_name="Mother 1")
+        pieces = b''.join(self.client.get(self.url, {'stream': '1', 'q': 'Mother 3'}).streaming_content).decode()
+        self.assertNotIn("Mother 1", pieces)
+        self.assertIn('No patients found matching "Mother 3".', pieces)
+
+    def test_every_list_page_streams(self):
+        mother = make_mother()
+        Appointment.objects.create(patient=mother, date=date(2026, 11, 2), time='09:00', purpose="Scan")
+        Delivery.objects.create(patient=mother, delivery_date=date(2026, 5, 1), delivery_type='Normal Delivery')
+        Discharge.objects.create(patient=mother, discharge_date=date(2026, 5, 3), condition='Good')
+        for name in ('appointment_list', 'delivery_list', 'discharge_list'):
+            response = self.client.get(reverse(f'patients:{name}'), {'stream': '1'})
+            self.assertTrue(response.streaming, name)
+            self.assertIn("Achieng Otieno", b''.join(response.streaming_content).decode(), name)
+
+    def test_template_without_a_rows_marker_is_refused(self):
+        request = RequestFactory().get(self.url)
+        request.user = User.objects.get()
+        with self.assertRaisesMessage(ValueError, "has no <!--stream-rows-->"):
+            streaming.stream_list(
+                request, 'patients/delete_patient.html', 'patients/rows/patient_rows.html', 'patients',
+                PregnantWoman.objects.all(), {'patient': make_mother()},
+            )
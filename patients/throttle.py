@@ -0,0 +1,155 @@
+"""
+Login throttling.
+
+Checking a password (PBKDF2, hundreds of thousands of rounds) is the most
+expensive thing the app does, so a credential-stuffing burst can keep every
+worker busy hashing. CachedModelBackend asks allow() before it hashes
+anything and refuses the attempt (no hash, no query) once a client is over
+its limits:
+
+    per IP address   attempts that have not succeeded, LOGIN_THROTTLE['ip']
+    per username     failed attempts,                   LOGIN_THROTTLE['username']
+
+Each limit is a list of (attempts, seconds) windows, e.g. a short one
+against bursts and a longer one against slow, steady guessing. An attempt
+is counted against the IP before its password is checked, so a hundred
+parallel requests cannot all slip in before the first failure is
+recorded; a successful login refunds it, so a clinic's staff behind one
+address are not locked out by logging in.
+
+Windows are sliding: the count is the current fixed window plus the
+previous one weighted by how much of it still overlaps, which needs only
+cache.add() / incr() and so works across processes with a shared cache
+(Redis). With the local-memory cache each process keeps its own counts.
+"""
+import hashlib
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+KEY_PREFIX = 'login-throttle:'
+
+DEFAULT_LIMITS = {
+    'ip': [(10, 60), (50, 3600)],
+    'username': [(5, 300), (20, 86400)],
+}
+
+
+def _limits(scope):
+    return getattr(settings, 'LOGIN_THROTTLE', DEFAULT_LIMITS).get(scope, [])
+
+
+def enabled():
+    return getattr(settings, 'LOGIN_THROTTLE_ENABLED', True)
+
+
+class SlidingWindow:
+    """At most `limit` events per `seconds` for each key, counted in the cache."""
+
+    def __init__(self, scope, limit, seconds):
+        self.scope = scope
+        self.limit = limit
+        self.seconds = seconds
+
+    def _key(self, key, slot):
+        return f"{KEY_PREFIX}{self.scope}:{self.seconds}:{key}:{slot}"
+
+    def _counts(self, key, now):
+        slot, into = divmod(now, self.seconds)
+        current, previous = self._key(key, int(slot)), self._key(key, int(slot) - 1)
+        counts = cache.get_many([current, previous])
+        # A refund straddling a window boundary can leave -1 behind
+        return max(counts.get(current, 0), 0), max(counts.get(previous, 0), 0), into
+
+    def count(self, key, now=None):
+        current, previous, into = self._counts(key, time.time() if now is None else now)
+        return previous * (1 - into / self.seconds) + current
+
+    def retry_after(self, key, now=None):
+        """Whole seconds until count() drops below the limit, if nothing else is added."""
+        current, previous, into = self._counts(key, time.time() if now is None else now)
+        if current < self.limit:
+            # The previous window's share shrinks as this one goes on
+            wait = self.seconds * (1 - (self.limit - current) / previous) - into
+        else:
+            # Then this window becomes the previous one and shrinks in turn
+            wait = self.seconds - into + self.seconds * (1 - self.limit / current)
+        return max(math.ceil(wait), 1)
+
+    def hit(self, key, now=None):
+        now = time.time() if now is None else now
+        current = self._key(key, int(now // self.seconds))
+        # add() + incr() are atomic in Redis / memcached / locmem, unlike get() + set()
+        cache.add(current, 0, 2 * self.seconds)
+        try:
+            cache.incr(current)
+        except ValueError:
+            # Expired between add() and incr()
+            cache.set(current, 1, 2 * self.seconds)
+
+    def refund(self, key, now=None):
+        now = time.time() if now is None else now
+        try:
+            cache.decr(self._key(key, int(now // self.seconds)))
+        except ValueError:
+            pass
+
+
+def _windows(scope):
+    return [SlidingWindow(scope, limit, seconds) for limit, seconds in _limits(scope)]
+
+
+def _digest(value):
+    # Cache keys must be short and plain (memcached): usernames can be anything
+    return hashlib.sha256(value.encode()).hexdigest()[:32]
+
+
+def client_ip(request):
+    """
+    The client's address; behind a proxy set LOGIN_THROTTLE_IP_HEADER (e.g.
+    'HTTP_X_FORWARDED_FOR'). Each proxy appends the address it saw, and the
+    client can put anything in front, so the address is counted from the
+    right: LOGIN_THROTTLE_PROXY_HOPS entries in is the one our first proxy saw.
+    """
+    header = getattr(settings, 'LOGIN_THROTTLE_IP_HEADER', 'REMOTE_ADDR')
+    value = request.META.get(header) or request.META.get('REMOTE_ADDR') or ''
+    addresses = [address.strip() for address in value.split(',') if address.strip()] or ['']
+    hops = max(getattr(settings, 'LOGIN_THROTTLE_PROXY_HOPS', 1), 1)
+    # Fewer entries than proxies: every one was added by a proxy, the first is the client
+    return addresses[-hops] if len(addresses) >= hops else addresses[0]
+
+
+def _keys(request, username):
+    return {'ip': _digest(client_ip(request)), 'username': _digest((username or '').strip().lower())}
+
+
+def allow(request, username):
+    """
+    Called before a password is checked: 0 if the attempt may go ahead (it
+    is then counted against the IP), otherwise the seconds to wait.
+    """
+    now = time.time()
+    keys = _keys(request, username)
+    wait = 0
+    for scope, key in keys.items():
+        for window in _windows(scope):
+            if window.count(key, now) >= window.limit:
+                wait = max(wait, window.retry_after(key, now))
+    if not wait:
+        for window in _windows('ip'):
+            window.hit(keys['ip'], now)
+    return wait
+
+
+def record(request, username, succeeded):
+    """Called once the password was checked."""
+    now = time.time()
+    keys = _keys(request, username)
+    if succeeded:
+        for window in _windows('ip'):
+            window.refund(keys['ip'], now)
+    else:
+        for window in _windows('username'):
+            window.hit(keys['username'], now)
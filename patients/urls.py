@@ -1,6 +1,6 @@
 from django.urls import path
 from django.contrib.auth import views as auth_views
-from . import views
+from . import views, api, sync
 
 app_name = 'patients'
 
@@ -8,19 +8,26 @@ urlpatterns = [
     # --- Authentication URLs ---
     
     # 1. ROOT URL IS NOW LOGIN
-    path('', auth_views.LoginView.as_view(template_name='patients/login.html', redirect_authenticated_user=True), name='login'),
+    path('', views.LoginView.as_view(), name='login'),
 
     # Logout now redirects explicitly back to the 'login' page defined above
     path('logout/', auth_views.LogoutView.as_view(next_page='patients:login'), name='logout'),
 
     # --- Dashboard ---
     path('dashboard/', views.dashboard, name='dashboard'),
+    # Async variant (serve through ASGI): runs the dashboard queries concurrently
+    path('dashboard/live/', views.dashboard_async, name='dashboard_async'),
 
     # --- Patients ---
     path('patients/', views.patient_list, name='patient_list'),
     path('patients/add/', views.add_patient, name='add_patient'),
     path('patients/edit/<int:id>/', views.edit_patient, name='edit_patient'),
     path('patients/delete/<int:id>/', views.delete_patient, name='delete_patient'),
+    path('patients/restore/<int:id>/', views.restore_patient, name='restore_patient'),
+    path('patients/archived/<int:id>/', views.archived_patient, name='archived_patient'),
+    path('patients/<int:id>/timeline/', views.patient_timeline, name='patient_timeline'),
+    path('patients/duplicates/', views.patient_duplicates, name='patient_duplicates'),
+    path('patients/duplicates/<int:id>/', views.review_patient_duplicate, name='review_patient_duplicate'),
 
     # --- Appointments ---
     path('appointments/', views.appointment_list, name='appointment_list'),
@@ -30,6 +37,7 @@ urlpatterns = [
 
     # --- Deliveries ---
     path('deliveries/add/', views.add_delivery, name='add_delivery'),
+    path('deliveries/batch/', views.add_delivery_batch, name='add_delivery_batch'),
     path('deliveries/', views.delivery_list, name='delivery_list'),
     path('deliveries/edit/<int:id>/', views.edit_delivery, name='edit_delivery'),
     path('deliveries/delete/<int:id>/', views.delete_delivery, name='delete_delivery'),
@@ -39,10 +47,35 @@ urlpatterns = [
     path('discharges/', views.discharge_list, name='discharge_list'),
     path('discharges/edit/<int:id>/', views.edit_discharge, name='edit_discharge'),
     path('discharges/delete/<int:id>/', views.delete_discharge, name='delete_discharge'),
+    path('discharges/<int:id>/summary/', views.discharge_summary, name='discharge_summary'),
+    path('discharges/summaries/', views.summary_batch, name='summary_batch'),
+    path('discharges/summaries/<int:id>/status/', views.summary_status, name='summary_status'),
+    path('discharges/summaries/<int:id>/download/', views.summary_download, name='summary_download'),
 
     # --- Billing & Payments (NEW) ---
     # This loads the page
     path('billing/', views.billing_view, name='billing_page'),
     # This handles the form submission (Charge button)
     path('billing/initiate/', views.initiate_stk_push, name='initiate_stk_push'),
+    path('billing/reconcile/', views.reconciliations, name='reconciliations'),
+    path('billing/reconcile/<int:id>/', views.reconciliation_detail, name='reconciliation'),
+
+    # --- Audit Log ---
+    path('audit/', views.audit_log, name='audit_log'),
+
+    # --- Regional Analytics ---
+    path('analytics/', views.analytics_page, name='analytics'),
+
+    # --- Outcome Reports ---
+    path('reports/', views.report_list, name='report_list'),
+    path('reports/<int:id>/', views.report_run, name='report_run'),
+    path('reports/<int:id>/export/<str:fmt>/', views.report_export, name='report_export'),
+
+    # --- Read-only JSON API (v1) ---
+    path('api/v1/sync/', sync.sync, name='api_sync'),
+    path('api/v1/payments/mpesa/callback/', views.mpesa_callback, name='mpesa_callback'),
+    path('api/v1/sms/delivery/', views.sms_delivery_report, name='sms_delivery_report'),
+    path('api/v1/analytics/', api.analytics, name='api_analytics'),
+    path('api/v1/<str:resource>/', api.collection, name='api_collection'),
+    path('api/v1/<str:resource>/<int:pk>/', api.detail, name='api_detail'),
 ]
\ No newline at end of file
@@ -1,63 +1,91 @@
 from django.shortcuts import render, redirect, get_object_or_404 
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.urls import reverse
+from django.utils.dateparse import parse_date
 from django.contrib import messages 
-from django.db.models import Q, Sum
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Count, F, Q, Sum
 from django.utils import timezone 
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from asgiref.sync import sync_to_async
+import asyncio
 import datetime
+import json
+from django.contrib.auth import views as auth_views
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.models import User
+from django.core.paginator import Paginator
 
 # IMPORTS: 
-from .models import PregnantWoman, Appointment, Delivery, Discharge, Transaction
-from .forms import PregnantWomanForm, AppointmentForm, DeliveryForm, DischargeForm
+from .models import (
+    PregnantWoman, Appointment, Delivery, Discharge, Transaction, ArchivedPatient, AuditEntry, ReportRun,
+    DischargeDocument, DuplicateCandidate, Reconciliation,
+)
+from . import analytics, archive, dedupe, documents, jobs, payments, reports, sms, streaming, timeline
+from .forms import (
+    PregnantWomanForm, AppointmentForm, DeliveryForm, DeliveryFormSet, DischargeForm, StatementUploadForm,
+    ThrottledAuthenticationForm,
+)
 
 # ==========================================
-# Dashboard
+# Login
 # ==========================================
-def dashboard(request):
-    today = timezone.now().date()
+class LoginView(auth_views.LoginView):
+    """The root page. Refused attempts (see throttle.py) get 429 and Retry-After."""
+    template_name = 'patients/login.html'
+    form_class = ThrottledAuthenticationForm
+    redirect_authenticated_user = True
+
+    def form_invalid(self, form):
+        response = super().form_invalid(form)
+        if form.throttled:
+            response.status_code = 429
+            response['Retry-After'] = str(form.throttled)
+        return response
 
-    # --- 1. Basic Stats ---
-    total_patients = PregnantWoman.objects.count()
-    high_risk_patients = PregnantWoman.objects.filter(risk_level='High').count()
-    upcoming_appointments = Appointment.objects.filter(status='Scheduled', date__gte=today).count()
-    total_deliveries = Delivery.objects.count()
-    total_discharges = Discharge.objects.count()
-    
-    # Calculate Total Revenue from Success Transactions
-    revenue_this_month = Transaction.objects.filter(
-        status='Success', 
+# ==========================================
+# Dashboard
+# ==========================================
+# Each entry is one independent query, so the async dashboard can run them
+# side by side. They all take `today` and return one value for the context.
+def _trimester_counts(today):
+    # weeks pregnant = 40 - (days to EDD / 7): <=12 weeks means EDD is 196+ days
+    # away, 12-27 weeks means 91-195 days away, beyond 27 weeks means < 91 days
+    t1_start = today + datetime.timedelta(days=196)
+    t3_start = today + datetime.timedelta(days=91)
+    return PregnantWoman.objects.filter(expected_due_date__isnull=False).aggregate(
+        t1=Count('pk', filter=Q(expected_due_date__gte=t1_start)),
+        t2=Count('pk', filter=Q(expected_due_date__gte=t3_start, expected_due_date__lt=t1_start)),
+        t3=Count('pk', filter=Q(expected_due_date__lt=t3_start)),
+    )
+
+DASHBOARD_QUERIES = {
+    'total_patients': lambda today: PregnantWoman.objects.count(),
+    'high_risk_patients': lambda today: PregnantWoman.objects.filter(risk_level='High').count(),
+    'upcoming_appointments': lambda today: Appointment.objects.filter(status='Scheduled', date__gte=today).count(),
+    'total_deliveries': lambda today: Delivery.objects.count(),
+    'total_discharges': lambda today: Discharge.objects.count(),
+    # Total Revenue from Success Transactions
+    'revenue_this_month': lambda today: Transaction.objects.filter(
+        status='Success',
         created_at__month=today.month
-    ).aggregate(Sum('amount'))['amount__sum'] or 0
-
-    # --- 2. Missed Appointments ---
-    missed_appointments = Appointment.objects.filter(status='Scheduled', date__lt=today).count()
-
-    # --- 3. Urgent Patient Logic ---
-    urgent_patient = PregnantWoman.objects.filter(
+    ).aggregate(Sum('amount'))['amount__sum'] or 0,
+    'missed_appointments': lambda today: Appointment.objects.filter(status='Scheduled', date__lt=today).count(),
+    # Urgent patient: high risk with the nearest due date
+    'urgent_patient': lambda today: PregnantWoman.objects.filter(
         risk_level='High',
         expected_due_date__isnull=False
-    ).order_by('expected_due_date').first()
-
-    # --- 4. Trimester Calculations ---
-    t1_count = 0
-    t2_count = 0
-    t3_count = 0
-    
-    all_patients = PregnantWoman.objects.filter(expected_due_date__isnull=False)
-
-    for patient in all_patients:
-        if patient.expected_due_date:
-            days_remaining = (patient.expected_due_date - today).days
-            weeks_pregnant = 40 - (days_remaining / 7)
-
-            if weeks_pregnant <= 12:
-                t1_count += 1
-            elif 12 < weeks_pregnant <= 27:
-                t2_count += 1
-            elif weeks_pregnant > 27:
-                t3_count += 1
+    ).order_by('expected_due_date').first(),
+    'trimesters': _trimester_counts,
+}
 
+def _dashboard_context(results):
+    trimesters = results.pop('trimesters')
+    t1_count, t2_count, t3_count = trimesters['t1'], trimesters['t2'], trimesters['t3']
     total_calculated = t1_count + t2_count + t3_count
-    
+
     if total_calculated > 0:
         t1_percent = round((t1_count / total_calculated) * 100)
         t2_percent = round((t2_count / total_calculated) * 100)
@@ -67,15 +95,8 @@ def dashboard(request):
         t2_percent = 0
         t3_percent = 0
 
-    context = {
-        'total_patients': total_patients,
-        'high_risk_patients': high_risk_patients,
-        'upcoming_appointments': upcoming_appointments,
-        'total_deliveries': total_deliveries,
-        'total_discharges': total_discharges,
-        'revenue_this_month': revenue_this_month,
-        'urgent_patient': urgent_patient,
-        'missed_appointments': missed_appointments,
+    return {
+        **results,
         'first_trimester': t1_count,
         'second_trimester': t2_count,
         'third_trimester': t3_count,
@@ -83,22 +104,93 @@ def dashboard(request):
         'second_trimester_percent': t2_percent,
         'third_trimester_percent': t3_percent,
     }
+
+def dashboard_stats(today):
+    """Runs the dashboard queries one after another."""
+    return _dashboard_context({name: query(today) for name, query in DASHBOARD_QUERIES.items()})
+
+async def dashboard_stats_async(today, concurrency=None):
+    """
+    Runs the dashboard queries at the same time, each on its own worker thread
+    (and so its own DB connection), at most DASHBOARD_QUERY_CONCURRENCY at once.
+    """
+    limit = asyncio.Semaphore(concurrency or settings.DASHBOARD_QUERY_CONCURRENCY)
+
+    def run_query(query):
+        try:
+            return query(today)
+        finally:
+            # Worker threads live outside the request cycle: don't leak connections
+            close_old_connections()
+
+    async def bounded(query):
+        async with limit:
+            return await sync_to_async(run_query, thread_sensitive=False)(query)
+
+    values = await asyncio.gather(*(bounded(query) for query in DASHBOARD_QUERIES.values()))
+    return _dashboard_context(dict(zip(DASHBOARD_QUERIES, values)))
+
+def dashboard(request):
+    today = timezone.now().date()
+    context = dashboard_stats(today)
     return render(request, 'patients/dashboard.html', context)
 
+async def dashboard_async(request):
+    # Same page as dashboard(), for ASGI: the independent queries run concurrently
+    today = timezone.now().date()
+    context = await dashboard_stats_async(today)
+    # Rendering touches the session and request.user, which are sync-only
+    return await sync_to_async(render)(request, 'patients/dashboard.html', context)
+
 # ==========================================
 # Patient Views
 # ==========================================
+# ?sort= and ?show= on the patient list, on the indexed care summary columns
+# (counters.py); mothers without a visit or delivery sort last
+PATIENT_SORTS = {
+    'next_visit': [F('next_appointment_date').asc(nulls_last=True)],
+    'visits': ['-visits_attended'],
+    'paid': ['-total_paid'],
+    'delivered': [F('last_delivery_date').desc(nulls_last=True)],
+}
+
+PATIENT_FILTERS = {
+    'overdue': lambda today: Q(next_appointment_date__lt=today),
+    'upcoming': lambda today: Q(next_appointment_date__range=(today, today + datetime.timedelta(days=7))),
+    'unpaid': lambda today: Q(total_paid=0),
+    'delivered': lambda today: Q(last_delivery_date__isnull=False),
+}
+
 def patient_list(request):
     search_query = request.GET.get('q')
-    patients = PregnantWoman.objects.all().order_by('-created_at')
+    sort = request.GET.get('sort')
+    show = request.GET.get('show')
+    patients = PregnantWoman.objects.all().order_by(*PATIENT_SORTS.get(sort, []), '-created_at')
+    if show in PATIENT_FILTERS:
+        patients = patients.filter(PATIENT_FILTERS[show](timezone.now().date()))
+    
+    archived_patients = []
     
     if search_query:
         patients = patients.filter(
             Q(full_name__icontains=search_query) | 
             Q(phone__icontains=search_query)
         )
+        # Closed episodes live in the archive, restored on request
+        archived_patients = ArchivedPatient.objects.filter(
+            Q(full_name__icontains=search_query) |
+            Q(phone__icontains=search_query)
+        ).only('patient_id', 'full_name', 'phone', 'last_discharge_date')[:20]
         
-    return render(request, 'patients/patient_list.html', {'patients': patients})
+    context = {
+        'patients': patients, 'archived_patients': archived_patients,
+        'sort': sort if sort in PATIENT_SORTS else '', 'show': show if show in PATIENT_FILTERS else '',
+    }
+    if streaming.wants_stream(request):
+        return streaming.stream_list(
+            request, 'patients/patient_list.html', 'patients/rows/patient_rows.html', 'patients', patients, context,
+        )
+    return render(request, 'patients/patient_list.html', context)
 
 def add_patient(request):
     if request.method == 'POST':
@@ -114,7 +206,7 @@ def add_patient(request):
     return render(request, 'patients/add_patient.html', {'form': form})
 
 def edit_patient(request, id):
-    patient = get_object_or_404(PregnantWoman, id=id)
+    patient = get_object_or_404(PregnantWoman.objects.defer(*PregnantWoman.SUMMARY_FIELDS), id=id)
     if request.method == 'POST':
         form = PregnantWomanForm(request.POST, instance=patient)
         if form.is_valid():
@@ -127,6 +219,31 @@ def edit_patient(request, id):
         form = PregnantWomanForm(instance=patient)
     return render(request, 'patients/edit_patient.html', {'form': form, 'patient': patient})
 
+def archived_patient(request, id):
+    """An archived mother's file, read from the archive: looking her up needs no restore."""
+    found = archive.archived_history(id)
+    if found is None:
+        raise Http404("No archived patient matches the given query.")
+    entry, patient, related = found
+    return render(request, 'patients/archived_patient.html', {
+        'entry': entry,
+        'patient': patient,
+        'events': timeline.archived_events(related),
+    })
+
+@require_POST
+def restore_patient(request, id):
+    """Brings an archived (closed) mother back into the hot tables, then opens her."""
+    try:
+        patient = archive.restore_patient(id)
+    except archive.RestoreConflict as e:
+        messages.error(request, str(e))
+        return redirect('patients:patient_list')
+    if patient is None:
+        raise Http404("No archived patient matches the given query.")
+    messages.success(request, f"{patient.full_name} was restored from the archive.")
+    return redirect('patients:edit_patient', id=patient.pk)
+
 def delete_patient(request, id):
     patient = get_object_or_404(PregnantWoman, id=id)
     if request.method == 'POST':
@@ -135,12 +252,55 @@ def delete_patient(request, id):
         return redirect('patients:patient_list')
     return render(request, 'patients/delete_patient.html', {'patient': patient})
 
+def patient_timeline(request, id):
+    """Everything recorded for one mother, oldest first, in a fixed 5 queries."""
+    patient = timeline.patient_with_history(id)
+    if patient is None:
+        raise Http404("No patient matches the given query.")
+    return render(request, 'patients/patient_timeline.html', {
+        'patient': patient,
+        'events': list(timeline.events(patient)),
+    })
+
+
+# ------------------------------------------------------
+# Duplicate registrations (found by `manage.py find_duplicates`)
+# ------------------------------------------------------
+def patient_duplicates(request):
+    """Review queue of likely duplicate mothers, most certain first."""
+    page = Paginator(dedupe.review_queue(), 25).get_page(request.GET.get('page'))
+    return render(request, 'patients/patient_duplicates.html', {'page': page})
+
+
+def review_patient_duplicate(request, id):
+    """POST action=merge&keep=<patient id> or action=dismiss."""
+    candidate = get_object_or_404(DuplicateCandidate, id=id, status='pending')
+    if request.method != 'POST':
+        return redirect('patients:patient_duplicates')
+
+    if request.POST.get('action') == 'dismiss':
+        dedupe.dismiss(candidate, request.user.get_username())
+        messages.success(request, "Marked as not a duplicate.")
+        return redirect('patients:patient_duplicates')
+
+    pair = {candidate.patient_a_id: candidate.patient_b_id, candidate.patient_b_id: candidate.patient_a_id}
+    keep = request.POST.get('keep')
+    if not keep or not keep.isdigit() or int(keep) not in pair:
+        messages.error(request, "Choose which registration to keep.")
+        return redirect('patients:patient_duplicates')
+
+    keep = int(keep)
+    moved = dedupe.merge_patients(keep, pair[keep])
+    total = sum(moved.values())
+    messages.success(request, f"Registrations merged; {total} record(s) moved to patient #{keep}.")
+    return redirect('patients:patient_duplicates')
+
 
 # ==========================================
 # Appointment Views
 # ==========================================
 def appointment_list(request):
-    appointments = Appointment.objects.all().order_by('date', 'time')
+    appointments = Appointment.objects.select_related('patient').order_by('date', 'time')
     
     search_query = request.GET.get('q')
     if search_query:
@@ -151,6 +311,10 @@ def appointment_list(request):
             Q(status__icontains=search_query)
         )
 
+    if streaming.wants_stream(request):
+        return streaming.stream_list(
+            request, 'patients/appointments.html', 'patients/rows/appointment_rows.html', 'appointments', appointments,
+        )
     return render(request, 'patients/appointments.html', {'appointments': appointments})
 
 def add_appointment(request):
@@ -239,8 +403,7 @@ def add_delivery(request):
         e_phone = request.POST.get('emergency_phone', '')
 
         if e_name: 
-            combined_contact = f"{e_name} ({e_rel}) - {e_phone}"
-            data['emergency_contact'] = combined_contact
+            data['emergency_contact'] = Delivery.format_emergency_contact(e_name, e_rel, e_phone)
 
         form = DeliveryForm(data)
 
@@ -255,8 +418,25 @@ def add_delivery(request):
         form = DeliveryForm()
     return render(request, 'patients/add_delivery.html', {'form': form})
 
+def add_delivery_batch(request):
+    if request.method == "POST":
+        formset = DeliveryFormSet(request.POST)
+
+        if formset.is_valid():
+            deliveries = formset.new_deliveries()
+            if deliveries:
+                Delivery.objects.bulk_register(deliveries)
+                messages.success(request, f"{len(deliveries)} deliveries recorded successfully!")
+                return redirect('patients:delivery_list')
+            messages.error(request, "No deliveries entered. Fill in at least one row.")
+        else:
+            messages.error(request, "Failed to record deliveries. Please check the highlighted rows.")
+    else:
+        formset = DeliveryFormSet()
+    return render(request, 'patients/add_delivery_batch.html', {'formset': formset})
+
 def delivery_list(request):
-    deliveries = Delivery.objects.all().order_by('-delivery_date')
+    deliveries = Delivery.objects.select_related('patient').order_by('-delivery_date')
     
     search_query = request.GET.get('q')
     if search_query:
@@ -267,6 +447,10 @@ def delivery_list(request):
             Q(notes__icontains=search_query)
         )
 
+    if streaming.wants_stream(request):
+        return streaming.stream_list(
+            request, 'patients/delivery_list.html', 'patients/rows/delivery_rows.html', 'deliveries', deliveries,
+        )
     return render(request, 'patients/delivery_list.html', {'deliveries': deliveries})
 
 def edit_delivery(request, id):
@@ -329,7 +513,7 @@ def add_discharge(request):
     return render(request, 'patients/add_discharge.html', {'form': form})
 
 def discharge_list(request):
-    discharges = Discharge.objects.all().order_by('-discharge_date')
+    discharges = Discharge.objects.select_related('patient').order_by('-discharge_date')
 
     search_query = request.GET.get('q')
     if search_query:
@@ -339,6 +523,10 @@ def discharge_list(request):
             Q(patient__phone__icontains=search_query)
         )
 
+    if streaming.wants_stream(request):
+        return streaming.stream_list(
+            request, 'patients/discharge_list.html', 'patients/rows/discharge_rows.html', 'discharges', discharges,
+        )
     return render(request, 'patients/discharge_list.html', {'discharges': discharges})
 
 def edit_discharge(request, id):
@@ -362,6 +550,58 @@ def delete_discharge(request, id):
     return render(request, 'patients/delete_discharge.html', {'discharge': discharge})
 
 
+# ------------------------------------------------------
+# Discharge summary PDFs (rendered in the background)
+# ------------------------------------------------------
+def discharge_summary(request, id):
+    """Downloads the summary if it is rendered, otherwise queues it and shows a waiting page."""
+    discharge = get_object_or_404(Discharge, id=id)
+    document = documents.request_summary(discharge)
+    if document.status == 'ready':
+        return redirect('patients:summary_download', id=document.pk)
+    return render(request, 'patients/discharge_summary.html', {'discharge': discharge, 'document': document})
+
+
+def summary_status(request, id):
+    document = get_object_or_404(DischargeDocument, id=id)
+    data = {'status': document.status}
+    if document.status == 'ready':
+        data['download_url'] = reverse('patients:summary_download', args=[document.pk])
+    elif document.status == 'failed':
+        data['error'] = document.error
+    return JsonResponse(data)
+
+
+def summary_download(request, id):
+    document = get_object_or_404(DischargeDocument, id=id, status='ready')
+    response = FileResponse(
+        document.file.open('rb'),
+        as_attachment=True,
+        filename=f"discharge-summary-{document.discharge_id}.pdf",
+        content_type='application/pdf',
+    )
+    # A document's content never changes (edits create a new one)
+    response['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+
+def summary_batch(request):
+    """All discharge summaries of one day: POST queues them, GET shows their progress."""
+    day = parse_date(request.GET.get('date') or request.POST.get('date') or '') or timezone.now().date()
+    if request.method == 'POST':
+        queued = documents.request_day(day)
+        messages.success(request, f"{len(queued)} discharge summaries requested for {day:%b %d, %Y}.")
+        return redirect(f"{reverse('patients:summary_batch')}?date={day.isoformat()}")
+
+    discharges = list(Discharge.objects.filter(discharge_date=day).select_related('patient').order_by('pk'))
+    latest = {}
+    for document in DischargeDocument.objects.filter(discharge__in=discharges).order_by('created_at'):
+        latest[document.discharge_id] = document
+    rows = [(discharge, latest.get(discharge.pk)) for discharge in discharges]
+    pending = any(doc and doc.status in ('queued', 'rendering') for _, doc in rows)
+    return render(request, 'patients/summary_batch.html', {'day': day, 'rows': rows, 'pending': pending})
+
+
 # ==========================================
 # Billing & Payment Views
 # ==========================================
@@ -397,22 +637,174 @@ def initiate_stk_push(request):
              # Handle custom amount input if you have a field for it in HTML, otherwise default
             amount = 500 
 
+        patient = get_object_or_404(PregnantWoman, id=patient_id)
         try:
-            patient = get_object_or_404(PregnantWoman, id=patient_id)
-            
-            # --- SIMULATION OF M-PESA LOGIC ---
-            Transaction.objects.create(
-                patient=patient,
-                amount=amount,
-                status='Success', # In production, this would be 'Pending' then updated via Callback
-                transaction_id=f"WS{datetime.datetime.now().strftime('%f')}" 
-            )
-            
-            messages.success(request, f"STK Push of KES {amount} sent to {patient.full_name} ({patient.phone}) successfully. Payment Recorded.")
-        
-        except Exception as e:
+            # Recorded as 'Pending'; the M-Pesa callback marks it paid or failed
+            payments.start_stk_push(patient, amount)
+            messages.success(request, f"STK Push of KES {amount} sent to {patient.full_name} ({patient.phone}). The payment shows as paid once she confirms it on her phone.")
+        except payments.StkPushError as e:
             messages.error(request, f"Error initiating payment: {str(e)}")
             
         return redirect('patients:billing_page')
     
-    return redirect('patients:billing_page')
\ No newline at end of file
+    return redirect('patients:billing_page')
+
+
+@csrf_exempt
+@require_POST
+def mpesa_callback(request):
+    """
+    Daraja posts STK push results here (?token=PAYMENT_CALLBACK_TOKEN). The
+    result is only stored; a background job applies it (see payments.py),
+    so the answer goes back at once and a redelivery is harmless.
+    """
+    token = getattr(settings, 'PAYMENT_CALLBACK_TOKEN', '')
+    if not token or request.GET.get('token') != token:
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': "Invalid token"}, status=403)
+    try:
+        payments.ingest([json.loads(request.body)])
+    except ValueError as e:
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': str(e)}, status=400)
+    return JsonResponse({'ResultCode': 0, 'ResultDesc': "Accepted"})
+
+
+@login_required
+def reconciliations(request):
+    """Upload an M-Pesa statement; it is reconciled in the background (see reconcile.py)."""
+    form = StatementUploadForm(request.POST or None, request.FILES or None)
+    if request.method == 'POST' and form.is_valid():
+        reconciliation = form.save(commit=False)
+        reconciliation.uploaded_by = request.user.get_username()
+        reconciliation.save()
+        jobs.enqueue('reconcile_statement', reconciliation_id=reconciliation.pk)
+        return redirect('patients:reconciliation', id=reconciliation.pk)
+
+    return render(request, 'patients/reconciliations.html', {
+        'form': form,
+        'recent': Reconciliation.objects.order_by('-created_at')[:20],
+    })
+
+
+@login_required
+def reconciliation_detail(request, id):
+    reconciliation = get_object_or_404(Reconciliation, id=id)
+    if request.GET.get('download') == 'report' and reconciliation.report:
+        return FileResponse(reconciliation.report.open('rb'), as_attachment=True,
+                            filename=f"reconciliation-{reconciliation.pk}-exceptions.csv")
+    return render(request, 'patients/reconciliation.html', {'reconciliation': reconciliation})
+
+
+# ==========================================
+# Audit Log
+# ==========================================
+def audit_log(request):
+    """
+    Who changed what. Filter by ?patient=<id> and/or ?user=<username>;
+    both use the (patient_id / user_id, created_at) indexes.
+    """
+    entries = AuditEntry.objects.all().order_by('-created_at')
+
+    patient_id = request.GET.get('patient')
+    if patient_id and patient_id.isdigit():
+        entries = entries.filter(patient_id=patient_id)
+
+    username = request.GET.get('user')
+    if username:
+        user_ids = User.objects.filter(username=username).values_list('id', flat=True)
+        entries = entries.filter(user_id__in=list(user_ids))
+
+    page = Paginator(entries, 50).get_page(request.GET.get('page'))
+    return render(request, 'patients/audit_log.html', {'page': page})
+
+
+# ==========================================
+# Regional Analytics
+# ==========================================
+def analytics_page(request):
+    """
+    County / ward / month totals read from the pre-aggregated rollups
+    (refreshed by `manage.py refresh_rollups`), never from the raw tables.
+    """
+    group_by = request.GET.get('group')
+    if group_by not in analytics.GROUPINGS:
+        group_by = 'county'
+    rows = analytics.slice_cube(
+        group_by,
+        county=request.GET.get('county') or None,
+        ward=request.GET.get('ward') or None,
+        month_from=analytics.parse_month(request.GET.get('from')),
+        month_to=analytics.parse_month(request.GET.get('to')),
+    )
+    _, refreshed_at = analytics.cube_state()
+    totals = {metric: sum(row[metric] or 0 for row in rows) for metric in analytics.METRICS}
+    return render(request, 'patients/analytics.html', {
+        'rows': rows,
+        'totals': totals,
+        'group_by': group_by,
+        'refreshed_at': refreshed_at,
+    })
+
+
+# ==========================================
+# Outcome Reports
+# ==========================================
+def report_list(request):
+    """Pick a report and its breakdown; finished runs are reused while the data is unchanged."""
+    if request.GET.get('report') in reports.REPORTS:
+        params = reports.clean_params(request.GET)
+        run = reports.get_or_submit(request.GET['report'], params)
+        return redirect('patients:report_run', id=run.pk)
+
+    return render(request, 'patients/reports.html', {
+        'reports': reports.REPORTS,
+        'dimensions': reports.DIMENSIONS,
+        'recent_runs': ReportRun.objects.defer('result').order_by('-created_at')[:20],
+    })
+
+
+def report_run(request, id):
+    run = get_object_or_404(ReportRun, id=id)
+    if run.status in ('queued', 'running'):
+        # Short reports finish while we wait; long ones show a polling page
+        reports.wait(run.pk, getattr(settings, 'REPORT_INLINE_WAIT', 2))
+        run.refresh_from_db()
+    return render(request, 'patients/report_run.html', {
+        'run': run,
+        'report': reports.REPORTS.get(run.report),
+        'exports': reports.EXPORTS,
+    })
+
+
+def report_export(request, id, fmt):
+    run = get_object_or_404(ReportRun, id=id, status='done')
+    if fmt not in reports.EXPORTS:
+        raise Http404("Unknown export format")
+    convert, content_type, extension = reports.EXPORTS[fmt]
+    response = HttpResponse(convert(run.result), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{run.report}-{run.pk}.{extension}"'
+    return response
+
+
+
+# ==========================================
+# SMS Delivery Reports
+# ==========================================
+@csrf_exempt
+@require_POST
+def sms_delivery_report(request):
+    """
+    Called by the SMS gateway with delivery reports, as a JSON list or
+    {"reports": [...]} of {"id": gateway id, "status": "delivered" | "failed"}.
+    The gateway authenticates with ?token=SMS_DELIVERY_REPORT_TOKEN.
+    """
+    token = getattr(settings, 'SMS_DELIVERY_REPORT_TOKEN', '')
+    if not token or request.GET.get('token') != token:
+        return JsonResponse({'error': "Invalid token"}, status=403)
+    try:
+        payload = json.loads(request.body or b'[]')
+        delivered = payload['reports'] if isinstance(payload, dict) else payload
+        if not isinstance(delivered, list) or not all(isinstance(r, dict) for r in delivered):
+            raise TypeError
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': "Body must be JSON: [{\"id\", \"status\"}, ...]"}, status=400)
+    return JsonResponse({'updated': sms.apply_delivery_reports(delivered)})